@@ -4,7 +4,10 @@ langGraph Agent 核心模块
 """
 
 import os
-from typing import Dict, Any, List, Optional, Annotated
+import asyncio
+import contextvars
+import threading
+from typing import Dict, Any, List, Optional, Annotated, AsyncIterator
 from langchain.schema import BaseMessage, HumanMessage, AIMessage, SystemMessage
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolExecutor, ToolInvocation
@@ -12,7 +15,40 @@ from langgraph.graph.message import add_messages
 from pydantic import BaseModel
 import json
 from excel_tools import get_excel_tools, TOOL_DESCRIPTIONS
-from llm_config import get_llm_config, call_llm
+from llm_config import get_llm_config, call_llm, stream_llm
+from prompts import get_prompt, get_prompt_registry
+
+
+def _render_tool_descriptions() -> str:
+    """按工具名排序渲染工具描述，保证系统提示词逐字节稳定"""
+    return "\n".join(f"- {name}: {TOOL_DESCRIPTIONS[name]}" for name in sorted(TOOL_DESCRIPTIONS))
+
+
+# Agent 系统提示词，导入时渲染一次
+get_prompt_registry().register("agent", "v1", """你是一个专业的Excel AI助手。你可以帮助用户：
+
+1. 理解和解释Excel公式
+2. 生成Excel公式
+3. 读取和分析Excel数据
+4. 创建图表和可视化
+5. 提供Excel操作指导
+
+可用的Excel工具：
+""" + _render_tool_descriptions() + """
+
+请根据用户需求，提供准确的帮助和指导。如果需要执行Excel操作，我会调用相应的工具来完成。
+""")
+
+
+# 当前对话的事件队列；仅在 stream_chat 中设置，普通 chat 调用时为 None
+_event_queue: contextvars.ContextVar[Optional[asyncio.Queue]] = contextvars.ContextVar("agent_event_queue", default=None)
+
+
+def _emit_event(event_type: str, **data: Any) -> None:
+    """向当前流式对话推送一个事件（未处于流式对话中时忽略）"""
+    queue = _event_queue.get()
+    if queue is not None:
+        queue.put_nowait({"type": event_type, **data})
 
 
 class AgentState(BaseModel):
@@ -74,7 +110,8 @@ class ExcelAgent:
         """调用语言模型"""
         try:
             # 构建系统消息
-            system_message = self._get_system_prompt()
+            prompt = get_prompt("agent")
+            system_message = prompt.text
             
             # 准备消息列表
             messages = [
@@ -92,8 +129,15 @@ class ExcelAgent:
             if state.user_input and not any(m["role"] == "user" for m in messages[-3:]):
                 messages.append({"role": "user", "content": state.user_input})
             
-            # 调用LLM
-            response = await call_llm(messages, temperature=0.1, max_tokens=1500)
+            # 调用LLM；流式对话时逐段推送 token 增量
+            if _event_queue.get() is not None:
+                chunks = []
+                async for delta in stream_llm(messages, temperature=0.1, max_tokens=1500, on_usage=prompt.record_usage, endpoint="agent"):
+                    chunks.append(delta)
+                    _emit_event("token", delta=delta)
+                response = "".join(chunks)
+            else:
+                response = await call_llm(messages, temperature=0.1, max_tokens=1500, on_usage=prompt.record_usage, endpoint="agent")
             
             # 创建AI消息
             ai_message = AIMessage(content=response)
@@ -117,7 +161,7 @@ class ExcelAgent:
             error_state.current_step = "end"
             return error_state
     
-    def _execute_tools(self, state: AgentState) -> AgentState:
+    async def _execute_tools(self, state: AgentState) -> AgentState:
         """执行工具调用"""
         try:
             # 从最后的AI消息中提取工具调用
@@ -131,15 +175,15 @@ class ExcelAgent:
             
             # 检测需要的Excel操作
             if "读取" in content or "查看" in content:
-                tool_result = self._execute_read_range_tool()
+                tool_result = self._run_tool("read_range", self._execute_read_range_tool)
                 tools_used.append(tool_result)
             
             if "公式" in content or "计算" in content:
-                tool_result = self._execute_formula_tool(state.user_input)
+                tool_result = self._run_tool("generate_formula", self._execute_formula_tool, state.user_input)
                 tools_used.append(tool_result)
             
             if "图表" in content or "chart" in content:
-                tool_result = self._execute_chart_tool()
+                tool_result = self._run_tool("create_chart", self._execute_chart_tool)
                 tools_used.append(tool_result)
             
             # 更新状态
@@ -155,6 +199,14 @@ class ExcelAgent:
             error_state.current_step = "end"
             return error_state
     
+    def _run_tool(self, tool_name: str, tool_func, *args) -> Dict[str, Any]:
+        """执行单个工具，并在流式对话中推送工具开始/结束以及生成的 Excel 操作"""
+        _emit_event("tool_start", tool=tool_name)
+        operation = tool_func(*args)
+        _emit_event("excel_operation", operation=operation)
+        _emit_event("tool_end", tool=tool_name)
+        return operation
+    
     def _should_continue(self, state: AgentState) -> str:
         """判断是否继续工作流"""
         if state.error_message:
@@ -176,20 +228,8 @@ class ExcelAgent:
         return any(keyword in response_lower for keyword in tool_keywords)
     
     def _get_system_prompt(self) -> str:
-        """获取系统提示词"""
-        return """你是一个专业的Excel AI助手。你可以帮助用户：
-
-1. 理解和解释Excel公式
-2. 生成Excel公式
-3. 读取和分析Excel数据
-4. 创建图表和可视化
-5. 提供Excel操作指导
-
-可用的Excel工具：
-""" + TOOL_DESCRIPTIONS + """
-
-请根据用户需求，提供准确的帮助和指导。如果需要执行Excel操作，我会调用相应的工具来完成。
-"""
+        """获取系统提示词（注册表中预先渲染的规范前缀）"""
+        return get_prompt("agent").text
     
     def _execute_read_range_tool(self) -> Dict[str, Any]:
         """执行读取范围工具"""
@@ -244,12 +284,19 @@ class ExcelAgent:
             "parameters": {"chart_type": "column", "data_range": "A1:B10", "title": "数据图表"}
         }
     
-    async def chat(self, user_input: str) -> Dict[str, Any]:
-        """与Agent对话"""
+    async def chat(self, user_input: str, data_profile: Optional[str] = None) -> Dict[str, Any]:
+        """
+        与Agent对话
+        
+        Args:
+            user_input: 用户输入
+            data_profile: 工作表统计概况（sheet_profiler 渲染的提示词），附加在用户消息之后
+        """
         try:
-            # 创建初始状态
+            # 创建初始状态；概况只进入发给模型的消息，工具仍按原始输入匹配
+            content = f"{user_input}\n\n{data_profile}" if data_profile else user_input
             initial_state = AgentState(
-                messages=[HumanMessage(content=user_input)],
+                messages=[HumanMessage(content=content)],
                 user_input=user_input,
                 excel_operations=[],
                 current_step="start"
@@ -277,20 +324,72 @@ class ExcelAgent:
                 "error": str(e)
             }
 
+    async def stream_chat(self, user_input: str, data_profile: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        与Agent流式对话
+        
+        在工作流执行过程中逐个产出事件：
+        token（LLM 增量文本）、tool_start / tool_end（工具执行）、
+        excel_operation（每个 Excel 操作生成后立即推送）、final（最终汇总）
+        
+        Args:
+            user_input: 用户输入
+            data_profile: 工作表统计概况，参见 chat
+        
+        Yields:
+            事件字典，格式为 {"type": "...", ...}
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+        
+        async def run() -> Dict[str, Any]:
+            try:
+                return await self.chat(user_input, data_profile)
+            finally:
+                queue.put_nowait(done)
+        
+        # create_task 会复制当前上下文，工作流中的节点因此能拿到这个队列
+        token = _event_queue.set(queue)
+        try:
+            task = asyncio.create_task(run())
+        finally:
+            _event_queue.reset(token)
+        
+        try:
+            while True:
+                event = await queue.get()
+                if event is done:
+                    break
+                yield event
+            
+            result = await task
+            yield {"type": "final", **result}
+        finally:
+            if not task.done():
+                task.cancel()
+
 
 # 全局Agent实例
 _agent_instance = None
+_agent_lock = threading.Lock()
 
 
 def get_agent() -> ExcelAgent:
-    """获取全局Agent实例"""
+    """
+    获取全局Agent实例
+    
+    构建 Agent（编译 LangGraph、初始化工具）开销较大，使用锁保证并发的首次请求只构建一次；
+    正常情况下由启动预热（warmup.py）提前完成构建
+    """
     global _agent_instance
     if _agent_instance is None:
-        _agent_instance = ExcelAgent()
+        with _agent_lock:
+            if _agent_instance is None:
+                _agent_instance = ExcelAgent()
     return _agent_instance
 
 
-async def chat_with_agent(user_input: str) -> Dict[str, Any]:
+async def chat_with_agent(user_input: str, data_profile: Optional[str] = None) -> Dict[str, Any]:
     """便捷的Agent对话函数"""
     agent = get_agent()
-    return await agent.chat(user_input) 
\ No newline at end of file
+    return await agent.chat(user_input, data_profile) 
\ No newline at end of file
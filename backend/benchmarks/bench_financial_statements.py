@@ -0,0 +1,80 @@
+"""
+三大报表生成基准测试
+构造借贷平衡的凭证分录（默认 100 万行），分别统计科目汇总、现金流量分类与报表生成的耗时，
+并核对资产负债表平衡与现金流量表期末余额
+
+运行: python benchmarks/bench_financial_statements.py [分录行数]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from financial_statements import aggregate_trial_balance, build_financial_statements, build_statement_rows
+
+# (借方科目, 贷方科目)：销售收款、采购付款、费用、折旧、借款、投资等常见业务
+ENTRY_PAIRS = [
+    ("100201", "600101"), ("112201", "600101"), ("100201", "112201"), ("140501", "220201"),
+    ("220201", "100201"), ("640101", "140501"), ("660201", "100101"), ("660101", "100201"),
+    ("660201", "160201"), ("160101", "100201"), ("100201", "200101"), ("200101", "100201"),
+    ("660301", "100201"), ("100201", "400101"), ("680101", "222101"), ("222101", "100201"),
+    ("100101", "100201"), ("221101", "100201"), ("660201", "221101"), ("151101", "100201"),
+]
+
+
+def build_vouchers(line_count: int):
+    """每张凭证一借一贷两行"""
+    rng = np.random.default_rng(42)
+    voucher_count = line_count // 2
+    pairs = rng.integers(0, len(ENTRY_PAIRS), voucher_count)
+    amounts = np.round(rng.lognormal(7, 1.2, voucher_count), 2)
+    debit_codes = np.array([pair[0] for pair in ENTRY_PAIRS], dtype=object)[pairs]
+    credit_codes = np.array([pair[1] for pair in ENTRY_PAIRS], dtype=object)[pairs]
+
+    codes = np.empty(voucher_count * 2, dtype=object)
+    codes[0::2] = debit_codes
+    codes[1::2] = credit_codes
+    debit = np.zeros(voucher_count * 2)
+    credit = np.zeros(voucher_count * 2)
+    debit[0::2] = amounts
+    credit[1::2] = amounts
+    voucher_ids = np.repeat(np.arange(voucher_count, dtype=np.float64), 2)
+    return codes, debit, credit, voucher_ids
+
+
+def timed(func, repeat: int = 3):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return result, best * 1000
+
+
+def main():
+    line_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    codes, debit, credit, voucher_ids = build_vouchers(line_count)
+    print(f"数据规模: {len(codes)} 行分录，{len(codes) // 2} 张凭证")
+
+    balance, aggregate_ms = timed(lambda: aggregate_trial_balance(codes, debit, credit, voucher_ids=voucher_ids))
+    _, aggregate_no_cash_ms = timed(lambda: aggregate_trial_balance(codes, debit, credit))
+    _, statements_ms = timed(lambda: build_statement_rows(balance))
+    result, total_ms = timed(lambda: build_financial_statements(codes, debit, credit, voucher_ids=voucher_ids))
+
+    print(f"{'阶段':<24}{'耗时 (ms)':>12}")
+    print(f"{'科目汇总 + 现金流量分类':<17}{aggregate_ms:>12.1f}")
+    print(f"{'科目汇总（不分类现金流量）':<15}{aggregate_no_cash_ms:>12.1f}")
+    print(f"{'报表行与公式':<19}{statements_ms:>12.1f}")
+    print(f"{'完整流程（含写入载荷）':<17}{total_ms:>12.1f}")
+    print(f"吞吐: {len(codes) / total_ms * 1000:,.0f} 行/秒")
+    print(f"科目数: {result['summary']['account_count']}，"
+          f"资产负债表差额: {result['check']['balance_difference']}，"
+          f"现金差额: {result['check']['cash_difference']}")
+
+
+if __name__ == "__main__":
+    main()
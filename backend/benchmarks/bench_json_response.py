@@ -0,0 +1,97 @@
+"""
+响应序列化吞吐对比（AgentChatResponse）
+对同一份 Agent 响应（含数 KB 的 Office.js 代码与写入载荷）比较三种路径：
+- legacy：构建模型并校验，经 jsonable_encoder 转换后由标准库 json 编码（FastAPI 默认 JSONResponse 的路径）
+- pydantic：构建模型并校验，按 response_model 再校验一次后以 dump_json 编码（较新 FastAPI 的路径）
+- fast：model_construct 跳过校验，由 fast_json（orjson）编码（接口返回 FastJSONResponse 的路径）
+另附任务结果的 Fragment 拼接与解析后重新编码的对比。
+
+运行: python benchmarks/bench_json_response.py [--operations 6] [--seconds 1]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("METRICS_ENABLED", "false")
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+import fast_json
+import schemas
+from bulk_write import build_chunked_write
+
+MESSAGE = "已按科目汇总 2024 年凭证，借贷平衡。下面的操作会写入科目余额表并标记异常分录。" * 4
+
+
+def build_response_data(operations: int) -> dict:
+    """与 agent_chat 返回值结构相同的数据：每个操作带分块写入的 js_code 与载荷"""
+    excel_operations = []
+    for index in range(operations):
+        values = [[f"2024-{r % 12 + 1:02d}-01", f"摘要{r}", round(r * 1.37, 2), round(r * 0.5, 2)] for r in range(60)]
+        js_code, payload = build_chunked_write(f"Sheet{index}", "A1", values)
+        excel_operations.append({
+            "operation_type": "write_range",
+            "description": f"写入第 {index + 1} 张工作表",
+            "js_code": js_code,
+            "parameters": {"sheet_name": f"Sheet{index}", "range": "A1:D60"},
+            "payload": payload,
+        })
+    return {"success": True, "response": MESSAGE, "excel_operations": excel_operations, "conversation_id": "conv_1"}
+
+
+def throughput(func: Callable[[], object], seconds: float) -> float:
+    """返回每秒完成次数"""
+    func()
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        func()
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="响应序列化吞吐对比")
+    parser.add_argument("--operations", type=int, default=6, help="响应中的 Excel 操作数")
+    parser.add_argument("--seconds", type=float, default=1.0, help="每种路径的测量时长")
+    args = parser.parse_args()
+
+    data = build_response_data(args.operations)
+    adapter = TypeAdapter(schemas.AgentChatResponse)
+
+    def legacy():
+        model = schemas.AgentChatResponse(**data)
+        return json.dumps(jsonable_encoder(model), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def pydantic_path():
+        model = schemas.AgentChatResponse(**data)
+        return adapter.dump_json(adapter.validate_python(model.model_dump()))
+
+    def fast():
+        return fast_json.dumps(schemas.AgentChatResponse.model_construct(**data))
+
+    size = len(fast())
+    assert json.loads(fast()) == json.loads(legacy()), "序列化结果不一致"
+    print(f"AgentChatResponse: {args.operations} 个操作，{size / 1024:.1f} KB，编码器: {'orjson' if fast_json.orjson else 'json'}")
+
+    rates = {}
+    for name, func in (("legacy", legacy), ("pydantic", pydantic_path), ("fast", fast)):
+        rates[name] = throughput(func, args.seconds)
+    for name, rate in rates.items():
+        print(f"{name:<10}{rate:>10.0f} 次/秒{1e6 / rate:>10.1f} us{rate / rates['legacy']:>8.2f}x")
+
+    stored = fast_json.dumps(data).decode("utf-8")
+    reencode = throughput(lambda: fast_json.dumps({"job_id": "j", "result": json.loads(stored)}), args.seconds)
+    spliced = throughput(lambda: fast_json.dumps({"job_id": "j", "result": fast_json.fragment(stored)}), args.seconds)
+    print(f"\n任务结果（{len(stored) / 1024:.1f} KB JSON 文本）: 解析后重新编码 {reencode:.0f} 次/秒，"
+          f"Fragment 拼接 {spliced:.0f} 次/秒（{spliced / reencode:.1f}x）")
+
+
+if __name__ == "__main__":
+    main()
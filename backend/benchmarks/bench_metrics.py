@@ -0,0 +1,73 @@
+"""
+运行指标记录开销基准测试
+统计单次直方图记录、计数器加一与阶段记录的耗时，以及 MetricsMiddleware 给每个请求增加的开销
+（以一个直接返回 200 的最小 ASGI 应用为基准，每个请求记录 auth、db 两个阶段）
+
+运行: python benchmarks/bench_metrics.py [请求数]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import MetricsMiddleware, get_registry, observe_stage, registry
+
+bench_histogram = registry.histogram("bench_seconds", "基准测试", ("endpoint", "stage"))
+bench_counter = registry.counter("bench_total", "基准测试", ("endpoint", "status"))
+
+
+async def minimal_app(scope, receive, send):
+    observe_stage("auth", 0.0002)
+    observe_stage("db", 0.0011)
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": b"{}"})
+
+
+async def receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def send(message):
+    pass
+
+
+def per_call_ns(func, count: int) -> float:
+    started = time.perf_counter()
+    for _ in range(count):
+        func()
+    return (time.perf_counter() - started) / count * 1e9
+
+
+async def per_request_us(app, count: int) -> float:
+    scope = {"type": "http", "method": "POST", "path": "/api/generate-formula"}
+    started = time.perf_counter()
+    for _ in range(count):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+    print(f"{'操作':<28}{'每次耗时 (ns)':>14}")
+    print(f"{'Histogram.observe':<28}{per_call_ns(lambda: bench_histogram.observe(0.0123, '/api/generate-formula', 'llm_total'), count):>14.0f}")
+    print(f"{'Counter.inc':<28}{per_call_ns(lambda: bench_counter.inc('/api/generate-formula', '200'), count):>14.0f}")
+    print(f"{'observe_stage（请求外）':<24}{per_call_ns(lambda: observe_stage('db', 0.001), count):>14.0f}")
+
+    baseline = asyncio.run(per_request_us(minimal_app, count))
+    instrumented = asyncio.run(per_request_us(MetricsMiddleware(minimal_app), count))
+    print(f"\n{'ASGI 请求':<28}{'每次耗时 (us)':>14}")
+    print(f"{'无中间件':<24}{baseline:>14.2f}")
+    print(f"{'MetricsMiddleware':<28}{instrumented:>14.2f}")
+    print(f"{'中间件开销':<23}{instrumented - baseline:>14.2f}")
+
+    started = time.perf_counter()
+    text = get_registry().render()
+    print(f"\n导出 /metrics: {len(text.splitlines())} 行，{(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+范围数据传输格式基准测试
+对比 100k 行 × 20 列的工作表在 JSON 与 MessagePack 列编码下的载荷大小和解析耗时
+
+运行: python benchmarks/bench_range_codec.py [行数]
+"""
+
+import json
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from range_codec import encode_rows, encode_columns, decode_columns, columns_to_rows
+from workbook_cache import columnize
+
+
+def build_sheet(row_count: int) -> list:
+    """构造贴近财务明细的数据：日期、凭证号、科目、摘要、金额、数量等 20 列"""
+    rng = np.random.default_rng(42)
+    accounts = ["1001 库存现金", "1002 银行存款", "1122 应收账款", "2202 应付账款", "6001 主营业务收入", "6602 管理费用"]
+    departments = ["财务部", "销售部", "采购部", "行政部", "研发部"]
+    amounts = np.round(rng.lognormal(8, 1.5, size=(row_count, 8)), 2).tolist()
+    quantities = rng.integers(0, 1000, size=(row_count, 4)).tolist()
+    rows = []
+    for i in range(row_count):
+        rows.append(
+            [f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d}", f"记-{i // 4:06d}", accounts[i % len(accounts)],
+             departments[i % len(departments)], f"摘要{i % 300}", i % 2 == 0]
+            + amounts[i] + quantities[i] + [None if i % 10 == 0 else f"备注{i % 17}", i]
+        )
+    return rows
+
+
+def timed(func, repeat: int = 3):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return result, best * 1000
+
+
+def main():
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rows = build_sheet(row_count)
+    print(f"数据规模: {row_count} 行 × {len(rows[0])} 列")
+
+    json_bytes, json_encode_ms = timed(lambda: json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    _, json_parse_ms = timed(lambda: json.loads(json_bytes))
+    json_gzip = zlib.compress(json_bytes, 6)
+
+    packed, pack_ms = timed(lambda: encode_rows(rows))
+    columns = columnize(rows, len(rows[0]))
+    _, pack_columns_ms = timed(lambda: encode_columns(columns, row_count))
+    _, unpack_ms = timed(lambda: decode_columns(packed))
+    _, unpack_rows_ms = timed(lambda: columns_to_rows(decode_columns(packed)))
+    packed_z, pack_z_ms = timed(lambda: encode_rows(rows, compress=True))
+    _, unpack_z_ms = timed(lambda: decode_columns(packed_z))
+
+    print(f"{'格式':<28}{'大小 (KB)':>12}{'编码 (ms)':>12}{'解析 (ms)':>12}")
+    print(f"{'JSON':<28}{len(json_bytes) / 1024:>12.0f}{json_encode_ms:>12.1f}{json_parse_ms:>12.1f}")
+    print(f"{'JSON + gzip(6)':<28}{len(json_gzip) / 1024:>12.0f}{'-':>12}{'-':>12}")
+    print(f"{'MessagePack 列编码':<24}{len(packed) / 1024:>12.0f}{pack_ms:>12.1f}{unpack_ms:>12.1f}")
+    print(f"{'MessagePack 列编码 + zlib':<22}{len(packed_z) / 1024:>12.0f}{pack_z_ms:>12.1f}{unpack_z_ms:>12.1f}")
+    print(f"{'MessagePack 解析并还原为行':<22}{'':>12}{'':>12}{unpack_rows_ms:>12.1f}")
+    print(f"{'MessagePack 由列存储编码':<23}{'':>12}{pack_columns_ms:>12.1f}{'':>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+凭证批量导入基准测试
+构造 CSV / NDJSON 格式的凭证分录（默认 100 万行，约 1% 的行带有错误），
+以 64KB 分块模拟请求体流，统计解析 + 校验 + 生成写入载荷的吞吐
+
+运行: python benchmarks/bench_voucher_import.py [分录行数]
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from voucher_import import VoucherValidator, import_vouchers, iter_csv_records, iter_ndjson_records
+
+# (借方科目, 贷方科目, 摘要)
+ENTRY_PAIRS = [
+    ("100201", "600101", "销售收款"), ("112201", "600101", "赊销"), ("140501", "220201", "采购入库"),
+    ("220201", "100201", "支付货款"), ("660201", "100101", "报销费用"), ("660101", "100201", "广告费"),
+    ("160101", "100201", "购置设备"), ("100201", "200101", "取得借款"), ("221101", "100201", "发放工资"),
+]
+CHUNK_SIZE = 64 * 1024
+
+
+def build_records(line_count: int, error_rate: float = 0.01):
+    rng = random.Random(42)
+    records = []
+    for voucher in range(line_count // 2):
+        debit_code, credit_code, summary = ENTRY_PAIRS[voucher % len(ENTRY_PAIRS)]
+        amount = round(rng.lognormvariate(7, 1.2), 2)
+        date = f"2024-{voucher % 12 + 1:02d}-{voucher % 28 + 1:02d}"
+        credit_amount = amount
+        if rng.random() < error_rate:
+            credit_amount = round(amount + 1, 2)
+        records.append((f"记-{voucher + 1}", date, debit_code, summary, amount, ""))
+        records.append((f"记-{voucher + 1}", date, credit_code, summary, "", credit_amount))
+    return records
+
+
+def to_csv(records) -> bytes:
+    lines = ["凭证号,日期,科目编码,摘要,借方,贷方"]
+    lines.extend(",".join(str(value) for value in record) for record in records)
+    return "\n".join(lines).encode("utf-8")
+
+
+def to_ndjson(records) -> bytes:
+    keys = ("voucher_id", "date", "account_code", "summary", "debit", "credit")
+    return "\n".join(json.dumps(dict(zip(keys, record)), ensure_ascii=False) for record in records).encode("utf-8")
+
+
+async def stream(body: bytes):
+    for offset in range(0, len(body), CHUNK_SIZE):
+        yield body[offset:offset + CHUNK_SIZE]
+
+
+def run(body: bytes, parser):
+    validator = VoucherValidator()
+    started = time.perf_counter()
+    result = asyncio.run(import_vouchers(parser(stream(body)), validator))
+    return result, time.perf_counter() - started
+
+
+def main():
+    line_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    records = build_records(line_count)
+    print(f"数据规模: {len(records)} 行分录，{len(records) // 2} 张凭证")
+
+    print(f"{'格式':<10}{'体积 (MB)':>12}{'耗时 (s)':>12}{'吞吐 (行/秒)':>16}{'错误凭证':>10}")
+    for name, body, parser in (
+        ("CSV", to_csv(records), iter_csv_records),
+        ("NDJSON", to_ndjson(records), iter_ndjson_records),
+    ):
+        result, seconds = run(body, parser)
+        summary = result["summary"]
+        print(f"{name:<10}{len(body) / 1e6:>12.1f}{seconds:>12.2f}"
+              f"{summary['line_count'] / seconds:>16,.0f}{summary['invalid_vouchers']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+冷启动导入预算检查
+在全新的子进程中以 python -X importtime 导入 main，检查两项：
+- 导入耗时（多次运行取最小值）不超过预算（--budget-ms，默认 IMPORT_BUDGET_MS 或 1500 毫秒）
+- 重型模块（langchain / langgraph、加密后端、tiktoken 等）没有在导入时加载，它们应在首次使用或预热阶段加载
+子进程不设置任何 LLM API Key，同时验证导入 main 不依赖提供商配置。
+任一项不满足时退出码为 1，可在 CI 中运行；耗时与机器相关，预算应按 CI 节点设定。
+
+运行: python benchmarks/import_budget.py [--budget-ms 1500] [--runs 5] [--top 15]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from typing import List, Tuple
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "1500"))
+
+# 导入 main 时不应加载的模块（按顶层包名匹配）
+LAZY_MODULES = (
+    "langchain", "langchain_core", "langgraph", "agent_core", "excel_tools",
+    "passlib", "bcrypt", "jose", "cryptography", "tiktoken",
+    "fake_llm_server", "gunicorn",
+)
+# 子进程中清除的提供商配置
+_PROVIDER_VARIABLES = ("DASHSCOPE_API_KEY", "DEEPSEEK_API_KEY", "OPENAI_API_KEY", "LLM_PROVIDER", "LLM_STUB_URL")
+
+
+def import_main(database_url: str) -> List[Tuple[str, int, int]]:
+    """在子进程中导入 main，返回 importtime 记录 [(模块名, 自身耗时 us, 累计耗时 us)]，按导入顺序"""
+    env = {key: value for key, value in os.environ.items() if key not in _PROVIDER_VARIABLES}
+    env.update(DATABASE_URL=database_url, WARMUP_ON_STARTUP="false", PYTHONDONTWRITEBYTECODE="1")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=BACKEND_DIR, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f"导入 main 失败:\n{result.stderr[-2000:]}")
+    records = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, self_us, cumulative_us, name = (part.strip() for part in line.replace("import time:", "|", 1).split("|"))
+        records.append((name, int(self_us), int(cumulative_us)))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导入 main 的冷启动预算检查")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--runs", type=int, default=5, help="运行次数，取最小耗时")
+    parser.add_argument("--top", type=int, default=15, help="列出累计耗时最高的模块数")
+    args = parser.parse_args()
+
+    database_url = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="excel-ai-import-"), "import.db")
+    best_ms = None
+    best_records: List[Tuple[str, int, int]] = []
+    for _ in range(max(args.runs, 1)):
+        records = import_main(database_url)
+        total_ms = next(cumulative for name, _, cumulative in records if name == "main") / 1000
+        if best_ms is None or total_ms < best_ms:
+            best_ms, best_records = total_ms, records
+
+    loaded = sorted({name for name, _, _ in best_records if name.split(".")[0] in LAZY_MODULES})
+    print(f"{'模块':<44}{'自身 (ms)':>11}{'累计 (ms)':>11}")
+    for name, self_us, cumulative_us in sorted(best_records, key=lambda record: -record[2])[:args.top]:
+        print(f"{name:<44}{self_us / 1000:>11.1f}{cumulative_us / 1000:>11.1f}")
+
+    failed = False
+    print(f"\n导入 main: {best_ms:.0f} ms（{args.runs} 次取最小），预算 {args.budget_ms:.0f} ms")
+    if best_ms > args.budget_ms:
+        print(f"❌ 超出预算 {best_ms - args.budget_ms:.0f} ms")
+        failed = True
+    if loaded:
+        print(f"❌ 导入时加载了应延迟加载的模块: {', '.join(loaded)}")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("✅ 通过")
+
+
+if __name__ == "__main__":
+    main()
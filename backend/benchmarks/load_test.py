@@ -0,0 +1,179 @@
+"""
+后端压测工具
+以目标速率（开环，按计划时间发出请求，不等待前一个请求完成）驱动注册、登录、公式生成与 Agent 对话等流程，
+统计各流程的 p50 / p95 / p99 延迟与吞吐。延迟从计划发出时间算起，服务端排队造成的等待也计入其中。
+
+配合本地 LLM 桩服务使用，不消耗真实额度：
+- 进程内：python benchmarks/load_test.py --in-process（自动设置 LLM_PROVIDER=stub，不需要启动服务）
+- 对运行中的服务：以 LLM_PROVIDER=stub 启动后端（可另行运行 fake_llm_server.py 并设置 LLM_STUB_URL）与 RATE_LIMIT_ENABLED=false，
+  然后 python benchmarks/load_test.py --base-url https://localhost:8000 --insecure
+
+运行: python benchmarks/load_test.py [--rps 20] [--duration 30] [--mix generate_formula=5,agent_chat=3,token=1,register=1]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PASSWORD = "loadtest-password"
+FORMULA_REQUESTS = ["计算 A 列的总和", "求 B2:B100 的平均值", "统计 C 列非空单元格个数", "查找客户编号对应的名称", "找出 D 列最大值"]
+CHAT_MESSAGES = ["帮我对 A 列求和", "生成本月的三大报表", "检查数据中的重复行", "读取当前工作表的数据"]
+DEFAULT_MIX = "generate_formula=5,agent_chat=3,token=1,register=1"
+
+
+class LoadTest:
+    def __init__(self, client: httpx.AsyncClient, users: int):
+        self.client = client
+        self.user_count = users
+        self.run_id = uuid.uuid4().hex[:8]
+        self.tokens: List[str] = []
+        self.emails: List[str] = []
+        self._registered = 0
+        # 流程名 -> [(相对计划时间的延迟, 服务时间, 状态码)]
+        self.results: Dict[str, List[Tuple[float, float, int]]] = defaultdict(list)
+
+    def _new_email(self) -> str:
+        self._registered += 1
+        return f"loadtest_{self.run_id}_{self._registered}@example.com"
+
+    async def setup(self) -> None:
+        """注册压测用户并取得令牌"""
+        for _ in range(self.user_count):
+            email = self._new_email()
+            response = await self.client.post("/register", json={"email": email, "password": PASSWORD})
+            response.raise_for_status()
+            response = await self.client.post("/token", data={"username": email, "password": PASSWORD})
+            response.raise_for_status()
+            self.emails.append(email)
+            self.tokens.append(response.json()["access_token"])
+
+    def _auth(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {random.choice(self.tokens)}"}
+
+    async def flow_register(self) -> httpx.Response:
+        return await self.client.post("/register", json={"email": self._new_email(), "password": PASSWORD})
+
+    async def flow_token(self) -> httpx.Response:
+        return await self.client.post("/token", data={"username": random.choice(self.emails), "password": PASSWORD})
+
+    async def flow_generate_formula(self) -> httpx.Response:
+        return await self.client.post("/api/generate-formula", json={"text": random.choice(FORMULA_REQUESTS)}, headers=self._auth())
+
+    async def flow_agent_chat(self) -> httpx.Response:
+        return await self.client.post("/agent/chat", json={"message": random.choice(CHAT_MESSAGES)}, headers=self._auth())
+
+    async def flow_agent_chat_stream(self) -> httpx.Response:
+        return await self.client.post("/agent/chat/stream", json={"message": random.choice(CHAT_MESSAGES)}, headers=self._auth())
+
+    async def _fire(self, name: str, scheduled: float, limiter: asyncio.Semaphore) -> None:
+        async with limiter:
+            started = time.perf_counter()
+            try:
+                response = await getattr(self, f"flow_{name}")()
+                status = response.status_code
+            except httpx.HTTPError:
+                status = 0
+            finished = time.perf_counter()
+        self.results[name].append((finished - scheduled, finished - started, status))
+
+    async def run(self, rps: float, duration: float, mix: Dict[str, float], max_in_flight: int) -> float:
+        """按计划时间发出请求，返回实际持续时间"""
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        limiter = asyncio.Semaphore(max_in_flight)
+        tasks = []
+        started = time.perf_counter()
+        total = int(rps * duration)
+        for i in range(total):
+            scheduled = started + i / rps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            name = random.choices(names, weights)[0]
+            tasks.append(asyncio.create_task(self._fire(name, scheduled, limiter)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def report(results: Dict[str, List[Tuple[float, float, int]]], elapsed: float) -> None:
+    print(f"\n{'流程':<20}{'请求':>7}{'失败':>7}{'p50 (ms)':>11}{'p95 (ms)':>11}{'p99 (ms)':>11}{'服务 p50':>10}{'吞吐 (/s)':>11}")
+    all_rows = [row for rows in results.values() for row in rows]
+    for name, rows in sorted(results.items()) + [("合计", all_rows)]:
+        latencies = sorted(row[0] * 1000 for row in rows)
+        service = sorted(row[1] * 1000 for row in rows)
+        ok = sum(1 for row in rows if 200 <= row[2] < 300)
+        print(f"{name:<20}{len(rows):>7}{len(rows) - ok:>7}{percentile(latencies, 0.5):>11.1f}"
+              f"{percentile(latencies, 0.95):>11.1f}{percentile(latencies, 0.99):>11.1f}"
+              f"{percentile(service, 0.5):>10.1f}{ok / elapsed:>11.1f}")
+    failures = Counter(row[2] for row in all_rows if not 200 <= row[2] < 300)
+    if failures:
+        print("失败状态码: " + ", ".join(f"{code or '连接错误'} × {count}" for code, count in failures.most_common()))
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if not hasattr(LoadTest, f"flow_{name.strip()}"):
+            raise SystemExit(f"未知流程: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+async def main_async(args) -> None:
+    if args.in_process:
+        os.environ["LLM_PROVIDER"] = "stub"
+        os.environ.setdefault("WARMUP_ON_STARTUP", "false")
+        # 压测用户来自同一地址且请求频率远超正常用户，默认不限流（限流效果见 rate_limit_fairness.py）
+        os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+        os.environ.setdefault("FAKE_LLM_LATENCY_MS", str(args.stub_latency_ms))
+        import main
+        transport = httpx.ASGITransport(app=main.app)
+        client = httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=args.timeout)
+    else:
+        limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+        client = httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, verify=not args.insecure, limits=limits)
+
+    async with client:
+        test = LoadTest(client, args.users)
+        await test.setup()
+        mix = parse_mix(args.mix)
+        print(f"目标速率 {args.rps}/s，持续 {args.duration}s，流程比例 {mix}")
+        elapsed = await test.run(args.rps, args.duration, mix, args.max_in_flight)
+        report(test.results, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Excel AI 后端压测")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--in-process", action="store_true", help="在本进程内加载后端并使用 LLM 桩服务")
+    parser.add_argument("--insecure", action="store_true", help="不校验 HTTPS 证书（本地自签名证书）")
+    parser.add_argument("--rps", type=float, default=20)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="流程=权重，逗号分隔")
+    parser.add_argument("--users", type=int, default=5, help="预先注册的用户数")
+    parser.add_argument("--max-in-flight", type=int, default=500, help="同时进行的请求上限")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--stub-latency-ms", type=float, default=300, help="--in-process 时桩服务的延迟中位数")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
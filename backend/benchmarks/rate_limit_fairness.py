@@ -0,0 +1,114 @@
+"""
+限流公平性测试
+一个高频用户（开环，--heavy-rps）与若干普通用户（各 --light-rps）同时调用 /agent/chat，
+分别在关闭与开启限流时运行，比较普通用户的 p50 / p95 延迟与高频用户被接受、被拒绝（429）的请求数。
+进程内加载后端并使用 LLM 桩服务（LLM_PROVIDER=stub），不需要启动服务。
+
+运行: python benchmarks/rate_limit_fairness.py [--duration 20] [--heavy-rps 30] [--light-users 4] [--rule 20/60]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Tuple
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from load_test import CHAT_MESSAGES, PASSWORD, percentile  # noqa: E402
+
+ENDPOINT = "/agent/chat"
+
+
+async def register(client: httpx.AsyncClient, email: str) -> str:
+    response = await client.post("/register", json={"email": email, "password": PASSWORD})
+    response.raise_for_status()
+    response = await client.post("/token", data={"username": email, "password": PASSWORD})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+async def drive(client: httpx.AsyncClient, token: str, rps: float, duration: float,
+                results: List[Tuple[float, int]]) -> None:
+    """开环发送请求，记录（相对计划时间的延迟, 状态码）"""
+    headers = {"Authorization": f"Bearer {token}"}
+
+    async def fire(i: int, scheduled: float) -> None:
+        try:
+            response = await client.post(ENDPOINT, json={"message": CHAT_MESSAGES[i % len(CHAT_MESSAGES)]}, headers=headers)
+            status = response.status_code
+        except httpx.HTTPError:
+            status = 0
+        results.append((time.perf_counter() - scheduled, status))
+
+    tasks = []
+    started = time.perf_counter()
+    for i in range(int(rps * duration)):
+        scheduled = started + i / rps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(fire(i, scheduled)))
+    await asyncio.gather(*tasks)
+
+
+async def run_once(client: httpx.AsyncClient, heavy: str, light: List[str], args) -> Dict[str, List[Tuple[float, int]]]:
+    results: Dict[str, List[Tuple[float, int]]] = {"heavy": [], "light": []}
+    await asyncio.gather(
+        drive(client, heavy, args.heavy_rps, args.duration, results["heavy"]),
+        *(drive(client, token, args.light_rps, args.duration, results["light"]) for token in light),
+    )
+    return results
+
+
+def report(label: str, results: Dict[str, List[Tuple[float, int]]]) -> None:
+    light = sorted(latency * 1000 for latency, status in results["light"] if status == 200)
+    heavy = Counter(status for _, status in results["heavy"])
+    light_failed = sum(1 for _, status in results["light"] if status != 200)
+    print(f"{label:<8}{percentile(light, 0.5):>12.1f}{percentile(light, 0.95):>12.1f}{light_failed:>10}"
+          f"{heavy[200]:>10}{heavy[429]:>10}{sum(heavy.values()) - heavy[200] - heavy[429]:>10}")
+
+
+async def main_async(args) -> None:
+    os.environ["LLM_PROVIDER"] = "stub"
+    os.environ.setdefault("WARMUP_ON_STARTUP", "false")
+    os.environ.setdefault("FAKE_LLM_LATENCY_MS", str(args.stub_latency_ms))
+    import main
+    from rate_limit import get_rate_limiter, parse_rules
+
+    limiter = get_rate_limiter()
+    run_id = uuid.uuid4().hex[:8]
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://fairness", timeout=args.timeout) as client:
+        limiter.enabled = False
+        heavy = await register(client, f"fairness_{run_id}_heavy@example.com")
+        light = [await register(client, f"fairness_{run_id}_{i}@example.com") for i in range(args.light_users)]
+
+        print(f"高频用户 {args.heavy_rps}/s，普通用户 {args.light_users} 个 × {args.light_rps}/s，"
+              f"持续 {args.duration}s，规则 {ENDPOINT}={args.rule}")
+        print(f"\n{'限流':<8}{'普通 p50':>12}{'普通 p95':>12}{'普通失败':>10}{'高频成功':>10}{'高频 429':>10}{'高频其他':>10}")
+        report("关闭", await run_once(client, heavy, light, args))
+
+        limiter.rules = {**limiter.rules, **parse_rules(f"{ENDPOINT}={args.rule}")}
+        limiter.enabled = True
+        report("开启", await run_once(client, heavy, light, args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="限流公平性测试")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--heavy-rps", type=float, default=30, help="高频用户的请求速率")
+    parser.add_argument("--light-users", type=int, default=4)
+    parser.add_argument("--light-rps", type=float, default=1, help="每个普通用户的请求速率")
+    parser.add_argument("--rule", default="20/60", help="测试使用的 /agent/chat 规则（次数/秒数[:突发]）")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--stub-latency-ms", type=float, default=300, help="桩服务的延迟中位数")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
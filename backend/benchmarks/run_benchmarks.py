@@ -0,0 +1,285 @@
+"""
+后端热路径微基准与回归检查
+覆盖 Agent 操作规划（parse_llm_response / generate_excel_operations）、Office.js 代码与写入载荷生成、
+JWT 编解码、get_current_user 的令牌校验与用户查询、响应序列化，输入为中英文长短消息与大数组。
+完全离线运行：LLM 使用进程内桩（LLM_PROVIDER=stub），数据库为临时 SQLite 文件。
+
+每项基准自动确定循环次数（单轮至少 0.2 秒），重复多轮取最小的单次耗时。
+基线与机器相关，不随代码提交，应在同一台机器（如 CI 节点）上生成和比较（基线不存在时 --compare 报错退出）：
+    python benchmarks/run_benchmarks.py --save-baseline            # 生成 benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --compare                  # 与基线比较，超过阈值时退出码为 1
+    python benchmarks/run_benchmarks.py --compare --threshold 0.15 --filter jwt
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_THRESHOLD = 0.25
+
+MESSAGES = {
+    "zh_short": "帮我对 A 列求和",
+    "zh_long": "请读取当前工作表中 2024 年全年的凭证数据，按科目汇总借贷方发生额，检查借贷是否平衡，"
+               "找出重复录入的凭证和金额异常的分录并标记出来，然后生成资产负债表、利润表和现金流量表，"
+               "最后在新工作表里画一个按月份的收入柱状图，并给出同比和环比分析的公式。" * 3,
+    "en_short": "sum column A",
+    "en_long": "Read every voucher in the current sheet for fiscal 2024, aggregate debit and credit totals per account, "
+               "verify the trial balance, flag duplicate entries and outlier amounts, then build the balance sheet, "
+               "income statement and cash flow statement and chart monthly revenue as a column chart. " * 3,
+}
+
+# 基准注册表：(名称, 准备函数)；准备函数返回被测的零参数函数，依赖不可用时抛出 ImportError
+BENCHMARKS: List[Tuple[str, Callable[[], Callable[[], object]]]] = []
+
+
+def benchmark(name: str):
+    def decorator(setup: Callable[[], Callable[[], object]]):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return decorator
+
+
+def _prepare_environment() -> None:
+    """离线运行所需的环境：LLM 桩与临时数据库（须在导入 main 之前设置）"""
+    os.environ["LLM_PROVIDER"] = "stub"
+    os.environ["WARMUP_ON_STARTUP"] = "false"
+    os.environ["METRICS_ENABLED"] = "false"
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="excel-ai-bench-"), "bench.db")
+
+
+def _sheet_ranges() -> dict:
+    return {"sheet_name": "凭证", "used_range": "A1:H5001", "sum_range": "F2:F5001", "sum_target": "F5002",
+            "chart_range": "A1:B5001"}
+
+
+def _values(rows: int, columns: int) -> list:
+    return [[f"2024-{r % 12 + 1:02d}-01" if c == 0 else f"摘要{r % 97}" if c == 1 else round(r * 1.37 + c, 2)
+             for c in range(columns)] for r in range(rows)]
+
+
+for _key, _message in MESSAGES.items():
+    def _setup(message=_message):
+        import main
+        return lambda: main.parse_llm_response(message, "=SUM(A1:A10)", _sheet_ranges())
+    benchmark(f"parse_llm_response.{_key}")(_setup)
+
+
+@benchmark("generate_excel_operations.zh_long_no_snapshot")
+def _bench_operations_default():
+    import main
+    return lambda: main.generate_excel_operations(MESSAGES["zh_long"])
+
+
+@benchmark("bulk_write.chunked_write.20k_x_8")
+def _bench_chunked_write():
+    from bulk_write import build_chunked_write
+    values = _values(20_000, 8)
+    return lambda: build_chunked_write("凭证", "A1", values)
+
+
+@benchmark("bulk_write.columnar_write.20k_x_8")
+def _bench_columnar_write():
+    from bulk_write import build_columnar_write
+    values = _values(20_000, 8)
+    columns = [list(column) for column in zip(*values)]
+    return lambda: build_columnar_write("凭证", "A1", columns)
+
+
+@benchmark("excel_tools.write_range.small")
+def _bench_tool_write_small():
+    from excel_tools import WriteRangeTool
+    tool = WriteRangeTool()
+    values = json.dumps(_values(20, 5), ensure_ascii=False)
+    return lambda: tool._run("Sheet1", "A1", values)
+
+
+@benchmark("excel_tools.write_range.large")
+def _bench_tool_write_large():
+    from excel_tools import WriteRangeTool
+    tool = WriteRangeTool()
+    values = json.dumps(_values(5_000, 8), ensure_ascii=False)
+    return lambda: tool._run("Sheet1", "A1", values)
+
+
+@benchmark("excel_tools.generate_formula")
+def _bench_tool_formula():
+    from excel_tools import FormulaGeneratorTool
+    tool = FormulaGeneratorTool()
+    return lambda: tool._run(MESSAGES["zh_short"], "B1", "Sheet1")
+
+
+@benchmark("jwt.encode")
+def _bench_jwt_encode():
+    from jose import jwt
+    from config import ALGORITHM, SECRET_KEY
+    return lambda: jwt.encode({"sub": "bench@example.com"}, SECRET_KEY, algorithm=ALGORITHM)
+
+
+@benchmark("jwt.decode")
+def _bench_jwt_decode():
+    from jose import jwt
+    from config import ALGORITHM, SECRET_KEY
+    token = jwt.encode({"sub": "bench@example.com"}, SECRET_KEY, algorithm=ALGORITHM)
+    return lambda: jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+
+@benchmark("auth.get_current_user")
+def _bench_current_user():
+    import main  # noqa: F401  建表
+    from jose import jwt
+    import crud, database, dependencies, schemas
+    from config import ALGORITHM, SECRET_KEY
+    with database.SessionLocal() as db:
+        if crud.get_user_by_email(db, "bench@example.com") is None:
+            crud.create_user(db, schemas.UserCreate(email="bench@example.com", password="bench-password"))
+    token = jwt.encode({"sub": "bench@example.com"}, SECRET_KEY, algorithm=ALGORITHM)
+    loop = asyncio.new_event_loop()
+    return lambda: loop.run_until_complete(dependencies.get_current_user(token))
+
+
+@benchmark("serialize.agent_chat_response")
+def _bench_serialize_agent():
+    import main, schemas
+    operations = main.generate_excel_operations(MESSAGES["zh_long"], _sheet_ranges())
+    response = schemas.AgentChatResponse(success=True, response=MESSAGES["zh_long"], excel_operations=operations,
+                                         conversation_id="conv_1")
+    return response.model_dump_json
+
+
+@benchmark("serialize.workbook_rows.5k_x_8.json")
+def _bench_serialize_rows_json():
+    import schemas
+    response = schemas.WorkbookRowsResponse(workbook_id="w", sheet_name="凭证", start=0, row_count=5_000, rows=_values(5_000, 8))
+    return response.model_dump_json
+
+
+@benchmark("serialize.workbook_rows.5k_x_8.msgpack")
+def _bench_serialize_rows_msgpack():
+    import msgpack
+    import schemas
+    response = schemas.WorkbookRowsResponse(workbook_id="w", sheet_name="凭证", start=0, row_count=5_000, rows=_values(5_000, 8))
+    return lambda: msgpack.packb(response.model_dump(), use_bin_type=True)
+
+
+def measure(func: Callable[[], object], repeat: int, min_time: float) -> Tuple[float, int]:
+    """返回 (最小单次耗时（秒）, 每轮循环次数)"""
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9) * 1.2))
+    timings = [elapsed] + timer.repeat(repeat=repeat - 1, number=number)
+    return min(timings) / number, number
+
+
+def run(filter_text: Optional[str], repeat: int, min_time: float) -> Dict[str, Dict[str, object]]:
+    results: Dict[str, Dict[str, object]] = {}
+    for name, setup in BENCHMARKS:
+        if filter_text and filter_text not in name:
+            continue
+        try:
+            func = setup()
+        except Exception as e:
+            # 可选依赖缺失或与当前环境不兼容（如 langchain 版本），记为跳过
+            results[name] = {"skipped": f"{type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''}"}
+            continue
+        per_call, number = measure(func, repeat, min_time)
+        results[name] = {"per_call_us": round(per_call * 1e6, 3), "iterations": number}
+    return results
+
+
+def environment() -> Dict[str, object]:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def compare(results: Dict[str, Dict[str, object]], baseline: Dict[str, object], threshold: float) -> List[str]:
+    """打印对比表，返回超过阈值的基准名"""
+    regressions = []
+    base_results = baseline.get("results", {})
+    print(f"\n{'基准':<46}{'当前 (us)':>12}{'基线 (us)':>12}{'变化':>9}")
+    for name, result in results.items():
+        if "skipped" in result:
+            print(f"{name:<46}{'跳过':>12}  {result['skipped']}")
+            continue
+        current = result["per_call_us"]
+        base = base_results.get(name, {}).get("per_call_us")
+        if base is None:
+            print(f"{name:<46}{current:>12.2f}{'-':>12}{'新增':>9}")
+            continue
+        change = current / base - 1
+        flag = "  ← 回归" if change > threshold else ""
+        print(f"{name:<46}{current:>12.2f}{base:>12.2f}{change:>+9.1%}{flag}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="后端热路径微基准")
+    parser.add_argument("--filter", help="只运行名称包含该字符串的基准")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="每轮最短耗时（秒）")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE, help="把结果保存为基线 JSON")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, help="与基线 JSON 比较")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="允许的相对变慢比例")
+    parser.add_argument("--output", help="把本次结果写入 JSON 文件")
+    args = parser.parse_args()
+    if args.compare and not os.path.exists(args.compare):
+        # 基线与机器相关，不随代码提交，须先在本机生成
+        parser.error(f"基线文件不存在: {args.compare}；请先在本机运行 --save-baseline 生成基线")
+
+    _prepare_environment()
+    started = time.perf_counter()
+    results = run(args.filter, max(args.repeat, 1), args.min_time)
+    document = {"environment": environment(), "results": results}
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("environment", {}).get("machine") != document["environment"]["machine"] or \
+                baseline.get("environment", {}).get("python") != document["environment"]["python"]:
+            print(f"⚠️  基线来自不同的环境: {baseline.get('environment')}")
+        regressions = compare(results, baseline, args.threshold)
+    else:
+        print(f"{'基准':<46}{'单次 (us)':>12}{'循环次数':>10}")
+        for name, result in results.items():
+            if "skipped" in result:
+                print(f"{name:<46}{'跳过':>12}  {result['skipped']}")
+            else:
+                print(f"{name:<46}{result['per_call_us']:>12.2f}{result['iterations']:>10}")
+        regressions = []
+
+    for path in filter(None, (args.save_baseline, args.output)):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(document, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {path}")
+
+    print(f"\n用时 {time.perf_counter() - started:.1f}s")
+    if regressions:
+        print(f"❌ {len(regressions)} 项超过阈值 {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
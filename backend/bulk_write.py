@@ -0,0 +1,246 @@
+"""
+大范围分块写入与批量标记
+把大块数据拆成若干行块，生成一段循环读取紧凑数据载荷的 Office.js 代码，
+每写完一块就 context.sync() 提交一次，失败时返回已提交的块号以便从断点续写。
+数据不再以字面量内联到 JS 源码中，脚本大小与数据量无关
+"""
+
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from excel_address import parse_cell, range_address
+
+# 超过该单元格数时自动启用分块写入
+CHUNK_THRESHOLD_CELLS = int(os.getenv("BULK_WRITE_THRESHOLD_CELLS", "10000"))
+# 自动分块时每块的目标单元格数
+DEFAULT_CHUNK_CELLS = int(os.getenv("BULK_WRITE_CHUNK_CELLS", "5000"))
+
+
+def _sheet_js(sheet_name: Optional[str]) -> str:
+    """获取工作表对象的 JS 表达式，未指定名称时使用活动工作表"""
+    if sheet_name:
+        return f"context.workbook.worksheets.getItem({json.dumps(sheet_name, ensure_ascii=False)})"
+    return "context.workbook.worksheets.getActiveWorksheet()"
+
+
+def should_chunk(values: Sequence[Sequence[Any]]) -> bool:
+    """数据量是否需要分块写入"""
+    column_count = max((len(row) for row in values), default=0)
+    return len(values) * column_count > CHUNK_THRESHOLD_CELLS
+
+
+def default_chunk_rows(column_count: int) -> int:
+    """按目标单元格数计算每块行数"""
+    return max(1, DEFAULT_CHUNK_CELLS // max(column_count, 1))
+
+
+def build_chunked_payload(values: Sequence[Sequence[Any]], top_left: str, chunk_rows: int,
+                          start_block: int = 0, write_property: str = "values") -> Dict[str, Any]:
+    """
+    构建分块写入的紧凑数据载荷
+
+    每块按列存放；全字符串列做字典编码（存放 dict 下标），数值列和混合列原样存放，
+    空值写为 ""（Excel 中即清空单元格）
+
+    Args:
+        values: 二维数组
+        top_left: 写入区域左上角单元格，如 "B2"
+        chunk_rows: 每块行数
+        start_block: 从第几块开始写（续写时使用）
+        write_property: 写入的范围属性，见 WRITE_PROPERTIES；写公式时重复的 R1C1 公式同样被字典编码
+
+    Returns:
+        载荷字典: {"columns", "chunkRows", "startBlock", "property", "types", "dict", "addresses", "blocks"}
+    """
+    column_count = max((len(row) for row in values), default=0)
+    columns = [
+        [row[col] if col < len(row) and row[col] is not None else "" for row in values]
+        for col in range(column_count)
+    ]
+    return build_columnar_payload(columns, top_left, chunk_rows, start_block, write_property)
+
+
+def build_columnar_payload(columns: Sequence[Sequence[Any]], top_left: str, chunk_rows: int,
+                           start_block: int = 0, write_property: str = "values") -> Dict[str, Any]:
+    """
+    按列构建分块写入载荷，格式与 build_chunked_payload 相同
+
+    数据本来就按列存放时（如服务端逐行校验后的结果）直接使用，省去转置和逐行容器的开销
+
+    Args:
+        columns: 各列的值，长度须一致；None 视为空单元格
+        top_left: 写入区域左上角单元格
+        chunk_rows: 每块行数
+        start_block: 从第几块开始写
+        write_property: 写入的范围属性
+    """
+    if chunk_rows <= 0:
+        raise ValueError("chunk_rows 必须为正整数")
+    if write_property not in WRITE_PROPERTIES:
+        raise ValueError(f"不支持的写入属性: {write_property}")
+    start_row, start_col = parse_cell(top_left)
+    column_count = len(columns)
+    row_count = len(columns[0]) if columns else 0
+
+    # 列类型：s = 字典编码字符串（整列先编码再切块），r = 原样
+    types: List[str] = []
+    encoded: List[List[Any]] = []
+    dictionary: Dict[str, int] = {}
+    for column in columns:
+        cells = [cell for cell in column if cell is not None and cell != ""]
+        if cells and all(isinstance(cell, str) for cell in cells):
+            types.append("s")
+            encoded.append([dictionary.setdefault("" if cell is None else cell, len(dictionary)) for cell in column])
+        else:
+            types.append("r")
+            encoded.append([("" if cell is None else cell) for cell in column])
+
+    blocks: List[List[List[Any]]] = []
+    addresses: List[str] = []
+    for block_start in range(0, row_count, chunk_rows):
+        block_end = min(block_start + chunk_rows, row_count)
+        blocks.append([column[block_start:block_end] for column in encoded])
+        addresses.append(range_address(start_row + block_start, start_col,
+                                       start_row + block_end - 1, start_col + column_count - 1))
+
+    return {
+        "columns": column_count,
+        "chunkRows": chunk_rows,
+        "startBlock": start_block,
+        "property": write_property,
+        "types": types,
+        "dict": list(dictionary),
+        "addresses": addresses,
+        "blocks": blocks,
+    }
+
+
+# 分块写入可以设置的范围属性；formulas / formulasR1C1 同样接受普通值
+WRITE_PROPERTIES = ("values", "formulas", "formulasR1C1")
+
+
+def build_chunked_write_js(sheet_name: Optional[str], create_sheet: bool = False) -> str:
+    """
+    生成分块写入的 Office.js 代码
+
+    代码通过 payload 参数读取数据（由前端执行时传入），不内联任何数据；
+    从 payload.startBlock 开始逐块写入并提交，出错时返回已提交的最后一块，便于以 start_block 续写
+
+    Args:
+        sheet_name: 工作表名称，为空时写入活动工作表
+        create_sheet: 工作表不存在时是否新建
+    """
+    if create_sheet and sheet_name:
+        name_js = json.dumps(sheet_name, ensure_ascii=False)
+        sheet_js = f"""context.workbook.worksheets.getItemOrNullObject({name_js});
+    await context.sync();
+    if (sheet.isNullObject) {{
+        sheet = context.workbook.worksheets.add({name_js});
+    }}"""
+    else:
+        sheet_js = _sheet_js(sheet_name) + ";"
+    return f"""
+// 分块写入单元格范围数据（数据来自 payload）
+return Excel.run(async (context) => {{
+    let sheet = {sheet_js}
+    const data = payload;
+    let committed = data.startBlock - 1;
+    try {{
+        for (let b = data.startBlock; b < data.blocks.length; b++) {{
+            const block = data.blocks[b];
+            const rowCount = block[0].length;
+            const values = new Array(rowCount);
+            for (let r = 0; r < rowCount; r++) {{
+                const row = new Array(data.columns);
+                for (let c = 0; c < data.columns; c++) {{
+                    row[c] = data.types[c] === "s" ? data.dict[block[c][r]] : block[c][r];
+                }}
+                values[r] = row;
+            }}
+            sheet.getRange(data.addresses[b])[data.property] = values;
+            await context.sync();
+            committed = b;
+        }}
+        return {{ status: "done", committedBlock: committed, totalBlocks: data.blocks.length }};
+    }} catch (error) {{
+        return {{ status: "partial", committedBlock: committed, nextBlock: committed + 1, totalBlocks: data.blocks.length, error: String(error) }};
+    }}
+}});
+"""
+
+
+def build_chunked_write(sheet_name: Optional[str], range_address_or_cell: str, values: Sequence[Sequence[Any]],
+                        chunk_rows: int = 0, start_block: int = 0, write_property: str = "values",
+                        create_sheet: bool = False) -> Tuple[str, Dict[str, Any]]:
+    """
+    生成分块写入的代码与数据载荷
+
+    Args:
+        sheet_name: 工作表名称，为空时写入活动工作表
+        range_address_or_cell: 目标范围或左上角单元格（只使用左上角）
+        values: 二维数组
+        chunk_rows: 每块行数，0 表示按 BULK_WRITE_CHUNK_CELLS 自动计算
+        start_block: 从第几块开始写
+        write_property: 写入的范围属性（values / formulas / formulasR1C1）
+        create_sheet: 工作表不存在时是否新建
+
+    Returns:
+        (js_code, payload)
+    """
+    top_left = range_address_or_cell.split(":")[0]
+    column_count = max((len(row) for row in values), default=0)
+    payload = build_chunked_payload(values, top_left, chunk_rows or default_chunk_rows(column_count), start_block,
+                                    write_property)
+    return build_chunked_write_js(sheet_name, create_sheet), payload
+
+
+def build_columnar_write(sheet_name: Optional[str], top_left: str, columns: Sequence[Sequence[Any]],
+                         chunk_rows: int = 0, create_sheet: bool = False) -> Tuple[str, Dict[str, Any]]:
+    """按列数据生成分块写入的代码与数据载荷，参数含义同 build_chunked_write"""
+    payload = build_columnar_payload(columns, top_left, chunk_rows or default_chunk_rows(len(columns)))
+    return build_chunked_write_js(sheet_name, create_sheet), payload
+
+
+# 每次 getRanges 调用包含的区域数上限
+_AREAS_PER_CALL = int(os.getenv("BULK_HIGHLIGHT_AREAS_PER_CALL", "200"))
+
+
+def build_highlight(sheet_name: Optional[str], fills: Sequence[Tuple[str, Sequence[str]]]) -> Tuple[str, Dict[str, Any]]:
+    """
+    生成批量填充底色的代码与数据载荷
+
+    同色的区域合并为多区域地址，通过 getRanges 一次设置，所有填充排队后只 sync 一次
+
+    Args:
+        sheet_name: 工作表名称，为空时使用活动工作表
+        fills: [(颜色, [区域地址, ...]), ...]
+
+    Returns:
+        (js_code, payload)
+    """
+    payload = {
+        "fills": [
+            {
+                "color": color,
+                "areas": [",".join(addresses[i:i + _AREAS_PER_CALL]) for i in range(0, len(addresses), _AREAS_PER_CALL)],
+            }
+            for color, addresses in fills if addresses
+        ]
+    }
+    sheet_js = _sheet_js(sheet_name)
+    js_code = f"""
+// 批量标记单元格底色（区域来自 payload）
+return Excel.run(async (context) => {{
+    const sheet = {sheet_js};
+    let areaCount = 0;
+    for (const fill of payload.fills) {{
+        for (const areas of fill.areas) {{
+            sheet.getRanges(areas).format.fill.color = fill.color;
+            areaCount += areas.split(",").length;
+        }}
+    }}
+    await context.sync();
+    return {{ status: "done", areaCount: areaCount }};
+}});
+"""
+    return js_code, payload
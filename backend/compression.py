@@ -0,0 +1,150 @@
+"""
+响应压缩
+按 Accept-Encoding 协商 br / gzip，对超过阈值的 JSON、文本、脚本与 MessagePack 响应压缩：
+- 流式响应（NDJSON、SSE 等分多次发送正文的响应）原样透传，不缓冲、不压缩，避免推迟首字节
+- 已设置 Content-Encoding 的响应、304 / 204 与 HEAD 请求不处理
+- 强 ETag 在压缩后追加编码后缀（"<hash>-gzip"），不同编码的表示不共用同一个强校验值；
+  比较 If-None-Match 时由 http_cache.etag_matches 去掉后缀
+- brotli 为可选依赖（pip install brotli），未安装时只提供 gzip
+"""
+
+import asyncio
+import gzip
+import os
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+# 小于该字节数的响应不压缩（压缩收益抵不上 CPU 与头部开销）
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "5"))
+# 超过该字节数的响应在线程池中压缩，不阻塞事件循环
+_THREAD_THRESHOLD = 256 * 1024
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-msgpack", "application/javascript", "text/")
+ETAG_SUFFIXES = ("-br", "-gzip")
+
+
+def parse_accept_encoding(header: Optional[str]) -> Dict[str, float]:
+    """解析 Accept-Encoding 为 编码 -> q 值"""
+    encodings: Dict[str, float] = {}
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        encodings[name] = q
+    return encodings
+
+
+def choose_encoding(header: Optional[str]) -> Optional[str]:
+    """选择响应编码：q 值较高者优先，相同时 brotli 优先；都不可接受时返回 None"""
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get("*", 0.0)
+    candidates = [("br", accepted.get("br", wildcard))] if brotli is not None else []
+    candidates.append(("gzip", accepted.get("gzip", wildcard)))
+    encoding, q = max(candidates, key=lambda item: item[1])
+    return encoding if q > 0 else None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+def _is_compressible(headers: List[Tuple[bytes, bytes]]) -> bool:
+    content_type = b""
+    for name, value in headers:
+        lowered = name.lower()
+        if lowered == b"content-encoding" or lowered == b"content-range":
+            return False
+        if lowered == b"content-type":
+            content_type = value
+    content_type = content_type.decode("latin-1").lower()
+    return any(content_type.startswith(prefix) for prefix in COMPRESSIBLE_TYPES)
+
+
+def _compressed_headers(headers: List[Tuple[bytes, bytes]], encoding: str, length: int) -> List[Tuple[bytes, bytes]]:
+    result = []
+    vary = None
+    for name, value in headers:
+        lowered = name.lower()
+        if lowered == b"content-length":
+            continue
+        if lowered == b"etag" and not value.startswith(b"W/") and value.endswith(b'"'):
+            value = value[:-1] + f"-{encoding}\"".encode()
+        if lowered == b"vary":
+            vary = value
+            continue
+        result.append((name, value))
+    result.append((b"content-encoding", encoding.encode()))
+    result.append((b"content-length", str(length).encode()))
+    result.append((b"vary", b"Accept-Encoding" if vary is None else vary + b", Accept-Encoding"))
+    return result
+
+
+class CompressionMiddleware:
+    """ASGI 中间件：单次发送正文的响应按协商结果压缩，流式响应透传"""
+
+    def __init__(self, app, min_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.min_size = min_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not COMPRESSION_ENABLED or scope.get("method") == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        request_headers = dict(scope.get("headers") or ())
+        encoding = choose_encoding(request_headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if status < 200 or status in (204, 304) or not _is_compressible(message.get("headers", [])):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start_message = message
+                return
+            # 首个正文消息：分多次发送的视为流式响应，原样透传
+            body = message.get("body", b"")
+            headers = list(start_message.get("headers", []))
+            if message.get("more_body", False) or len(body) < self.min_size:
+                passthrough = True
+                if not message.get("more_body", False):
+                    headers.append((b"vary", b"Accept-Encoding"))
+                await send({**start_message, "headers": headers})
+                await send(message)
+                return
+            if len(body) > _THREAD_THRESHOLD:
+                compressed = await asyncio.to_thread(compress, body, encoding)
+            else:
+                compressed = compress(body, encoding)
+            passthrough = True
+            await send({**start_message, "headers": _compressed_headers(headers, encoding, len(compressed))})
+            await send({"type": "http.response.body", "body": compressed, "more_body": False})
+
+        await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,395 @@
+"""
+数据清洗引擎
+在列存储数据上做向量化检测：
+- 完全重复行：逐列计算 64 位值哈希，组合为行哈希后分组，再逐列核对实际值排除碰撞
+- 近似重复行：对文本做规范化（全半角、大小写、空白），金额按分取整后再比较关键列
+- 异常值：按科目（分组列）或整列计算稳健 z 分数（中位数 / MAD）或 IQR 围栏
+结果给出单元格坐标，并合并为一个批量标记底色的 Office.js 操作
+"""
+
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from bulk_write import build_highlight
+from excel_address import column_index, column_letter, parse_cell, range_address
+from sheet_profiler import split_header
+
+# 标记颜色
+DUPLICATE_COLOR = "#FFC7CE"
+NEAR_DUPLICATE_COLOR = "#FFEB9C"
+OUTLIER_COLOR = "#F8CBAD"
+
+# 稳健 z 分数的默认阈值（Iglewicz & Hoaglin）与 IQR 围栏系数
+DEFAULT_Z_THRESHOLD = 3.5
+DEFAULT_IQR_FACTOR = 1.5
+# 样本数少于该值的分组不做异常值检测
+MIN_GROUP_SIZE = 5
+
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+_NAN_BITS = np.uint64(0x7FF8000000000001)
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+# 比较单元格值时代表 NaN（NaN 与自身不相等，但重复检测中视为相同）
+_NAN = object()
+
+
+def _numeric_hashes(column: np.ndarray, decimals: Optional[int] = None) -> np.ndarray:
+    """数值列的 64 位哈希：直接取 float64 的位模式（-0.0 归一为 0.0，NaN 归一为同一个值）"""
+    values = np.round(column, decimals) if decimals is not None else column
+    bits = (values + 0.0).view(np.uint64)
+    return np.where(np.isnan(values), _NAN_BITS, bits)
+
+
+def normalize_text(value: str) -> str:
+    """文本规范化：NFKC（全角转半角）、去除首尾空白、合并连续空白、忽略大小写"""
+    return _WHITESPACE_PATTERN.sub(" ", unicodedata.normalize("NFKC", value)).strip().casefold()
+
+
+def _normalized_value_hash(value: Any) -> int:
+    if isinstance(value, str):
+        text = normalize_text(value)
+        return hash(text) if text else hash(None)
+    return hash(value)
+
+
+def _value_key(value: Any, normalize: bool) -> Any:
+    """单元格值的比较键，与 column_hashes 的相等语义一致"""
+    if isinstance(value, float) and value != value:
+        return _NAN
+    if normalize and isinstance(value, str):
+        return normalize_text(value) or None
+    return value
+
+
+def _comparable(column: np.ndarray, normalize: bool) -> np.ndarray:
+    """
+    可直接逐元素比较的列：数值列（规范化时按分取整），文本等 object 列按值编码为整数（无碰撞）
+    规范化文本时每个不同的原始值只规范化一次
+    """
+    if column.dtype == np.float64:
+        return np.round(column, 2) if normalize else column
+    codes: Dict[Any, int] = {}
+    raw = np.fromiter((codes.setdefault(_value_key(value, False), len(codes)) for value in column.tolist()),
+                      dtype=np.int64, count=column.size)
+    if not normalize:
+        return raw
+    normalized: Dict[Any, int] = {}
+    remap = np.fromiter((normalized.setdefault(_value_key(value, True), len(normalized)) for value in codes),
+                        dtype=np.int64, count=len(codes))
+    return remap[raw]
+
+
+def column_hashes(column: np.ndarray, normalize: bool = False, exact: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    计算列中每个单元格的 64 位哈希
+
+    Args:
+        column: float64 或 object 列
+        normalize: 是否规范化（文本规范化、数值按分取整），用于近似重复检测
+        exact: 已计算的精确哈希；规范化文本时据此分组，每个不同的值只规范化一次
+    """
+    if column.dtype == np.float64:
+        return _numeric_hashes(column, 2 if normalize else None)
+    if exact is None:
+        exact = np.fromiter(map(hash, column.tolist()), dtype=np.int64, count=column.size).view(np.uint64)
+    if not normalize:
+        return exact
+    _, first_index, inverse = np.unique(exact, return_index=True, return_inverse=True)
+    normalized = np.fromiter(map(_normalized_value_hash, column[first_index].tolist()), dtype=np.int64,
+                             count=first_index.size).view(np.uint64)
+    return normalized[inverse]
+
+
+def _combine(hashes: Sequence[np.ndarray]) -> np.ndarray:
+    """组合各列哈希为行哈希"""
+    row_hash = np.zeros(len(hashes[0]), dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for column_hash in hashes:
+            row_hash = (row_hash ^ column_hash) * _HASH_MULTIPLIER
+            row_hash ^= row_hash >> np.uint64(29)
+    return row_hash
+
+
+def find_duplicate_rows(columns: Sequence[np.ndarray], normalize: bool = False,
+                        exact_hashes: Optional[Sequence[np.ndarray]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    查找重复行
+
+    Args:
+        columns: 参与比较的列
+        normalize: 是否按规范化后的值比较
+        exact_hashes: 各列已计算的精确哈希（可选，避免重复计算）
+
+    Returns:
+        (重复行下标, 对应的首次出现行下标)，按行下标排序
+    """
+    if not columns or len(columns[0]) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if exact_hashes is None:
+        exact_hashes = [None] * len(columns)
+    hashes = [column_hashes(column, normalize, exact) for column, exact in zip(columns, exact_hashes)]
+    row_hash = _combine(hashes)
+
+    _, first_index, inverse = np.unique(row_hash, return_index=True, return_inverse=True)
+    first = first_index[inverse]
+    candidates = np.flatnonzero(first != np.arange(row_hash.size))
+    originals = first[candidates]
+
+    # 逐列核对实际值，排除哈希碰撞
+    values = [_comparable(column, normalize) for column in columns]
+    same = np.ones(candidates.size, dtype=bool)
+    for column in values:
+        a, b = column[candidates], column[originals]
+        same &= (a == b) | ((a != a) & (b != b))
+    if same.all():
+        return candidates, originals
+
+    # 存在碰撞的哈希分组（极少）按实际值重新分组
+    collided = np.isin(inverse, inverse[candidates[~same]])
+    keep = ~collided[candidates]
+    duplicates, firsts = candidates[keep].tolist(), originals[keep].tolist()
+    rows = np.flatnonzero(collided)
+    first_seen: Dict[tuple, int] = {}
+    keys = zip(*([_value_key(value, False) for value in column[rows].tolist()] for column in values))
+    for row, key in zip(rows.tolist(), keys):
+        original = first_seen.setdefault(key, row)
+        if original != row:
+            duplicates.append(row)
+            firsts.append(original)
+    order = np.argsort(duplicates, kind="stable")
+    return np.asarray(duplicates, dtype=np.int64)[order], np.asarray(firsts, dtype=np.int64)[order]
+
+
+def _group_ids(column: Optional[np.ndarray], row_count: int) -> Tuple[np.ndarray, int]:
+    """分组列转为连续的分组编号；未指定分组时所有行属于同一组"""
+    if column is None:
+        return np.zeros(row_count, dtype=np.int64), 1
+    _, inverse = np.unique(column_hashes(column), return_inverse=True)
+    return inverse.astype(np.int64), int(inverse.max()) + 1 if row_count else 0
+
+
+def _grouped_quantile(sorted_values: np.ndarray, starts: np.ndarray, counts: np.ndarray, q: float) -> np.ndarray:
+    """已按 (分组, 值) 排序的数据上，线性插值计算每组的分位数"""
+    position = starts + q * (counts - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, starts + counts - 1)
+    weight = position - lower
+    return sorted_values[lower] * (1 - weight) + sorted_values[upper] * weight
+
+
+def find_outliers(values: np.ndarray, groups: Optional[np.ndarray] = None, method: str = "mad",
+                  threshold: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    分组检测数值异常
+
+    Args:
+        values: float64 列，NaN 不参与
+        groups: 分组列（如科目），为空时整列作为一组
+        method: "mad"（稳健 z 分数）或 "iqr"（四分位距围栏）
+        threshold: mad 时为 |z| 阈值（默认 3.5），iqr 时为围栏系数（默认 1.5）
+
+    Returns:
+        (异常行下标, 异常分数)；mad 时分数为稳健 z，iqr 时为超出围栏的 IQR 倍数（带符号）
+    """
+    if method not in ("mad", "iqr"):
+        raise ValueError(f"不支持的异常值检测方法: {method}")
+    row_count = values.size
+    group_ids, group_count = _group_ids(groups, row_count)
+    present = np.flatnonzero(~np.isnan(values))
+    if present.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    present_values = values[present]
+    present_groups = group_ids[present]
+    order = np.lexsort((present_values, present_groups))
+    sorted_values = present_values[order]
+    counts = np.bincount(present_groups, minlength=group_count)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    valid = counts >= MIN_GROUP_SIZE
+    safe_counts = np.maximum(counts, 1)
+
+    if method == "mad":
+        median = _grouped_quantile(sorted_values, starts, safe_counts, 0.5)
+        deviation = np.abs(present_values - median[present_groups])
+        sorted_deviation = deviation[np.lexsort((deviation, present_groups))]
+        mad = _grouped_quantile(sorted_deviation, starts, safe_counts, 0.5)
+        scale = mad[present_groups]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            score = 0.6745 * (present_values - median[present_groups]) / scale
+        flagged = valid[present_groups] & (scale > 0) & (np.abs(score) > (threshold or DEFAULT_Z_THRESHOLD))
+    else:
+        q1 = _grouped_quantile(sorted_values, starts, safe_counts, 0.25)
+        q3 = _grouped_quantile(sorted_values, starts, safe_counts, 0.75)
+        iqr = (q3 - q1)[present_groups]
+        factor = threshold or DEFAULT_IQR_FACTOR
+        low = q1[present_groups] - factor * iqr
+        high = q3[present_groups] + factor * iqr
+        with np.errstate(divide="ignore", invalid="ignore"):
+            score = np.where(present_values > high, (present_values - q3[present_groups]) / iqr,
+                             (present_values - q1[present_groups]) / iqr)
+        flagged = valid[present_groups] & (iqr > 0) & ((present_values < low) | (present_values > high))
+
+    return present[flagged], score[flagged]
+
+
+def _row_runs(rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """已排序的行下标合并为连续区间 (起始, 结束)"""
+    if rows.size == 0:
+        return rows, rows
+    breaks = np.flatnonzero(np.diff(rows) != 1)
+    return np.concatenate(([rows[0]], rows[breaks + 1])), np.concatenate((rows[breaks], [rows[-1]]))
+
+
+def _row_areas(rows: np.ndarray, first_row: int, start_col: int, end_col: int) -> List[str]:
+    starts, ends = _row_runs(np.sort(rows))
+    return [range_address(first_row + int(lo), start_col, first_row + int(hi), end_col) for lo, hi in zip(starts, ends)]
+
+
+def resolve_column(reference: Any, headers: Optional[Sequence[Any]], start_col: int, column_count: int) -> int:
+    """
+    把列引用解析为列序号（相对于数据区域）
+
+    依次尝试：表头名称、列字母（如 "C"）、列序号（从 0 开始的整数）
+    """
+    if headers is not None:
+        for col, header in enumerate(headers):
+            if header is not None and str(header) == str(reference):
+                return col
+    if isinstance(reference, str) and reference.isalpha():
+        col = column_index(reference) - start_col
+    elif isinstance(reference, int) or (isinstance(reference, str) and reference.isdigit()):
+        col = int(reference)
+    else:
+        col = -1
+    if not 0 <= col < column_count:
+        raise ValueError(f"找不到列: {reference}")
+    return col
+
+
+def detect_anomalies(columns: Sequence[np.ndarray], start_cell: str = "A1", has_header: Optional[bool] = None,
+                     key_columns: Optional[Sequence[Any]] = None, value_columns: Optional[Sequence[Any]] = None,
+                     group_by: Optional[Any] = None, method: str = "mad", threshold: Optional[float] = None,
+                     near_duplicates: bool = True, max_items: int = 1000) -> Dict[str, Any]:
+    """
+    检测重复行与异常值
+
+    Args:
+        columns: 范围的列数据（含表头行）
+        start_cell: 范围左上角单元格
+        has_header: 首行是否为表头，为空时自动判断
+        key_columns: 判断重复使用的列，默认全部列
+        value_columns: 检测异常值的数值列，默认全部数值列（分组列除外）
+        group_by: 分组列（如科目），异常值在组内判断
+        method: 异常值检测方法，"mad" 或 "iqr"
+        threshold: 异常值阈值，参见 find_outliers
+        near_duplicates: 是否检测近似重复
+        max_items: 明细列表的最大条数（标记区域不受此限制）
+
+    Returns:
+        检测结果: {"summary", "exact_duplicates", "near_duplicates", "outliers", "highlight"}
+        highlight 为 [(颜色, [区域地址, ...]), ...]，可直接传给 bulk_write.build_highlight
+    """
+    headers, body = split_header(columns, has_header)
+    start_row, start_col = parse_cell(start_cell)
+    first_row = start_row + (1 if headers is not None else 0)
+    column_count = len(body)
+    row_count = len(body[0]) if body else 0
+    end_col = start_col + column_count - 1
+
+    def column_name(col: int) -> str:
+        header = headers[col] if headers is not None else None
+        return str(header) if header not in (None, "") else column_letter(start_col + col)
+
+    key_indices = (
+        [resolve_column(ref, headers, start_col, column_count) for ref in key_columns]
+        if key_columns else list(range(column_count))
+    )
+    group_index = resolve_column(group_by, headers, start_col, column_count) if group_by is not None else None
+    if value_columns:
+        value_indices = [resolve_column(ref, headers, start_col, column_count) for ref in value_columns]
+    else:
+        value_indices = [col for col in range(column_count) if body[col].dtype == np.float64 and col != group_index]
+
+    # 完全重复
+    key_data = [body[col] for col in key_indices]
+    key_hashes = [column_hashes(column) for column in key_data]
+    duplicate_rows, duplicate_of = find_duplicate_rows(key_data, exact_hashes=key_hashes)
+
+    # 近似重复：规范化后相同、但不属于完全重复的行
+    near_rows = near_of = np.empty(0, dtype=np.int64)
+    if near_duplicates and row_count:
+        near_rows, near_of = find_duplicate_rows(key_data, normalize=True, exact_hashes=key_hashes)
+        keep = ~np.isin(near_rows, duplicate_rows)
+        near_rows, near_of = near_rows[keep], near_of[keep]
+
+    # 异常值
+    groups = body[group_index] if group_index is not None else None
+    outliers: List[Dict[str, Any]] = []
+    outlier_areas: List[str] = []
+    outlier_count = 0
+    for col in value_indices:
+        column = body[col]
+        if column.dtype != np.float64:
+            raise ValueError(f"列 {column_name(col)} 不是数值列")
+        rows, scores = find_outliers(column, groups, method, threshold)
+        outlier_count += rows.size
+        sheet_col = start_col + col
+        outlier_areas.extend(_row_areas(rows, first_row, sheet_col, sheet_col))
+        for row, score in zip(rows[:max(max_items - len(outliers), 0)].tolist(), scores.tolist()):
+            item = {
+                "row": first_row + row,
+                "column": sheet_col,
+                "address": range_address(first_row + row, sheet_col, first_row + row, sheet_col),
+                "column_name": column_name(col),
+                "value": float(column[row]),
+                "score": round(float(score), 3),
+            }
+            if groups is not None:
+                item["group"] = groups[row].item() if hasattr(groups[row], "item") else groups[row]
+            outliers.append(item)
+
+    def pairs(rows: np.ndarray, originals: np.ndarray) -> List[Dict[str, Any]]:
+        return [
+            {
+                "row": first_row + row,
+                "duplicate_of": first_row + original,
+                "address": range_address(first_row + row, start_col, first_row + row, end_col),
+            }
+            for row, original in zip(rows[:max_items].tolist(), originals[:max_items].tolist())
+        ]
+
+    return {
+        "summary": {
+            "row_count": row_count,
+            "exact_duplicates": int(duplicate_rows.size),
+            "near_duplicates": int(near_rows.size),
+            "outliers": outlier_count,
+            "method": method,
+            "group_by": column_name(group_index) if group_index is not None else None,
+            "value_columns": [column_name(col) for col in value_indices],
+        },
+        "exact_duplicates": pairs(duplicate_rows, duplicate_of),
+        "near_duplicates": pairs(near_rows, near_of),
+        "outliers": outliers,
+        "highlight": [
+            (DUPLICATE_COLOR, _row_areas(duplicate_rows, first_row, start_col, end_col) if column_count else []),
+            (NEAR_DUPLICATE_COLOR, _row_areas(near_rows, first_row, start_col, end_col) if column_count else []),
+            (OUTLIER_COLOR, outlier_areas),
+        ],
+    }
+
+
+def build_cleaning_operation(sheet_name: Optional[str], result: Dict[str, Any]) -> Dict[str, Any]:
+    """把检测结果转为一个批量标记底色的 Excel 操作"""
+    js_code, payload = build_highlight(sheet_name, result["highlight"])
+    summary = result["summary"]
+    return {
+        "operation_type": "data_cleaning",
+        "description": (
+            f"标记 {summary['exact_duplicates']} 行完全重复、{summary['near_duplicates']} 行近似重复、"
+            f"{summary['outliers']} 个异常值"
+        ),
+        "js_code": js_code,
+        "payload": payload,
+        "parameters": {"operation": "highlight_anomalies", "summary": summary},
+    }
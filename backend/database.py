@@ -16,6 +16,11 @@ else:
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+def init_db():
+    """建表；启动时执行一次（多 worker 部署由 serve.py 在主进程中执行）"""
+    import models  # noqa: F401  注册表结构
+    Base.metadata.create_all(bind=engine)
+
 def get_db():
     db = SessionLocal()
     try:
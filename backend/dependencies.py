@@ -1,29 +1,65 @@
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, WebSocketException, status
 from fastapi.security import OAuth2PasswordBearer
 from config import SECRET_KEY, ALGORITHM
-from jose import JWTError, jwt
 from sqlalchemy.orm import Session
-import database, crud, schemas
+from typing import Optional
+import asyncio
+from metrics import observe_stage
+import time
+import database, crud, schemas, models
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+def get_user_from_token(token: str, db: Session) -> Optional[models.User]:
+    """解析 JWT 并查询对应用户，无效时返回 None"""
+    # 延迟导入：jose 的加密后端较重，导入 main 时不加载，由预热阶段 crypto 或首次校验令牌时加载
+    from jose import JWTError, jwt
+    started = time.perf_counter()
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email = payload.get("sub")
         if email is None:
-            raise credentials_exception
+            return None
         token_data = schemas.TokenData(email=email)
     except JWTError:
-        raise credentials_exception
+        return None
+    finally:
+        observe_stage("auth", time.perf_counter() - started)
     if token_data.email is None:
-        raise credentials_exception
-    user = crud.get_user_by_email(db, email=token_data.email)
+        return None
+    started = time.perf_counter()
+    try:
+        return crud.get_user_by_email(db, email=token_data.email)
+    finally:
+        observe_stage("db", time.perf_counter() - started)
+
+def lookup_user(token: str) -> Optional[schemas.User]:
+    """
+    用独立的数据库会话校验令牌并查询用户，查询完立即归还连接
+    返回脱离会话的 schemas.User；会在线程池中调用
+    """
+    db = database.SessionLocal()
+    try:
+        user = get_user_from_token(token, db)
+        return schemas.User.model_validate(user) if user is not None else None
+    finally:
+        db.close()
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    # 数据库查询是阻塞调用，放到线程池执行；连接不会在整个请求（包括等待 LLM）期间被占用
+    user = await asyncio.to_thread(lookup_user, token)
     if user is None:
         raise credentials_exception
     return user
+
+async def get_current_user_ws(token: Optional[str] = Query(None)):
+    """WebSocket 认证：浏览器无法为 WebSocket 设置请求头，因此通过 ?token= 传递 JWT"""
+    user = await asyncio.to_thread(lookup_user, token) if token else None
+    if user is None:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Could not validate credentials")
+    return user
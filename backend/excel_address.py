@@ -0,0 +1,55 @@
+"""
+Excel 单元格地址工具
+在 A1 表示法与从 0 开始的行列下标之间转换
+"""
+
+import re
+from typing import Tuple
+
+_CELL_PATTERN = re.compile(r"^\$?([A-Za-z]{1,3})\$?(\d+)$")
+
+
+def column_letter(index: int) -> str:
+    """列下标（从 0 开始）转列字母，如 0 -> A，27 -> AB"""
+    letters = ""
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def column_index(letters: str) -> int:
+    """列字母转列下标（从 0 开始），如 A -> 0，AB -> 27"""
+    index = 0
+    for char in letters.upper():
+        index = index * 26 + (ord(char) - 64)
+    return index - 1
+
+
+def parse_cell(address: str) -> Tuple[int, int]:
+    """
+    解析单元格地址
+
+    Args:
+        address: 单元格地址，如 "B3" 或 "$B$3"
+
+    Returns:
+        (行下标, 列下标)，均从 0 开始
+    """
+    match = _CELL_PATTERN.match(address.strip())
+    if not match:
+        raise ValueError(f"无效的单元格地址: {address}")
+    return int(match.group(2)) - 1, column_index(match.group(1))
+
+
+def cell_address(row: int, col: int) -> str:
+    """行列下标（从 0 开始）转单元格地址，如 (2, 1) -> B3"""
+    return f"{column_letter(col)}{row + 1}"
+
+
+def range_address(start_row: int, start_col: int, end_row: int, end_col: int) -> str:
+    """行列下标（从 0 开始，含端点）转范围地址，如 (0, 0, 9, 1) -> A1:B10"""
+    start = cell_address(start_row, start_col)
+    end = cell_address(end_row, end_col)
+    return start if start == end else f"{start}:{end}"
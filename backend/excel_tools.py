@@ -7,6 +7,7 @@ from typing import Dict, Any, List, Optional
 from langchain.tools import BaseTool
 from pydantic import BaseModel, Field
 import json
+from bulk_write import build_chunked_write, should_chunk
 
 
 class ExcelOperation(BaseModel):
@@ -19,8 +20,8 @@ class ExcelOperation(BaseModel):
 
 class ReadRangeTool(BaseTool):
     """读取 Excel 单元格范围的工具"""
-    name = "read_range"
-    description = "读取 Excel 工作表中指定范围的单元格数据"
+    name: str = "read_range"
+    description: str = "读取 Excel 工作表中指定范围的单元格数据"
     
     def _run(self, sheet_name: str = "Sheet1", range_address: str = "A1:A10") -> str:
         """
@@ -66,18 +67,24 @@ Excel.run(async (context) => {{
 
 class WriteRangeTool(BaseTool):
     """写入 Excel 单元格范围的工具"""
-    name = "write_range"
-    description = "向 Excel 工作表中指定范围写入数据"
+    name: str = "write_range"
+    description: str = "向 Excel 工作表中指定范围写入数据"
     
     def _run(self, sheet_name: str = "Sheet1", range_address: str = "A1", 
-             values: str = "[[1]]") -> str:
+             values: str = "[[1]]", chunk_rows: int = 0, start_block: int = 0) -> str:
         """
         生成写入单元格范围的 Office.js 代码
         
+        数据量超过 BULK_WRITE_THRESHOLD_CELLS 或指定了 chunk_rows 时使用分块写入：
+        数据以紧凑载荷随操作下发（operation.payload），脚本逐块写入并提交，
+        失败时返回已提交的块号，可用 start_block 从断点续写
+        
         Args:
             sheet_name: 工作表名称
             range_address: 目标单元格范围
             values: 要写入的数据，JSON 格式的二维数组字符串
+            chunk_rows: 分块写入时每块的行数，0 表示自动
+            start_block: 分块写入时从第几块开始（续写）
         
         Returns:
             JSON 格式的操作指令
@@ -88,6 +95,27 @@ class WriteRangeTool(BaseTool):
         except:
             values_array = [[values]]
         
+        if chunk_rows or start_block or should_chunk(values_array):
+            js_code, payload = build_chunked_write(sheet_name, range_address, values_array, chunk_rows, start_block)
+            operation = ExcelOperation(
+                operation_type="write_range",
+                target=f"{sheet_name}!{range_address}",
+                parameters={
+                    "sheet_name": sheet_name,
+                    "range_address": range_address,
+                    "chunk_rows": payload["chunkRows"],
+                    "start_block": start_block,
+                    "total_blocks": len(payload["blocks"])
+                },
+                description=f"向工作表 {sheet_name} 中 {range_address} 分 {len(payload['blocks'])} 块写入数据"
+            )
+            return json.dumps({
+                "operation": operation.dict(),
+                "js_code": js_code,
+                "payload": payload,
+                "success": True
+            }, ensure_ascii=False, separators=(",", ":"))
+        
         operation = ExcelOperation(
             operation_type="write_range",
             target=f"{sheet_name}!{range_address}",
@@ -117,14 +145,14 @@ Excel.run(async (context) => {{
         }, ensure_ascii=False, indent=2)
     
     async def _arun(self, sheet_name: str = "Sheet1", range_address: str = "A1", 
-                    values: str = "[[1]]") -> str:
-        return self._run(sheet_name, range_address, values)
+                    values: str = "[[1]]", chunk_rows: int = 0, start_block: int = 0) -> str:
+        return self._run(sheet_name, range_address, values, chunk_rows, start_block)
 
 
 class FormulaGeneratorTool(BaseTool):
     """Excel 公式生成工具"""
-    name = "generate_formula"
-    description = "根据自然语言描述生成 Excel 公式"
+    name: str = "generate_formula"
+    description: str = "根据自然语言描述生成 Excel 公式"
     
     def _run(self, description: str, target_cell: str = "A1", 
              sheet_name: str = "Sheet1") -> str:
@@ -196,8 +224,8 @@ Excel.run(async (context) => {{
 
 class CreateChartTool(BaseTool):
     """创建图表工具"""
-    name = "create_chart"
-    description = "基于指定数据范围创建图表"
+    name: str = "create_chart"
+    description: str = "基于指定数据范围创建图表"
     
     def _run(self, data_range: str = "A1:B10", chart_type: str = "Column", 
              sheet_name: str = "Sheet1", chart_title: str = "图表") -> str:
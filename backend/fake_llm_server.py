@@ -0,0 +1,200 @@
+"""
+本地 LLM 桩服务（OpenAI 兼容的 /v1/chat/completions）
+压测与联调时代替 DashScope / DeepSeek，不消耗真实额度：
+- 延迟按可配置的分布抽样（fixed / uniform / lognormal / exponential），流式响应按固定间隔推送数据块
+- 可按比例注入 500 错误与 429 限流
+- 按提示词返回固定答案：公式生成、解释、优化、诊断均为后端可解析的格式，批量公式提示词返回 JSON 数组
+
+用法:
+- 进程内：LLM_PROVIDER=stub（LLMConfig 通过 ASGI transport 直接调用本模块的 app）
+- 独立进程：python fake_llm_server.py [端口]，并设置 LLM_PROVIDER=stub、LLM_STUB_URL=http://127.0.0.1:8900/v1/chat/completions
+- 运行时调整参数：POST /stub/config（字段同 StubSettings），GET /stub/stats 查看调用统计
+"""
+
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from dataclasses import asdict, dataclass, fields
+from typing import Any, Dict, List
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+@dataclass
+class StubSettings:
+    """桩服务参数（默认值可由 FAKE_LLM_* 环境变量覆盖）"""
+    latency_ms: float = 300.0          # 首字节延迟的中位数 / 均值
+    latency_dist: str = "lognormal"    # fixed | uniform | lognormal | exponential
+    latency_sigma: float = 0.5         # lognormal 的形状参数；uniform 时为相对半宽
+    chunk_ms: float = 20.0             # 流式数据块间隔
+    chunk_chars: int = 4               # 每个数据块的字符数
+    error_rate: float = 0.0            # 返回 500 的比例
+    throttle_rate: float = 0.0         # 返回 429 的比例
+    retry_after: int = 1               # 429 响应的 Retry-After（秒）
+
+    @classmethod
+    def from_env(cls) -> "StubSettings":
+        settings = cls()
+        settings.update({
+            field.name: os.environ[f"FAKE_LLM_{field.name.upper()}"]
+            for field in fields(cls) if f"FAKE_LLM_{field.name.upper()}" in os.environ
+        })
+        return settings
+
+    def update(self, values: Dict[str, Any]) -> None:
+        for field in fields(self):
+            if field.name in values:
+                setattr(self, field.name, type(getattr(self, field.name))(values[field.name]))
+
+
+settings = StubSettings.from_env()
+_rng = random.Random(os.getenv("FAKE_LLM_SEED"))
+_stats = {"requests": 0, "streams": 0, "errors": 0, "throttled": 0}
+
+# 公式生成的固定答案（按关键词匹配，先匹配先用）
+FORMULA_ANSWERS = [
+    (("平均", "average", "mean"), "=AVERAGE(A1:A10)"),
+    (("计数", "个数", "count"), "=COUNTA(A1:A10)"),
+    (("最大", "max"), "=MAX(A1:A10)"),
+    (("最小", "min"), "=MIN(A1:A10)"),
+    (("查找", "匹配", "lookup"), "=VLOOKUP(A2,Sheet2!A:B,2,FALSE)"),
+    (("条件", "if"), "=IF(A1>0,\"正数\",\"非正数\")"),
+    (("求和", "合计", "总和", "sum", "total"), "=SUM(A1:A10)"),
+]
+DEFAULT_FORMULA = "=SUM(A1:A10)"
+_BATCH_LINE = re.compile(r'^\{"id":\s*(\d+),\s*"input":')
+
+
+def sample_latency() -> float:
+    """按配置的分布抽样一次延迟（秒）"""
+    base = max(settings.latency_ms, 0.0) / 1000
+    if settings.latency_dist == "fixed" or base == 0:
+        return base
+    if settings.latency_dist == "uniform":
+        return _rng.uniform(base * (1 - settings.latency_sigma), base * (1 + settings.latency_sigma))
+    if settings.latency_dist == "exponential":
+        return _rng.expovariate(1 / base)
+    return _rng.lognormvariate(0, settings.latency_sigma) * base
+
+
+def _formula_for(text: str) -> str:
+    lowered = text.lower()
+    for keywords, formula in FORMULA_ANSWERS:
+        if any(keyword in lowered for keyword in keywords):
+            return formula
+    return DEFAULT_FORMULA
+
+
+def _batch_answer(lines: List[str]) -> str:
+    """批量公式提示词：为每个条目填写所有操作的字段，后端按操作取用"""
+    results = []
+    for line in lines:
+        item = json.loads(line)
+        formula = _formula_for(str(item.get("input", "")))
+        results.append({
+            "id": item["id"],
+            "formula": formula,
+            "explanation": f"该公式对指定区域进行计算: {item.get('input')}",
+            "suggested_formula": formula,
+            "error_type": "#VALUE!",
+            "suggested_fix": formula,
+        })
+    return json.dumps(results, ensure_ascii=False)
+
+
+def canned_answer(messages: List[Dict[str, Any]]) -> str:
+    """按最后一条用户消息生成固定答案"""
+    content = next((message.get("content") for message in reversed(messages) if message.get("role") == "user"), "")
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False)
+    lines = [line for line in content.splitlines() if _BATCH_LINE.match(line)]
+    if lines:
+        return _batch_answer(lines)
+    if content.startswith("Explain the Excel formula:"):
+        return "该公式对 A1:A10 区域求和，返回所有数值的合计。"
+    if content.startswith("Optimize the Excel formula:"):
+        formula = content.split(":", 1)[1].strip()
+        return f"Optimized Formula: {formula}\nExplanation: 公式已足够简洁，无需进一步优化。"
+    if content.startswith("Diagnose the error"):
+        formula = content.split(":", 1)[1].strip()
+        return f"Error Type: #VALUE!\nExplanation: 参数类型不匹配。\nSuggested Fix: {formula}"
+    return _formula_for(content)
+
+
+def _usage(messages: List[Dict[str, Any]], answer: str) -> Dict[str, int]:
+    prompt_chars = sum(len(str(message.get("content", ""))) for message in messages)
+    return {"prompt_tokens": prompt_chars // 2 + 1, "completion_tokens": len(answer) // 2 + 1}
+
+
+async def chat_completions(request: Request):
+    body = await request.json()
+    _stats["requests"] += 1
+    await asyncio.sleep(sample_latency())
+
+    roll = _rng.random()
+    if roll < settings.throttle_rate:
+        _stats["throttled"] += 1
+        return JSONResponse({"error": {"message": "Rate limit exceeded", "type": "rate_limit"}}, status_code=429,
+                            headers={"Retry-After": str(settings.retry_after)})
+    if roll < settings.throttle_rate + settings.error_rate:
+        _stats["errors"] += 1
+        return JSONResponse({"error": {"message": "Injected failure", "type": "server_error"}}, status_code=500)
+
+    messages = body.get("messages") or []
+    answer = canned_answer(messages)
+    created = int(time.time())
+    model = body.get("model", "stub-model")
+
+    if not body.get("stream"):
+        return JSONResponse({
+            "id": f"stub-{_stats['requests']}",
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": _usage(messages, answer),
+        })
+
+    _stats["streams"] += 1
+
+    async def events():
+        size = max(settings.chunk_chars, 1)
+        for offset in range(0, len(answer), size):
+            if offset:
+                await asyncio.sleep(settings.chunk_ms / 1000)
+            chunk = {"choices": [{"index": 0, "delta": {"content": answer[offset:offset + size]}}], "model": model}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield f"data: {json.dumps({'choices': [], 'usage': _usage(messages, answer)})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+async def update_config(request: Request):
+    settings.update(await request.json())
+    return JSONResponse(asdict(settings))
+
+
+async def get_stats(request: Request):
+    return JSONResponse({**_stats, "settings": asdict(settings)})
+
+
+app = Starlette(routes=[
+    Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+    Route("/stub/config", update_config, methods=["POST"]),
+    Route("/stub/stats", get_stats, methods=["GET"]),
+])
+
+
+if __name__ == "__main__":
+    import sys
+    import uvicorn
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8900
+    print(f"🧪 LLM 桩服务: http://127.0.0.1:{port}/v1/chat/completions")
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
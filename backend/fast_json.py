@@ -0,0 +1,76 @@
+"""
+快速 JSON 响应
+接口返回的模型由本进程构建，字段已经是正确的类型，不需要 FastAPI 再按 response_model 校验并经 jsonable_encoder 转换：
+- FastJSONResponse 直接把模型或普通对象交给 orjson 编码（未安装 orjson 时退化为标准库 json）
+- 热路径可用 model_construct 构建响应模型，连构建时的校验也省去
+- loads() 解析请求中的 JSON 文本（如 NDJSON 导入），有 orjson 时同样由 orjson 完成
+- fragment() 包装已编码的 JSON（如数据库中保存的任务结果），编码时原样拼接，不再解析和重新编码
+"""
+
+import json
+import time
+from decimal import Decimal
+from typing import Any, Union
+from pydantic import BaseModel
+from starlette.responses import JSONResponse
+from metrics import observe_stage
+
+try:
+    # 可选依赖：orjson 的编码速度为标准库 json 的数倍，并支持 Fragment 拼接
+    import orjson
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+except ImportError:
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    """orjson / json 无法直接编码的类型"""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(warnings=False)
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if hasattr(obj, "tolist"):
+        # 未启用 OPT_SERIALIZE_NUMPY 的标准库路径中的 numpy 数组与标量
+        return obj.tolist()
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    raise TypeError(f"无法编码为 JSON 的类型: {type(obj).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    """
+    编码为 JSON 字节串
+
+    模型按 Python 模式导出（不做校验，model_construct 构建的模型中的原始 dict 原样保留），再由 orjson 编码
+    """
+    if isinstance(content, BaseModel):
+        content = content.model_dump(warnings=False)
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=_ORJSON_OPTIONS)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def loads(raw: Union[bytes, str]) -> Any:
+    """解析 JSON（有 orjson 时使用 orjson），格式错误时抛出 ValueError"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def fragment(raw: Union[bytes, str]) -> Any:
+    """已编码的 JSON 片段，编码时原样拼接（没有 orjson 时解析为对象，结果相同）"""
+    if orjson is not None:
+        return orjson.Fragment(raw)
+    return json.loads(raw)
+
+
+class FastJSONResponse(JSONResponse):
+    """以 orjson 编码的 JSON 响应；接口直接返回该响应时 FastAPI 不再校验与转换返回值"""
+
+    def render(self, content: Any) -> bytes:
+        started = time.perf_counter()
+        body = dumps(content)
+        observe_stage("serialization", time.perf_counter() - started)
+        return body
@@ -0,0 +1,585 @@
+"""
+财务三大报表生成
+由凭证分录或科目余额数据计算资产负债表、利润表、现金流量表：
+- 科目按一级科目（编码前 4 位）归入报表项目，映射只对出现过的科目编码计算一次
+- 按科目编码一次 np.unique 分组，用 bincount 汇总期初、借方、贷方
+- 生成科目余额表（含报表项目列）与三张报表，报表单元格是引用科目余额表的跨表 SUMIF 公式，
+  每张工作表一次分块写入
+- 现金流量按凭证中现金类科目的净额分类：有现金流量项目列时按该列，
+  否则按同一凭证中金额最大的非现金科目判断经营 / 投资 / 筹资活动
+未结转损益的期间，本期净利润计入资产负债表的未分配利润
+"""
+
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from bulk_write import build_chunked_write
+from excel_address import column_letter
+
+TRIAL_BALANCE_SHEET = "科目余额表"
+BALANCE_SHEET = "资产负债表"
+INCOME_STATEMENT = "利润表"
+CASH_FLOW_STATEMENT = "现金流量表"
+
+# 现金及现金等价物科目
+CASH_ACCOUNTS = ("1001", "1002", "1012")
+
+# 一级科目：编码 -> (名称, 报表项目)
+DEFAULT_ACCOUNTS: Dict[str, Tuple[str, str]] = {
+    "1001": ("库存现金", "货币资金"),
+    "1002": ("银行存款", "货币资金"),
+    "1012": ("其他货币资金", "货币资金"),
+    "1101": ("交易性金融资产", "交易性金融资产"),
+    "1121": ("应收票据", "应收票据"),
+    "1122": ("应收账款", "应收账款"),
+    "1123": ("预付账款", "预付款项"),
+    "1131": ("应收股利", "其他应收款"),
+    "1132": ("应收利息", "其他应收款"),
+    "1221": ("其他应收款", "其他应收款"),
+    "1231": ("坏账准备", "应收账款"),
+    "1401": ("材料采购", "存货"),
+    "1402": ("在途物资", "存货"),
+    "1403": ("原材料", "存货"),
+    "1404": ("材料成本差异", "存货"),
+    "1405": ("库存商品", "存货"),
+    "1406": ("发出商品", "存货"),
+    "1408": ("委托加工物资", "存货"),
+    "1411": ("周转材料", "存货"),
+    "1471": ("存货跌价准备", "存货"),
+    "1511": ("长期股权投资", "长期股权投资"),
+    "1512": ("长期股权投资减值准备", "长期股权投资"),
+    "1601": ("固定资产", "固定资产"),
+    "1602": ("累计折旧", "固定资产"),
+    "1603": ("固定资产减值准备", "固定资产"),
+    "1604": ("在建工程", "在建工程"),
+    "1605": ("工程物资", "在建工程"),
+    "1606": ("固定资产清理", "固定资产"),
+    "1701": ("无形资产", "无形资产"),
+    "1702": ("累计摊销", "无形资产"),
+    "1703": ("无形资产减值准备", "无形资产"),
+    "1801": ("长期待摊费用", "长期待摊费用"),
+    "2001": ("短期借款", "短期借款"),
+    "2201": ("应付票据", "应付票据"),
+    "2202": ("应付账款", "应付账款"),
+    "2203": ("预收账款", "预收款项"),
+    "2211": ("应付职工薪酬", "应付职工薪酬"),
+    "2221": ("应交税费", "应交税费"),
+    "2231": ("应付利息", "其他应付款"),
+    "2232": ("应付股利", "其他应付款"),
+    "2241": ("其他应付款", "其他应付款"),
+    "2501": ("长期借款", "长期借款"),
+    "2502": ("应付债券", "应付债券"),
+    "4001": ("实收资本", "实收资本"),
+    "4002": ("资本公积", "资本公积"),
+    "4101": ("盈余公积", "盈余公积"),
+    "4103": ("本年利润", "未分配利润"),
+    "4104": ("利润分配", "未分配利润"),
+    "5001": ("生产成本", "存货"),
+    "5101": ("制造费用", "存货"),
+    "5201": ("劳务成本", "存货"),
+    "6001": ("主营业务收入", "营业收入"),
+    "6051": ("其他业务收入", "营业收入"),
+    "6101": ("公允价值变动损益", "公允价值变动收益"),
+    "6111": ("投资收益", "投资收益"),
+    "6117": ("其他收益", "其他收益"),
+    "6301": ("营业外收入", "营业外收入"),
+    "6401": ("主营业务成本", "营业成本"),
+    "6402": ("其他业务成本", "营业成本"),
+    "6403": ("税金及附加", "税金及附加"),
+    "6601": ("销售费用", "销售费用"),
+    "6602": ("管理费用", "管理费用"),
+    "6603": ("财务费用", "财务费用"),
+    "6701": ("资产减值损失", "资产减值损失"),
+    "6711": ("营业外支出", "营业外支出"),
+    "6801": ("所得税费用", "所得税费用"),
+}
+
+# 未登记的一级科目按编码首位归入的报表项目
+FALLBACK_LINES = {
+    "1": "其他流动资产",
+    "2": "其他流动负债",
+    "3": "其他流动资产",
+    "4": "其他权益",
+    "5": "存货",
+    "6": "其他收益",
+}
+
+# 现金流量的活动分类：对方科目的一级编码 -> 活动
+INVESTING_PREFIXES = ("1101", "15", "16", "17", "6111")
+FINANCING_PREFIXES = ("2001", "2231", "2232", "25", "4001", "4002", "4104", "6603")
+ACTIVITIES = ("经营", "投资", "筹资")
+
+# 资产负债表：(分组, 符号, 项目, 小计名称)；(合计名称, 组成项目)
+BALANCE_SHEET_LAYOUT = [
+    ("流动资产", 1, ["货币资金", "交易性金融资产", "应收票据", "应收账款", "预付款项", "其他应收款", "存货", "其他流动资产"], "流动资产合计"),
+    ("非流动资产", 1, ["长期股权投资", "固定资产", "在建工程", "无形资产", "长期待摊费用", "其他非流动资产"], "非流动资产合计"),
+    ("资产总计", ["流动资产合计", "非流动资产合计"]),
+    ("流动负债", -1, ["短期借款", "应付票据", "应付账款", "预收款项", "应付职工薪酬", "应交税费", "其他应付款", "其他流动负债"], "流动负债合计"),
+    ("非流动负债", -1, ["长期借款", "应付债券", "其他非流动负债"], "非流动负债合计"),
+    ("负债合计", ["流动负债合计", "非流动负债合计"]),
+    ("所有者权益", -1, ["实收资本", "资本公积", "盈余公积", "未分配利润", "其他权益"], "所有者权益合计"),
+    ("负债和所有者权益总计", ["负债合计", "所有者权益合计"]),
+]
+
+# 利润表：(项目, 符号)，收入类取贷方净额（符号 -1），费用类取借方净额；计算行为 (项目, [(项目, 系数), ...])
+INCOME_STATEMENT_LAYOUT = [
+    ("营业收入", -1),
+    ("营业成本", 1),
+    ("税金及附加", 1),
+    ("销售费用", 1),
+    ("管理费用", 1),
+    ("财务费用", 1),
+    ("其他收益", -1),
+    ("投资收益", -1),
+    ("公允价值变动收益", -1),
+    ("资产减值损失", 1),
+    ("营业利润", [("营业收入", 1), ("营业成本", -1), ("税金及附加", -1), ("销售费用", -1), ("管理费用", -1),
+              ("财务费用", -1), ("其他收益", 1), ("投资收益", 1), ("公允价值变动收益", 1), ("资产减值损失", -1)]),
+    ("营业外收入", -1),
+    ("营业外支出", 1),
+    ("利润总额", [("营业利润", 1), ("营业外收入", 1), ("营业外支出", -1)]),
+    ("所得税费用", 1),
+    ("净利润", [("利润总额", 1), ("所得税费用", -1)]),
+]
+
+# 输入列的常见表头
+COLUMN_ALIASES = {
+    "account_code": ("科目编码", "科目代码", "科目号", "会计科目编码", "account_code", "account"),
+    "account_name": ("科目名称", "会计科目", "account_name"),
+    "debit": ("借方", "借方金额", "本期借方", "debit"),
+    "credit": ("贷方", "贷方金额", "本期贷方", "credit"),
+    "opening": ("期初余额", "期初", "年初余额", "opening", "opening_balance"),
+    "voucher_id": ("凭证号", "凭证编号", "凭证字号", "voucher", "voucher_id"),
+    "cash_flow_item": ("现金流量项目", "现金流量", "cash_flow_item"),
+}
+
+
+def detect_columns(headers: Sequence[Any]) -> Dict[str, int]:
+    """按表头识别输入列，返回 {字段: 列序号}；至少需要科目编码、借方、贷方"""
+    mapping: Dict[str, int] = {}
+    normalized = [str(header).strip() if header is not None else "" for header in headers]
+    for field, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in normalized:
+                mapping[field] = normalized.index(alias)
+                break
+    return mapping
+
+
+def normalize_codes(column: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    科目编码分组：一次 np.unique 得到不同的编码与每行的分组下标
+
+    Returns:
+        (科目编码字符串数组, 每行对应的下标)
+    """
+    if column.dtype == np.float64:
+        codes, inverse = np.unique(np.nan_to_num(column, nan=-1).astype(np.int64), return_inverse=True)
+        return np.array(["" if code < 0 else str(code) for code in codes.tolist()], dtype=object), inverse
+    text = np.array(["" if value is None else str(value).strip() for value in column.tolist()], dtype=str)
+    codes, inverse = np.unique(text, return_inverse=True)
+    return codes.astype(object), inverse
+
+
+def _amounts(column: Optional[np.ndarray], row_count: int) -> np.ndarray:
+    """金额列转为 float64，空值与无法解析的文本按 0 处理"""
+    if column is None:
+        return np.zeros(row_count)
+    if column.dtype != np.float64:
+        column = np.array([
+            value if isinstance(value, (int, float)) and not isinstance(value, bool)
+            else _parse_amount(value) for value in column.tolist()
+        ], dtype=np.float64)
+    return np.nan_to_num(column, nan=0.0)
+
+
+_AMOUNT_PATTERN = re.compile(r"[,\s￥¥]")
+
+
+def _parse_amount(value: Any) -> float:
+    if value is None:
+        return 0.0
+    try:
+        return float(_AMOUNT_PATTERN.sub("", str(value)) or 0)
+    except ValueError:
+        return 0.0
+
+
+class ChartOfAccounts:
+    """
+    科目表索引
+
+    预先把一级科目映射为报表项目；明细科目按编码前 4 位归入一级科目，
+    未登记的一级科目按编码首位归入 FALLBACK_LINES
+    """
+
+    def __init__(self, accounts: Optional[Dict[str, Tuple[str, str]]] = None, top_level_length: int = 4):
+        self.accounts = dict(accounts or DEFAULT_ACCOUNTS)
+        self.top_level_length = top_level_length
+
+    def top_level(self, code: str) -> str:
+        return code[:self.top_level_length]
+
+    def line_item(self, code: str) -> str:
+        account = self.accounts.get(self.top_level(code))
+        if account is not None:
+            return account[1]
+        return FALLBACK_LINES.get(code[:1], "其他流动资产")
+
+    def name(self, code: str) -> str:
+        account = self.accounts.get(code) or self.accounts.get(self.top_level(code))
+        return account[0] if account else ""
+
+    def activity(self, code: str) -> int:
+        """对方科目对应的现金流量活动：0 经营、1 投资、2 筹资"""
+        top = self.top_level(code)
+        if top.startswith(INVESTING_PREFIXES):
+            return 1
+        if top.startswith(FINANCING_PREFIXES):
+            return 2
+        return 0
+
+    def is_cash(self, code: str) -> bool:
+        return self.top_level(code) in CASH_ACCOUNTS
+
+
+def _activity_from_text(value: Any) -> int:
+    text = "" if value is None else str(value)
+    for index, keyword in enumerate(ACTIVITIES):
+        if keyword in text:
+            return index
+    return 0
+
+
+def classify_cash_flows(code_index: np.ndarray, net: np.ndarray, cash_codes: np.ndarray, code_activity: np.ndarray,
+                        voucher_ids: Optional[np.ndarray] = None, cash_flow_items: Optional[np.ndarray] = None) -> Dict[str, Any]:
+    """
+    现金流量分类
+
+    Args:
+        code_index: 每行的科目分组下标
+        net: 每行的借方减贷方
+        cash_codes: 每个科目分组是否为现金科目
+        code_activity: 每个科目分组作为对方科目时的活动
+        voucher_ids: 凭证号列
+        cash_flow_items: 现金流量项目列（优先使用）
+
+    Returns:
+        {"inflow": [经营, 投资, 筹资], "outflow": [...], "method": "..."}
+    """
+    is_cash = cash_codes[code_index]
+    inflow = np.zeros(3)
+    outflow = np.zeros(3)
+
+    if cash_flow_items is not None:
+        # 按现金流量项目列逐行分类，只看现金科目行
+        activity = np.fromiter(map(_activity_from_text, cash_flow_items[is_cash].tolist()), dtype=np.int64)
+        cash_net = net[is_cash]
+        inflow += np.bincount(activity, weights=np.maximum(cash_net, 0), minlength=3)
+        outflow += np.bincount(activity, weights=np.maximum(-cash_net, 0), minlength=3)
+        return {"inflow": inflow.tolist(), "outflow": outflow.tolist(), "method": "cash_flow_item"}
+
+    if voucher_ids is None:
+        cash_net = net[is_cash]
+        inflow[0] = np.maximum(cash_net, 0).sum()
+        outflow[0] = np.maximum(-cash_net, 0).sum()
+        return {"inflow": inflow.tolist(), "outflow": outflow.tolist(), "method": "operating_only"}
+
+    # 凭证分组：现金科目净额按凭证汇总，活动取凭证中金额最大的非现金科目
+    if voucher_ids.dtype == np.float64:
+        _, voucher_index = np.unique(voucher_ids, return_inverse=True)
+    else:
+        _, voucher_index = np.unique(np.array(["" if v is None else str(v) for v in voucher_ids.tolist()], dtype=str),
+                                     return_inverse=True)
+    voucher_count = int(voucher_index.max()) + 1 if voucher_index.size else 0
+    voucher_cash = np.bincount(voucher_index[is_cash], weights=net[is_cash], minlength=voucher_count)
+
+    other = np.flatnonzero(~is_cash)
+    voucher_activity = np.zeros(voucher_count, dtype=np.int64)
+    if other.size:
+        order = other[np.lexsort((-np.abs(net[other]), voucher_index[other]))]
+        vouchers, first = np.unique(voucher_index[order], return_index=True)
+        voucher_activity[vouchers] = code_activity[code_index[order[first]]]
+
+    inflow += np.bincount(voucher_activity, weights=np.maximum(voucher_cash, 0), minlength=3)
+    outflow += np.bincount(voucher_activity, weights=np.maximum(-voucher_cash, 0), minlength=3)
+    return {"inflow": inflow.tolist(), "outflow": outflow.tolist(), "method": "counterpart_account"}
+
+
+def aggregate_trial_balance(codes: np.ndarray, debit: np.ndarray, credit: np.ndarray, opening: Optional[np.ndarray] = None,
+                            names: Optional[np.ndarray] = None, voucher_ids: Optional[np.ndarray] = None,
+                            cash_flow_items: Optional[np.ndarray] = None,
+                            chart: Optional[ChartOfAccounts] = None) -> Dict[str, Any]:
+    """
+    按科目一次分组汇总
+
+    Args:
+        codes: 科目编码列
+        debit / credit: 借方 / 贷方金额列
+        opening: 期初余额列（借方为正），科目余额表输入时使用
+        names: 科目名称列（可选，缺省时取科目表中的名称）
+        voucher_ids: 凭证号列（可选，用于现金流量分类）
+        cash_flow_items: 现金流量项目列（可选）
+        chart: 科目表索引
+
+    Returns:
+        {"codes", "names", "lines", "opening", "debit", "credit", "cash_flow", "line_count"}
+    """
+    chart = chart or ChartOfAccounts()
+    row_count = len(codes)
+    account_codes, code_index = normalize_codes(codes)
+    debit = _amounts(debit, row_count)
+    credit = _amounts(credit, row_count)
+    opening = _amounts(opening, row_count)
+    group_count = len(account_codes)
+
+    totals_debit = np.bincount(code_index, weights=debit, minlength=group_count)
+    totals_credit = np.bincount(code_index, weights=credit, minlength=group_count)
+    totals_opening = np.bincount(code_index, weights=opening, minlength=group_count)
+
+    # 科目表映射只对不同的科目编码计算一次
+    code_list = account_codes.tolist()
+    lines = [chart.line_item(code) for code in code_list]
+    if names is not None:
+        first_row = np.zeros(group_count, dtype=np.int64)
+        first_row[code_index[::-1]] = np.arange(row_count)[::-1]
+        given = names[first_row].tolist()
+        account_names = [str(name) if name not in (None, "") else chart.name(code) for name, code in zip(given, code_list)]
+    else:
+        account_names = [chart.name(code) for code in code_list]
+
+    cash_codes = np.array([chart.is_cash(code) for code in code_list], dtype=bool)
+    code_activity = np.array([chart.activity(code) for code in code_list], dtype=np.int64)
+    cash_flow = classify_cash_flows(code_index, debit - credit, cash_codes, code_activity, voucher_ids, cash_flow_items)
+    cash_opening = float(totals_opening[cash_codes].sum())
+
+    keep = np.array([code != "" for code in code_list], dtype=bool)
+    return {
+        "codes": [code for code, kept in zip(code_list, keep) if kept],
+        "names": [name for name, kept in zip(account_names, keep) if kept],
+        "lines": [line for line, kept in zip(lines, keep) if kept],
+        "opening": totals_opening[keep],
+        "debit": totals_debit[keep],
+        "credit": totals_credit[keep],
+        "cash_flow": cash_flow,
+        "cash_opening": cash_opening,
+        "line_count": row_count,
+    }
+
+
+def _sumif(line: str, value_column: str, last_row: int, sign: int) -> str:
+    criteria = f"'{TRIAL_BALANCE_SHEET}'!$D$2:$D${last_row}"
+    values = f"'{TRIAL_BALANCE_SHEET}'!${value_column}$2:${value_column}${last_row}"
+    formula = f'SUMIF({criteria},"{line}",{values})'
+    return f"=-{formula}" if sign < 0 else f"={formula}"
+
+
+def build_trial_balance_rows(balance: Dict[str, Any]) -> List[List[Any]]:
+    """
+    科目余额表（含表头与合计行），公式为 R1C1 形式，整列相同、便于字典编码
+
+    列: 科目编码 | 科目名称 | 一级科目 | 报表项目 | 期初余额 | 本期借方 | 本期贷方 | 期末余额 | 本期净额
+    金额以借方为正
+    """
+    rows: List[List[Any]] = [["科目编码", "科目名称", "一级科目", "报表项目", "期初余额", "本期借方", "本期贷方", "期末余额", "本期净额"]]
+    for code, name, line, opening, debit, credit in zip(
+        balance["codes"], balance["names"], balance["lines"],
+        balance["opening"].tolist(), balance["debit"].tolist(), balance["credit"].tolist(),
+    ):
+        rows.append([code, name, code[:4], line, round(opening, 2), round(debit, 2), round(credit, 2),
+                     "=RC[-3]+RC[-2]-RC[-1]", "=RC[-3]-RC[-2]"])
+    rows.append(["合计", "", "", ""] + ["=SUM(R2C:R[-1]C)"] * 5)
+    return rows
+
+
+def build_statement_rows(balance: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    生成三张报表的行（A1 公式）并在服务端计算对应数值
+
+    Returns:
+        {"balance_sheet": {"rows", "values"}, "income_statement": {...}, "cash_flow": {...}, "check": {...}}
+    """
+    last_row = len(balance["codes"]) + 1
+    closing = balance["opening"] + balance["debit"] - balance["credit"]
+    activity = balance["debit"] - balance["credit"]
+    line_keys = np.array(balance["lines"], dtype=object)
+
+    def line_total(values: np.ndarray, line: str) -> float:
+        return float(values[line_keys == line].sum()) if len(line_keys) else 0.0
+
+    # 利润表
+    income_rows: List[List[Any]] = [[INCOME_STATEMENT, ""], ["项目", "本期金额"]]
+    income_cells: Dict[str, str] = {}
+    income_values: Dict[str, float] = {}
+    for name, spec in INCOME_STATEMENT_LAYOUT:
+        row_number = len(income_rows) + 1
+        income_cells[name] = f"B{row_number}"
+        if isinstance(spec, int):
+            formula = _sumif(name, "I", last_row, spec)
+            income_values[name] = spec * line_total(activity, name)
+        else:
+            formula = "=" + "".join(
+                f"{'+' if coefficient > 0 else '-'}{income_cells[part]}" for part, coefficient in spec
+            ).lstrip("+")
+            income_values[name] = sum(coefficient * income_values[part] for part, coefficient in spec)
+        income_rows.append([name, formula])
+    net_profit_ref = f"'{INCOME_STATEMENT}'!{income_cells['净利润']}"
+
+    # 资产负债表
+    balance_rows: List[List[Any]] = [[BALANCE_SHEET, "", ""], ["项目", "期末余额", "年初余额"]]
+    balance_cells: Dict[str, int] = {}
+    closing_values: Dict[str, float] = {}
+    opening_values: Dict[str, float] = {}
+    for entry in BALANCE_SHEET_LAYOUT:
+        if len(entry) == 4:
+            group, sign, items, subtotal = entry
+            balance_rows.append([group + "：", "", ""])
+            first = len(balance_rows) + 1
+            for item in items:
+                row_number = len(balance_rows) + 1
+                balance_cells[item] = row_number
+                closing_formula = _sumif(item, "H", last_row, sign)
+                closing_values[item] = sign * line_total(closing, item)
+                opening_values[item] = sign * line_total(balance["opening"], item)
+                if item == "未分配利润":
+                    # 未结转的本期净利润
+                    closing_formula += f"+{net_profit_ref}"
+                    closing_values[item] += income_values["净利润"]
+                balance_rows.append(["  " + item, closing_formula, _sumif(item, "E", last_row, sign)])
+            last = len(balance_rows)
+            balance_cells[subtotal] = last + 1
+            closing_values[subtotal] = sum(closing_values[item] for item in items)
+            opening_values[subtotal] = sum(opening_values[item] for item in items)
+            balance_rows.append([subtotal, f"=SUM(B{first}:B{last})", f"=SUM(C{first}:C{last})"])
+        else:
+            total, parts = entry
+            row_number = len(balance_rows) + 1
+            balance_cells[total] = row_number
+            closing_values[total] = sum(closing_values[part] for part in parts)
+            opening_values[total] = sum(opening_values[part] for part in parts)
+            balance_rows.append([
+                total,
+                "=" + "+".join(f"B{balance_cells[part]}" for part in parts),
+                "=" + "+".join(f"C{balance_cells[part]}" for part in parts),
+            ])
+    check_row = len(balance_rows) + 1
+    balance_rows.append([
+        "平衡校验（资产 - 负债和所有者权益）",
+        f"=B{balance_cells['资产总计']}-B{balance_cells['负债和所有者权益总计']}",
+        f"=C{balance_cells['资产总计']}-C{balance_cells['负债和所有者权益总计']}",
+    ])
+    cash_row = balance_cells["货币资金"]
+
+    # 现金流量表
+    cash_flow = balance["cash_flow"]
+    cash_rows: List[List[Any]] = [[CASH_FLOW_STATEMENT, ""], ["项目", "本期金额"]]
+    cash_values: Dict[str, float] = {}
+    net_cells = []
+    for index, activity_name in enumerate(ACTIVITIES):
+        inflow_row = len(cash_rows) + 1
+        cash_rows.append([f"{activity_name}活动现金流入小计", round(cash_flow["inflow"][index], 2)])
+        cash_rows.append([f"{activity_name}活动现金流出小计", round(cash_flow["outflow"][index], 2)])
+        cash_rows.append([f"{activity_name}活动产生的现金流量净额", f"=B{inflow_row}-B{inflow_row + 1}"])
+        cash_values[f"{activity_name}活动产生的现金流量净额"] = cash_flow["inflow"][index] - cash_flow["outflow"][index]
+        net_cells.append(f"B{inflow_row + 2}")
+    increase_row = len(cash_rows) + 1
+    cash_rows.append(["现金及现金等价物净增加额", "=" + "+".join(net_cells)])
+    cash_rows.append(["期初现金及现金等价物余额", f"='{BALANCE_SHEET}'!C{cash_row}"])
+    cash_rows.append(["期末现金及现金等价物余额", f"=B{increase_row}+B{increase_row + 1}"])
+    cash_rows.append(["与资产负债表货币资金差额", f"=B{increase_row + 2}-'{BALANCE_SHEET}'!B{cash_row}"])
+    cash_values["现金及现金等价物净增加额"] = sum(cash_flow["inflow"]) - sum(cash_flow["outflow"])
+    cash_values["期初现金及现金等价物余额"] = opening_values["货币资金"]
+    cash_values["期末现金及现金等价物余额"] = cash_values["现金及现金等价物净增加额"] + opening_values["货币资金"]
+
+    return {
+        "balance_sheet": {"rows": balance_rows, "values": {"closing": closing_values, "opening": opening_values}},
+        "income_statement": {"rows": income_rows, "values": income_values},
+        "cash_flow": {"rows": cash_rows, "values": cash_values, "method": cash_flow["method"]},
+        "check": {
+            "balance_difference": round(closing_values["资产总计"] - closing_values["负债和所有者权益总计"], 2) + 0.0,
+            "cash_difference": round(cash_values["期末现金及现金等价物余额"] - closing_values["货币资金"], 2) + 0.0,
+            "balance_check_cell": f"'{BALANCE_SHEET}'!B{check_row}",
+        },
+    }
+
+
+def _rounded(values: Dict[str, float]) -> Dict[str, float]:
+    return {name: round(value, 2) + 0.0 for name, value in values.items()}
+
+
+def _write_operation(sheet_name: str, rows: List[List[Any]], write_property: str, description: str) -> Dict[str, Any]:
+    js_code, payload = build_chunked_write(sheet_name, "A1", rows, write_property=write_property, create_sheet=True)
+    end = f"{column_letter(max(len(row) for row in rows) - 1)}{len(rows)}"
+    return {
+        "operation_type": "financial_reports",
+        "description": description,
+        "js_code": js_code,
+        "payload": payload,
+        "parameters": {"sheet_name": sheet_name, "range": f"A1:{end}", "total_blocks": len(payload["blocks"])},
+    }
+
+
+def build_financial_statements(codes: np.ndarray, debit: np.ndarray, credit: np.ndarray, opening: Optional[np.ndarray] = None,
+                               names: Optional[np.ndarray] = None, voucher_ids: Optional[np.ndarray] = None,
+                               cash_flow_items: Optional[np.ndarray] = None,
+                               chart: Optional[ChartOfAccounts] = None) -> Dict[str, Any]:
+    """
+    由凭证分录或科目余额数据生成三大报表
+
+    参数见 aggregate_trial_balance
+
+    Returns:
+        {"summary", "statements": {...数值...}, "check", "operations": [科目余额表, 资产负债表, 利润表, 现金流量表]}
+        operations 需按顺序执行：报表公式引用科目余额表
+    """
+    balance = aggregate_trial_balance(codes, debit, credit, opening, names, voucher_ids, cash_flow_items, chart)
+    statements = build_statement_rows(balance)
+    trial_rows = build_trial_balance_rows(balance)
+
+    operations = [
+        _write_operation(TRIAL_BALANCE_SHEET, trial_rows, "formulasR1C1", f"生成科目余额表（{len(balance['codes'])} 个科目）"),
+        _write_operation(BALANCE_SHEET, statements["balance_sheet"]["rows"], "formulas", "生成资产负债表"),
+        _write_operation(INCOME_STATEMENT, statements["income_statement"]["rows"], "formulas", "生成利润表"),
+        _write_operation(CASH_FLOW_STATEMENT, statements["cash_flow"]["rows"], "formulas", "生成现金流量表"),
+    ]
+    return {
+        "summary": {
+            "line_count": balance["line_count"],
+            "account_count": len(balance["codes"]),
+            "debit_total": round(float(balance["debit"].sum()), 2),
+            "credit_total": round(float(balance["credit"].sum()), 2),
+            "cash_flow_method": statements["cash_flow"]["method"],
+        },
+        "statements": {
+            "balance_sheet": {
+                "closing": _rounded(statements["balance_sheet"]["values"]["closing"]),
+                "opening": _rounded(statements["balance_sheet"]["values"]["opening"]),
+            },
+            "income_statement": _rounded(statements["income_statement"]["values"]),
+            "cash_flow": _rounded(statements["cash_flow"]["values"]),
+        },
+        "check": statements["check"],
+        "operations": operations,
+    }
+
+
+def build_from_columns(headers: Sequence[Any], body: Sequence[np.ndarray], mapping: Optional[Dict[str, int]] = None,
+                       chart: Optional[ChartOfAccounts] = None) -> Dict[str, Any]:
+    """
+    由带表头的列数据生成三大报表，列按表头自动识别（可用 mapping 覆盖）
+
+    缺少科目编码、借方或贷方列时抛出 ValueError
+    """
+    mapping = {**detect_columns(headers), **(mapping or {})}
+    missing = [field for field in ("account_code", "debit", "credit") if field not in mapping]
+    if missing:
+        raise ValueError(f"无法识别必需的列: {', '.join(missing)}")
+
+    def column(field: str) -> Optional[np.ndarray]:
+        return body[mapping[field]] if field in mapping else None
+
+    return build_financial_statements(
+        column("account_code"), column("debit"), column("credit"),
+        opening=column("opening"), names=column("account_name"),
+        voucher_ids=column("voucher_id"), cash_flow_items=column("cash_flow_item"), chart=chart,
+    )
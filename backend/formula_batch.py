@@ -0,0 +1,383 @@
+"""
+公式批量处理
+对一批公式（或公式需求描述）执行生成 / 解释 / 优化 / 诊断：
+1. 规范化后去重，相同公式只处理一次
+2. 先查本地结果缓存，再尝试本地规则（括号不匹配、简单聚合函数、连续单元格相加等）
+3. 剩余条目按批打包为多条目提示词，在有限并发下调用 LLM
+4. 结果按完成顺序产出，供接口以 NDJSON 流式返回
+"""
+
+import asyncio
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from excel_address import column_index, column_letter
+from llm_config import call_llm, check_llm_config, get_llm_config
+from metrics import LLM_RETRIES, record_cache, record_llm_queue_wait
+from prompts import get_prompt
+
+# 支持的操作及其结果字段（与单条接口的响应字段一致）
+OPERATIONS: Dict[str, Tuple[str, ...]] = {
+    "generate": ("formula",),
+    "explain": ("explanation",),
+    "optimize": ("suggested_formula", "explanation"),
+    "diagnose": ("error_type", "explanation", "suggested_fix"),
+}
+
+# 每个 LLM 请求包含的条目数、同时进行的 LLM 请求数、单批最多条目数
+DEFAULT_BATCH_SIZE = int(os.getenv("FORMULA_BATCH_SIZE", "20"))
+LLM_CONCURRENCY = int(os.getenv("FORMULA_BATCH_CONCURRENCY", "4"))
+MAX_BATCH_ITEMS = int(os.getenv("FORMULA_BATCH_MAX_ITEMS", "5000"))
+# 每个条目预留的输出 token 数
+_TOKENS_PER_ITEM = {"generate": 80, "explain": 160, "optimize": 200, "diagnose": 200}
+
+_STRING_LITERAL = re.compile(r'("(?:[^"]|"")*")')
+# 空白已合并为单个空格后，运算符两侧最多各有一个空格
+_OPERATOR_SPACES = re.compile(r" ?([,()+\-*/&=<>^:;]) ?")
+# 交集运算符（空格）两侧：左侧为引用或右括号，右侧为引用或左括号
+_REFERENCE_END = re.compile(r"[\w$.')\]]")
+_REFERENCE_START = re.compile(r"[\w$'(]")
+_SIMPLE_AGGREGATE = re.compile(r"^=(SUM|AVERAGE|COUNT|COUNTA|MAX|MIN|PRODUCT)\(([A-Z0-9$:!,]+)\)$")
+_SINGLE_REFERENCE = re.compile(r"^=\$?([A-Z]{1,3})\$?(\d+)$")
+_CELL = re.compile(r"^\$?([A-Z]{1,3})\$?(\d+)$")
+
+_AGGREGATE_DESCRIPTIONS = {
+    "SUM": "数值之和",
+    "AVERAGE": "数值的平均值",
+    "COUNT": "包含数字的单元格个数",
+    "COUNTA": "非空单元格个数",
+    "MAX": "最大值",
+    "MIN": "最小值",
+    "PRODUCT": "数值的乘积",
+}
+
+
+def _strip_operator_space(match: "re.Match") -> str:
+    """去掉运算符两侧的空格，但保留括号外侧作为交集运算符的空格，如 SUM(A1:A3) SUM(B1:B3)、A1:C3 (B2:B4)"""
+    text, operator = match.string, match.group(1)
+    start, end = match.start(), match.end()
+    leading = (operator == "(" and text[start] == " " and start > 0
+               and _REFERENCE_END.match(text[start - 1]) is not None)
+    trailing = (operator == ")" and text[end - 1] == " " and end < len(text)
+                and _REFERENCE_START.match(text[end]) is not None)
+    return (" " if leading else "") + operator + (" " if trailing else "")
+
+
+def normalize_formula(formula: str) -> str:
+    """
+    规范化公式用于去重和缓存：补齐前导 "="，字符串字面量之外统一大写、
+    去掉运算符两侧空白并把其余连续空白合并为一个（空格在 Excel 中是交集运算符，不能全部删除）
+    """
+    text = unicodedata.normalize("NFKC", formula.strip())
+    if not text.startswith("="):
+        text = "=" + text
+    parts = _STRING_LITERAL.split(text)
+    for i in range(0, len(parts), 2):
+        parts[i] = _OPERATOR_SPACES.sub(_strip_operator_space, " ".join(parts[i].split())).upper()
+    return "".join(parts)
+
+
+def normalize_request_text(text: str) -> str:
+    """规范化公式需求描述：NFKC、合并空白、忽略大小写"""
+    return " ".join(unicodedata.normalize("NFKC", text).split()).casefold()
+
+
+def _outside_strings(formula: str) -> str:
+    """去掉字符串字面量后的公式文本"""
+    return _STRING_LITERAL.sub('""', formula)
+
+
+def _diagnose_rule(formula: str, original: str) -> Optional[Dict[str, str]]:
+    """可在本地确定的错误：引号、括号不匹配与 #REF! 引用；修正建议基于原始公式，保留其大小写"""
+    original = original if original.startswith("=") else "=" + original
+    if formula.count('"') % 2:
+        return {
+            "error_type": "语法错误",
+            "explanation": "字符串缺少结束引号",
+            "suggested_fix": original + '"',
+        }
+    code = _outside_strings(formula)
+    opened, closed = code.count("("), code.count(")")
+    if opened != closed:
+        return {
+            "error_type": "语法错误",
+            "explanation": f"括号不匹配：左括号 {opened} 个，右括号 {closed} 个",
+            "suggested_fix": original + ")" * (opened - closed) if opened > closed else "删除多余的右括号",
+        }
+    if "#REF!" in code:
+        return {
+            "error_type": "#REF!",
+            "explanation": "公式引用的单元格已被删除或移动，引用变为 #REF!",
+            "suggested_fix": "将公式中的 #REF! 替换为正确的单元格或区域引用",
+        }
+    return None
+
+
+def _explain_rule(formula: str, original: str) -> Optional[Dict[str, str]]:
+    """单一聚合函数或单元格引用的解释"""
+    match = _SIMPLE_AGGREGATE.match(formula)
+    if match:
+        function, arguments = match.groups()
+        return {"explanation": f"计算 {arguments.replace(',', '、')} 中{_AGGREGATE_DESCRIPTIONS[function]}（{function} 函数）"}
+    match = _SINGLE_REFERENCE.match(formula)
+    if match:
+        return {"explanation": f"引用单元格 {formula[1:]} 的值"}
+    return None
+
+
+def _optimize_rule(formula: str, original: str) -> Optional[Dict[str, str]]:
+    """三个及以上同列（或同行）连续单元格逐个相加，改写为 SUM 区域"""
+    terms = formula[1:].split("+")
+    if len(terms) < 3:
+        return None
+    cells = []
+    for term in terms:
+        match = _CELL.match(term)
+        if not match:
+            return None
+        cells.append((column_index(match.group(1)), int(match.group(2))))
+    first, last = cells[0], cells[-1]
+    same_column = all(col == first[0] and row == first[1] + i for i, (col, row) in enumerate(cells))
+    same_row = all(row == first[1] and col == first[0] + i for i, (col, row) in enumerate(cells))
+    if not same_column and not same_row:
+        return None
+    start = f"{column_letter(first[0])}{first[1]}"
+    end = f"{column_letter(last[0])}{last[1]}"
+    return {
+        "suggested_formula": f"=SUM({start}:{end})",
+        "explanation": "将逐个相加的连续单元格改写为 SUM 区域求和，公式更短，中间插入行列后也会自动包含",
+    }
+
+
+_RULES = {
+    "explain": _explain_rule,
+    "optimize": _optimize_rule,
+    "diagnose": _diagnose_rule,
+}
+
+
+def apply_rules(operation: str, normalized: str, original: str) -> Optional[Dict[str, str]]:
+    """对规范化后的公式尝试本地规则，无法确定时返回 None"""
+    rule = _RULES.get(operation)
+    return rule(normalized, original) if rule else None
+
+
+class FormulaResultCache:
+    """
+    公式处理结果的 LRU 缓存
+    键包含提示词哈希，提示词改动后旧结果自动失效
+    """
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self.max_entries = max_entries or int(os.getenv("FORMULA_CACHE_SIZE", "4096"))
+        self._entries: "OrderedDict[Tuple[str, str, str], Dict[str, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[str, str, str]) -> Optional[Dict[str, str]]:
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+            record_cache("formula_result", False)
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        record_cache("formula_result", True)
+        return result
+
+    def put(self, key: Tuple[str, str, str], result: Dict[str, str]) -> None:
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+# 全局结果缓存与 LLM 并发限制
+formula_cache = FormulaResultCache()
+_llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+
+def get_formula_cache() -> FormulaResultCache:
+    """获取全局公式结果缓存"""
+    return formula_cache
+
+
+def parse_batch_response(content: str) -> List[Dict[str, Any]]:
+    """从 LLM 回复中取出 JSON 数组（允许包裹在代码块或说明文字中）"""
+    start, end = content.find("["), content.rfind("]")
+    if start < 0 or end <= start:
+        raise ValueError("LLM 未返回 JSON 数组")
+    items = json.loads(content[start:end + 1])
+    if not isinstance(items, list):
+        raise ValueError("LLM 未返回 JSON 数组")
+    return [item for item in items if isinstance(item, dict)]
+
+
+def _validate_result(operation: str, result: Dict[str, Any]) -> Optional[Dict[str, str]]:
+    """取出单条结果的字段，字段缺失或生成失败时返回 None"""
+    fields = OPERATIONS[operation]
+    values = {field: str(result.get(field) or "").strip() for field in fields}
+    if not all(values.values()):
+        return None
+    if operation == "generate" and values["formula"].lower().startswith("error:"):
+        return None
+    return values
+
+
+async def _call_batch(operation: str, items: List[Tuple[str, str]]) -> Dict[str, Dict[str, str]]:
+    """
+    用一个多条目提示词处理一批条目
+
+    Args:
+        operation: 操作名
+        items: [(规范化键, 原始输入)]
+
+    Returns:
+        {规范化键: 结果}，LLM 未给出有效结果的条目不在其中
+    """
+    prompt = get_prompt(f"formula_batch_{operation}")
+    lines = [json.dumps({"id": i, "input": text}, ensure_ascii=False) for i, (_, text) in enumerate(items)]
+    messages = prompt.build_messages("\n".join(lines))
+    max_tokens = min(8000, 200 + _TOKENS_PER_ITEM[operation] * len(items))
+    waiting = time.perf_counter()
+    async with _llm_semaphore:
+        record_llm_queue_wait(get_llm_config().provider, f"formula_batch_{operation}", time.perf_counter() - waiting)
+        content = await call_llm(messages, on_usage=prompt.record_usage, endpoint=f"formula_batch_{operation}",
+                                 max_tokens=max_tokens)
+
+    results: Dict[str, Dict[str, str]] = {}
+    for item in parse_batch_response(content):
+        try:
+            index = int(item.get("id"))
+        except (TypeError, ValueError):
+            continue
+        if 0 <= index < len(items):
+            result = _validate_result(operation, item)
+            if result is not None:
+                results[items[index][0]] = result
+    return results
+
+
+async def _resolve_chunk(operation: str, items: List[Tuple[str, str]]) -> List[Tuple[str, Optional[Dict[str, str]], Optional[str]]]:
+    """处理一批条目，LLM 漏掉的条目以更小的批次重试一次；返回 [(键, 结果, 错误)]"""
+    resolved: Dict[str, Dict[str, str]] = {}
+    pending = items
+    error = "LLM 未返回该条目的有效结果"
+    for attempt in range(2):
+        if attempt:
+            LLM_RETRIES.inc(get_llm_config().provider, f"formula_batch_{operation}")
+        try:
+            resolved.update(await _call_batch(operation, pending))
+        except Exception as e:
+            error = f"LLM 调用失败: {e}"
+        pending = [item for item in pending if item[0] not in resolved]
+        if not pending:
+            break
+    return [(key, resolved.get(key), None if key in resolved else error) for key, _ in items]
+
+
+async def run_formula_batch(operation: str, inputs: List[str], batch_size: int = 0) -> AsyncIterator[Dict[str, Any]]:
+    """
+    批量处理公式，按完成顺序产出结果事件
+
+    相同的输入只处理一次，结果事件的 indices 列出所有对应的原始位置；
+    缓存与本地规则命中的结果最先产出，随后按 LLM 批次完成顺序产出，最后产出汇总事件
+
+    Args:
+        operation: generate / explain / optimize / diagnose
+        inputs: 公式列表（generate 时为公式需求描述）
+        batch_size: 每个 LLM 请求包含的条目数，0 表示使用 FORMULA_BATCH_SIZE
+
+    Yields:
+        {"type": "result", "indices", "input", "source": cache | rule | llm | error, "result" | "error"}，
+        最后为 {"type": "summary", "summary": {...}}
+    """
+    started = time.perf_counter()
+    normalize = normalize_request_text if operation == "generate" else normalize_formula
+    prompt_hash = get_prompt(f"formula_batch_{operation}").sha256[:12]
+    cache = get_formula_cache()
+
+    groups: "OrderedDict[str, List[int]]" = OrderedDict()
+    originals: Dict[str, str] = {}
+    for index, text in enumerate(inputs):
+        key = normalize(text)
+        groups.setdefault(key, []).append(index)
+        originals.setdefault(key, text.strip())
+
+    counts = {"cache": 0, "rule": 0, "llm": 0, "error": 0}
+
+    def event(key: str, source: str, result: Optional[Dict[str, str]] = None, error: Optional[str] = None) -> Dict[str, Any]:
+        counts[source] += 1
+        payload = {"type": "result", "indices": groups[key], "input": originals[key], "source": source}
+        if result is not None:
+            # 优化结果附带原始公式，与单条接口的响应字段一致
+            payload["result"] = {**result, "original_formula": originals[key]} if operation == "optimize" else result
+        else:
+            payload["error"] = error
+        return payload
+
+    pending: List[Tuple[str, str]] = []
+    for key in groups:
+        cached = cache.get((operation, prompt_hash, key))
+        if cached is not None:
+            yield event(key, "cache", cached)
+            continue
+        ruled = apply_rules(operation, key, originals[key])
+        if ruled is not None:
+            yield event(key, "rule", ruled)
+            continue
+        # 生成公式时把原始描述发给 LLM，其余操作发送规范化后的公式
+        pending.append((key, originals[key] if operation == "generate" else key))
+
+    if pending and not check_llm_config():
+        for key, _ in pending:
+            yield event(key, "error", error="LLM API 配置无效")
+        pending = []
+
+    size = max(1, batch_size or DEFAULT_BATCH_SIZE)
+    tasks = [
+        asyncio.create_task(_resolve_chunk(operation, pending[i:i + size]))
+        for i in range(0, len(pending), size)
+    ]
+    llm_calls = len(tasks)
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            for key, result, error in await next_done:
+                if result is not None:
+                    cache.put((operation, prompt_hash, key), result)
+                    yield event(key, "llm", result)
+                else:
+                    yield event(key, "error", error=error)
+    finally:
+        # 客户端断开时取消尚未完成的批次
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    yield {
+        "type": "summary",
+        "summary": {
+            "total": len(inputs),
+            "unique": len(groups),
+            "cache_hits": counts["cache"],
+            "rule_hits": counts["rule"],
+            "llm_items": counts["llm"],
+            "llm_batches": llm_calls,
+            "errors": counts["error"],
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+        },
+    }
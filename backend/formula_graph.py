@@ -0,0 +1,492 @@
+"""
+公式依赖图与重算成本分析
+解析工作簿快照中的全部公式，建立单元格 / 区域依赖图：
+- 每列公式单元格按行号排序，并在其上建立线段树；区域引用分解为 O(log n) 个线段树节点，
+  不必为区域内的每个公式单元格单独连边
+- 一次拓扑排序得到最长依赖链、易失函数的影响范围与循环引用
+- 按公式模式（R1C1 形式，填充复制得到的公式模式相同）汇总估算的重算成本，
+  给出可直接提交给 /api/optimize-formula 的优化目标
+"""
+
+import re
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque
+from typing import Any, Dict, List, Sequence, Tuple
+import numpy as np
+from excel_address import cell_address, column_index, column_letter
+
+# 每次编辑都会触发重算的易失函数
+VOLATILE_FUNCTIONS = frozenset({"NOW", "TODAY", "RAND", "RANDBETWEEN", "RANDARRAY", "OFFSET", "INDIRECT", "CELL", "INFO"})
+# 在区域上逐个扫描的查找 / 条件汇总函数
+LOOKUP_FUNCTIONS = frozenset({
+    "VLOOKUP", "HLOOKUP", "LOOKUP", "XLOOKUP", "MATCH", "XMATCH", "SUMIF", "SUMIFS", "COUNTIF", "COUNTIFS",
+    "AVERAGEIF", "AVERAGEIFS", "SUMPRODUCT", "MAXIFS", "MINIFS", "FILTER", "UNIQUE", "SORT",
+})
+# 受易失函数影响的公式每次编辑都会重算，估算成本时相对普通公式的倍数
+VOLATILE_RECALC_FACTOR = 10
+# Excel 工作表的行数 / 列数上限
+MAX_ROWS = 1048576
+MAX_COLUMNS = 16384
+# 依赖链中最多列出的单元格数（超过时保留首尾）
+_CHAIN_CELLS = 30
+
+_STRING_LITERAL = re.compile(r'"(?:[^"]|"")*"')
+_FUNCTION = re.compile(r"([A-Z][A-Z0-9._]*)\(")
+_REFERENCE = re.compile(
+    r"(?<![\w.$'\]])"
+    r"(?P<sheet>(?:'(?:[^']|'')+'|[A-Z_一-鿿][\w一-鿿.]*)!)?"
+    r"(?:"
+    r"(?P<c1>\$?[A-Z]{1,3})(?P<r1>\$?\d+)(?::(?P<c2>\$?[A-Z]{1,3})(?P<r2>\$?\d+))?"
+    r"|(?P<cc1>\$?[A-Z]{1,3}):(?P<cc2>\$?[A-Z]{1,3})"
+    r"|(?P<rr1>\$?\d+):(?P<rr2>\$?\d+)"
+    r")"
+    r"(?![\w(!])"
+)
+
+# 引用: (工作表名, 起始行, 起始列, 结束行, 结束列, 类型)，行列从 0 开始；类型为 cell / range / column / row
+Reference = Tuple[str, int, int, int, int, str]
+
+
+# 列字母到下标的缓存（公式中出现的列字母种类很少）
+_COLUMN_INDEX: Dict[str, int] = {}
+
+
+def _column(token: str) -> int:
+    index = _COLUMN_INDEX.get(token)
+    if index is None:
+        index = _COLUMN_INDEX[token] = column_index(token.lstrip("$"))
+    return index
+
+
+def _r1c1(col_token: str, row_token: str, row: int, col: int) -> Tuple[int, int, str]:
+    """解析 A1 坐标，返回 (行, 列, R1C1 形式)；相对引用写为相对公式所在单元格的偏移"""
+    target_col = _column(col_token)
+    if row_token[0] == "$":
+        target_row = int(row_token[1:]) - 1
+        row_part = "R" + row_token[1:]
+    else:
+        target_row = int(row_token) - 1
+        row_part = f"R[{target_row - row}]"
+    col_part = f"C{target_col + 1}" if col_token[0] == "$" else f"C[{target_col - col}]"
+    return target_row, target_col, row_part + col_part
+
+
+def parse_formula(formula: str, sheet: str, row: int, col: int) -> Tuple[List[Reference], List[str], str]:
+    """
+    解析一个公式
+
+    Args:
+        formula: 公式文本（以 "=" 开头）
+        sheet: 公式所在工作表
+        row, col: 公式所在单元格（从 0 开始）
+
+    Returns:
+        (引用列表, 函数名列表, R1C1 模式)；字符串字面量在模式中统一为 ""
+    """
+    code = formula[1:]
+    if '"' in code:
+        code = _STRING_LITERAL.sub('""', code)
+    code = code.upper()
+
+    references: List[Reference] = []
+    pieces: List[str] = []
+    last = 0
+    for match in _REFERENCE.finditer(code):
+        pieces.append(code[last:match.start()])
+        last = match.end()
+        prefix, c1, r1, c2, r2, cc1, cc2, rr1, rr2 = match.groups()
+        target = sheet
+        if prefix:
+            target = prefix[:-1]
+            if target.startswith("'"):
+                target = target[1:-1].replace("''", "'")
+            pieces.append(prefix)
+        if c1:
+            start_row, start_col, pattern = _r1c1(c1, r1, row, col)
+            if c2:
+                end_row, end_col, end_pattern = _r1c1(c2, r2, row, col)
+                references.append((target, min(start_row, end_row), min(start_col, end_col),
+                                   max(start_row, end_row), max(start_col, end_col), "range"))
+                pattern += ":" + end_pattern
+            else:
+                references.append((target, start_row, start_col, start_row, start_col, "cell"))
+            pieces.append(pattern)
+        elif cc1:
+            start_col, end_col = _column(cc1), _column(cc2)
+            references.append((target, 0, min(start_col, end_col), MAX_ROWS - 1, max(start_col, end_col), "column"))
+            pieces.append(f"{cc1}:{cc2}")
+        else:
+            start_row, end_row = int(rr1.lstrip("$")) - 1, int(rr2.lstrip("$")) - 1
+            references.append((target, min(start_row, end_row), 0, max(start_row, end_row), MAX_COLUMNS - 1, "row"))
+            pieces.append(f"{rr1}:{rr2}")
+    pieces.append(code[last:])
+    return references, _FUNCTION.findall(code), "=" + "".join(pieces)
+
+
+def extract_formulas(columns: Sequence[np.ndarray], start_row: int, start_col: int) -> List[Tuple[int, int, str]]:
+    """从快照列中取出公式单元格，返回 [(行, 列, 公式)]；数值列直接跳过"""
+    formulas: List[Tuple[int, int, str]] = []
+    for offset, column in enumerate(columns):
+        if column.dtype != object:
+            continue
+        col = start_col + offset
+        for row, value in enumerate(column.tolist()):
+            if isinstance(value, str) and value.startswith("="):
+                formulas.append((start_row + row, col, value))
+    return formulas
+
+
+class _ColumnIndex:
+    """
+    一列公式单元格的区间索引
+    rows 为排序后的行号，在其上建立数组形式的线段树：叶子是公式节点，
+    内部节点（堆下标 k）的全局编号为 base + k
+    """
+
+    def __init__(self, rows: List[int], node_ids: List[int], base: int):
+        self.rows = rows
+        self.node_ids = node_ids
+        self.base = base
+        self.size = 1
+        while self.size < len(rows):
+            self.size *= 2
+
+    @property
+    def internal_count(self) -> int:
+        """需要为内部节点预留的编号数（堆下标 0 不使用）"""
+        return self.size if len(self.rows) > 1 else 0
+
+    def _id(self, k: int) -> int:
+        return self.node_ids[k - self.size] if k >= self.size else self.base + k
+
+    def internal_edges(self) -> List[Tuple[int, int]]:
+        """内部节点依赖其子节点：[(子节点, 父节点)]；只含覆盖了真实叶子的节点"""
+        edges: List[Tuple[int, int]] = []
+        if self.internal_count == 0:
+            return edges
+        count = len(self.rows)
+        for k in range(1, self.size):
+            # 子树最左叶子的下标
+            depth_shift = self.size.bit_length() - k.bit_length()
+            if (k << depth_shift) - self.size >= count:
+                continue
+            for child in (2 * k, 2 * k + 1):
+                leftmost = child << (self.size.bit_length() - child.bit_length())
+                if leftmost - self.size < count:
+                    edges.append((self._id(child), self.base + k))
+        return edges
+
+    def query(self, row_start: int, row_end: int) -> List[int]:
+        """行区间 [row_start, row_end] 内的公式单元格，分解为若干节点编号"""
+        lo = bisect_left(self.rows, row_start)
+        hi = bisect_right(self.rows, row_end)
+        if lo >= hi:
+            return []
+        if hi - lo == 1:
+            return [self.node_ids[lo]]
+        nodes: List[int] = []
+        left, right = lo + self.size, hi + self.size
+        while left < right:
+            if left & 1:
+                nodes.append(self._id(left))
+                left += 1
+            if right & 1:
+                right -= 1
+                nodes.append(self._id(right))
+            left >>= 1
+            right >>= 1
+        return nodes
+
+
+def _reference_text(reference: Reference, current_sheet: str) -> str:
+    sheet, start_row, start_col, end_row, end_col, kind = reference
+    prefix = "" if sheet == current_sheet else f"{sheet}!"
+    if kind == "column":
+        return f"{prefix}{column_letter(start_col)}:{column_letter(end_col)}"
+    if kind == "row":
+        return f"{prefix}{start_row + 1}:{end_row + 1}"
+    start = cell_address(start_row, start_col)
+    end = cell_address(end_row, end_col)
+    return prefix + (start if start == end else f"{start}:{end}")
+
+
+def analyze_formulas(sheets: Dict[str, Tuple[List[Tuple[int, int, str]], int, int]], top_n: int = 20) -> Dict[str, Any]:
+    """
+    分析一组工作表中的公式
+
+    Args:
+        sheets: {工作表名: ([(行, 列, 公式)], 已用行数, 已用列数)}；已用范围用于估算整列 / 整行引用的成本
+        top_n: 各类排名列出的条目数
+
+    Returns:
+        {"summary", "hotspots", "volatile", "longest_chains", "whole_column_references", "circular",
+         "optimize_targets", "optimize_batch"}
+    """
+    started = time.perf_counter()
+
+    # 1. 解析公式
+    cell_sheet: List[str] = []
+    cell_row: List[int] = []
+    cell_col: List[int] = []
+    cell_formula: List[str] = []
+    cell_refs: List[Tuple[Reference, ...]] = []
+    cell_pattern: List[str] = []
+    cell_volatile: List[Tuple[str, ...]] = []
+    cell_lookup: List[bool] = []
+    # 公式在解析时统一大写，工作表名按不区分大小写匹配（与 Excel 一致）
+    sheet_names = {name.upper(): name for name in sheets}
+    for sheet, (formulas, _, _) in sheets.items():
+        for row, col, formula in formulas:
+            references, functions, pattern = parse_formula(formula, sheet, row, col)
+            if any(ref[0] != sheet for ref in references):
+                references = [
+                    ref if ref[0] == sheet else (sheet_names.get(ref[0], ref[0]),) + ref[1:]
+                    for ref in references
+                ]
+            cell_sheet.append(sheet)
+            cell_row.append(row)
+            cell_col.append(col)
+            cell_formula.append(formula)
+            # 元组只含不可变值，可被垃圾回收器跳过，百万级引用时明显减少 GC 开销
+            cell_refs.append(tuple(references))
+            cell_pattern.append(pattern)
+            cell_volatile.append(tuple(sorted(VOLATILE_FUNCTIONS.intersection(functions))))
+            cell_lookup.append(not LOOKUP_FUNCTIONS.isdisjoint(functions))
+    formula_count = len(cell_formula)
+    parse_ms = (time.perf_counter() - started) * 1000
+
+    # 2. 每个工作表每列一个区间索引
+    by_column: Dict[Tuple[str, int], List[int]] = {}
+    for node in range(formula_count):
+        by_column.setdefault((cell_sheet[node], cell_col[node]), []).append(node)
+    indexes: Dict[str, Dict[int, _ColumnIndex]] = {}
+    sheet_columns: Dict[str, List[int]] = {}
+    node_count = formula_count
+    for (sheet, col), nodes in by_column.items():
+        nodes.sort(key=cell_row.__getitem__)
+        index = _ColumnIndex([cell_row[node] for node in nodes], nodes, node_count)
+        node_count += index.internal_count
+        indexes.setdefault(sheet, {})[col] = index
+    for sheet, columns in indexes.items():
+        sheet_columns[sheet] = sorted(columns)
+
+    # 3. 依赖边：(被依赖节点, 依赖它的节点)
+    sources: List[int] = []
+    targets: List[int] = []
+    for index_map in indexes.values():
+        for index in index_map.values():
+            for child, parent in index.internal_edges():
+                sources.append(child)
+                targets.append(parent)
+    unresolved_sheets = set()
+    reference_count = 0
+    own_cost = [1] * formula_count
+    for node in range(formula_count):
+        cost = 1
+        for sheet, start_row, start_col, end_row, end_col, kind in cell_refs[node]:
+            reference_count += 1
+            bounds = sheets.get(sheet)
+            if kind == "column":
+                end_row = (bounds[1] - 1) if bounds else MAX_ROWS - 1
+            elif kind == "row":
+                end_col = (bounds[2] - 1) if bounds else MAX_COLUMNS - 1
+            cost += (end_row - start_row + 1) * (end_col - start_col + 1)
+            if bounds is None:
+                unresolved_sheets.add(sheet)
+                continue
+            columns = sheet_columns.get(sheet)
+            if not columns:
+                continue
+            index_map = indexes[sheet]
+            for position in range(bisect_left(columns, start_col), bisect_right(columns, end_col)):
+                # 引用自身时形成自环，在拓扑排序中计为循环引用
+                for source in index_map[columns[position]].query(start_row, end_row):
+                    sources.append(source)
+                    targets.append(node)
+        own_cost[node] = cost
+
+    # 4. 拓扑排序：最长依赖链（只计公式节点）与易失函数影响范围
+    edge_count = len(sources)
+    source_array = np.asarray(sources, dtype=np.int64)
+    target_array = np.asarray(targets, dtype=np.int64)
+    order = np.argsort(source_array, kind="stable")
+    successors = target_array[order].tolist()
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(source_array, minlength=node_count))]).tolist()
+    indegree = np.bincount(target_array, minlength=node_count).tolist()
+
+    weight = [1] * formula_count + [0] * (node_count - formula_count)
+    depth = weight[:]
+    best_pred = [-1] * node_count
+    tainted = [bool(cell_volatile[node]) for node in range(formula_count)] + [False] * (node_count - formula_count)
+    queue = deque(node for node in range(node_count) if indegree[node] == 0)
+    processed = 0
+    while queue:
+        node = queue.popleft()
+        processed += 1
+        node_depth = depth[node]
+        node_tainted = tainted[node]
+        for successor in successors[offsets[node]:offsets[node + 1]]:
+            if node_depth + weight[successor] > depth[successor]:
+                depth[successor] = node_depth + weight[successor]
+                best_pred[successor] = node
+            if node_tainted:
+                tainted[successor] = True
+            indegree[successor] -= 1
+            if indegree[successor] == 0:
+                queue.append(successor)
+    circular = [node for node in range(formula_count) if indegree[node] > 0]
+
+    def address(node: int) -> str:
+        return f"{cell_sheet[node]}!{cell_address(cell_row[node], cell_col[node])}"
+
+    # 5. 最长依赖链：按链尾深度排序，已出现在前面链中的链尾跳过
+    longest_chains = []
+    covered = set()
+    for node in sorted(range(formula_count), key=depth.__getitem__, reverse=True):
+        if len(longest_chains) >= min(top_n, 5) or depth[node] <= 1:
+            break
+        if node in covered or indegree[node] > 0:
+            continue
+        chain = []
+        current = node
+        while current >= 0:
+            if current < formula_count:
+                chain.append(current)
+                covered.add(current)
+            current = best_pred[current]
+        chain.reverse()
+        cells = [address(member) for member in chain]
+        if len(cells) > _CHAIN_CELLS:
+            cells = cells[:_CHAIN_CELLS // 2] + ["..."] + cells[-(_CHAIN_CELLS // 2):]
+        longest_chains.append({"length": len(chain), "start": address(chain[0]), "end": address(chain[-1]), "cells": cells})
+
+    # 6. 按公式模式汇总成本
+    groups: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    total_cost = 0
+    for node in range(formula_count):
+        cost = own_cost[node] * (VOLATILE_RECALC_FACTOR if tainted[node] else 1)
+        total_cost += cost
+        key = (cell_sheet[node], cell_pattern[node])
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {"nodes": [], "cost": 0, "own_cost": 0, "tainted": 0, "max_depth": 0}
+        group["nodes"].append(node)
+        group["cost"] += cost
+        group["own_cost"] += own_cost[node]
+        group["tainted"] += tainted[node]
+        group["max_depth"] = max(group["max_depth"], depth[node])
+
+    def reasons(group: Dict[str, Any]) -> List[str]:
+        example = group["nodes"][0]
+        notes = []
+        if cell_volatile[example]:
+            notes.append(f"包含易失函数 {', '.join(cell_volatile[example])}，每次编辑都会重算")
+        elif group["tainted"]:
+            notes.append(f"{group['tainted']} 个单元格依赖易失函数，每次编辑都会重算")
+        whole = [_reference_text(ref, cell_sheet[example]) for ref in cell_refs[example] if ref[5] in ("column", "row")]
+        if whole:
+            notes.append(f"整列 / 整行引用 {', '.join(whole)}")
+        if cell_lookup[example] and own_cost[example] > 1000:
+            notes.append(f"查找 / 条件汇总函数每次扫描约 {own_cost[example] - 1:,} 个单元格")
+        if group["max_depth"] > 50:
+            notes.append(f"位于长度 {group['max_depth']} 的依赖链上")
+        return notes
+
+    ranked = sorted(groups.items(), key=lambda item: item[1]["cost"], reverse=True)
+    hotspots = []
+    for (sheet, pattern), group in ranked[:top_n]:
+        example = group["nodes"][0]
+        hotspots.append({
+            "sheet": sheet,
+            "pattern": pattern,
+            "count": len(group["nodes"]),
+            "example_cell": address(example),
+            "example_formula": cell_formula[example],
+            "estimated_cost": group["cost"],
+            "share": round(group["cost"] / total_cost, 4) if total_cost else 0.0,
+            "reasons": reasons(group),
+        })
+
+    # 7. 易失函数：按模式汇总，多源 BFS 统计受影响的公式数
+    volatile_groups = [(key, group) for key, group in groups.items() if cell_volatile[group["nodes"][0]]]
+    volatile_groups.sort(key=lambda item: len(item[1]["nodes"]), reverse=True)
+    volatile = []
+    for (sheet, pattern), group in volatile_groups[:top_n]:
+        seen = set(group["nodes"])
+        frontier = deque(group["nodes"])
+        dependents = 0
+        while frontier:
+            node = frontier.popleft()
+            for successor in successors[offsets[node]:offsets[node + 1]]:
+                if successor not in seen:
+                    seen.add(successor)
+                    frontier.append(successor)
+                    dependents += successor < formula_count
+        example = group["nodes"][0]
+        volatile.append({
+            "sheet": sheet,
+            "pattern": pattern,
+            "functions": list(cell_volatile[example]),
+            "count": len(group["nodes"]),
+            "example_cell": address(example),
+            "example_formula": cell_formula[example],
+            "dependents": dependents,
+        })
+
+    # 8. 整列 / 整行引用
+    whole_column_references = []
+    for (sheet, pattern), group in ranked:
+        example = group["nodes"][0]
+        whole = [_reference_text(ref, sheet) for ref in cell_refs[example] if ref[5] in ("column", "row")]
+        if whole:
+            whole_column_references.append({
+                "sheet": sheet,
+                "pattern": pattern,
+                "count": len(group["nodes"]),
+                "example_cell": address(example),
+                "example_formula": cell_formula[example],
+                "references": whole,
+            })
+            if len(whole_column_references) >= top_n:
+                break
+
+    # 9. 优化目标：有明确问题的高成本公式模式
+    optimize_targets = [
+        {
+            "formula": hotspot["example_formula"],
+            "cell": hotspot["example_cell"],
+            "count": hotspot["count"],
+            "estimated_cost": hotspot["estimated_cost"],
+            "reasons": hotspot["reasons"],
+        }
+        for hotspot in hotspots if hotspot["reasons"]
+    ]
+
+    return {
+        "summary": {
+            "sheet_count": len(sheets),
+            "formula_count": formula_count,
+            "pattern_count": len(groups),
+            "reference_count": reference_count,
+            "graph_nodes": node_count,
+            "graph_edges": edge_count,
+            "volatile_cells": sum(1 for functions in cell_volatile if functions),
+            "volatile_dependents": sum(tainted[:formula_count]) - sum(1 for functions in cell_volatile if functions),
+            "whole_column_reference_cells": sum(
+                1 for references in cell_refs if any(ref[5] in ("column", "row") for ref in references)),
+            "max_chain_length": max(depth[:formula_count], default=0),
+            "circular_cells": len(circular),
+            "unresolved_sheets": sorted(unresolved_sheets),
+            "estimated_total_cost": total_cost,
+            "parse_ms": round(parse_ms, 2),
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+        },
+        "hotspots": hotspots,
+        "volatile": volatile,
+        "longest_chains": longest_chains,
+        "whole_column_references": whole_column_references,
+        "circular": [address(node) for node in circular[:top_n]],
+        "optimize_targets": optimize_targets,
+        "optimize_batch": {"operation": "optimize", "items": [target["formula"] for target in optimize_targets]},
+    }
@@ -0,0 +1,130 @@
+"""
+HTTP 缓存
+- 强 ETag 与条件请求：If-None-Match 命中时返回 304，不再发送正文
+- 按内容寻址的操作脚本：Excel 操作的 js_code 以 SHA-256 登记，客户端通过 /api/scripts/{sha} 取回并永久缓存
+  （脚本内容由哈希唯一确定，响应为 immutable）；脚本保存在本进程内存中，多进程部署时未命中的哈希返回 404，
+  客户端应改为不带 script_refs 重新请求
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+from starlette.requests import Request
+from starlette.responses import Response
+from compression import ETAG_SUFFIXES
+from fast_json import FastJSONResponse, dumps
+
+# 内存中保留的操作脚本数（LRU）
+SCRIPT_STORE_SIZE = int(os.getenv("SCRIPT_STORE_SIZE", "2000"))
+# 按哈希取回的脚本可永久缓存
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+# 需要登录、可能变化的接口：浏览器可缓存，但每次使用前须用 ETag 重新验证
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts: Any) -> str:
+    """由正文字节（或能唯一确定正文的若干部分）生成强 ETag"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def _opaque_tag(tag: str) -> str:
+    """去掉弱校验前缀与压缩中间件追加的编码后缀"""
+    tag = tag.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    tag = tag.strip('"')
+    for suffix in ETAG_SUFFIXES:
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)]
+    return tag
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match 是否与 ETag 匹配（弱比较，GET 条件请求的语义）"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    target = _opaque_tag(etag)
+    return any(_opaque_tag(tag) == target for tag in if_none_match.split(","))
+
+
+def not_modified(request: Request, etag: str, cache_control: str = REVALIDATE_CACHE_CONTROL) -> Optional[Response]:
+    """If-None-Match 命中时返回 304 响应，否则返回 None"""
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+    return None
+
+
+def conditional_json(request: Request, content: Any, etag: Optional[str] = None,
+                     cache_control: str = REVALIDATE_CACHE_CONTROL) -> Response:
+    """
+    带 ETag 的 JSON 响应；未指定 etag 时由编码后的正文计算
+    If-None-Match 命中时返回 304
+    """
+    headers = {"Cache-Control": cache_control}
+    if etag is not None:
+        headers["ETag"] = etag
+        return not_modified(request, etag, cache_control) or FastJSONResponse(content, headers=headers)
+    body = dumps(content)
+    headers["ETag"] = make_etag(body)
+    return not_modified(request, headers["ETag"], cache_control) or Response(
+        content=body, media_type="application/json", headers=headers
+    )
+
+
+class ScriptStore:
+    """按 SHA-256 登记的操作脚本（LRU）"""
+
+    def __init__(self, max_entries: int = SCRIPT_STORE_SIZE):
+        self.max_entries = max_entries
+        self._scripts: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(code: str) -> str:
+        return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+    def put(self, code: str) -> str:
+        sha = self.digest(code)
+        with self._lock:
+            self._scripts[sha] = code
+            self._scripts.move_to_end(sha)
+            while len(self._scripts) > self.max_entries:
+                self._scripts.popitem(last=False)
+        return sha
+
+    def get(self, sha: str) -> Optional[str]:
+        with self._lock:
+            code = self._scripts.get(sha)
+            if code is not None:
+                self._scripts.move_to_end(sha)
+            return code
+
+    def attach_refs(self, operations: Iterable[Dict[str, Any]]) -> list:
+        """登记各操作的 js_code，返回以 script_sha 代替 js_code 的操作列表"""
+        result = []
+        for operation in operations:
+            code = operation.get("js_code")
+            if code:
+                operation = {**operation, "js_code": None, "script_sha": self.put(code)}
+            result.append(operation)
+        return result
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"scripts": len(self._scripts), "max_entries": self.max_entries}
+
+
+# 全局脚本存储
+script_store = ScriptStore()
+
+
+def get_script_store() -> ScriptStore:
+    """获取全局脚本存储"""
+    return script_store
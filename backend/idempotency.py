@@ -0,0 +1,337 @@
+"""
+幂等键（Idempotency-Key）与响应重放
+加载项在网络不稳定时重试 /agent/chat、/api/generate-formula 等请求，每次重试都会再调用一次上游 LLM。
+请求携带 Idempotency-Key 头时：
+- 首个请求正常执行，成功（2xx）的完整响应按（用户, 路径, 幂等键）保存 IDEMPOTENCY_TTL 秒
+- 之后的重复请求直接重放保存的响应（带 Idempotent-Replayed: true），不再经过路由与 LLM
+- 首个请求仍在处理时到达的重复请求等待其完成后重放（最长 IDEMPOTENCY_WAIT_TIMEOUT 秒，超时返回 409）；
+  首个请求失败或未完成时不保存，等待者改为自己执行，重试可以正常恢复
+- 同一幂等键用于请求体不同的请求时返回 422
+- 存储有界：进程内最多 IDEMPOTENCY_MAX_ENTRIES 条、响应体合计不超过 IDEMPOTENCY_MAX_BYTES 字节，
+  超过 IDEMPOTENCY_MAX_BODY 字节的响应不保存；
+  设置 IDEMPOTENCY_REDIS_URL 时使用 Redis（需 pip install redis），多个 worker 共享，Redis 不可用时按无幂等键处理
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from metrics import IDEMPOTENCY_REQUESTS
+from rate_limit import bearer_token, get_rate_limiter
+
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+IDEMPOTENCY_PATHS = os.getenv(
+    "IDEMPOTENCY_PATHS",
+    "/agent/chat,/api/generate-formula,/api/explain-formula,/api/optimize-formula,/api/diagnose-error",
+)
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "3600"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "1000"))
+IDEMPOTENCY_MAX_BODY = int(os.getenv("IDEMPOTENCY_MAX_BODY", str(1024 * 1024)))
+IDEMPOTENCY_MAX_BYTES = int(os.getenv("IDEMPOTENCY_MAX_BYTES", str(64 * 1024 * 1024)))
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", "120"))
+IDEMPOTENCY_REDIS_URL = os.getenv("IDEMPOTENCY_REDIS_URL", "")
+
+MAX_KEY_LENGTH = 255
+# 不随响应保存的头：限流状态属于每次请求
+_SKIPPED_HEADERS = (b"ratelimit-limit", b"ratelimit-remaining", b"ratelimit-reset", b"ratelimit-policy")
+
+
+@dataclass
+class StoredResponse:
+    fingerprint: str
+    status: int
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes
+
+    def dumps(self) -> str:
+        return json.dumps({
+            "fingerprint": self.fingerprint,
+            "status": self.status,
+            "headers": [[name.decode("latin-1"), value.decode("latin-1")] for name, value in self.headers],
+            "body": base64.b64encode(self.body).decode("ascii"),
+        })
+
+    @classmethod
+    def loads(cls, raw) -> "StoredResponse":
+        data = json.loads(raw)
+        return cls(
+            data["fingerprint"], data["status"],
+            [(name.encode("latin-1"), value.encode("latin-1")) for name, value in data["headers"]],
+            base64.b64decode(data["body"]),
+        )
+
+
+class MemoryIdempotencyStore:
+    """
+    进程内存储：已完成的响应按保存顺序过期（先进先出），条目数或响应体总字节数超出上限时淘汰最早保存的；
+    进行中的请求用 Future 通知等待者
+    """
+
+    def __init__(self, max_entries: int = IDEMPOTENCY_MAX_ENTRIES, ttl: float = IDEMPOTENCY_TTL,
+                 max_bytes: int = IDEMPOTENCY_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self._responses: "OrderedDict[str, Tuple[float, StoredResponse]]" = OrderedDict()
+        self._inflight: Dict[str, Tuple[str, asyncio.Future]] = {}
+
+    def _remove(self, key: str) -> None:
+        entry = self._responses.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[1].body)
+
+    async def get(self, key: str) -> Optional[StoredResponse]:
+        entry = self._responses.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._remove(key)
+            return None
+        return entry[1]
+
+    async def lock(self, key: str, fingerprint: str) -> Optional[str]:
+        """标记请求进行中；已有进行中的请求时返回其请求指纹，否则返回 None"""
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return inflight[0]
+        self._inflight[key] = (fingerprint, asyncio.get_running_loop().create_future())
+        return None
+
+    async def wait(self, key: str, timeout: float) -> bool:
+        """等待进行中的请求结束，超时返回 False"""
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            return True
+        try:
+            await asyncio.wait_for(asyncio.shield(inflight[1]), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def save(self, key: str, response: StoredResponse) -> None:
+        now = time.monotonic()
+        self._remove(key)
+        self._responses[key] = (now + self.ttl, response)
+        self.total_bytes += len(response.body)
+        while self._responses:
+            oldest_key, (expires_at, _) = next(iter(self._responses.items()))
+            if expires_at > now and len(self._responses) <= self.max_entries and self.total_bytes <= self.max_bytes:
+                break
+            self._remove(oldest_key)
+
+    async def release(self, key: str) -> None:
+        inflight = self._inflight.pop(key, None)
+        if inflight is not None and not inflight[1].done():
+            inflight[1].set_result(None)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "responses": len(self._responses),
+            "inflight": len(self._inflight),
+            "bytes": self.total_bytes,
+        }
+
+
+class RedisIdempotencyStore:
+    """Redis 存储（所有 worker 共享）；进行中的请求用带过期时间的锁键标记，等待者轮询；Redis 出错时放行"""
+
+    def __init__(self, url: str, ttl: float = IDEMPOTENCY_TTL, lock_ttl: float = IDEMPOTENCY_WAIT_TIMEOUT,
+                 prefix: str = "excel_ai:idempotency:"):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.prefix = prefix
+        self.errors = 0
+
+    async def get(self, key: str) -> Optional[StoredResponse]:
+        try:
+            raw = await self._redis.get(self.prefix + key)
+        except Exception:
+            self.errors += 1
+            return None
+        return StoredResponse.loads(raw) if raw else None
+
+    async def lock(self, key: str, fingerprint: str) -> Optional[str]:
+        lock_key = f"{self.prefix}lock:{key}"
+        try:
+            if await self._redis.set(lock_key, fingerprint, nx=True, px=int(self.lock_ttl * 1000)):
+                return None
+            holder = await self._redis.get(lock_key)
+        except Exception:
+            self.errors += 1
+            return None
+        # 锁在两次调用之间被释放：按同一请求进行中处理，等待后重新查询结果
+        return holder.decode() if holder else fingerprint
+
+    async def wait(self, key: str, timeout: float) -> bool:
+        lock_key = f"{self.prefix}lock:{key}"
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if not await self._redis.exists(lock_key):
+                    return True
+            except Exception:
+                self.errors += 1
+                return True
+            await asyncio.sleep(0.05)
+        return False
+
+    async def save(self, key: str, response: StoredResponse) -> None:
+        try:
+            await self._redis.set(self.prefix + key, response.dumps(), px=int(self.ttl * 1000))
+        except Exception:
+            self.errors += 1
+
+    async def release(self, key: str) -> None:
+        try:
+            await self._redis.delete(f"{self.prefix}lock:{key}")
+        except Exception:
+            self.errors += 1
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"errors": self.errors}
+
+
+def _owner(scope) -> str:
+    """幂等键的作用域：登录用户，未登录时为客户端 IP；不同用户的相同幂等键互不影响"""
+    token = bearer_token(scope)
+    user = get_rate_limiter().user_for_token(token) if token else None
+    if user:
+        return f"user:{user}"
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+async def _send_json(send, status: int, detail: str, headers: List[Tuple[bytes, bytes]] = ()) -> None:
+    body = json.dumps({"detail": detail}, ensure_ascii=False).encode("utf-8")
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), *headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+class IdempotencyMiddleware:
+    """
+    ASGI 中间件：按 Idempotency-Key 合并重复的 POST 请求
+    位于限流之外（重放与等待中的重复请求不消耗配额）、CORS 与压缩之内（保存未压缩的响应）
+    """
+
+    def __init__(self, app, store=None, paths: Optional[str] = None, enabled: bool = IDEMPOTENCY_ENABLED):
+        self.app = app
+        self.store = store or (RedisIdempotencyStore(IDEMPOTENCY_REDIS_URL) if IDEMPOTENCY_REDIS_URL else MemoryIdempotencyStore())
+        self.paths = {path.strip() for path in (paths if paths is not None else IDEMPOTENCY_PATHS).split(",") if path.strip()}
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        if (not self.enabled or scope["type"] != "http" or scope["method"] != "POST"
+                or scope["path"] not in self.paths):
+            await self.app(scope, receive, send)
+            return
+        key = next((value.decode("latin-1") for name, value in scope["headers"] if name == b"idempotency-key"), None)
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        key = key.strip()
+        if not key or len(key) > MAX_KEY_LENGTH:
+            await _send_json(send, 400, f"Idempotency-Key 须为 1 到 {MAX_KEY_LENGTH} 个字符")
+            return
+
+        body = await _read_body(receive)
+        if body is None:
+            return
+        store_key = hashlib.sha256(f"{_owner(scope)}\0{path}\0{key}".encode("utf-8")).hexdigest()
+        fingerprint = hashlib.sha256(body).hexdigest()
+
+        joined = False
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_TIMEOUT
+        while True:
+            stored = await self.store.get(store_key)
+            if stored is None:
+                holder = await self.store.lock(store_key, fingerprint)
+                if holder is None:
+                    # 加锁前结果可能刚被其他 worker 保存
+                    stored = await self.store.get(store_key)
+                    if stored is None:
+                        break
+                    await self.store.release(store_key)
+                elif holder != fingerprint:
+                    IDEMPOTENCY_REQUESTS.inc(path, "mismatch")
+                    await _send_json(send, 422, "Idempotency-Key 已用于内容不同的请求")
+                    return
+                else:
+                    joined = True
+                    if not await self.store.wait(store_key, max(deadline - time.monotonic(), 0)):
+                        IDEMPOTENCY_REQUESTS.inc(path, "conflict")
+                        await _send_json(send, 409, "相同 Idempotency-Key 的请求仍在处理中，请稍后重试",
+                                         [(b"retry-after", b"1")])
+                        return
+                    continue
+            if stored.fingerprint != fingerprint:
+                IDEMPOTENCY_REQUESTS.inc(path, "mismatch")
+                await _send_json(send, 422, "Idempotency-Key 已用于内容不同的请求")
+                return
+            IDEMPOTENCY_REQUESTS.inc(path, "joined" if joined else "replayed")
+            await send({"type": "http.response.start", "status": stored.status,
+                        "headers": [*stored.headers, (b"idempotent-replayed", b"true")]})
+            await send({"type": "http.response.body", "body": stored.body})
+            return
+
+        IDEMPOTENCY_REQUESTS.inc(path, "executed")
+        try:
+            response = await self._execute(scope, receive, send, body, fingerprint)
+            if response is not None:
+                await self.store.save(store_key, response)
+        finally:
+            await self.store.release(store_key)
+
+    async def _execute(self, scope, receive, send, body: bytes, fingerprint: str) -> Optional[StoredResponse]:
+        """执行请求并转发响应；成功且完整的响应同时返回以供保存，否则返回 None"""
+        body_sent = False
+        start: Dict = {}
+        chunks: List[bytes] = []
+        size = 0
+        complete = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        async def capture(message):
+            nonlocal size, complete
+            if message["type"] == "http.response.start":
+                start.update(message)
+            elif message["type"] == "http.response.body" and size <= IDEMPOTENCY_MAX_BODY:
+                chunk = message.get("body", b"")
+                chunks.append(chunk)
+                size += len(chunk)
+                complete = not message.get("more_body", False)
+            await send(message)
+
+        await self.app(scope, replay_receive, capture)
+        status = start.get("status", 500)
+        if not complete or size > IDEMPOTENCY_MAX_BODY or not 200 <= status < 300:
+            return None
+        headers = [(name, value) for name, value in start.get("headers", ()) if name.lower() not in _SKIPPED_HEADERS]
+        return StoredResponse(fingerprint, status, headers, b"".join(chunks))
+
+
+async def _read_body(receive) -> Optional[bytes]:
+    """读取完整请求体；客户端已断开时返回 None"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
@@ -0,0 +1,442 @@
+"""
+后台任务队列
+对账、报表生成、数据清洗、批量公式等耗时操作以任务形式提交，由进程内的 asyncio worker 池执行：
+- 有界队列，队列满时拒绝提交，请求处理协程不会被批量任务占住
+- 任务可报告进度、可取消，结束后的结果保留 JOB_RESULT_TTL 秒，最多保留 JOB_MAX_RETAINED 个（超出时淘汰最早结束的）
+- JOB_STORE=database 时任务状态同步写入数据库，多进程部署中任意 worker 都能查询状态、结果并请求取消
+"""
+
+import asyncio
+import contextvars
+import json
+import os
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Type
+from fastapi import HTTPException
+from pydantic import BaseModel
+from metrics import observe_stage
+from fast_json import dumps as json_dumps, fragment
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TERMINAL_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))
+JOB_MAX_RETAINED = int(os.getenv("JOB_MAX_RETAINED", "1000"))
+# 使用数据库存储时，进度写入与取消检查的最小间隔（秒）
+_PERSIST_INTERVAL = 0.5
+# 跨进程查询任务进度时的轮询间隔（秒）
+_POLL_INTERVAL = 1.0
+# 清理过期任务的间隔（秒）
+_SWEEP_INTERVAL = 60
+
+
+class JobQueueFull(Exception):
+    """任务队列已满"""
+
+
+class JobCancelled(Exception):
+    """任务已被取消（由 JobContext.check_cancelled 抛出）"""
+
+
+class Job:
+    """一个后台任务的状态"""
+
+    def __init__(self, job_id: str, user_id: int, kind: str, params: Any = None, owner: Optional[str] = None):
+        self.id = job_id
+        self.user_id = user_id
+        self.kind = kind
+        self.params = params
+        self.owner = owner
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message: Optional[str] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.cancel_requested = False
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.expires_at: Optional[float] = None
+        # 每次状态变化都会替换的事件，等待进度的协程在其上等待
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in TERMINAL_STATES
+
+    def notify(self) -> None:
+        """唤醒等待进度的协程"""
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def to_status(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": round(self.progress, 4),
+            "message": self.message,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "expires_at": self.expires_at,
+        }
+
+
+class JobContext:
+    """传给任务处理函数的上下文：报告进度、检查取消"""
+
+    def __init__(self, manager: "JobManager", job: Job):
+        self.manager = manager
+        self.job = job
+        self._persisted_at = 0.0
+
+    @property
+    def user_id(self) -> int:
+        return self.job.user_id
+
+    async def report(self, progress: float, message: Optional[str] = None) -> None:
+        """
+        报告进度
+
+        Args:
+            progress: 0 ~ 1 的完成比例
+            message: 当前步骤说明
+        """
+        self.job.progress = min(max(progress, 0.0), 1.0)
+        if message is not None:
+            self.job.message = message
+        self.job.notify()
+        now = time.monotonic()
+        if self.manager.store is not None and now - self._persisted_at >= _PERSIST_INTERVAL:
+            self._persisted_at = now
+            await self.manager.persist(self.job)
+            await self.check_cancelled()
+        elif self.job.cancel_requested:
+            raise JobCancelled()
+
+    async def check_cancelled(self) -> None:
+        """任务已被取消时抛出 JobCancelled；使用数据库存储时同时检查其他 worker 发出的取消请求"""
+        if not self.job.cancel_requested and self.manager.store is not None:
+            self.job.cancel_requested = await asyncio.to_thread(self.manager.store.is_cancel_requested, self.job.id)
+        if self.job.cancel_requested:
+            raise JobCancelled()
+
+
+class DatabaseJobStore:
+    """把任务状态写入 jobs 表（models.Job），结果以 JSON 文本存储"""
+
+    def __init__(self, session_factory=None):
+        import database
+        self.session_factory = session_factory or database.SessionLocal
+
+    def _columns(self, job: Job) -> Dict[str, Any]:
+        return {
+            "status": job.status,
+            "progress": job.progress,
+            "message": job.message,
+            "result": json_dumps(job.result).decode("utf-8") if job.done and job.result is not None else None,
+            "error": job.error,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+            "expires_at": job.expires_at,
+        }
+
+    def create(self, job: Job) -> None:
+        import models
+        with self.session_factory() as db:
+            db.add(models.Job(
+                id=job.id, user_id=job.user_id, kind=job.kind, owner=job.owner,
+                cancel_requested=False, created_at=job.created_at, **self._columns(job),
+            ))
+            db.commit()
+
+    def update(self, job: Job) -> None:
+        """更新状态；不覆盖 cancel_requested，其他 worker 写入的取消请求不会丢失"""
+        import models
+        with self.session_factory() as db:
+            db.query(models.Job).filter(models.Job.id == job.id).update(self._columns(job))
+            db.commit()
+
+    def load(self, job_id: str) -> Optional[Job]:
+        import models
+        with self.session_factory() as db:
+            row = db.get(models.Job, job_id)
+            if row is None:
+                return None
+            job = Job(row.id, row.user_id, row.kind, owner=row.owner)
+            job.status = row.status
+            job.progress = row.progress or 0.0
+            job.message = row.message
+            # 结果保持为已编码的 JSON 片段，取回时原样拼接进响应
+            job.result = fragment(row.result) if row.result else None
+            job.error = row.error
+            job.cancel_requested = bool(row.cancel_requested)
+            job.created_at = row.created_at
+            job.started_at = row.started_at
+            job.finished_at = row.finished_at
+            job.expires_at = row.expires_at
+            return job
+
+    def request_cancel(self, job_id: str) -> None:
+        import models
+        with self.session_factory() as db:
+            db.query(models.Job).filter(models.Job.id == job_id).update({"cancel_requested": True})
+            db.commit()
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        import models
+        with self.session_factory() as db:
+            row = db.query(models.Job.cancel_requested).filter(models.Job.id == job_id).first()
+            return bool(row and row[0])
+
+    def delete_expired(self, now: float) -> int:
+        import models
+        with self.session_factory() as db:
+            count = db.query(models.Job).filter(models.Job.expires_at != None, models.Job.expires_at < now).delete()  # noqa: E711
+            db.commit()
+            return count
+
+
+# 任务处理函数：接收上下文与校验后的参数，返回可 JSON 序列化的结果
+JobHandler = Callable[[JobContext, Any], Awaitable[Any]]
+
+
+class JobManager:
+    """
+    进程内任务管理器
+    本进程提交的任务保存在内存中并由本进程的 worker 执行；配置了持久化存储时，
+    查询不到的任务会到存储中查找（由其他 worker 进程提交）
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, queue_size: int = JOB_QUEUE_SIZE, ttl: int = JOB_RESULT_TTL,
+                 store: Optional[DatabaseJobStore] = None, max_retained: int = JOB_MAX_RETAINED):
+        self.worker_count = max(1, workers)
+        self.queue_size = queue_size
+        self.ttl = ttl
+        self.store = store
+        self.max_retained = max(1, max_retained)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._handlers: Dict[str, tuple] = {}
+        self._jobs: Dict[str, Job] = {}
+        # 已结束任务的 id，按结束顺序排列，用于淘汰最早结束的任务
+        self._finished: "OrderedDict[str, None]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    def register(self, kind: str, handler: JobHandler, params_model: Optional[Type[BaseModel]] = None) -> None:
+        """注册任务类型；params_model 用于在提交时校验参数"""
+        self._handlers[kind] = (handler, params_model)
+
+    @property
+    def kinds(self) -> List[str]:
+        return sorted(self._handlers)
+
+    def start(self) -> None:
+        """
+        启动 worker（应用启动时调用；首次提交任务时也会自动启动）
+        worker 在空的上下文中运行：即使由请求中的 submit 懒启动，也不会继承该请求的 ContextVar
+        （如 metrics 的阶段列表），任务的阶段耗时归入 background
+        """
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._workers = [asyncio.create_task(self._worker(), context=contextvars.Context()) for _ in range(self.worker_count)]
+        self._workers.append(asyncio.create_task(self._sweeper(), context=contextvars.Context()))
+
+    async def stop(self) -> None:
+        """停止 worker，运行中的任务被取消"""
+        for job in self._jobs.values():
+            if job.task is not None and not job.task.done():
+                job.task.cancel()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+
+    async def persist(self, job: Job) -> None:
+        if self.store is not None:
+            await asyncio.to_thread(self.store.update, job)
+
+    def validate(self, kind: str, params: Dict[str, Any]) -> Any:
+        """校验任务类型与参数，失败时抛出 KeyError / pydantic.ValidationError"""
+        if kind not in self._handlers:
+            raise KeyError(kind)
+        _, params_model = self._handlers[kind]
+        return params_model(**params) if params_model is not None else params
+
+    async def submit(self, user_id: int, kind: str, params: Dict[str, Any]) -> Job:
+        """提交任务；队列已满时抛出 JobQueueFull"""
+        parsed = self.validate(kind, params)
+        self.start()
+        self._sweep()
+        job = Job(uuid.uuid4().hex, user_id, kind, parsed, self.owner)
+        if self._queue.full():
+            raise JobQueueFull()
+        if self.store is not None:
+            await asyncio.to_thread(self.store.create, job)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            # 写入存储期间队列被占满
+            await self._finish(job, CANCELLED)
+            raise JobQueueFull()
+        self._jobs[job.id] = job
+        return job
+
+    async def get(self, job_id: str, user_id: int) -> Optional[Job]:
+        """查询任务（只能查询自己的任务）；本进程没有时到持久化存储中查找"""
+        self._sweep()
+        job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = await asyncio.to_thread(self.store.load, job_id)
+            if job is not None and job.expires_at is not None and job.expires_at < time.time():
+                job = None
+        if job is None or job.user_id != user_id:
+            return None
+        return job
+
+    async def cancel(self, job: Job) -> Job:
+        """取消任务：排队中的任务直接结束，运行中的任务被中断"""
+        if job.done:
+            return job
+        job.cancel_requested = True
+        if job.id not in self._jobs:
+            # 其他 worker 进程的任务：写入取消请求，由其在下次报告进度时中断
+            await asyncio.to_thread(self.store.request_cancel, job.id)
+            return job
+        if job.status == QUEUED:
+            await self._finish(job, CANCELLED)
+        elif job.task is not None:
+            job.task.cancel()
+        return job
+
+    async def watch(self, job_id: str, user_id: int) -> AsyncIterator[Dict[str, Any]]:
+        """产出任务状态，每次变化产出一次，直到任务结束"""
+        job = await self.get(job_id, user_id)
+        while job is not None:
+            yield job.to_status()
+            if job.done:
+                return
+            if job_id in self._jobs:
+                changed = job.changed
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=15)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(_POLL_INTERVAL)
+                job = await self.get(job_id, user_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.status == QUEUED:
+                    await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _sweeper(self) -> None:
+        while True:
+            await asyncio.sleep(_SWEEP_INTERVAL)
+            self._sweep()
+            try:
+                await self.purge_store()
+            except Exception as e:
+                print(f"清理过期任务失败: {e}")
+
+    async def _run(self, job: Job) -> None:
+        handler, _ = self._handlers[job.kind]
+        job.status = RUNNING
+        job.started_at = time.time()
+        observe_stage(f"job_queue_wait:{job.kind}", job.started_at - job.created_at)
+        job.notify()
+        await self.persist(job)
+        context = JobContext(self, job)
+        job.task = asyncio.create_task(handler(context, job.params))
+        try:
+            job.result = await job.task
+            # 处理函数最后一个阶段之后也检查一次（含其他 worker 发出的取消请求），已取消的任务不标记为成功
+            await context.check_cancelled()
+            job.progress = 1.0
+            await self._finish(job, SUCCEEDED)
+        except (asyncio.CancelledError, JobCancelled):
+            if not job.cancel_requested:
+                # worker 本身被取消（进程关闭），不吞掉取消
+                await self._finish(job, CANCELLED)
+                raise
+            await self._finish(job, CANCELLED)
+        except HTTPException as e:
+            job.error = e.detail if isinstance(e.detail, str) else json.dumps(e.detail, ensure_ascii=False)
+            await self._finish(job, FAILED)
+        except Exception as e:
+            job.error = f"任务执行出错: {e}"
+            await self._finish(job, FAILED)
+        finally:
+            job.task = None
+
+    async def _finish(self, job: Job, status: str) -> None:
+        job.status = status
+        job.finished_at = time.time()
+        job.expires_at = job.finished_at + self.ttl
+        job.notify()
+        if job.id in self._jobs:
+            self._retain(job.id)
+        await self.persist(job)
+
+    def _retain(self, job_id: str) -> None:
+        """记录已结束的任务；超过 max_retained 时从内存中淘汰最早结束的任务（持久化存储中的记录按 TTL 清理）"""
+        self._finished[job_id] = None
+        while len(self._finished) > self.max_retained:
+            evicted, _ = self._finished.popitem(last=False)
+            self._jobs.pop(evicted, None)
+
+    def _sweep(self) -> None:
+        """清理过期的已结束任务"""
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items() if job.expires_at is not None and job.expires_at < now]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._finished.pop(job_id, None)
+
+    async def purge_store(self) -> int:
+        """清理持久化存储中过期的任务"""
+        if self.store is None:
+            return 0
+        return await asyncio.to_thread(self.store.delete_expired, time.time())
+
+    def get_stats(self) -> Dict[str, Any]:
+        counts: Dict[str, int] = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "workers": self.worker_count if self._workers else 0,
+            "queue_size": self.queue_size,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_retained": self.max_retained,
+            "jobs": counts,
+            "store": "database" if self.store is not None else "memory",
+        }
+
+
+# 全局任务管理器
+job_manager = JobManager(store=DatabaseJobStore() if os.getenv("JOB_STORE", "memory").lower() == "database" else None)
+
+
+def get_job_manager() -> JobManager:
+    """获取全局任务管理器"""
+    return job_manager
@@ -4,13 +4,245 @@
 """
 
 import os
+import re
+import json
+import asyncio
+import time
 import httpx
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, AsyncIterator, Callable, Tuple
 from dotenv import load_dotenv
+from metrics import LLM_ERRORS, record_llm_call
 
 load_dotenv()
 
 
+# ---------------------------------------------------------------------------
+# Token 估算与上下文预算
+# ---------------------------------------------------------------------------
+
+# 可选依赖：安装了 tiktoken 时用真实分词器计数（对 Qwen / DeepSeek 仍是近似值）；
+# 分词表加载较慢（首次可能需要下载），在第一次计数时才加载
+_tiktoken_encoding = None
+_tiktoken_loaded = False
+
+
+def _get_tiktoken_encoding():
+    global _tiktoken_encoding, _tiktoken_loaded
+    if not _tiktoken_loaded:
+        _tiktoken_loaded = True
+        try:
+            import tiktoken
+            _tiktoken_encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _tiktoken_encoding = None
+    return _tiktoken_encoding
+
+# 中日韩字符（含全角标点）大致一字一 token；其余按单词、数字串、符号切分
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+_ALPHA_PATTERN = re.compile(r"[A-Za-z]+")
+_DIGIT_PATTERN = re.compile(r"\d+")
+_SYMBOL_PATTERN = re.compile(r"[^\sA-Za-z\d\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+# 每条消息的固定开销（role、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 各模型的上下文窗口（按模型名前缀匹配，取最长匹配）
+MODEL_CONTEXT_WINDOWS = {
+    "qwen-turbo": 131072,
+    "qwen-plus": 131072,
+    "qwen-max": 32768,
+    "qwen-long": 1000000,
+    "deepseek-chat": 65536,
+    "deepseek-reasoner": 65536,
+    "gpt-3.5-turbo": 16385,
+    "gpt-4o": 128000,
+    "stub-model": 131072,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的 token 数
+
+    安装了 tiktoken 时直接计数；否则使用本地启发式规则：
+    中日韩字符每字 1 个 token，英文单词约每 4 个字母 1 个 token，数字约每 3 位 1 个 token，符号各 1 个 token
+    """
+    if not text:
+        return 0
+    encoding = _get_tiktoken_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    tokens = len(_CJK_PATTERN.findall(text)) + len(_SYMBOL_PATTERN.findall(text))
+    alpha_runs = _ALPHA_PATTERN.findall(text)
+    tokens += (sum(map(len, alpha_runs)) + 3 * len(alpha_runs)) // 4
+    digit_runs = _DIGIT_PATTERN.findall(text)
+    tokens += (sum(map(len, digit_runs)) + 2 * len(digit_runs)) // 3
+    return tokens
+
+
+def estimate_message_tokens(messages: List[Dict[str, Any]]) -> int:
+    """估算消息列表的 token 数（含每条消息的固定开销）"""
+    total = 0
+    for message in messages:
+        content = message.get("content")
+        total += MESSAGE_OVERHEAD_TOKENS + (estimate_tokens(content) if isinstance(content, str) else 0)
+    return total
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    将文本截断到指定 token 数以内（截断策略）
+
+    多行文本（如粘贴的表格）保留开头和结尾的行，中间替换为省略说明；
+    单行长文本保留首尾字符。首尾各占一半预算，保证表头和最后几行都能被模型看到
+    """
+    if max_tokens <= 0:
+        return ""
+    total = estimate_tokens(text)
+    if total <= max_tokens:
+        return text
+
+    lines = text.split("\n")
+    if len(lines) > 4:
+        ratio = max_tokens / total
+        for _ in range(8):
+            keep = max(2, int(len(lines) * ratio))
+            head, tail = lines[:keep - keep // 2], lines[len(lines) - keep // 2:]
+            omitted = len(lines) - len(head) - len(tail)
+            candidate = "\n".join(head + [f"...[已省略中间 {omitted} 行，共 {len(lines)} 行]..."] + tail)
+            candidate_tokens = estimate_tokens(candidate)
+            if candidate_tokens <= max_tokens:
+                return candidate
+            if keep == 2:
+                break
+            ratio *= max_tokens / candidate_tokens * 0.95
+        # 单行过长时退化为按字符截断
+        text, total = candidate, candidate_tokens
+
+    ratio = max_tokens / total
+    for _ in range(8):
+        keep = max(1, int(len(text) * ratio))
+        head, tail = text[:keep - keep // 2], text[len(text) - keep // 2:]
+        candidate = f"{head}...[已省略 {len(text) - len(head) - len(tail)} 个字符]...{tail}"
+        candidate_tokens = estimate_tokens(candidate)
+        if candidate_tokens <= max_tokens:
+            return candidate
+        ratio *= max_tokens / candidate_tokens * 0.95
+    return candidate
+
+
+class TokenBudgeter:
+    """
+    上下文窗口预算器
+
+    在请求发出前估算输入 token，按上下文窗口与输入上限裁剪消息，并据此确定 max_tokens。
+    超限策略（LLM_OVERFLOW_POLICY）：
+    - truncate（默认）：截断最后一条用户消息的中间部分，仍超限时丢弃最早的历史消息
+    - reject：直接拒绝请求
+    """
+
+    def __init__(self, model_name: str):
+        self.context_window = int(os.getenv("LLM_CONTEXT_WINDOW", "0")) or self._lookup_context_window(model_name)
+        # 单次请求输入 token 上限，控制成本与延迟，默认远小于上下文窗口
+        self.max_input_tokens = min(int(os.getenv("LLM_MAX_INPUT_TOKENS", "16000")), self.context_window)
+        # 至少为输出预留的 token 数
+        self.min_output_tokens = int(os.getenv("LLM_MIN_OUTPUT_TOKENS", "256"))
+        self.overflow_policy = os.getenv("LLM_OVERFLOW_POLICY", "truncate").lower()
+
+    @staticmethod
+    def _lookup_context_window(model_name: str) -> int:
+        matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if model_name.startswith(prefix)]
+        if not matches:
+            return DEFAULT_CONTEXT_WINDOW
+        return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+
+    def fit(self, messages: List[Dict[str, Any]], max_tokens: int) -> Tuple[List[Dict[str, Any]], int, Dict[str, Any]]:
+        """
+        使消息适配预算
+
+        Args:
+            messages: 待发送的消息列表
+            max_tokens: 调用方期望的最大输出 token 数
+
+        Returns:
+            (裁剪后的消息列表, 实际使用的 max_tokens, 预算报告)
+        """
+        input_limit = min(self.max_input_tokens, self.context_window - self.min_output_tokens)
+        input_tokens = estimate_message_tokens(messages)
+        report: Dict[str, Any] = {"input_tokens": input_tokens, "original_input_tokens": input_tokens, "truncated": False, "dropped_messages": 0}
+
+        if input_tokens > input_limit:
+            if self.overflow_policy == "reject":
+                raise ValueError(f"输入过长：约 {input_tokens} 个 token，超过上限 {input_limit}")
+            messages = list(messages)
+            report["truncated"] = True
+
+            # 1. 截断最后一条用户消息（可变内容都在这里）
+            last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=None)
+            if last_user is not None and isinstance(messages[last_user].get("content"), str):
+                others = input_tokens - estimate_message_tokens([messages[last_user]])
+                allowed = max(input_limit - others - MESSAGE_OVERHEAD_TOKENS, input_limit // 4)
+                messages[last_user] = {**messages[last_user], "content": truncate_to_tokens(messages[last_user]["content"], allowed)}
+                input_tokens = estimate_message_tokens(messages)
+
+            # 2. 仍超限时丢弃最早的历史消息（保留系统提示词和最后一条消息）
+            while input_tokens > input_limit and len(messages) > 2:
+                start = 1 if messages[0].get("role") == "system" else 0
+                if start >= len(messages) - 1:
+                    break
+                messages.pop(start)
+                report["dropped_messages"] += 1
+                input_tokens = estimate_message_tokens(messages)
+
+            report["input_tokens"] = input_tokens
+
+        available_output = self.context_window - input_tokens
+        if available_output < self.min_output_tokens and self.overflow_policy == "reject":
+            raise ValueError(f"上下文窗口不足：输入约 {input_tokens} 个 token，窗口 {self.context_window}")
+        report["max_tokens"] = max(1, min(max_tokens, available_output))
+        return messages, report["max_tokens"], report
+
+
+class TokenUsageLedger:
+    """按接口统计 token 输入输出"""
+
+    def __init__(self):
+        self._entries: Dict[str, Dict[str, int]] = {}
+
+    def _entry(self, endpoint: str) -> Dict[str, int]:
+        entry = self._entries.get(endpoint)
+        if entry is None:
+            entry = self._entries[endpoint] = {
+                "requests": 0,
+                "estimated_input_tokens": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cached_tokens": 0,
+                "truncated_requests": 0,
+            }
+        return entry
+
+    def record_request(self, endpoint: str, report: Dict[str, Any]) -> None:
+        """记录一次请求的预算结果"""
+        entry = self._entry(endpoint)
+        entry["requests"] += 1
+        entry["estimated_input_tokens"] += report["input_tokens"]
+        if report["truncated"]:
+            entry["truncated_requests"] += 1
+
+    def record_usage(self, endpoint: str, usage: Dict[str, Any]) -> None:
+        """记录提供商返回的实际用量"""
+        entry = self._entry(endpoint)
+        entry["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        entry["completion_tokens"] += usage.get("completion_tokens", 0)
+        entry["cached_tokens"] += usage.get("cached_tokens", 0)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        """获取各接口的累计用量"""
+        return {endpoint: dict(entry) for endpoint, entry in self._entries.items()}
+
+
 class LLMConfig:
     """统一的LLM配置类"""
     
@@ -20,8 +252,17 @@ class LLMConfig:
         self.deepseek_api_key = os.getenv("DEEPSEEK_API_KEY")
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
         
+        # 本地桩服务地址；为空时在进程内直接调用 fake_llm_server.app
+        self.stub_url = os.getenv("LLM_STUB_URL", "")
+        
         # 确定使用的LLM提供商
-        if self.qwen_api_key and self.qwen_api_key != "你的API_KEY":
+        if os.getenv("LLM_PROVIDER", "").lower() == "stub":
+            # 压测 / 联调用的本地桩服务（fake_llm_server.py），不消耗真实额度
+            self.provider = "stub"
+            self.api_key = "stub"
+            self.api_url = self.stub_url or "http://llm-stub/v1/chat/completions"
+            self.model_name = "stub-model"
+        elif self.qwen_api_key and self.qwen_api_key != "你的API_KEY":
             self.provider = "qwen"
             self.api_key = self.qwen_api_key
             self.api_url = os.getenv("DASHSCOPE_API_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions")
@@ -38,18 +279,94 @@ class LLMConfig:
             self.model_name = "gpt-3.5-turbo"
         else:
             raise ValueError("未找到有效的LLM API配置，请配置 DASHSCOPE_API_KEY、DEEPSEEK_API_KEY 或 OPENAI_API_KEY")
+        
+        # 上下文预算与按接口的 token 统计
+        self.budgeter = TokenBudgeter(self.model_name)
+        self.usage_ledger = TokenUsageLedger()
+        
+        # DashScope 显式缓存：为系统提示词加 cache_control 标记（隐式前缀缓存无需配置，默认生效）
+        self.explicit_prompt_cache = self.provider == "qwen" and os.getenv("QWEN_EXPLICIT_CACHE", "false").lower() == "true"
+        
+        # 共享的 HTTP 客户端，复用到上游的 TCP/TLS 连接
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    def get_client(self) -> httpx.AsyncClient:
+        """
+        获取共享的 httpx.AsyncClient
+        
+        AsyncClient 的连接池绑定在创建它的事件循环上，事件循环变化时（如测试中）重新创建
+        """
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._client_loop is not loop:
+            if self.provider == "stub" and not self.stub_url:
+                # 进程内桩服务：ASGI transport 会缓冲完整响应，流式分块间隔需用独立进程的桩服务测量
+                import fake_llm_server
+                self._client = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake_llm_server.app), timeout=30.0)
+            else:
+                self._client = httpx.AsyncClient(timeout=30.0)
+            self._client_loop = loop
+        return self._client
+    
+    async def warmup(self) -> None:
+        """预先建立到上游 API 的连接（DNS、TCP、TLS 握手），响应状态码不重要"""
+        client = self.get_client()
+        try:
+            await client.head(self.api_url, timeout=5.0)
+        except httpx.RequestError as e:
+            raise ConnectionError(f"连接到 {self.provider.upper()} API 时出错: {e}")
+    
+    async def aclose(self) -> None:
+        """关闭共享的 HTTP 客户端"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+        self._client_loop = None
     
     def check_api_key(self) -> bool:
         """检查API密钥是否有效"""
         return bool(self.api_key and self.api_key != "你的API_KEY")
     
+    def _prepare_messages(self, messages: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+        """按提供商的缓存机制调整消息格式"""
+        if not self.explicit_prompt_cache:
+            return messages
+        prepared: List[Dict[str, Any]] = []
+        for message in messages:
+            if message["role"] == "system" and isinstance(message["content"], str):
+                prepared.append({
+                    "role": "system",
+                    "content": [{"type": "text", "text": message["content"], "cache_control": {"type": "ephemeral"}}]
+                })
+            else:
+                prepared.append(message)
+        return prepared
+    
+    @staticmethod
+    def normalize_usage(usage: Optional[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        归一化各提供商返回的 token 用量
+        
+        DeepSeek 通过 prompt_cache_hit_tokens 报告缓存命中，
+        DashScope / OpenAI 通过 prompt_tokens_details.cached_tokens 报告
+        """
+        usage = usage or {}
+        details = usage.get("prompt_tokens_details") or {}
+        return {
+            "prompt_tokens": usage.get("prompt_tokens") or 0,
+            "completion_tokens": usage.get("completion_tokens") or 0,
+            "cached_tokens": usage.get("prompt_cache_hit_tokens") or details.get("cached_tokens") or 0
+        }
+    
     async def call_llm_api(self, messages: List[Dict[str, str]], **kwargs) -> str:
         """
         统一的LLM API调用接口
         
         Args:
             messages: 消息列表，格式为 [{"role": "user", "content": "..."}]
-            **kwargs: 其他参数如 temperature, max_tokens 等
+            **kwargs: 其他参数如 temperature, max_tokens 等；
+                on_usage 为可选回调，调用结束后接收 token 用量与首字节延迟 ttft_ms；
+                endpoint 为统计用的接口名
         
         Returns:
             LLM响应内容
@@ -62,12 +379,19 @@ class LLMConfig:
             "Content-Type": "application/json"
         }
         
+        on_usage: Optional[Callable[[Dict[str, Any]], None]] = kwargs.get("on_usage")
+        endpoint = kwargs.get("endpoint", "default")
+        
+        # 发送前估算 token，按预算裁剪输入并确定 max_tokens
+        messages, max_tokens, budget = self.budgeter.fit(messages, kwargs.get("max_tokens", 1000))
+        self.usage_ledger.record_request(endpoint, budget)
+        
         # 构建请求数据
         data = {
             "model": self.model_name,
-            "messages": messages,
+            "messages": self._prepare_messages(messages),
             "temperature": kwargs.get("temperature", 0.7),
-            "max_tokens": kwargs.get("max_tokens", 1000)
+            "max_tokens": max_tokens
         }
         
         # 添加其他参数
@@ -75,48 +399,166 @@ class LLMConfig:
             data["stream"] = kwargs["stream"]
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(self.api_url, headers=headers, json=data, timeout=30.0)
-                response.raise_for_status()
+            client = self.get_client()
+            started = time.perf_counter()
+            request = client.build_request("POST", self.api_url, headers=headers, json=data, timeout=30.0)
+            response = await client.send(request, stream=True)
+            # 非流式调用以响应头到达时间作为首字节延迟
+            ttft_ms = (time.perf_counter() - started) * 1000
+            try:
+                await response.aread()
+            finally:
+                await response.aclose()
+            response.raise_for_status()
+            
+            result = response.json()
+            if "choices" in result and len(result["choices"]) > 0:
+                usage = self.normalize_usage(result.get("usage"))
+                self.usage_ledger.record_usage(endpoint, usage)
+                record_llm_call(self.provider, endpoint, ttft_ms / 1000, time.perf_counter() - started, usage)
+                if on_usage is not None:
+                    on_usage({**usage, "ttft_ms": ttft_ms})
+                return result["choices"][0]["message"]["content"]
+            else:
+                raise ValueError("LLM API返回了意外的响应格式")
                 
-                result = response.json()
-                if "choices" in result and len(result["choices"]) > 0:
-                    return result["choices"][0]["message"]["content"]
-                else:
-                    raise ValueError("LLM API返回了意外的响应格式")
-                    
         except httpx.RequestError as e:
+            LLM_ERRORS.inc(self.provider, endpoint)
             raise ConnectionError(f"连接到 {self.provider.upper()} API 时出错: {e}")
         except httpx.HTTPStatusError as e:
+            LLM_ERRORS.inc(self.provider, endpoint)
             raise ConnectionError(f"{self.provider.upper()} API返回错误: {e.response.status_code}")
         except Exception as e:
+            LLM_ERRORS.inc(self.provider, endpoint)
             raise RuntimeError(f"调用 {self.provider.upper()} API时出现未知错误: {e}")
     
+    async def stream_llm_api(self, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[str]:
+        """
+        流式LLM API调用接口（OpenAI 兼容的 SSE 协议）
+        
+        Args:
+            messages: 消息列表，格式为 [{"role": "user", "content": "..."}]
+            **kwargs: 其他参数如 temperature, max_tokens 等；
+                on_usage 为可选回调，流结束后接收 token 用量与首 token 延迟 ttft_ms；
+                endpoint 为统计用的接口名
+        
+        Yields:
+            LLM 逐段返回的增量文本
+        """
+        if not self.check_api_key():
+            raise ValueError(f"无效的 {self.provider.upper()} API Key")
+        
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream"
+        }
+        
+        on_usage: Optional[Callable[[Dict[str, Any]], None]] = kwargs.get("on_usage")
+        endpoint = kwargs.get("endpoint", "default")
+        
+        messages, max_tokens, budget = self.budgeter.fit(messages, kwargs.get("max_tokens", 1000))
+        self.usage_ledger.record_request(endpoint, budget)
+        
+        data = {
+            "model": self.model_name,
+            "messages": self._prepare_messages(messages),
+            "temperature": kwargs.get("temperature", 0.7),
+            "max_tokens": max_tokens,
+            "stream": True,
+            # 让最后一个数据块携带 usage
+            "stream_options": {"include_usage": True}
+        }
+        
+        usage: Optional[Dict[str, Any]] = None
+        ttft_ms: Optional[float] = None
+        try:
+            client = self.get_client()
+            started = time.perf_counter()
+            async with client.stream("POST", self.api_url, headers=headers, json=data, timeout=30.0) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    # SSE 格式: "data: {...}"，以 "data: [DONE]" 结束
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if payload == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(payload)
+                    except json.JSONDecodeError:
+                        continue
+                    if chunk.get("usage"):
+                        usage = chunk["usage"]
+                    choices = chunk.get("choices") or []
+                    if not choices:
+                        continue
+                    delta = choices[0].get("delta") or {}
+                    content = delta.get("content")
+                    if content:
+                        if ttft_ms is None:
+                            ttft_ms = (time.perf_counter() - started) * 1000
+                        yield content
+            
+            usage = self.normalize_usage(usage)
+            self.usage_ledger.record_usage(endpoint, usage)
+            record_llm_call(self.provider, endpoint, ttft_ms / 1000 if ttft_ms is not None else None,
+                            time.perf_counter() - started, usage)
+            if on_usage is not None:
+                on_usage({**usage, "ttft_ms": ttft_ms})
+                        
+        except httpx.RequestError as e:
+            LLM_ERRORS.inc(self.provider, endpoint)
+            raise ConnectionError(f"连接到 {self.provider.upper()} API 时出错: {e}")
+        except httpx.HTTPStatusError as e:
+            LLM_ERRORS.inc(self.provider, endpoint)
+            raise ConnectionError(f"{self.provider.upper()} API返回错误: {e.response.status_code}")
+    
     def get_provider_info(self) -> Dict[str, Any]:
         """获取当前LLM提供商信息"""
         return {
             "provider": self.provider,
             "model": self.model_name,
             "api_url": self.api_url,
-            "has_valid_key": self.check_api_key()
+            "has_valid_key": self.check_api_key(),
+            "context_window": self.budgeter.context_window,
+            "max_input_tokens": self.budgeter.max_input_tokens
         }
 
 
-# 全局LLM配置实例
-llm_config = LLMConfig()
+# 全局LLM配置实例；首次使用时按环境变量解析提供商，导入本模块不会因缺少 API Key 而失败
+_llm_config: Optional[LLMConfig] = None
 
 
 def get_llm_config() -> LLMConfig:
-    """获取全局LLM配置实例"""
-    return llm_config
+    """获取全局LLM配置实例；未配置任何 API Key 时抛出 ValueError"""
+    global _llm_config
+    if _llm_config is None:
+        _llm_config = LLMConfig()
+    return _llm_config
+
+
+async def close_llm_config() -> None:
+    """关闭全局实例的上游连接（未创建过实例时不做任何事）"""
+    if _llm_config is not None:
+        await _llm_config.aclose()
 
 
 # 便捷函数
 async def call_llm(messages: List[Dict[str, str]], **kwargs) -> str:
     """便捷的LLM调用函数"""
-    return await llm_config.call_llm_api(messages, **kwargs)
+    return await get_llm_config().call_llm_api(messages, **kwargs)
+
+
+async def stream_llm(messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[str]:
+    """便捷的流式LLM调用函数"""
+    async for delta in get_llm_config().stream_llm_api(messages, **kwargs):
+        yield delta
 
 
 def check_llm_config() -> bool:
-    """检查LLM配置是否有效"""
-    return llm_config.check_api_key() 
\ No newline at end of file
+    """检查LLM配置是否有效；未配置任何 API Key 时返回 False"""
+    try:
+        return get_llm_config().check_api_key()
+    except ValueError:
+        return False 
\ No newline at end of file
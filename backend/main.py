@@ -1,23 +1,74 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, WebSocket, WebSocketDisconnect, status
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-import crud, models, schemas, database, dependencies
+import crud, schemas, database, dependencies
 from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
-from datetime import timedelta
-from jose import jwt
+from datetime import date, timedelta
 import re
 import os
-import httpx
+import asyncio
 import time
 import json
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from llm_config import get_llm_config, call_llm, check_llm_config
+from llm_config import get_llm_config, call_llm, check_llm_config, close_llm_config
+from prompts import get_prompt, get_prompt_registry
+from workbook_cache import get_workbook_cache, is_number, ColumnBlock
+from range_codec import MAX_DECODED_BYTES, MSGPACK_MEDIA_TYPE, DecodeLimitError, wants_msgpack, decode_columns_map, encode_columns_map
+from pydantic import ValidationError
+import msgpack
+from excel_address import parse_cell, cell_address, range_address
+from sheet_profiler import describe_sheet, split_header
+from data_cleaning import detect_anomalies, build_cleaning_operation, resolve_column
+from financial_statements import build_from_columns, detect_columns, normalize_codes
+from formula_graph import analyze_formulas, extract_formulas
+from formula_batch import OPERATIONS as FORMULA_BATCH_OPERATIONS, MAX_BATCH_ITEMS, run_formula_batch
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, METRICS_TOKEN, MetricsMiddleware, get_registry, observe_stage, record_cache, timed
+from profiling import ProfilingMiddleware, get_profile_store, is_authorized as is_profile_authorized
+from fast_json import FastJSONResponse
+from compression import CompressionMiddleware
+from http_cache import IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, conditional_json, get_script_store, make_etag, not_modified
+from rate_limit import RateLimitMiddleware, get_rate_limiter
+from idempotency import IdempotencyMiddleware
+from jobs import JobContext, JobQueueFull, get_job_manager
+from voucher_import import AccountIndex, LineTooLongError, VoucherValidator, import_vouchers, iter_csv_records, iter_ndjson_records
+from typing import Optional
+from warmup import run_warmup, warmup_crypto, warmup_database, warmup_llm_connection, warmup_agent
 
-models.Base.metadata.create_all(bind=database.engine)
+# 建表；由 serve.py 启动时已在主进程中完成，各 worker 跳过
+if os.getenv("DB_AUTO_CREATE", "true").lower() == "true":
+    database.init_db()
 load_dotenv()
 
-app = FastAPI(title="Excel AI 用户认证API")
+def _warmup_operation_templates() -> None:
+    """走一遍 Excel 操作规划的关键词匹配路径，预热相关代码与模板字符串"""
+    generate_excel_operations("凭证录入 对账 数据清洗 三大报表 求和 读取 图表")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时预热并启动任务 worker，关闭时停止 worker、释放上游连接"""
+    app.state.warmup = None
+    if os.getenv("WARMUP_ON_STARTUP", "true").lower() == "true":
+        app.state.warmup = await run_warmup([
+            ("crypto", warmup_crypto),
+            ("database", warmup_database),
+            ("llm_connection", warmup_llm_connection),
+            ("agent", warmup_agent),
+            ("operation_templates", _warmup_operation_templates),
+        ])
+    get_job_manager().start()
+    yield
+    await get_job_manager().stop()
+    await close_llm_config()
+
+app = FastAPI(title="Excel AI 用户认证API", lifespan=lifespan)
+
+# 限流在路由与数据库查询之前判定；位于 CORS 之内，浏览器可以读取 429 响应
+app.add_middleware(RateLimitMiddleware)
+# 携带 Idempotency-Key 的重试请求重放首次响应；位于限流之外，重放不消耗配额
+app.add_middleware(IdempotencyMiddleware)
 
 # 添加CORS中间件，允许本地前端访问
 app.add_middleware(
@@ -34,59 +85,165 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 最后添加的中间件在最外层，统计的耗时包含 CORS 处理与压缩
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(MetricsMiddleware)
 
-# 获取LLM配置
-llm_config = get_llm_config()
+def _require_llm_config():
+    """获取 LLM 配置；未配置任何 API Key 时返回 500（配置在首次使用时才解析，导入时不会失败）"""
+    try:
+        return get_llm_config()
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=f"LLM API 配置无效: {e}")
 
-async def call_llm_with_excel_context(user_message: str) -> str:
-    """调用 LLM API 进行Excel相关对话"""
+async def call_llm_with_excel_context(user_message: str, data_profile: Optional[str] = None) -> str:
+    """
+    调用 LLM API 进行Excel相关对话
+    
+    Args:
+        user_message: 用户消息
+        data_profile: 工作表统计概况（sheet_profiler 渲染的提示词），附加在用户消息之后
+    """
     try:
-        # 构建系统提示词，专门针对 Excel 操作
-        system_prompt = """你是一个专业的 Excel 财务助手。你的任务是理解用户的 Excel 需求，特别是财务相关的操作，并提供清晰的解决方案。
+        prompt = get_prompt("excel_assistant")
+        messages = prompt.build_messages(with_data_profile(user_message, data_profile))
+        
+        return await call_llm(messages, temperature=0.7, max_tokens=1000, on_usage=prompt.record_usage, endpoint="agent_chat")
+        
+    except Exception as e:
+        print(f"LLM API 调用失败: {e}")
+        return "抱歉，处理您的请求时出现错误，请稍后重试。"
 
-你应该：
-1. 用简洁明了的中文回复用户
-2. 如果用户需要 Excel 操作，描述具体的操作步骤
-3. 对于财务相关需求，提供专业的会计和财务指导
-4. 保持专业和友好的语调
+def with_data_profile(user_message: str, data_profile: Optional[str]) -> str:
+    """把工作表概况附加在用户消息之后（可变内容放在最后，不影响系统提示词的前缀缓存）"""
+    return f"{user_message}\n\n{data_profile}" if data_profile else user_message
 
-用户的需求可能包括：
+async def describe_context(user_id: int, context: Optional[schemas.AgentContext]) -> Optional[str]:
+    """为对话上下文指向的工作表快照生成概况提示词；统计在线程池中进行，结果按快照内容缓存"""
+    if context is None or not context.workbook_id or not context.sheet_name:
+        return None
+    return await asyncio.to_thread(describe_sheet, user_id, context.workbook_id, context.sheet_name)
 
-**基础功能：**
-- 公式生成和解释
-- 数据筛选和排序  
-- 图表创建
-- 数据分析
-- 格式化操作
+async def plan_context_operations(user_id: int, user_message: str, context: Optional[schemas.AgentContext]) -> list:
+    """
+    依据对话上下文中的工作表快照生成数据相关的操作
+    目前包括：
+    - 提到去重 / 异常值时在快照上运行清洗引擎，生成一个批量标记操作
+    - 提到三大报表且快照中能识别出科目编码、借方、贷方列时，生成科目余额表与三大报表的写入操作
+    """
+    if context is None or not context.workbook_id or not context.sheet_name:
+        return []
+    wants_cleaning = any(keyword in user_message for keyword in ["去重", "重复", "异常值", "异常"])
+    wants_statements = any(keyword in user_message for keyword in ["三大报表", "财务报表", "资产负债表", "利润表", "现金流量表"])
+    if not wants_cleaning and not wants_statements:
+        return []
+    cache = get_workbook_cache()
+    snapshot = cache.get_sheet(user_id, context.workbook_id, context.sheet_name)
+    if snapshot is None or snapshot.row_count == 0:
+        return []
+    
+    operations = []
+    if wants_cleaning:
+        def run():
+            columns = cache.read_columns(user_id, snapshot)
+            return detect_anomalies(columns, start_cell=snapshot.start_cell)
+        
+        try:
+            result = await asyncio.to_thread(run)
+            operations.append(build_cleaning_operation(snapshot.sheet_name, result))
+        except (KeyError, ValueError) as e:
+            print(f"数据清洗检测失败: {e}")
+    if wants_statements:
+        try:
+            result = await asyncio.to_thread(_build_statements_from_snapshot, user_id, snapshot)
+            operations.extend(result["operations"])
+        except (KeyError, ValueError) as e:
+            print(f"报表生成失败: {e}")
+    return operations
 
-**财务专业功能：**
-- 凭证录入：创建标准会计凭证录入模板，包括科目、借贷方向、金额等
-- 表格对账：对比两个数据表格，找出差异，生成对账报告
-- 数据清洗：清理财务数据，去除重复项，统一格式，处理异常值
-- 三大报表生成：创建资产负债表、利润表、现金流量表的标准模板
+def discard_task(task: asyncio.Task) -> None:
+    """取消不再需要的任务；已结束的任务取走其异常，避免 “Task exception was never retrieved” 警告"""
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        task.exception()
 
-当用户提到财务相关需求时，我会自动生成相应的Excel操作代码来帮助完成任务。
+def merge_context_operations(template_operations: list, context_operations: list) -> list:
+    """基于快照数据生成的操作取代同类型的关键词模板操作"""
+    replaced = {operation["operation_type"] for operation in context_operations}
+    return [operation for operation in template_operations if operation["operation_type"] not in replaced] + context_operations
 
-请根据用户输入提供最合适的建议。"""
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
-        ]
-        
-        return await call_llm(messages, temperature=0.7, max_tokens=1000)
-        
-    except Exception as e:
-        print(f"LLM API 调用失败: {e}")
-        return "抱歉，处理您的请求时出现错误，请稍后重试。"
+def parse_llm_response(user_message: str, ai_response: str, sheet_ranges: Optional[dict] = None) -> list:
+    """
+    解析 LLM 响应并生成相应的 Excel 操作
+    
+    目前的操作规划只依赖用户消息，因此直接委托给 generate_excel_operations；
+    需要依据 LLM 回复调整操作的逻辑应放在这里
+    """
+    return generate_excel_operations(user_message, sheet_ranges)
+
+# 没有工作表快照时使用的示例范围
+DEFAULT_SHEET_RANGES = {
+    "sheet_name": None,
+    "used_range": "A1:A10",
+    "sum_range": "A1:A10",
+    "sum_target": "A1",
+    "chart_range": "A1:B10",
+}
+
+def resolve_sheet_ranges(user_id: int, context: Optional[schemas.AgentContext]) -> Optional[dict]:
+    """
+    根据对话上下文指向的工作表快照推断操作使用的范围
+    
+    读取快照首块的前若干行判断是否有表头，并找出第一个数值列作为求和范围
+    """
+    if context is None or not context.workbook_id or not context.sheet_name:
+        return None
+    cache = get_workbook_cache()
+    snapshot = cache.get_sheet(user_id, context.workbook_id, context.sheet_name)
+    if snapshot is None or not snapshot.address or not snapshot.block_hashes:
+        return None
+    try:
+        sample = cache.read_rows(user_id, snapshot, 0, 50)
+    except KeyError:
+        return None
+    
+    start_row, start_col = parse_cell(snapshot.start_cell)
+    end_row = start_row + snapshot.row_count - 1
+    has_header = len(sample) > 1 and all(isinstance(v, str) for v in sample[0] if v is not None)
+    data_start = start_row + (1 if has_header else 0)
+    body = sample[1:] if has_header else sample
+    
+    numeric_col = 0
+    for col in range(snapshot.column_count):
+        values = [row[col] for row in body if col < len(row) and row[col] is not None]
+        if values and all(is_number(v) for v in values):
+            numeric_col = col
+            break
+    
+    sum_col = start_col + numeric_col
+    return {
+        "sheet_name": snapshot.sheet_name,
+        "used_range": snapshot.address,
+        "sum_range": range_address(data_start, sum_col, end_row, sum_col),
+        "sum_target": cell_address(end_row + 1, sum_col),
+        "chart_range": range_address(start_row, start_col, end_row, start_col + min(snapshot.column_count, 2) - 1),
+    }
 
-def parse_llm_response(user_message: str, ai_response: str) -> list:
-    """解析 LLM 响应并生成相应的 Excel 操作"""
+@timed("plan_operations")
+def generate_excel_operations(user_message: str, sheet_ranges: Optional[dict] = None) -> list:
+    """
+    根据用户消息生成 Excel 操作，不依赖 LLM 回复，可与 LLM 调用并行执行
+    
+    Args:
+        user_message: 用户消息
+        sheet_ranges: resolve_sheet_ranges 推断出的范围，为空时使用示例范围
+    """
     excel_operations = []
     
     # 简单的关键词匹配来生成操作
     user_message_lower = user_message.lower().strip()
-    ai_response_lower = ai_response.lower()
     
     # 检查是否是简单对话，不需要 Excel 操作
     simple_chat_keywords = [
@@ -313,10 +470,10 @@ def parse_llm_response(user_message: str, ai_response: str) -> list:
     incomeStatement.getRange("A4:B10").values = [
         ["营业收入", ""],
         ["营业成本", ""],
-        ["营业利润", "=A4-A5"],
+        ["营业利润", "=B4-B5"],
         ["营业外收入", ""],
         ["营业外支出", ""],
-        ["利润总额", "=A6+A7-A8"],
+        ["利润总额", "=B6+B7-B8"],
         ["所得税费用", ""]
     ];
     
@@ -337,10 +494,10 @@ def parse_llm_response(user_message: str, ai_response: str) -> list:
     cashFlow.getRange("A4:B10").values = [
         ["经营活动现金流入", ""],
         ["经营活动现金流出", ""],
-        ["经营活动产生的现金流量净额", "=A4-A5"],
+        ["经营活动产生的现金流量净额", "=B4-B5"],
         ["投资活动产生的现金流量净额", ""],
         ["筹资活动产生的现金流量净额", ""],
-        ["现金及现金等价物净增加额", "=A6+A7+A8"],
+        ["现金及现金等价物净增加额", "=B6+B7+B8"],
         ["期初现金余额", ""]
     ];
     
@@ -350,19 +507,27 @@ def parse_llm_response(user_message: str, ai_response: str) -> list:
             "parameters": {"reports": ["balance_sheet", "income_statement", "cash_flow"]}
         })
     
+    # 有工作表快照时使用真实的数据范围，否则使用默认示例范围
+    ranges = sheet_ranges or DEFAULT_SHEET_RANGES
+    sheet_js = (
+        f"context.workbook.worksheets.getItem({json.dumps(ranges['sheet_name'], ensure_ascii=False)})"
+        if ranges.get("sheet_name") else "context.workbook.worksheets.getActiveWorksheet()"
+    )
+    
     # 检查是否需要生成公式
     if any(keyword in user_message_lower for keyword in ["求和", "总和", "sum", "公式", "计算"]):
+        formula = f"=SUM({ranges['sum_range']})"
         excel_operations.append({
             "operation_type": "generate_formula",
             "description": "生成求和公式",
-            "js_code": """Excel.run(async (context) => {
-    const sheet = context.workbook.worksheets.getActiveWorksheet();
-    const range = sheet.getRange("A1");
-    range.formulas = [["=SUM(A1:A10)"]];
+            "js_code": f"""Excel.run(async (context) => {{
+    const sheet = {sheet_js};
+    const range = sheet.getRange("{ranges['sum_target']}");
+    range.formulas = [["{formula}"]];
     await context.sync();
     console.log("求和公式已生成");
-});""",
-            "parameters": {"formula": "=SUM(A1:A10)", "target_cell": "A1"}
+}});""",
+            "parameters": {"formula": formula, "target_cell": ranges["sum_target"]}
         })
     
     # 检查是否需要读取数据
@@ -370,14 +535,14 @@ def parse_llm_response(user_message: str, ai_response: str) -> list:
         excel_operations.append({
             "operation_type": "read_range",
             "description": "读取数据范围",
-            "js_code": """Excel.run(async (context) => {
-    const sheet = context.workbook.worksheets.getActiveWorksheet();
-    const range = sheet.getRange("A1:A10");
+            "js_code": f"""Excel.run(async (context) => {{
+    const sheet = {sheet_js};
+    const range = sheet.getRange("{ranges['used_range']}");
     range.load("values");
     await context.sync();
     console.log("数据已读取:", range.values);
-});""",
-            "parameters": {"range": "A1:A10"}
+}});""",
+            "parameters": {"range": ranges["used_range"]}
         })
     
     # 检查是否需要创建图表
@@ -385,16 +550,16 @@ def parse_llm_response(user_message: str, ai_response: str) -> list:
         excel_operations.append({
             "operation_type": "create_chart",
             "description": "创建柱状图",
-            "js_code": """Excel.run(async (context) => {
-    const sheet = context.workbook.worksheets.getActiveWorksheet();
-    const dataRange = sheet.getRange("A1:B10");
+            "js_code": f"""Excel.run(async (context) => {{
+    const sheet = {sheet_js};
+    const dataRange = sheet.getRange("{ranges['chart_range']}");
     const chart = sheet.charts.add(Excel.ChartType.columnClustered, dataRange);
     chart.title.text = "数据图表";
     chart.legend.position = Excel.ChartLegendPosition.right;
     await context.sync();
     console.log("图表创建成功");
-});""",
-            "parameters": {"chart_type": "column", "data_range": "A1:B10", "title": "数据图表"}
+}});""",
+            "parameters": {"chart_type": "column", "data_range": ranges["chart_range"], "title": "数据图表"}
         })
     
     # 只有在检测到明确的 Excel 相关关键词时才提供通用操作
@@ -421,9 +586,9 @@ def parse_llm_response(user_message: str, ai_response: str) -> list:
     
     return excel_operations
 
-# 注册接口
+# 注册接口（同步数据库查询与 bcrypt：定义为普通函数，由线程池执行，不阻塞事件循环）
 @app.post("/register", response_model=schemas.User)
-async def register_user(user: schemas.UserCreate, db: Session = Depends(database.get_db)):
+def register_user(user: schemas.UserCreate, db: Session = Depends(database.get_db)):
     db_user = crud.get_user_by_email(db, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
@@ -433,9 +598,9 @@ async def register_user(user: schemas.UserCreate, db: Session = Depends(database
         raise HTTPException(status_code=400, detail="Password must contain English characters")
     return crud.create_user(db=db, user=user)
 
-# 登录接口
+# 登录接口（同上，由线程池执行）
 @app.post("/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(database.get_db)):
+def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(database.get_db)):
     user = crud.get_user_by_email(db, form_data.username)
     hashed_password = getattr(user, 'hashed_password', None)
     if not user or not isinstance(hashed_password, str) or not crud.verify_password(form_data.password, hashed_password):
@@ -445,6 +610,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             headers={"WWW-Authenticate": "Bearer"},
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    from jose import jwt  # 延迟导入：加密后端较重，由预热阶段 crypto 提前加载
     access_token = jwt.encode({"sub": user.email}, SECRET_KEY, algorithm=ALGORITHM)
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -460,17 +626,15 @@ async def generate_formula(request: schemas.NLToFormulaRequest, current_user: sc
         raise HTTPException(status_code=500, detail="LLM API 配置无效")
     
     try:
-        messages = [
-            {"role": "system", "content": "You are an AI assistant that generates Excel formulas from natural language descriptions. Provide only the formula, without any additional text or explanation. If you cannot generate a formula, respond with 'Error: Could not generate formula.'"},
-            {"role": "user", "content": request.text}
-        ]
+        prompt = get_prompt("generate_formula")
+        messages = prompt.build_messages(request.text)
         
-        generated_formula = await call_llm(messages)
+        generated_formula = await call_llm(messages, on_usage=prompt.record_usage, endpoint="generate_formula")
         
         if generated_formula.lower().startswith("error:"):
             raise HTTPException(status_code=500, detail=generated_formula)
         
-        return schemas.FormulaResponse(formula=generated_formula.strip())
+        return FastJSONResponse(schemas.FormulaResponse.model_construct(formula=generated_formula.strip()))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成公式时出错: {str(e)}")
@@ -482,13 +646,11 @@ async def explain_formula(request: schemas.ExplainFormulaRequest, current_user:
         raise HTTPException(status_code=500, detail="LLM API 配置无效")
     
     try:
-        messages = [
-            {"role": "system", "content": "You are an AI assistant that explains Excel formulas in a clear and concise manner. Provide only the explanation, without any additional text or introduction."},
-            {"role": "user", "content": f"Explain the Excel formula: {request.formula}"}
-        ]
+        prompt = get_prompt("explain_formula")
+        messages = prompt.build_messages(f"Explain the Excel formula: {request.formula}")
         
-        explanation = await call_llm(messages)
-        return schemas.ExplainFormulaResponse(explanation=explanation.strip())
+        explanation = await call_llm(messages, on_usage=prompt.record_usage, endpoint="explain_formula")
+        return FastJSONResponse(schemas.ExplainFormulaResponse.model_construct(explanation=explanation.strip()))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"解释公式时出错: {str(e)}")
@@ -500,12 +662,10 @@ async def optimize_formula(request: schemas.OptimizeFormulaRequest, current_user
         raise HTTPException(status_code=500, detail="LLM API 配置无效")
     
     try:
-        messages = [
-            {"role": "system", "content": "You are an AI assistant that optimizes Excel formulas. Provide the optimized formula and a brief explanation of the optimization. Format your response as: Optimized Formula: [formula]\nExplanation: [explanation]."},
-            {"role": "user", "content": f"Optimize the Excel formula: {request.formula}"}
-        ]
+        prompt = get_prompt("optimize_formula")
+        messages = prompt.build_messages(f"Optimize the Excel formula: {request.formula}")
         
-        content = await call_llm(messages)
+        content = await call_llm(messages, on_usage=prompt.record_usage, endpoint="optimize_formula")
         
         optimized_formula = ""
         explanation = ""
@@ -519,11 +679,11 @@ async def optimize_formula(request: schemas.OptimizeFormulaRequest, current_user
         if not optimized_formula or not explanation:
             raise HTTPException(status_code=500, detail="LLM API返回了无法解析的优化格式")
         
-        return schemas.OptimizeFormulaResponse(
+        return FastJSONResponse(schemas.OptimizeFormulaResponse.model_construct(
             original_formula=request.formula,
             suggested_formula=optimized_formula,
             explanation=explanation
-        )
+        ))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"优化公式时出错: {str(e)}")
@@ -535,12 +695,10 @@ async def diagnose_error(request: schemas.DiagnoseErrorRequest, current_user: sc
         raise HTTPException(status_code=500, detail="LLM API 配置无效")
     
     try:
-        messages = [
-            {"role": "system", "content": "You are an AI assistant that diagnoses errors in Excel formulas and suggests fixes. Provide the error type, explanation, and suggested fix. Format your response as: Error Type: [type]\nExplanation: [explanation]\nSuggested Fix: [fix]."},
-            {"role": "user", "content": f"Diagnose the error in this Excel formula: {request.formula}"}
-        ]
+        prompt = get_prompt("diagnose_error")
+        messages = prompt.build_messages(f"Diagnose the error in this Excel formula: {request.formula}")
         
-        content = await call_llm(messages)
+        content = await call_llm(messages, on_usage=prompt.record_usage, endpoint="diagnose_error")
         
         error_type = ""
         explanation = ""
@@ -557,15 +715,40 @@ async def diagnose_error(request: schemas.DiagnoseErrorRequest, current_user: sc
         if not error_type or not explanation or not suggested_fix:
             raise HTTPException(status_code=500, detail="LLM API返回了无法解析的诊断格式")
         
-        return schemas.DiagnoseErrorResponse(
+        return FastJSONResponse(schemas.DiagnoseErrorResponse.model_construct(
             error_type=error_type,
             explanation=explanation,
             suggested_fix=suggested_fix
-        )
+        ))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"诊断公式错误时出错: {str(e)}")
 
+def _check_formula_batch(request: schemas.FormulaBatchRequest) -> None:
+    if request.operation not in FORMULA_BATCH_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"不支持的操作: {request.operation}")
+    if len(request.items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"单次最多处理 {MAX_BATCH_ITEMS} 条")
+
+# 公式批量处理（NDJSON 流式返回）
+@app.post("/api/formulas/batch")
+async def formula_batch(request: schemas.FormulaBatchRequest, current_user: schemas.User = Depends(dependencies.get_current_user)):
+    """
+    批量生成 / 解释 / 优化 / 诊断公式
+    相同公式只处理一次，缓存与本地规则能确定的结果立即返回，其余打包为多条目提示词并发调用 LLM；
+    响应为 application/x-ndjson，每行一个 FormulaBatchEvent，按完成顺序推送，最后一行为汇总
+    """
+    _check_formula_batch(request)
+    
+    async def event_stream():
+        async for event in run_formula_batch(request.operation, request.items, request.batch_size):
+            started = time.perf_counter()
+            line = schemas.FormulaBatchEvent(**event).model_dump_json(exclude_none=True) + "\n"
+            observe_stage("serialization", time.perf_counter() - started)
+            yield line
+    
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
 # Agent 对话接口
 @app.post("/agent/chat")
 async def agent_chat(
@@ -580,11 +763,22 @@ async def agent_chat(
         if not check_llm_config():
             raise HTTPException(status_code=500, detail="LLM API 配置无效")
         
-        # 调用 LLM API 进行对话
-        llm_response = await call_llm_with_excel_context(request.message)
-        
-        # 解析响应并生成 Excel 操作
-        excel_operations = parse_llm_response(request.message, llm_response)
+        # LLM 调用与 Excel 操作规划并行：先发出 LLM 请求，再在等待期间生成操作
+        data_profile = await describe_context(current_user.id, request.context)
+        llm_task = asyncio.create_task(call_llm_with_excel_context(request.message, data_profile))
+        try:
+            await asyncio.sleep(0)
+            sheet_ranges = resolve_sheet_ranges(current_user.id, request.context)
+            excel_operations = merge_context_operations(
+                generate_excel_operations(request.message, sheet_ranges),
+                await plan_context_operations(current_user.id, request.message, request.context),
+            )
+            llm_response = await llm_task
+        finally:
+            # 规划操作失败时不再等待 LLM 回复，取消仍在进行的调用
+            discard_task(llm_task)
+        if request.script_refs:
+            excel_operations = get_script_store().attach_refs(excel_operations)
         
         response_data = {
             "success": True,
@@ -593,59 +787,666 @@ async def agent_chat(
             "conversation_id": request.conversation_id or f"conv_{int(time.time())}"
         }
         
-        return schemas.AgentChatResponse(**response_data)
+        # 操作由本进程的模板生成，字段已是正确类型：跳过模型校验，直接编码
+        return FastJSONResponse(schemas.AgentChatResponse.model_construct(**response_data))
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, 
             detail=f"Agent 处理请求时出错: {str(e)}"
         )
 
+# Agent 对话接口（NDJSON 流式返回）
+@app.post("/agent/chat/stream")
+async def agent_chat_stream(
+    request: schemas.AgentChatRequest,
+    current_user: schemas.User = Depends(dependencies.get_current_user)
+):
+    """
+    Agent 对话接口的流式版本
+    Excel 操作只依赖用户消息，在 LLM 返回之前就以 excel_operation 事件先行推送，
+    前端可以立即开始执行；LLM 回复到达后再推送 final 事件
+    响应为 application/x-ndjson，每行一个 AgentEvent
+    """
+    if not check_llm_config():
+        raise HTTPException(status_code=500, detail="LLM API 配置无效")
+    
+    conversation_id = request.conversation_id or f"conv_{int(time.time())}"
+    
+    def encode(event: schemas.AgentEvent) -> str:
+        started = time.perf_counter()
+        line = event.model_dump_json(exclude_none=True) + "\n"
+        observe_stage("serialization", time.perf_counter() - started)
+        return line
+    
+    async def event_stream():
+        data_profile = await describe_context(current_user.id, request.context)
+        llm_task = asyncio.create_task(call_llm_with_excel_context(request.message, data_profile))
+        try:
+            sheet_ranges = resolve_sheet_ranges(current_user.id, request.context)
+            excel_operations = merge_context_operations(
+                generate_excel_operations(request.message, sheet_ranges),
+                await plan_context_operations(current_user.id, request.message, request.context),
+            )
+            for operation in excel_operations:
+                yield encode(schemas.AgentEvent(type="excel_operation", conversation_id=conversation_id, operation=operation))
+            
+            llm_response = await llm_task
+            yield encode(schemas.AgentEvent(
+                type="final",
+                conversation_id=conversation_id,
+                success=True,
+                response=llm_response,
+                excel_operations=excel_operations
+            ))
+        except Exception as e:
+            yield encode(schemas.AgentEvent(type="error", conversation_id=conversation_id, error=f"Agent 处理请求时出错: {str(e)}"))
+        finally:
+            discard_task(llm_task)
+    
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+# Agent 流式对话接口
+@app.websocket("/agent/ws")
+async def agent_chat_ws(
+    websocket: WebSocket,
+    current_user: schemas.User = Depends(dependencies.get_current_user_ws)
+):
+    """
+    Agent 流式对话接口（WebSocket）
+    客户端连接 /agent/ws?token=<JWT> 后发送 {"message": "...", "conversation_id": "..."}，
+    服务端依次推送 token / tool_start / tool_end / excel_operation / final 事件，
+    前端可在收到第一个 excel_operation 时即开始执行，无需等待整个工作流结束
+    """
+    # agent_core 依赖 langchain / langgraph，仅在使用该接口时导入
+    from agent_core import get_agent
+    
+    await websocket.accept()
+    try:
+        while True:
+            payload = await websocket.receive_json()
+            try:
+                request = schemas.AgentStreamRequest(**payload)
+            except Exception as e:
+                await websocket.send_json(schemas.AgentEvent(type="error", error=f"无效的请求: {str(e)}").model_dump(exclude_none=True))
+                continue
+            
+            conversation_id = request.conversation_id or f"conv_{int(time.time())}"
+            limited = await get_rate_limiter().hit("/agent/ws", f"user:{current_user.email}")
+            if limited is not None and not limited[1].allowed:
+                await websocket.send_json(schemas.AgentEvent(
+                    type="error", conversation_id=conversation_id,
+                    error=f"请求过于频繁，请 {limited[1].retry_seconds} 秒后重试"
+                ).model_dump(exclude_none=True))
+                continue
+            try:
+                if not check_llm_config():
+                    raise ValueError("LLM API 配置无效")
+                agent = get_agent()
+                data_profile = await describe_context(current_user.id, request.context)
+                async for event in agent.stream_chat(request.message, data_profile):
+                    await websocket.send_json(
+                        schemas.AgentEvent(conversation_id=conversation_id, **event).model_dump(exclude_none=True)
+                    )
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                await websocket.send_json(
+                    schemas.AgentEvent(type="error", conversation_id=conversation_id, error=f"Agent 处理请求时出错: {str(e)}").model_dump(exclude_none=True)
+                )
+    except WebSocketDisconnect:
+        pass
+
+async def read_negotiated_body(http_request: Request) -> dict:
+    """按 Content-Type 解析 JSON 或 MessagePack 请求体"""
+    body = await http_request.body()
+    try:
+        if http_request.headers.get("content-type", "").startswith(MSGPACK_MEDIA_TYPE):
+            payload = msgpack.unpackb(body, raw=False)
+        else:
+            payload = json.loads(body)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"无法解析请求体: {str(e)}")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="请求体必须是对象")
+    return payload
+
+def negotiated_response(http_request: Request, model):
+    """客户端 Accept 包含 MessagePack 时以 MessagePack 返回，否则按 JSON 返回"""
+    if wants_msgpack(http_request.headers.get("accept")):
+        started = time.perf_counter()
+        content = msgpack.packb(model.model_dump(), use_bin_type=True)
+        observe_stage("serialization", time.perf_counter() - started)
+        return Response(content=content, media_type=MSGPACK_MEDIA_TYPE)
+    return FastJSONResponse(model)
+
+def _store_snapshot_blocks(user_id: int, blocks: list) -> list:
+    """
+    解码并存入快照块，返回按顺序排列的块哈希
+    所有块解码后的总大小不超过 MAX_DECODED_BYTES，超出时返回 413
+    """
+    cache = get_workbook_cache()
+    budget = MAX_DECODED_BYTES
+    block_hashes = []
+    for block in blocks:
+        if block.rows is not None:
+            budget -= len(block.rows) * max((len(row) for row in block.rows), default=0) * 8
+            if budget < 0:
+                raise HTTPException(status_code=413, detail=f"解码后的数据超过单次请求的上限 {MAX_DECODED_BYTES // (1024 * 1024)} MB")
+            block_hashes.append(cache.put_block(user_id, block.rows))
+        elif block.columns is not None:
+            try:
+                columns = decode_columns_map(block.columns, max_bytes=budget)
+            except DecodeLimitError as e:
+                raise HTTPException(status_code=413, detail=str(e))
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"无法解码列数据: {str(e)}")
+            budget -= sum(column.nbytes for column in columns)
+            encoded = msgpack.packb(block.columns, use_bin_type=True)
+            block_hashes.append(cache.put_column_block(user_id, ColumnBlock.from_columns(columns, block.columns["n"], encoded)))
+        elif block.hash:
+            block_hashes.append(block.hash)
+        else:
+            raise HTTPException(status_code=400, detail="每个块必须提供 rows 或 hash")
+    return block_hashes
+
+# 工作表快照上传 / 增量同步
+@app.post(
+    "/api/workbook/snapshot",
+    response_model=schemas.WorkbookSnapshotResponse,
+    openapi_extra={"requestBody": {"content": {
+        "application/json": {"schema": schemas.WorkbookSnapshotRequest.model_json_schema()},
+        MSGPACK_MEDIA_TYPE: {"schema": {"type": "string", "format": "binary"}}
+    }}}
+)
+async def upload_workbook_snapshot(
+    http_request: Request,
+    current_user: schemas.User = Depends(dependencies.get_current_user)
+):
+    """
+    上传或增量同步工作表快照
+    
+    blocks 按顺序列出工作表的全部行块：内容有变化的块携带 rows（JSON）或 columns（MessagePack 列编码），
+    未变化的块只携带 hash。如果服务端缺少某些只给出 hash 的块（从未上传或已被淘汰），
+    返回 complete=false 和 missing 列表，客户端补传这些块后重新提交即可。
+    返回的 block_hashes 是服务端计算的权威哈希。
+    请求体可以是 JSON，也可以是 application/x-msgpack
+    """
+    try:
+        request = schemas.WorkbookSnapshotRequest(**(await read_negotiated_body(http_request)))
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=json.loads(e.json()))
+    
+    if request.block_rows <= 0:
+        raise HTTPException(status_code=400, detail="block_rows 必须为正整数")
+    try:
+        parse_cell(request.start_cell)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    cache = get_workbook_cache()
+    # 解码、列化与哈希计算在线程池中执行，大快照不阻塞事件循环
+    block_hashes = await asyncio.to_thread(_store_snapshot_blocks, current_user.id, request.blocks)
+    
+    missing = cache.missing_blocks(current_user.id, block_hashes)
+    # 只传哈希的块是客户端复用的已缓存块
+    referenced = sum(1 for block in request.blocks if block.rows is None and block.columns is None)
+    record_cache("workbook_block", True, referenced - len(missing))
+    record_cache("workbook_block", False, len(missing))
+    if missing:
+        return negotiated_response(http_request, schemas.WorkbookSnapshotResponse(complete=False, missing=missing, block_hashes=block_hashes))
+    
+    snapshot = cache.commit_sheet(current_user.id, request.workbook_id, request.sheet_name, request.start_cell, request.block_rows, block_hashes)
+    return negotiated_response(http_request, schemas.WorkbookSnapshotResponse(
+        complete=True,
+        block_hashes=block_hashes,
+        row_count=snapshot.row_count,
+        column_count=snapshot.column_count,
+        address=snapshot.address
+    ))
+
+# 工作表快照清单
+@app.get("/api/workbook/{workbook_id}/sheets/{sheet_name}")
+async def get_workbook_sheet(
+    workbook_id: str,
+    sheet_name: str,
+    current_user: schemas.User = Depends(dependencies.get_current_user)
+):
+    """获取工作表快照清单（块哈希、范围等），客户端据此计算需要同步的块"""
+    snapshot = get_workbook_cache().get_sheet(current_user.id, workbook_id, sheet_name)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="未找到工作表快照")
+    manifest = snapshot.to_dict()
+    manifest["missing"] = get_workbook_cache().missing_blocks(current_user.id, snapshot.block_hashes)
+    return manifest
+
+async def _detect_anomalies(user_id: int, request: schemas.DataCleaningRequest) -> schemas.DataCleaningResponse:
+    """数据清洗检测（接口与后台任务共用）"""
+    cache = get_workbook_cache()
+    snapshot = cache.get_sheet(user_id, request.workbook_id, request.sheet_name)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="未找到工作表快照")
+    
+    def run():
+        columns = cache.read_columns(user_id, snapshot)
+        return detect_anomalies(
+            columns,
+            start_cell=snapshot.start_cell,
+            key_columns=request.key_columns,
+            value_columns=request.value_columns,
+            group_by=request.group_by,
+            method=request.method,
+            threshold=request.threshold,
+            near_duplicates=request.near_duplicates,
+            max_items=request.max_items,
+        )
+    
+    try:
+        result = await asyncio.to_thread(run)
+    except KeyError as e:
+        raise HTTPException(status_code=409, detail={"message": "快照数据块已失效，请重新同步", "missing": e.args[0]})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return schemas.DataCleaningResponse(
+        summary=result["summary"],
+        exact_duplicates=result["exact_duplicates"],
+        near_duplicates=result["near_duplicates"],
+        outliers=result["outliers"],
+        operation=build_cleaning_operation(snapshot.sheet_name, result),
+    )
+
+# 数据清洗：重复行与异常值检测
+@app.post("/api/data-cleaning/detect", response_model=schemas.DataCleaningResponse)
+async def detect_data_anomalies(
+    request: schemas.DataCleaningRequest,
+    current_user: schemas.User = Depends(dependencies.get_current_user)
+):
+    """
+    在工作表快照上检测完全重复、近似重复与异常值
+    返回单元格坐标明细，以及一个批量标记底色的 Excel 操作（js_code + payload）
+    """
+    return FastJSONResponse(await _detect_anomalies(current_user.id, request))
+
+def _build_statements_from_snapshot(user_id: int, snapshot, columns: Optional[dict] = None) -> dict:
+    """读取快照并生成三大报表；列引用无法解析时抛出 ValueError，数据块失效时抛出 KeyError"""
+    headers, body = split_header(get_workbook_cache().read_columns(user_id, snapshot), True)
+    start_col = parse_cell(snapshot.start_cell)[1]
+    mapping = {
+        field: resolve_column(reference, headers, start_col, len(body))
+        for field, reference in (columns or {}).items()
+    }
+    return build_from_columns(headers, body, mapping)
+
+async def _generate_statements(user_id: int, request: schemas.FinancialStatementsRequest) -> schemas.FinancialStatementsResponse:
+    """三大报表生成（接口与后台任务共用）"""
+    snapshot = get_workbook_cache().get_sheet(user_id, request.workbook_id, request.sheet_name)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="未找到工作表快照")
+    try:
+        result = await asyncio.to_thread(_build_statements_from_snapshot, user_id, snapshot, request.columns)
+    except KeyError as e:
+        raise HTTPException(status_code=409, detail={"message": "快照数据块已失效，请重新同步", "missing": e.args[0]})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return schemas.FinancialStatementsResponse(**result)
+
+# 三大报表生成
+@app.post("/api/financial-statements", response_model=schemas.FinancialStatementsResponse)
+async def generate_financial_statements(
+    request: schemas.FinancialStatementsRequest,
+    current_user: schemas.User = Depends(dependencies.get_current_user)
+):
+    """
+    由工作表快照中的凭证分录或科目余额数据生成科目余额表与三大报表
+    返回服务端计算的报表数值、平衡校验，以及每张工作表一个分块写入操作（需按顺序执行）
+    """
+    return FastJSONResponse(await _generate_statements(current_user.id, request))
+
+def _account_index_from_snapshot(user_id: int, snapshot) -> AccountIndex:
+    """由科目表快照建立科目索引：按表头识别科目编码 / 名称列，未识别时取第一列为编码"""
+    headers, body = split_header(get_workbook_cache().read_columns(user_id, snapshot), True)
+    mapping = detect_columns(headers or [])
+    codes, inverse = normalize_codes(body[mapping.get("account_code", 0)])
+    names = {}
+    if "account_name" in mapping:
+        for index, name in zip(inverse.tolist(), body[mapping["account_name"]].tolist()):
+            if name is not None and codes[index]:
+                names.setdefault(codes[index], str(name).strip())
+    return AccountIndex(codes=[code for code in codes.tolist() if code], names=names)
+
+# 凭证批量导入
+@app.post("/api/vouchers/import", response_model=schemas.VoucherImportResponse)
+async def import_voucher_batch(
+    http_request: Request,
+    format: Optional[str] = None,
+    period_start: Optional[date] = None,
+    period_end: Optional[date] = None,
+    target_sheet: str = "凭证导入",
+    max_errors: int = 1000,
+    workbook_id: Optional[str] = None,
+    accounts_sheet: Optional[str] = None,
+    current_user: schemas.User = Depends(dependencies.get_current_user)
+):
+    """
+    以流的方式导入凭证分录（CSV 首行为表头，或 NDJSON 每行一个对象）
+    单次遍历校验借贷平衡、科目编码与日期范围，返回错误索引和写入规范化数据集的分块写入操作
+    format 未指定时按 Content-Type 判断；指定 workbook_id + accounts_sheet 时以该快照中的科目表校验科目编码
+    """
+    accounts = None
+    if accounts_sheet:
+        snapshot = get_workbook_cache().get_sheet(current_user.id, workbook_id or "", accounts_sheet)
+        if snapshot is None:
+            raise HTTPException(status_code=404, detail="未找到科目表快照")
+        try:
+            accounts = await asyncio.to_thread(_account_index_from_snapshot, current_user.id, snapshot)
+        except KeyError as e:
+            raise HTTPException(status_code=409, detail={"message": "快照数据块已失效，请重新同步", "missing": e.args[0]})
+
+    if format is None:
+        content_type = http_request.headers.get("content-type", "")
+        format = "ndjson" if "ndjson" in content_type or "jsonl" in content_type else "csv"
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format 仅支持 csv 或 ndjson")
+    if period_start and period_end and period_start > period_end:
+        raise HTTPException(status_code=400, detail="会计期间起始日期晚于结束日期")
+
+    validator = VoucherValidator(accounts, period_start, period_end, max_errors=max(max_errors, 0))
+    records = iter_ndjson_records(http_request.stream()) if format == "ndjson" else iter_csv_records(http_request.stream())
+    try:
+        result = await import_vouchers(records, validator, target_sheet)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="凭证数据须为 UTF-8 编码")
+    except LineTooLongError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    return FastJSONResponse(schemas.VoucherImportResponse(**result))
+
+def _analyze_formula_snapshots(user_id: int, snapshots: list, top_n: int) -> dict:
+    """读取各工作表快照中的公式并分析依赖图；数据块失效时抛出 KeyError"""
+    cache = get_workbook_cache()
+    sheets = {}
+    for snapshot in snapshots:
+        start_row, start_col = parse_cell(snapshot.start_cell)
+        formulas = extract_formulas(cache.read_columns(user_id, snapshot), start_row, start_col)
+        sheets[snapshot.sheet_name] = (formulas, start_row + snapshot.row_count, start_col + snapshot.column_count)
+    return analyze_formulas(sheets, top_n)
+
+async def _analyze_formula_graph(user_id: int, request: schemas.FormulaGraphRequest) -> schemas.FormulaGraphResponse:
+    """公式依赖图分析（接口与后台任务共用）"""
+    cache = get_workbook_cache()
+    if request.sheet_names:
+        snapshots = [cache.get_sheet(user_id, request.workbook_id, name) for name in request.sheet_names]
+        missing = [name for name, snapshot in zip(request.sheet_names, snapshots) if snapshot is None]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"未找到工作表快照: {', '.join(missing)}")
+    else:
+        snapshots = cache.list_sheets(user_id, request.workbook_id)
+        if not snapshots:
+            raise HTTPException(status_code=404, detail="未找到工作簿快照")
+    try:
+        result = await asyncio.to_thread(_analyze_formula_snapshots, user_id, snapshots, max(request.top_n, 1))
+    except KeyError as e:
+        raise HTTPException(status_code=409, detail={"message": "快照数据块已失效，请重新同步", "missing": e.args[0]})
+    return schemas.FormulaGraphResponse(**result)
+
+# 公式依赖图与重算成本分析
+@app.post("/api/formula-graph/analyze", response_model=schemas.FormulaGraphResponse)
+async def analyze_formula_graph(
+    request: schemas.FormulaGraphRequest,
+    current_user: schemas.User = Depends(dependencies.get_current_user)
+):
+    """
+    解析工作簿快照中的全部公式，建立依赖图
+    返回按估算重算成本排序的热点公式模式、易失函数的影响范围、最长依赖链、整列引用与循环引用，
+    optimize_targets 可直接提交给 /api/optimize-formula
+    """
+    return FastJSONResponse(await _analyze_formula_graph(current_user.id, request))
+
+# 后台任务：耗时的报表 / 清洗 / 批量公式处理以任务形式提交，轮询或订阅进度后取回结果
+# 各任务在每个阶段结束后检查取消（含其他 worker 发出的取消请求），已取消的任务不再进入下一阶段
+async def _data_cleaning_job(context: JobContext, params: schemas.DataCleaningRequest):
+    await context.report(0.0, "正在检测重复行与异常值")
+    result = await _detect_anomalies(context.user_id, params)
+    await context.check_cancelled()
+    await context.report(0.9, "正在整理结果")
+    return result.model_dump(mode="json")
+
+async def _financial_statements_job(context: JobContext, params: schemas.FinancialStatementsRequest):
+    await context.report(0.0, "正在生成三大报表")
+    result = await _generate_statements(context.user_id, params)
+    await context.check_cancelled()
+    await context.report(0.9, "正在整理结果")
+    return result.model_dump(mode="json")
+
+async def _formula_graph_job(context: JobContext, params: schemas.FormulaGraphRequest):
+    await context.report(0.0, "正在分析公式依赖")
+    result = await _analyze_formula_graph(context.user_id, params)
+    await context.check_cancelled()
+    await context.report(0.9, "正在整理结果")
+    return result.model_dump(mode="json")
+
+async def _formula_batch_job(context: JobContext, params: schemas.FormulaBatchRequest):
+    """批量公式任务：结果按原始位置排列，进度为已完成条目的比例"""
+    _check_formula_batch(params)
+    total = len(params.items)
+    results = [None] * total
+    done = 0
+    summary = None
+    async for event in run_formula_batch(params.operation, params.items, params.batch_size):
+        if event["type"] == "summary":
+            summary = event["summary"]
+            continue
+        item = schemas.FormulaBatchEvent(**event).model_dump(exclude_none=True, exclude={"type", "indices"})
+        for index in event["indices"]:
+            results[index] = item
+        done += len(event["indices"])
+        await context.report(done / total if total else 1.0, f"已完成 {done}/{total}")
+    return {"results": results, "summary": summary}
+
+job_manager = get_job_manager()
+job_manager.register("data_cleaning", _data_cleaning_job, schemas.DataCleaningRequest)
+job_manager.register("financial_statements", _financial_statements_job, schemas.FinancialStatementsRequest)
+job_manager.register("formula_graph", _formula_graph_job, schemas.FormulaGraphRequest)
+job_manager.register("formula_batch", _formula_batch_job, schemas.FormulaBatchRequest)
+
+async def _get_user_job(job_id: str, user_id: int):
+    job = await job_manager.get(job_id, user_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return job
+
+@app.post("/api/jobs", response_model=schemas.JobStatus, status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(request: schemas.JobSubmitRequest, current_user: schemas.User = Depends(dependencies.get_current_user)):
+    """
+    提交后台任务，立即返回任务状态
+    之后通过 GET /api/jobs/{job_id} 轮询或 /events 订阅进度，完成后从 /result 取回结果；队列已满时返回 429
+    """
+    try:
+        job = await job_manager.submit(current_user.id, request.kind, request.params)
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"不支持的任务类型: {request.kind}，可选: {', '.join(job_manager.kinds)}")
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+    except JobQueueFull:
+        raise HTTPException(status_code=429, detail="任务队列已满，请稍后重试", headers={"Retry-After": "5"})
+    return job.to_status()
+
+@app.get("/api/jobs/{job_id}", response_model=schemas.JobStatus)
+async def get_job_status(job_id: str, current_user: schemas.User = Depends(dependencies.get_current_user)):
+    """查询任务状态与进度"""
+    return (await _get_user_job(job_id, current_user.id)).to_status()
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, current_user: schemas.User = Depends(dependencies.get_current_user)):
+    """
+    订阅任务进度（application/x-ndjson）
+    每次状态或进度变化推送一行 JobStatus，任务结束后关闭连接
+    """
+    await _get_user_job(job_id, current_user.id)
+    
+    async def event_stream():
+        async for job_status in job_manager.watch(job_id, current_user.id):
+            yield json.dumps(job_status, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+@app.get("/api/jobs/{job_id}/result", response_model=schemas.JobResult)
+async def get_job_result(job_id: str, http_request: Request, current_user: schemas.User = Depends(dependencies.get_current_user)):
+    """取回任务结果；任务尚未结束时返回 409，失败或取消时 error 为原因；结束后的结果不再变化，带 ETag"""
+    job = await _get_user_job(job_id, current_user.id)
+    if not job.done:
+        raise HTTPException(status_code=409, detail={"message": "任务尚未完成", "status": job.status, "progress": job.progress})
+    etag = make_etag(job.id, job.status, job.finished_at)
+    return conditional_json(
+        http_request,
+        schemas.JobResult.model_construct(job_id=job.id, kind=job.kind, status=job.status, result=job.result, error=job.error),
+        etag=etag,
+    )
+
+@app.delete("/api/jobs/{job_id}", response_model=schemas.JobStatus)
+async def cancel_job(job_id: str, current_user: schemas.User = Depends(dependencies.get_current_user)):
+    """取消任务；已结束的任务保持原状态"""
+    job = await job_manager.cancel(await _get_user_job(job_id, current_user.id))
+    return job.to_status()
+
+# 读取工作表快照数据
+@app.get("/api/workbook/{workbook_id}/sheets/{sheet_name}/rows", response_model=schemas.WorkbookRowsResponse)
+async def get_workbook_rows(
+    http_request: Request,
+    workbook_id: str,
+    sheet_name: str,
+    start: int = 0,
+    limit: int = 1000,
+    compress: bool = False,
+    current_user: schemas.User = Depends(dependencies.get_current_user)
+):
+    """
+    按行读取工作表快照中的数据
+    Accept 包含 application/x-msgpack 时返回列编码（range 字段，见 range_codec），compress=true 时启用 zlib
+    """
+    cache = get_workbook_cache()
+    snapshot = cache.get_sheet(current_user.id, workbook_id, sheet_name)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="未找到工作表快照")
+    start, limit = max(start, 0), max(limit, 0)
+    # 快照内容由块哈希唯一确定，ETag 无需读取数据即可计算；命中时直接返回 304
+    as_msgpack = wants_msgpack(http_request.headers.get("accept"))
+    etag = make_etag(workbook_id, sheet_name, snapshot.start_cell, *snapshot.block_hashes, start, limit,
+                     "msgpack" if as_msgpack else "json", compress)
+    cached = not_modified(http_request, etag)
+    if cached is not None:
+        return cached
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
+    try:
+        if as_msgpack:
+            columns = cache.read_columns(current_user.id, snapshot, start, limit)
+            row_count = len(columns[0]) if columns else 0
+            payload = {
+                "workbook_id": workbook_id,
+                "sheet_name": sheet_name,
+                "start": start,
+                "row_count": row_count,
+                "range": encode_columns_map(columns, row_count, compress)
+            }
+            return Response(content=msgpack.packb(payload, use_bin_type=True), media_type=MSGPACK_MEDIA_TYPE, headers=headers)
+        rows = cache.read_rows(current_user.id, snapshot, start, limit)
+    except KeyError as e:
+        raise HTTPException(status_code=409, detail={"message": "快照数据块已失效，请重新同步", "missing": e.args[0]})
+    return FastJSONResponse(schemas.WorkbookRowsResponse.model_construct(workbook_id=workbook_id, sheet_name=sheet_name, start=start, row_count=len(rows), rows=rows),
+                            headers=headers)
+
+# 提示词统计接口
+@app.get("/api/prompt-stats")
+async def get_prompt_stats(current_user: schemas.User = Depends(dependencies.get_current_user)):
+    """按提示词版本统计 token 消耗、前缀缓存命中与首 token 延迟"""
+    return get_prompt_registry().get_stats()
+
+# Token 用量接口
+@app.get("/api/llm-usage")
+async def get_llm_usage(current_user: schemas.User = Depends(dependencies.get_current_user)):
+    """按接口统计的 token 输入输出（预算估算值与提供商返回的实际值）"""
+    return _require_llm_config().usage_ledger.snapshot()
+
+# 健康检查接口
+@app.get("/health")
+async def health():
+    """
+    服务健康状态及启动预热各阶段是否成功
+    接口无需登录，只返回状态标志；预热的错误信息与耗时只记录在启动日志中
+    """
+    warmup = app.state.warmup
+    if warmup is not None:
+        phases = {name: phase["ok"] for name, phase in warmup["phases"].items()}
+        warmup = {"ok": all(phases.values()), "phases": phases}
+    return {"status": "ok", "warmup": warmup}
+
+# 运行指标（Prometheus 抓取）
+@app.get("/metrics", include_in_schema=False)
+async def metrics(http_request: Request):
+    """Prometheus 文本格式的运行指标；设置了 METRICS_TOKEN 时需携带 Bearer 令牌"""
+    if METRICS_TOKEN and http_request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="无权访问运行指标")
+    return Response(content=get_registry().render(), media_type=METRICS_CONTENT_TYPE)
+
+def _require_profile_token(http_request: Request) -> None:
+    if not is_profile_authorized(http_request.headers.get("x-profile-token")):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="需要管理员剖析令牌")
+
+# 单请求剖析结果（管理员）
+@app.get("/api/profiles", include_in_schema=False)
+async def list_profiles(http_request: Request):
+    """列出最近的剖析结果摘要"""
+    _require_profile_token(http_request)
+    return get_profile_store().list()
+
+@app.get("/api/profiles/{profile_id}", include_in_schema=False)
+async def get_profile(profile_id: str, http_request: Request, format: str = "json"):
+    """
+    取回一次剖析结果
+    format=text 时返回纯文本：栈采样为折叠栈（每行 "根;...;叶 次数"，可直接交给 flamegraph.pl / speedscope），
+    cProfile 为按累计耗时排序的统计表
+    """
+    _require_profile_token(http_request)
+    profile = get_profile_store().get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="剖析结果不存在或已被淘汰")
+    if format == "text":
+        content = profile.get("stats") or "\n".join(f"{stack} {count}" for stack, count in profile["stacks"].items())
+        return Response(content=content, media_type="text/plain")
+    return profile
+
 # LLM配置信息接口
 @app.get("/api/llm-info")
-async def get_llm_info(current_user: schemas.User = Depends(dependencies.get_current_user)):
-    """获取当前LLM配置信息"""
-    return llm_config.get_provider_info()
+async def get_llm_info(http_request: Request, current_user: schemas.User = Depends(dependencies.get_current_user)):
+    """获取当前LLM配置信息；带 ETag，配置未变化时条件请求返回 304"""
+    return conditional_json(http_request, _require_llm_config().get_provider_info())
+
+# 按内容寻址的操作脚本
+@app.get("/api/scripts/{sha}")
+async def get_script(sha: str, http_request: Request, current_user: schemas.User = Depends(dependencies.get_current_user)):
+    """
+    按 SHA-256 取回 Excel 操作脚本（/agent/chat 请求 script_refs=true 时返回的 script_sha）
+    内容由哈希唯一确定，响应可永久缓存
+    """
+    etag = f'"{sha}"'
+    cached = not_modified(http_request, etag, IMMUTABLE_CACHE_CONTROL)
+    if cached is not None:
+        return cached
+    code = get_script_store().get(sha)
+    if code is None:
+        raise HTTPException(status_code=404, detail="脚本不存在或已被淘汰，请不带 script_refs 重新请求")
+    return Response(content=code, media_type="application/javascript",
+                    headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL})
 
-# HTTPS 启动配置
+# HTTPS 启动配置（开发模式：单进程 + 自动重载；生产环境使用 serve.py）
 if __name__ == "__main__":
     import uvicorn
-    import ssl
-    import os
-    from pathlib import Path
+    from serve import find_ssl_files
     
     # 查找证书文件 - 优先查找用户目录下的证书
-    cert_file = None
-    key_file = None
-    
-    # 检查可能的证书文件位置（按优先级顺序）
-    possible_cert_paths = [
-        Path.home() / ".office-addin-dev-certs" / "localhost.crt",
-        Path.home() / ".office-addin-dev-certs" / "ca.crt",
-        Path(__file__).parent.parent / "localhost.crt",
-        Path(__file__).parent.parent / "localhost.pem"
-    ]
-    
-    possible_key_paths = [
-        Path.home() / ".office-addin-dev-certs" / "localhost.key", 
-        Path.home() / ".office-addin-dev-certs" / "ca.key",
-        Path(__file__).parent.parent / "localhost-key.pem",
-        Path(__file__).parent.parent / "localhost.key"
-    ]
-    
-    # 寻找证书文件
-    for cert_path in possible_cert_paths:
-        if cert_path.exists():
-            cert_file = str(cert_path)
-            print(f"找到证书文件: {cert_file}")
-            break
-    
-    # 寻找私钥文件
-    for key_path in possible_key_paths:
-        if key_path.exists():
-            key_file = str(key_path)
-            print(f"找到私钥文件: {key_file}")
-            break
+    cert_file, key_file = find_ssl_files()
     
     if cert_file and key_file:
         print("🔒 启动 HTTPS 服务器...")
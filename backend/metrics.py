@@ -0,0 +1,283 @@
+"""
+运行指标（Prometheus 文本格式，/metrics 导出）
+请求路径上各阶段的耗时直方图与缓存、重试、token 用量计数器，不依赖 prometheus_client：
+- 每次记录只做一次字典查找、一次二分查找和两次列表加法，可以放在热路径上
+- 请求内的阶段耗时先记到当前请求的列表中（contextvar），请求结束时由 MetricsMiddleware 按路由模板归类，
+  请求之外（后台任务等）记录的阶段归入 endpoint="background"
+- 计数不加锁：主要在事件循环线程中记录，线程池中的少量并发记录可能丢失个别增量，对统计无实质影响
+"""
+
+import os
+import re
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# 设置后 /metrics 需携带 Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# 为响应加上 Server-Timing 头（各阶段耗时，浏览器开发者工具可直接查看）
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() == "true"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 默认桶边界（秒），覆盖从 JWT 校验（亚毫秒）到 LLM 长回复（数十秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """单调递增计数器"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """
+    直方图
+    每个标签组合保存各桶的（非累计）计数与总和，导出时再累加为 Prometheus 的累计桶
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            # 各桶计数 + +Inf 桶 + 总和
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return int(sum(series[:-1])) if series else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        bounds = [_format_value(bound) for bound in self.buckets] + ["+Inf"]
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                le = 'le="' + bound + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"指标已注册: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """导出为 Prometheus 文本格式"""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# 全局指标注册表与指标
+registry = MetricsRegistry()
+
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "excel_ai_http_request_seconds", "HTTP 请求总耗时（含流式响应体）", ("endpoint", "method"))
+HTTP_REQUESTS = registry.counter(
+    "excel_ai_http_requests_total", "HTTP 请求数", ("endpoint", "method", "status"))
+STAGE_SECONDS = registry.histogram(
+    "excel_ai_stage_seconds",
+    "请求各阶段耗时：auth、db、llm_queue_wait、llm_ttfb、llm_total、plan_operations、serialization、ttfb 等",
+    ("endpoint", "stage"))
+LLM_SECONDS = registry.histogram(
+    "excel_ai_llm_seconds", "上游 LLM 调用耗时，phase: queue_wait | ttfb | total", ("provider", "endpoint", "phase"))
+LLM_TOKENS = registry.counter(
+    "excel_ai_llm_tokens_total", "LLM token 用量，type: prompt | completion | cached", ("provider", "endpoint", "type"))
+LLM_ERRORS = registry.counter(
+    "excel_ai_llm_errors_total", "LLM 调用失败次数", ("provider", "endpoint"))
+LLM_RETRIES = registry.counter(
+    "excel_ai_llm_retries_total", "LLM 调用重试次数", ("provider", "endpoint"))
+CACHE_REQUESTS = registry.counter(
+    "excel_ai_cache_requests_total", "缓存查询次数，result: hit | miss", ("cache", "result"))
+RATE_LIMITED = registry.counter(
+    "excel_ai_rate_limited_total", "被限流拒绝的请求数，scope: user | ip", ("endpoint", "scope"))
+IDEMPOTENCY_REQUESTS = registry.counter(
+    "excel_ai_idempotency_requests_total",
+    "携带 Idempotency-Key 的请求，result: executed | replayed | joined | mismatch | conflict", ("endpoint", "result"))
+
+# 当前请求已记录的阶段耗时 [(阶段, 秒)]，由 MetricsMiddleware 设置
+_request_stages: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("request_stages", default=None)
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """记录一个阶段的耗时，归入当前请求的路由"""
+    stages = _request_stages.get()
+    if stages is None:
+        STAGE_SECONDS.observe(seconds, "background", stage)
+    else:
+        stages.append((stage, seconds))
+
+
+def timed(stage: str) -> Callable:
+    """装饰同步函数，把每次调用的耗时记为一个阶段"""
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe_stage(stage, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def record_cache(cache: str, hit: bool, count: int = 1) -> None:
+    """记录缓存命中 / 未命中"""
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss", amount=count)
+
+
+def record_llm_call(provider: str, endpoint: str, ttfb: Optional[float], total: float, usage: Optional[Dict[str, int]]) -> None:
+    """记录一次 LLM 调用的首字节延迟、总耗时与 token 用量（秒）"""
+    if ttfb is not None:
+        LLM_SECONDS.observe(ttfb, provider, endpoint, "ttfb")
+        observe_stage("llm_ttfb", ttfb)
+    LLM_SECONDS.observe(total, provider, endpoint, "total")
+    observe_stage("llm_total", total)
+    if usage:
+        for kind, key in (("prompt", "prompt_tokens"), ("completion", "completion_tokens"), ("cached", "cached_tokens")):
+            if usage.get(key):
+                LLM_TOKENS.inc(provider, endpoint, kind, amount=usage[key])
+
+
+def record_llm_queue_wait(provider: str, endpoint: str, seconds: float) -> None:
+    """记录等待 LLM 并发名额的时间"""
+    LLM_SECONDS.observe(seconds, provider, endpoint, "queue_wait")
+    observe_stage("llm_queue_wait", seconds)
+
+
+_TIMING_NAME = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def server_timing_header(stages: List[Tuple[str, float]], total: float) -> bytes:
+    """
+    生成 Server-Timing 头：同名阶段合并累加，另加 total 为响应头发出前的耗时（毫秒）
+    流式响应在发出响应头后才执行的阶段（如流式 LLM 调用）不在其中
+    """
+    durations: Dict[str, float] = {}
+    for stage, seconds in stages:
+        name = _TIMING_NAME.sub("_", stage)
+        durations[name] = durations.get(name, 0.0) + seconds
+    parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in durations.items()]
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts).encode("latin-1")
+
+
+class MetricsMiddleware:
+    """
+    ASGI 中间件：统计请求总耗时、首字节时间与状态码，并把请求内记录的阶段耗时按路由模板归类
+    路由在中间件之内才匹配，因此在请求结束后从 scope["route"] 读取路由模板（未匹配的请求归为 unmatched）；
+    SERVER_TIMING=true 时在响应头中附带已完成阶段的耗时
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (METRICS_ENABLED or SERVER_TIMING):
+            await self.app(scope, receive, send)
+            return
+
+        stages: List[Tuple[str, float]] = []
+        token = _request_stages.set(stages)
+        started = time.perf_counter()
+        response = {"status": 500, "first_byte": None}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["first_byte"] = time.perf_counter()
+                if SERVER_TIMING:
+                    header = server_timing_header(stages, response["first_byte"] - started)
+                    message = {**message, "headers": [*message.get("headers", ()), (b"server-timing", header)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_stages.reset(token)
+            if METRICS_ENABLED:
+                self._record(scope, stages, started, response)
+
+    @staticmethod
+    def _record(scope, stages: List[Tuple[str, float]], started: float, response: Dict) -> None:
+        elapsed = time.perf_counter() - started
+        route = scope.get("route")
+        endpoint = getattr(route, "path", None) or "unmatched"
+        method = scope.get("method", "")
+        for stage, seconds in stages:
+            STAGE_SECONDS.observe(seconds, endpoint, stage)
+        if response["first_byte"] is not None:
+            STAGE_SECONDS.observe(response["first_byte"] - started, endpoint, "ttfb")
+        HTTP_REQUEST_SECONDS.observe(elapsed, endpoint, method)
+        HTTP_REQUESTS.inc(endpoint, method, str(response["status"]))
+
+
+def get_registry() -> MetricsRegistry:
+    """获取全局指标注册表"""
+    return registry
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, Integer, String
+from sqlalchemy import Boolean, Column, Float, Integer, String, Text
 from database import Base
 
 class User(Base):
@@ -7,3 +7,21 @@ class User(Base):
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     is_active = Column(Boolean, default=True)
+
+class Job(Base):
+    """后台任务状态（JOB_STORE=database 时写入，供多进程部署中的其他 worker 查询）"""
+    __tablename__ = "jobs"
+    id = Column(String, primary_key=True, index=True)
+    user_id = Column(Integer, index=True)
+    kind = Column(String)
+    status = Column(String, index=True)
+    progress = Column(Float, default=0.0)
+    message = Column(String, nullable=True)
+    result = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    owner = Column(String, nullable=True)
+    cancel_requested = Column(Boolean, default=False)
+    created_at = Column(Float)
+    started_at = Column(Float, nullable=True)
+    finished_at = Column(Float, nullable=True)
+    expires_at = Column(Float, nullable=True, index=True)
@@ -0,0 +1,172 @@
+"""
+单请求性能剖析
+排查个别慢请求时，对该请求采集调用栈样本（或 cProfile 统计），保存在内存中供管理员取回：
+- 按需剖析：请求头 X-Profile-Token 与 PROFILE_TOKEN 一致时剖析该请求，X-Profile-Mode 可选 sample | cprofile
+- 随机剖析：PROFILE_SAMPLE_RATE > 0 时按比例对请求做栈采样（开销很低，可在生产环境常开）
+- 同一时间只剖析一个请求；剖析期间事件循环上其他请求的协程也会出现在样本中
+- 响应头 X-Profile-Id 为剖析结果编号，通过 /api/profiles/{id} 取回（同样需要 X-Profile-Token）
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# 栈采样间隔（毫秒）
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# 内存中保留的剖析结果数
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+# cProfile 结果保留的函数行数
+_CPROFILE_LINES = 60
+# 单个栈样本保留的最大帧数
+_MAX_DEPTH = 64
+
+
+def is_authorized(token: Optional[str]) -> bool:
+    """请求头中的令牌是否为管理员剖析令牌（未配置 PROFILE_TOKEN 时一律拒绝）"""
+    return bool(PROFILE_TOKEN) and token == PROFILE_TOKEN
+
+
+class StackSampler:
+    """
+    采样线程：按固定间隔读取目标线程（事件循环线程）的当前调用栈，
+    以折叠格式（"根;...;叶" -> 次数）累计，可直接用于生成火焰图
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        own_file = __file__
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names: List[str] = []
+            while frame is not None and len(names) < _MAX_DEPTH:
+                code = frame.f_code
+                if code.co_filename != own_file:
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if names:
+                stack = ";".join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+
+
+class ProfileStore:
+    """最近的剖析结果（环形缓冲）"""
+
+    def __init__(self, keep: int = PROFILE_KEEP):
+        self._profiles: Deque[Dict[str, Any]] = deque(maxlen=keep)
+
+    def add(self, profile: Dict[str, Any]) -> None:
+        self._profiles.append(profile)
+
+    def get(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        for profile in self._profiles:
+            if profile["id"] == profile_id:
+                return profile
+        return None
+
+    def list(self) -> List[Dict[str, Any]]:
+        """按时间倒序列出剖析摘要（不含样本明细）"""
+        return [
+            {key: value for key, value in profile.items() if key not in ("stacks", "stats")}
+            for profile in reversed(self._profiles)
+        ]
+
+
+class ProfilingMiddleware:
+    """ASGI 中间件：对带有效剖析令牌的请求或按 PROFILE_SAMPLE_RATE 抽中的请求做剖析"""
+
+    def __init__(self, app, store: Optional["ProfileStore"] = None):
+        self.app = app
+        self.store = store or profile_store
+        self._active = threading.Lock()
+
+    def _requested_mode(self, scope) -> Optional[str]:
+        headers = dict(scope.get("headers") or ())
+        token = headers.get(b"x-profile-token")
+        if token is not None and is_authorized(token.decode("latin-1")):
+            mode = headers.get(b"x-profile-mode", b"sample").decode("latin-1")
+            return mode if mode in ("sample", "cprofile") else "sample"
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            return "sample"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        mode = self._requested_mode(scope) if scope["type"] == "http" else None
+        if mode is None or not self._active.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex[:16]
+        response = {"status": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                message = {**message, "headers": [*message.get("headers", ()), (b"x-profile-id", profile_id.encode())]}
+            await send(message)
+
+        sampler = profiler = None
+        if mode == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+            sampler.start()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            profile = {
+                "id": profile_id,
+                "mode": mode,
+                "method": scope.get("method"),
+                "path": scope.get("path"),
+                "status": response["status"],
+                "duration_ms": round(elapsed * 1000, 2),
+                "created_at": time.time(),
+            }
+            if profiler is not None:
+                profiler.disable()
+                output = io.StringIO()
+                pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(_CPROFILE_LINES)
+                profile["stats"] = output.getvalue()
+            else:
+                sampler.stop()
+                profile["samples"] = sampler.samples
+                profile["stacks"] = dict(sorted(sampler.stacks.items(), key=lambda item: -item[1]))
+            self._active.release()
+            self.store.add(profile)
+
+
+# 全局剖析结果存储
+profile_store = ProfileStore()
+
+
+def get_profile_store() -> ProfileStore:
+    """获取全局剖析结果存储"""
+    return profile_store
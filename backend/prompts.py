@@ -0,0 +1,194 @@
+"""
+提示词注册表
+所有系统提示词在注册时渲染一次，得到字节级稳定的规范前缀；
+每次调用的可变内容（历史消息、用户输入、表格上下文）一律放在前缀之后，
+使 DashScope / DeepSeek 的前缀缓存（上下文硬盘缓存）能够命中
+"""
+
+import hashlib
+import time
+import unicodedata
+from functools import cached_property
+from typing import Any, Dict, List, Optional
+from llm_config import estimate_tokens
+
+
+def canonicalize_prompt(text: str) -> str:
+    """
+    将提示词规范化为稳定的字节序列
+
+    统一换行符、去掉行尾空白和首尾空行，并做 NFC 归一化，
+    避免编辑器或拼接方式导致的不可见差异破坏前缀缓存
+    """
+    text = unicodedata.normalize("NFC", text.replace("\r\n", "\n").replace("\r", "\n"))
+    lines = [line.rstrip() for line in text.split("\n")]
+    return "\n".join(lines).strip("\n")
+
+
+class PromptSpec:
+    """已渲染的系统提示词及其调用统计"""
+
+    def __init__(self, name: str, version: str, text: str):
+        self.name = name
+        self.version = version
+        self.text = canonicalize_prompt(text)
+        self.sha256 = hashlib.sha256(self.text.encode("utf-8")).hexdigest()
+        # 统计键包含内容哈希，文本改动但忘记升级版本号时也不会混淆统计
+        self.key = f"{name}@{version}#{self.sha256[:12]}"
+        self.stats: Dict[str, float] = {
+            "calls": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+            "ttft_ms_total": 0.0,
+            "ttft_ms_max": 0.0,
+        }
+
+    @cached_property
+    def prefix_tokens(self) -> int:
+        """前缀的 token 估算值；首次读取时计算，导入模块时不加载分词器"""
+        return estimate_tokens(self.text)
+
+    def build_messages(self, user_content: str, history: Optional[List[Dict[str, str]]] = None) -> List[Dict[str, str]]:
+        """
+        构建消息列表：规范前缀在最前，可变内容在最后
+
+        Args:
+            user_content: 本次用户输入
+            history: 历史消息（位于系统提示词与本次输入之间）
+
+        Returns:
+            消息列表，格式为 [{"role": "...", "content": "..."}]
+        """
+        messages = [{"role": "system", "content": self.text}]
+        if history:
+            messages.extend(history)
+        messages.append({"role": "user", "content": user_content})
+        return messages
+
+    def record_usage(self, usage: Dict[str, Any]) -> None:
+        """
+        记录一次调用的 token 用量与首 token 延迟，作为 call_llm 的 on_usage 回调使用
+
+        Args:
+            usage: LLMConfig 归一化后的用量，包含 prompt_tokens、completion_tokens、cached_tokens、ttft_ms
+        """
+        stats = self.stats
+        stats["calls"] += 1
+        stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+        stats["completion_tokens"] += usage.get("completion_tokens", 0)
+        stats["cached_tokens"] += usage.get("cached_tokens", 0)
+        ttft_ms = usage.get("ttft_ms")
+        if ttft_ms is not None:
+            stats["ttft_ms_total"] += ttft_ms
+            stats["ttft_ms_max"] = max(stats["ttft_ms_max"], ttft_ms)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取该提示词版本的统计信息"""
+        stats = self.stats
+        calls = stats["calls"]
+        prompt_tokens = stats["prompt_tokens"]
+        return {
+            "name": self.name,
+            "version": self.version,
+            "sha256": self.sha256,
+            "prefix_chars": len(self.text),
+            "prefix_tokens": self.prefix_tokens,
+            "calls": int(calls),
+            "prompt_tokens": int(prompt_tokens),
+            "completion_tokens": int(stats["completion_tokens"]),
+            "cached_tokens": int(stats["cached_tokens"]),
+            "cache_hit_ratio": round(stats["cached_tokens"] / prompt_tokens, 4) if prompt_tokens else 0.0,
+            "avg_ttft_ms": round(stats["ttft_ms_total"] / calls, 2) if calls else None,
+            "max_ttft_ms": round(stats["ttft_ms_max"], 2) if calls else None,
+        }
+
+
+class PromptRegistry:
+    """系统提示词注册表"""
+
+    def __init__(self):
+        self._prompts: Dict[str, PromptSpec] = {}
+        self.created_at = time.time()
+
+    def register(self, name: str, version: str, text: str) -> PromptSpec:
+        """注册（或替换）一个系统提示词，注册时即完成渲染"""
+        spec = PromptSpec(name, version, text)
+        self._prompts[name] = spec
+        return spec
+
+    def get(self, name: str) -> PromptSpec:
+        """按名称获取已注册的提示词"""
+        if name not in self._prompts:
+            raise KeyError(f"未注册的提示词: {name}")
+        return self._prompts[name]
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """获取所有提示词版本的统计信息"""
+        return [spec.get_stats() for spec in self._prompts.values()]
+
+
+# 全局提示词注册表
+prompt_registry = PromptRegistry()
+
+
+def get_prompt_registry() -> PromptRegistry:
+    """获取全局提示词注册表"""
+    return prompt_registry
+
+
+def get_prompt(name: str) -> PromptSpec:
+    """便捷函数：获取已注册的提示词"""
+    return prompt_registry.get(name)
+
+
+# Excel 财务助手（/agent/chat）
+prompt_registry.register("excel_assistant", "v1", """你是一个专业的 Excel 财务助手。你的任务是理解用户的 Excel 需求，特别是财务相关的操作，并提供清晰的解决方案。
+
+你应该：
+1. 用简洁明了的中文回复用户
+2. 如果用户需要 Excel 操作，描述具体的操作步骤
+3. 对于财务相关需求，提供专业的会计和财务指导
+4. 保持专业和友好的语调
+
+用户的需求可能包括：
+
+**基础功能：**
+- 公式生成和解释
+- 数据筛选和排序  
+- 图表创建
+- 数据分析
+- 格式化操作
+
+**财务专业功能：**
+- 凭证录入：创建标准会计凭证录入模板，包括科目、借贷方向、金额等
+- 表格对账：对比两个数据表格，找出差异，生成对账报告
+- 数据清洗：清理财务数据，去除重复项，统一格式，处理异常值
+- 三大报表生成：创建资产负债表、利润表、现金流量表的标准模板
+
+当用户提到财务相关需求时，我会自动生成相应的Excel操作代码来帮助完成任务。
+
+请根据用户输入提供最合适的建议。""")
+
+# 公式生成
+prompt_registry.register("generate_formula", "v1", "You are an AI assistant that generates Excel formulas from natural language descriptions. Provide only the formula, without any additional text or explanation. If you cannot generate a formula, respond with 'Error: Could not generate formula.'")
+
+# 公式解释
+prompt_registry.register("explain_formula", "v1", "You are an AI assistant that explains Excel formulas in a clear and concise manner. Provide only the explanation, without any additional text or introduction.")
+
+# 公式优化
+prompt_registry.register("optimize_formula", "v1", "You are an AI assistant that optimizes Excel formulas. Provide the optimized formula and a brief explanation of the optimization. Format your response as: Optimized Formula: [formula]\nExplanation: [explanation].")
+
+# 公式错误诊断
+prompt_registry.register("diagnose_error", "v1", "You are an AI assistant that diagnoses errors in Excel formulas and suggests fixes. Provide the error type, explanation, and suggested fix. Format your response as: Error Type: [type]\nExplanation: [explanation]\nSuggested Fix: [fix].")
+
+# 公式批量处理（/api/formulas/batch）：输入每行一个 {"id", "input"}，输出一个 JSON 数组
+_BATCH_FORMAT = " You will receive one JSON object per line, each with an \"id\" and an \"input\". Reply with only a JSON array that contains exactly one object per input, in any order, formatted as: {fields}. Do not add any other text."
+
+prompt_registry.register("formula_batch_generate", "v1", "You are an AI assistant that generates Excel formulas from natural language descriptions. Each input is a description; the formula must start with '='. If you cannot generate a formula for an input, set its formula to 'Error: Could not generate formula.'" + _BATCH_FORMAT.format(fields='{"id": <id>, "formula": "<formula>"}'))
+
+prompt_registry.register("formula_batch_explain", "v1", "You are an AI assistant that explains Excel formulas in a clear and concise manner. Each input is a formula." + _BATCH_FORMAT.format(fields='{"id": <id>, "explanation": "<explanation>"}'))
+
+prompt_registry.register("formula_batch_optimize", "v1", "You are an AI assistant that optimizes Excel formulas. Each input is a formula; give the optimized formula and a brief explanation of the optimization." + _BATCH_FORMAT.format(fields='{"id": <id>, "suggested_formula": "<formula>", "explanation": "<explanation>"}'))
+
+prompt_registry.register("formula_batch_diagnose", "v1", "You are an AI assistant that diagnoses errors in Excel formulas and suggests fixes. Each input is a formula; give the error type, explanation, and suggested fix." + _BATCH_FORMAT.format(fields='{"id": <id>, "error_type": "<type>", "explanation": "<explanation>", "suggested_fix": "<fix>"}'))
@@ -0,0 +1,226 @@
+"""
+单元格范围的紧凑二进制编码（MessagePack）
+作为 JSON 之外的可协商传输格式：按列编码，数值列为原始小端字节，
+字符串列做字典编码，可选 zlib 压缩；解码直接得到 numpy 列，避免逐单元格创建 Python 对象
+
+编码结构:
+{
+    "v": 1,                 # 格式版本
+    "n": 行数,
+    "z": "zlib",            # 可选，存在时所有 "d" / "m" 字节段均经过 zlib 压缩
+    "cols": [
+        {"t": "f8", "d": <float64 字节>},                     # 数值列，NaN 表示空
+        {"t": "i4", "d": <int32 字节>, "m": <空值掩码>},       # 整数列（可完整表示为 int32）
+        {"t": "b1", "d": <uint8 字节>, "m": <空值掩码>},       # 布尔列
+        {"t": "dict", "w": 2 或 4, "dict": [...], "d": <编码>}, # 字符串列，编码为 0 表示空，其余为 dict 下标 + 1
+        {"t": "obj", "d": [...]}                              # 混合类型列，原样存放
+    ]
+}
+掩码为每行一个 uint8，1 表示空值
+"""
+
+import os
+import zlib
+from typing import Any, Dict, List, Optional, Sequence
+import msgpack
+import numpy as np
+from workbook_cache import columnize
+
+# 请求 / 响应使用的媒体类型
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+FORMAT_VERSION = 1
+# 解码时接受的最大行数（Excel 工作表的行数上限），同时限定各字节段解压后的大小
+MAX_ROWS = 1_048_576
+# 解码时接受的最大列数（Excel 工作表的列数上限）
+MAX_COLUMNS = 16_384
+# 一次请求中所有块解码后的总大小上限（每个单元格按 8 字节计：float64 或对象指针）
+MAX_DECODED_BYTES = int(os.getenv("SNAPSHOT_MAX_DECODED_MB", "128")) * 1024 * 1024
+
+
+class DecodeLimitError(ValueError):
+    """解码后的数据超出列数或总大小限制"""
+_INT32_MIN, _INT32_MAX = -(2 ** 31), 2 ** 31 - 1
+
+
+def _pack_bytes(data: bytes, compress: bool) -> bytes:
+    return zlib.compress(data, 1) if compress else data
+
+
+def _unpack_bytes(data: bytes, compressed: bool, expected_size: int) -> bytes:
+    """
+    还原一个字节段，长度须恰好为 expected_size（行数 × 元素字节数）
+    解压时最多输出 expected_size + 1 字节，客户端构造的高压缩比数据不会展开到内存中
+    """
+    if not isinstance(data, bytes):
+        raise ValueError("数据段须为二进制")
+    if compressed:
+        decompressor = zlib.decompressobj()
+        try:
+            data = decompressor.decompress(data, expected_size + 1)
+        except zlib.error as e:
+            raise ValueError(f"数据段解压失败: {e}")
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("数据段解压后的长度与行数不一致")
+    if len(data) != expected_size:
+        raise ValueError("数据段长度与行数不一致")
+    return data
+
+
+def _encode_numeric(column: np.ndarray, compress: bool) -> Dict[str, Any]:
+    nulls = np.isnan(column)
+    values = column[~nulls]
+    if values.size and np.all(values == np.floor(values)) and values.min() >= _INT32_MIN and values.max() <= _INT32_MAX:
+        encoded: Dict[str, Any] = {"t": "i4", "d": _pack_bytes(np.where(nulls, 0, column).astype("<i4").tobytes(), compress)}
+        if nulls.any():
+            encoded["m"] = _pack_bytes(nulls.astype(np.uint8).tobytes(), compress)
+        return encoded
+    return {"t": "f8", "d": _pack_bytes(column.astype("<f8").tobytes(), compress)}
+
+
+def _encode_object(column: np.ndarray, compress: bool) -> Dict[str, Any]:
+    values = column.tolist()
+    non_null = [value for value in values if value is not None]
+
+    if non_null and all(isinstance(value, bool) for value in non_null):
+        nulls = np.fromiter((value is None for value in values), dtype=np.uint8, count=len(values))
+        data = np.fromiter((bool(value) for value in values), dtype=np.uint8, count=len(values))
+        encoded: Dict[str, Any] = {"t": "b1", "d": _pack_bytes(data.tobytes(), compress)}
+        if nulls.any():
+            encoded["m"] = _pack_bytes(nulls.tobytes(), compress)
+        return encoded
+
+    if all(isinstance(value, str) for value in non_null):
+        dictionary: Dict[str, int] = {}
+        codes = np.fromiter(
+            (0 if value is None else dictionary.setdefault(value, len(dictionary) + 1) for value in values),
+            dtype=np.uint32,
+            count=len(values),
+        )
+        width = 2 if len(dictionary) < 2 ** 16 else 4
+        return {
+            "t": "dict",
+            "w": width,
+            "dict": list(dictionary),
+            "d": _pack_bytes(codes.astype("<u2" if width == 2 else "<u4").tobytes(), compress),
+        }
+
+    return {"t": "obj", "d": values}
+
+
+def encode_columns(columns: Sequence[np.ndarray], row_count: int, compress: bool = False) -> bytes:
+    """
+    将列数据编码为 MessagePack 字节
+
+    Args:
+        columns: workbook_cache.columnize 产生的列（float64 或 object）
+        row_count: 行数
+        compress: 是否对各字节段做 zlib 压缩
+
+    Returns:
+        编码后的字节
+    """
+    return msgpack.packb(encode_columns_map(columns, row_count, compress), use_bin_type=True)
+
+
+def encode_columns_map(columns: Sequence[np.ndarray], row_count: int, compress: bool = False) -> Dict[str, Any]:
+    """将列数据编码为可嵌入其他 MessagePack 消息的字典"""
+    encoded_columns = [
+        _encode_numeric(column, compress) if column.dtype == np.float64 else _encode_object(column, compress)
+        for column in columns
+    ]
+    payload: Dict[str, Any] = {"v": FORMAT_VERSION, "n": row_count, "cols": encoded_columns}
+    if compress:
+        payload["z"] = "zlib"
+    return payload
+
+
+def encode_rows(rows: Sequence[Sequence[Any]], compress: bool = False) -> bytes:
+    """将行数据编码为 MessagePack 字节"""
+    column_count = max((len(row) for row in rows), default=0)
+    return encode_columns(columnize(rows, column_count), len(rows), compress)
+
+
+def decode_columns_map(payload: Dict[str, Any], max_bytes: Optional[int] = None) -> List[np.ndarray]:
+    """
+    解码为列数据：数值列为 float64（空值为 NaN），其余为 object 数组（空值为 None）
+
+    Args:
+        payload: 列编码字典
+        max_bytes: 解码结果的大小上限（行数 × 列数 × 8），在解压任何数据前检查；超出时抛出 DecodeLimitError
+    """
+    if payload.get("v") != FORMAT_VERSION:
+        raise ValueError(f"不支持的范围编码版本: {payload.get('v')}")
+    row_count = payload["n"]
+    if not isinstance(row_count, int) or isinstance(row_count, bool) or not 0 <= row_count <= MAX_ROWS:
+        raise ValueError(f"行数须为 0 到 {MAX_ROWS} 之间的整数")
+    if not isinstance(payload["cols"], list):
+        raise ValueError("cols 须为数组")
+    if len(payload["cols"]) > MAX_COLUMNS:
+        raise DecodeLimitError(f"列数超过上限 {MAX_COLUMNS}")
+    if max_bytes is not None and row_count * len(payload["cols"]) * 8 > max_bytes:
+        raise DecodeLimitError(f"解码后的数据超过单次请求的上限 {MAX_DECODED_BYTES // (1024 * 1024)} MB")
+    compressed = payload.get("z") == "zlib"
+    columns: List[np.ndarray] = []
+
+    for column in payload["cols"]:
+        column_type = column["t"]
+        if column_type == "f8":
+            values = np.frombuffer(_unpack_bytes(column["d"], compressed, row_count * 8), dtype="<f8").astype(np.float64)
+        elif column_type == "i4":
+            values = np.frombuffer(_unpack_bytes(column["d"], compressed, row_count * 4), dtype="<i4").astype(np.float64)
+            if "m" in column:
+                values[np.frombuffer(_unpack_bytes(column["m"], compressed, row_count), dtype=np.uint8).astype(bool)] = np.nan
+        elif column_type == "b1":
+            data = np.frombuffer(_unpack_bytes(column["d"], compressed, row_count), dtype=np.uint8).astype(bool)
+            values = data.astype(object)
+            if "m" in column:
+                values[np.frombuffer(_unpack_bytes(column["m"], compressed, row_count), dtype=np.uint8).astype(bool)] = None
+        elif column_type == "dict":
+            width = column["w"]
+            if width not in (2, 4):
+                raise ValueError(f"无效的字典编码宽度: {width}")
+            codes = np.frombuffer(_unpack_bytes(column["d"], compressed, row_count * width), dtype="<u2" if width == 2 else "<u4")
+            lookup = np.empty(len(column["dict"]) + 1, dtype=object)
+            lookup[0] = None
+            lookup[1:] = column["dict"]
+            values = lookup[codes]
+        elif column_type == "obj":
+            values = np.empty(len(column["d"]), dtype=object)
+            values[:] = column["d"]
+        else:
+            raise ValueError(f"未知的列类型: {column_type}")
+
+        if len(values) != row_count:
+            raise ValueError("列长度与行数不一致")
+        columns.append(values)
+
+    return columns
+
+
+def decode_columns(data: bytes) -> List[np.ndarray]:
+    """解码 MessagePack 字节为列数据"""
+    return decode_columns_map(msgpack.unpackb(data, raw=False))
+
+
+def columns_to_rows(columns: Sequence[np.ndarray], row_count: Optional[int] = None) -> List[List[Any]]:
+    """列数据转为行数据（NaN 还原为 None）"""
+    if row_count is None:
+        row_count = len(columns[0]) if columns else 0
+    column_lists = []
+    for column in columns:
+        if column.dtype == np.float64:
+            column_lists.append([None if value != value else value for value in column.tolist()])
+        else:
+            column_lists.append(column.tolist())
+    return [list(row) for row in zip(*column_lists)] if column_lists else [[] for _ in range(row_count)]
+
+
+def decode_rows(data: bytes) -> List[List[Any]]:
+    """解码 MessagePack 字节为行数据"""
+    return columns_to_rows(decode_columns(data))
+
+
+def wants_msgpack(accept: Optional[str]) -> bool:
+    """根据 Accept 头判断客户端是否接受 MessagePack"""
+    return bool(accept) and MSGPACK_MEDIA_TYPE in accept
@@ -0,0 +1,294 @@
+"""
+接口限流（按用户 + 接口，GCRA）
+防止单个用户高频调用 /agent/chat 等接口耗尽共享的上游 LLM 额度：
+- 算法为 GCRA（通用信元速率算法）：每个键只保存一个“理论到达时间”，效果等同平滑的滑动窗口，
+  每条规则为 “period 秒内最多 limit 次”，可瞬时突发 burst 次（默认等于 limit）
+- 在路由、依赖注入（数据库查询）与 LLM 调用之前判定；已校验过的 JWT 缓存在内存中，
+  超额请求只做一次字典查找与一次计算即返回 429
+- 未携带有效令牌的请求按客户端 IP 计数；/token、/register 等规则可直接按 IP 计数（@ip）
+- 响应带 RateLimit-Limit / RateLimit-Remaining / RateLimit-Reset / RateLimit-Policy 头（IETF 草案），429 另带 Retry-After
+- 计数存储可替换：默认进程内存（多 worker 时各自计数，实际上限为 worker 数倍）；
+  设置 RATE_LIMIT_REDIS_URL 时使用 Redis（需 pip install redis），所有 worker 共享计数，Redis 不可用时放行
+
+规则配置 RATE_LIMITS（逗号分隔，覆盖同路径的默认规则）:
+    /agent/chat=20/60,/api/formulas/batch=10/60:2,/token=10/60@ip
+"""
+
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from metrics import RATE_LIMITED, observe_stage
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMITS = os.getenv("RATE_LIMITS", "")
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "")
+# 内存中缓存的已校验令牌数（令牌 -> 用户）
+RATE_LIMIT_TOKEN_CACHE = int(os.getenv("RATE_LIMIT_TOKEN_CACHE", "10000"))
+
+# 默认规则：调用 LLM 的接口按用户限流，登录注册按 IP 限流
+DEFAULT_RATE_LIMITS = (
+    "/agent/chat=20/60,/agent/chat/stream=20/60,/agent/ws=20/60,"
+    "/api/generate-formula=60/60,/api/explain-formula=60/60,/api/optimize-formula=60/60,/api/diagnose-error=60/60,"
+    "/api/formulas/batch=10/60,/api/jobs=30/60,"
+    "/token=10/60@ip,/register=5/60@ip"
+)
+
+
+@dataclass(frozen=True)
+class RateLimitRule:
+    """period 秒内最多 limit 次，可瞬时突发 burst 次；scope: user | ip"""
+    path: str
+    limit: int
+    period: float
+    burst: int
+    scope: str = "user"
+
+    @property
+    def interval(self) -> float:
+        """平均每次请求占用的时间（GCRA 的发射间隔）"""
+        return self.period / self.limit
+
+    @property
+    def policy(self) -> str:
+        return f"{self.limit};w={self.period:g};burst={self.burst}"
+
+
+@dataclass
+class RateLimitResult:
+    allowed: bool
+    limit: int
+    remaining: int
+    reset_after: float      # 配额完全恢复所需秒数
+    retry_after: float      # 被拒绝时距下次可请求的秒数
+
+    @property
+    def retry_seconds(self) -> int:
+        """Retry-After 的整数秒（至少 1 秒）"""
+        return max(math.ceil(self.retry_after), 1)
+
+    def headers(self, rule: RateLimitRule) -> List[Tuple[bytes, bytes]]:
+        headers = [
+            (b"ratelimit-limit", str(self.limit).encode()),
+            (b"ratelimit-remaining", str(self.remaining).encode()),
+            (b"ratelimit-reset", str(math.ceil(self.reset_after)).encode()),
+            (b"ratelimit-policy", rule.policy.encode()),
+        ]
+        if not self.allowed:
+            headers.append((b"retry-after", str(self.retry_seconds).encode()))
+        return headers
+
+
+def parse_rules(text: str) -> Dict[str, RateLimitRule]:
+    """解析 “路径=次数/秒数[:突发][@ip]” 列表"""
+    rules = {}
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        path, _, spec = part.partition("=")
+        spec, _, scope = spec.partition("@")
+        quota, _, burst = spec.partition(":")
+        limit, _, period = quota.partition("/")
+        try:
+            limit, period = int(limit), float(period or 60)
+            burst = int(burst) if burst else limit
+        except ValueError:
+            raise ValueError(f"无效的限流规则: {part}")
+        if limit <= 0 or period <= 0 or burst <= 0:
+            raise ValueError(f"无效的限流规则: {part}")
+        rules[path.strip()] = RateLimitRule(path.strip(), limit, period, burst, scope.strip() or "user")
+    return rules
+
+
+def gcra(tat: Optional[float], now: float, rule: RateLimitRule) -> Tuple[RateLimitResult, Optional[float]]:
+    """
+    对一次请求做 GCRA 判定
+
+    Returns:
+        (判定结果, 新的理论到达时间；被拒绝时为 None，存储不需要更新)
+    """
+    interval = rule.interval
+    new_tat = max(tat or now, now) + interval
+    allow_at = new_tat - rule.burst * interval
+    if now < allow_at:
+        return RateLimitResult(False, rule.limit, 0, (tat or now) - now, allow_at - now), None
+    remaining = min(int((now - allow_at) / interval + 1e-9), rule.burst - 1)
+    return RateLimitResult(True, rule.limit, remaining, new_tat - now, 0.0), new_tat
+
+
+def bearer_token(scope) -> Optional[str]:
+    """从 ASGI scope 的 Authorization 头中取出 Bearer 令牌"""
+    for name, value in scope.get("headers") or ():
+        if name == b"authorization":
+            scheme, _, credentials = value.decode("latin-1").partition(" ")
+            return credentials.strip() if scheme.lower() == "bearer" else None
+    return None
+
+
+class MemoryRateLimitStore:
+    """进程内计数：键 -> 理论到达时间；超过 max_keys 时清理已完全恢复的键（与不存在等价）"""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._tat: Dict[str, float] = {}
+
+    async def acquire(self, key: str, rule: RateLimitRule) -> RateLimitResult:
+        now = time.monotonic()
+        result, new_tat = gcra(self._tat.get(key), now, rule)
+        if new_tat is not None:
+            self._tat[key] = new_tat
+            if len(self._tat) > self.max_keys:
+                self._sweep(now)
+        return result
+
+    def _sweep(self, now: float) -> None:
+        self._tat = {key: tat for key, tat in self._tat.items() if tat > now}
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"keys": len(self._tat)}
+
+
+# 在 Redis 中原子地执行 GCRA；时间取 Redis 服务器时钟，各 worker 时钟不一致也不影响
+_GCRA_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+local new_tat = tat + interval
+if now < new_tat - burst * interval then
+    return {0, tostring(tat), tostring(now)}
+end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil((new_tat - now) * 1000))
+return {1, tostring(tat), tostring(now)}
+"""
+
+
+class RedisRateLimitStore:
+    """Redis 计数（所有 worker 共享）；Redis 不可用时放行，可用性优先于严格限流"""
+
+    def __init__(self, url: str, prefix: str = "excel_ai:rate:"):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self._script = self._redis.register_script(_GCRA_SCRIPT)
+        self.prefix = prefix
+        self.errors = 0
+
+    async def acquire(self, key: str, rule: RateLimitRule) -> RateLimitResult:
+        try:
+            allowed, tat, now = await self._script(keys=[self.prefix + key], args=[rule.interval, rule.burst])
+        except Exception:
+            self.errors += 1
+            return RateLimitResult(True, rule.limit, rule.burst - 1, 0.0, 0.0)
+        tat, now = float(tat), float(now)
+        result, _ = gcra(tat if tat > now else None, now, rule)
+        if not int(allowed):
+            result.allowed, result.remaining = False, 0
+        return result
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"errors": self.errors}
+
+
+class RateLimiter:
+    """按路径匹配规则并识别请求者（JWT 用户或客户端 IP）"""
+
+    def __init__(self, rules: Optional[Dict[str, RateLimitRule]] = None, store=None, enabled: bool = RATE_LIMIT_ENABLED):
+        self.rules = rules if rules is not None else {**parse_rules(DEFAULT_RATE_LIMITS), **parse_rules(RATE_LIMITS)}
+        self.store = store or (RedisRateLimitStore(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else MemoryRateLimitStore())
+        self.enabled = enabled
+        # 令牌 -> (用户, 过期时间戳)；过期时间为 None 表示令牌没有 exp
+        self._tokens: "OrderedDict[str, Tuple[str, Optional[float]]]" = OrderedDict()
+
+    def user_for_token(self, token: str) -> Optional[str]:
+        """校验 JWT 并返回用户（sub）；结果缓存到令牌过期为止，同一令牌的后续请求不再验签"""
+        cached = self._tokens.get(token)
+        if cached is not None:
+            user, expires_at = cached
+            if expires_at is None or expires_at > time.time():
+                self._tokens.move_to_end(token)
+                return user
+            # 已过期的令牌不再信任，交由下面的验签拒绝
+            del self._tokens[token]
+        from jose import JWTError, jwt
+        from config import ALGORITHM, SECRET_KEY
+        try:
+            claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            return None
+        user = claims.get("sub")
+        if user:
+            expires_at = claims.get("exp")
+            self._tokens[token] = (user, float(expires_at) if isinstance(expires_at, (int, float)) else None)
+            if len(self._tokens) > RATE_LIMIT_TOKEN_CACHE:
+                self._tokens.popitem(last=False)
+        return user
+
+    def identity(self, scope, rule: RateLimitRule) -> str:
+        """请求者标识：user:<用户> 或 ip:<客户端地址>"""
+        if rule.scope == "user":
+            token = bearer_token(scope)
+            user = self.user_for_token(token) if token else None
+            if user:
+                return f"user:{user}"
+        client = scope.get("client")
+        return f"ip:{client[0] if client else 'unknown'}"
+
+    async def hit(self, path: str, identity: str) -> Optional[Tuple[RateLimitRule, RateLimitResult]]:
+        """对一次请求计数；路径没有规则或限流关闭时返回 None"""
+        rule = self.rules.get(path)
+        if rule is None or not self.enabled:
+            return None
+        result = await self.store.acquire(f"{path}|{identity}", rule)
+        if not result.allowed:
+            RATE_LIMITED.inc(path, rule.scope)
+        return rule, result
+
+
+class RateLimitMiddleware:
+    """
+    ASGI 中间件：在路由与依赖注入之前限流
+    须位于 CORS 中间件之内（先于 CORSMiddleware 添加），浏览器才能读取 429 响应
+    """
+
+    def __init__(self, app, limiter: Optional[RateLimiter] = None):
+        self.app = app
+        self.limiter = limiter or rate_limiter
+
+    async def __call__(self, scope, receive, send):
+        rule = self.limiter.rules.get(scope.get("path")) if scope["type"] == "http" and self.limiter.enabled else None
+        if rule is None:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        _, result = await self.limiter.hit(rule.path, self.limiter.identity(scope, rule))
+        headers = result.headers(rule)
+        observe_stage("rate_limit", time.perf_counter() - started)
+        if not result.allowed:
+            body = json.dumps({"detail": f"请求过于频繁，请 {result.retry_seconds} 秒后重试"}, ensure_ascii=False).encode("utf-8")
+            await send({"type": "http.response.start", "status": 429, "headers": [
+                (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), *headers]})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", ()), *headers]}
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+# 全局限流器
+rate_limiter = RateLimiter()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """获取全局限流器"""
+    return rate_limiter
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import Any, Optional
 
 class UserBase(BaseModel):
     email: str
@@ -49,17 +49,55 @@ class DiagnoseErrorResponse(BaseModel):
     explanation: str
     suggested_fix: str
 
+class FormulaBatchRequest(BaseModel):
+    """
+    批量处理公式
+    operation: generate | explain | optimize | diagnose；generate 时 items 为公式需求描述
+    batch_size 为每个 LLM 请求包含的条目数，0 表示使用服务端默认值
+    """
+    operation: str
+    items: list[str]
+    batch_size: int = 0
+
+class FormulaBatchEvent(BaseModel):
+    """
+    批量处理的流式事件（NDJSON 每行一个）
+    type: result | summary；result 事件的 indices 为该结果对应的所有原始位置，
+    source: cache | rule | llm | error，result 字段与对应单条接口的响应字段一致
+    """
+    type: str
+    indices: Optional[list[int]] = None
+    input: Optional[str] = None
+    source: Optional[str] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    summary: Optional[dict] = None
+
 # Agent 相关模型
 class ExcelOperation(BaseModel):
     operation_type: str
     description: str
     js_code: Optional[str] = None
     parameters: Optional[dict] = None
+    # 分块写入等操作的数据载荷，执行 js_code 时作为 payload 参数传入
+    payload: Optional[Any] = None
+    # 请求 script_refs=true 时 js_code 为空，脚本通过 GET /api/scripts/{script_sha} 取回（可永久缓存）
+    script_sha: Optional[str] = None
+
+class AgentContext(BaseModel):
+    """对话上下文；workbook_id + sheet_name 指向已上传的工作表快照"""
+    workbook_id: Optional[str] = None
+    sheet_name: Optional[str] = None
+    selected_range: Optional[str] = None
+    class Config:
+        extra = "allow"
 
 class AgentChatRequest(BaseModel):
     message: str
     conversation_id: Optional[str] = None
-    context: Optional[dict] = None
+    context: Optional[AgentContext] = None
+    # 为 true 时操作只返回脚本哈希（script_sha），客户端按哈希取回并缓存脚本
+    script_refs: bool = False
 
 class AgentChatResponse(BaseModel):
     success: bool
@@ -67,3 +105,161 @@ class AgentChatResponse(BaseModel):
     excel_operations: list[ExcelOperation] = []
     conversation_id: Optional[str] = None
     error: Optional[str] = None
+
+class AgentStreamRequest(BaseModel):
+    """/agent/ws 上客户端发送的消息"""
+    message: str
+    conversation_id: Optional[str] = None
+    context: Optional[AgentContext] = None
+
+class AgentEvent(BaseModel):
+    """
+    流式对话事件
+    type: token | tool_start | tool_end | excel_operation | final | error
+    """
+    type: str
+    conversation_id: Optional[str] = None
+    delta: Optional[str] = None
+    tool: Optional[str] = None
+    operation: Optional[ExcelOperation] = None
+    response: Optional[str] = None
+    excel_operations: Optional[list[ExcelOperation]] = None
+    success: Optional[bool] = None
+    error: Optional[str] = None
+
+# 工作簿快照相关模型
+class WorkbookBlock(BaseModel):
+    """
+    快照中的一个行块
+    rows 与 columns 都为空时表示客户端认为服务端已有该块，只发送 hash
+    hash 为规范 JSON（紧凑分隔符、UTF-8）编码的 SHA-256；
+    columns 为 MessagePack 请求中的列编码（见 range_codec），此时哈希基于该块的编码字节
+    """
+    hash: Optional[str] = None
+    rows: Optional[list[list[Any]]] = None
+    columns: Optional[dict] = None
+
+class WorkbookSnapshotRequest(BaseModel):
+    workbook_id: str
+    sheet_name: str
+    start_cell: str = "A1"
+    block_rows: int = 1000
+    blocks: list[WorkbookBlock]
+
+class WorkbookSnapshotResponse(BaseModel):
+    complete: bool
+    missing: list[str] = []
+    block_hashes: list[str] = []
+    row_count: int = 0
+    column_count: int = 0
+    address: Optional[str] = None
+
+class WorkbookRowsResponse(BaseModel):
+    workbook_id: str
+    sheet_name: str
+    start: int
+    row_count: int
+    rows: list[list[Any]]
+
+# 数据清洗相关模型
+class DataCleaningRequest(BaseModel):
+    """
+    对已上传的工作表快照做重复行与异常值检测
+    列可以用表头名称、列字母或从 0 开始的列序号引用
+    """
+    workbook_id: str
+    sheet_name: str
+    key_columns: Optional[list[str]] = None
+    value_columns: Optional[list[str]] = None
+    group_by: Optional[str] = None
+    method: str = "mad"
+    threshold: Optional[float] = None
+    near_duplicates: bool = True
+    max_items: int = 1000
+
+class DataCleaningResponse(BaseModel):
+    summary: dict
+    exact_duplicates: list[dict] = []
+    near_duplicates: list[dict] = []
+    outliers: list[dict] = []
+    operation: ExcelOperation
+
+# 财务报表相关模型
+class FinancialStatementsRequest(BaseModel):
+    """
+    由工作表快照中的凭证分录或科目余额数据生成三大报表
+    columns 指定字段对应的列（表头名称、列字母或列序号），未指定的字段按表头自动识别；
+    字段: account_code, account_name, debit, credit, opening, voucher_id, cash_flow_item
+    """
+    workbook_id: str
+    sheet_name: str
+    columns: Optional[dict[str, str]] = None
+
+class FinancialStatementsResponse(BaseModel):
+    summary: dict
+    statements: dict
+    check: dict
+    operations: list[ExcelOperation]
+
+# 公式依赖分析相关模型
+class FormulaGraphRequest(BaseModel):
+    """
+    分析工作簿快照中全部公式的依赖关系与重算成本
+    快照须按 Range.formulas 上传（公式单元格为以 "=" 开头的文本）；sheet_names 为空时分析该工作簿的全部快照
+    """
+    workbook_id: str
+    sheet_names: Optional[list[str]] = None
+    top_n: int = 20
+
+class FormulaGraphResponse(BaseModel):
+    summary: dict
+    hotspots: list[dict] = []
+    volatile: list[dict] = []
+    longest_chains: list[dict] = []
+    whole_column_references: list[dict] = []
+    circular: list[str] = []
+    # 可逐条提交 /api/optimize-formula，或整体作为 /api/formulas/batch 的请求体
+    optimize_targets: list[dict] = []
+    optimize_batch: dict = {}
+
+# 凭证导入相关模型
+class VoucherImportResponse(BaseModel):
+    """
+    凭证批量导入的校验结果
+    errors 为错误索引（行号、凭证号、错误类型），最多 max_errors 条；error_counts 为各类错误的总数
+    """
+    summary: dict
+    error_counts: dict = {}
+    errors: list[dict] = []
+    operation: ExcelOperation
+
+# 后台任务相关模型
+class JobSubmitRequest(BaseModel):
+    """
+    提交后台任务
+    kind: data_cleaning | financial_statements | formula_graph | formula_batch，
+    params 与对应同步接口的请求体一致
+    """
+    kind: str
+    params: dict = {}
+
+class JobStatus(BaseModel):
+    """任务状态；status: queued | running | succeeded | failed | cancelled，时间为 Unix 时间戳"""
+    job_id: str
+    kind: str
+    status: str
+    progress: float = 0.0
+    message: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    expires_at: Optional[float] = None
+
+class JobResult(BaseModel):
+    """任务结果；result 与对应同步接口的响应体一致"""
+    job_id: str
+    kind: str
+    status: str
+    result: Optional[Any] = None
+    error: Optional[str] = None
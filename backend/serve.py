@@ -0,0 +1,232 @@
+"""
+生产环境启动器（多 worker）
+- gunicorn + UvicornWorker，默认 1 个 worker（--workers / WEB_CONCURRENCY 覆盖；异步 worker 不需要 2n+1）
+- 预加载：主进程导入应用后再 fork，模块、编译后的正则与操作模板在 worker 间写时复制共享；
+  导入后执行 gc.freeze()，避免垃圾回收触碰共享对象导致页面被复制
+- 建表等启动工作只在主进程中执行一次（worker 的 DB_AUTO_CREATE=false），fork 后各 worker 重建数据库连接池
+- 平滑重载：kill -HUP <主进程>，新 worker 就绪后旧 worker 处理完已接收的请求再退出（最长 GRACEFUL_TIMEOUT 秒）；
+  预加载模式下 HUP 不会重新导入代码，升级代码时先 kill -USR2 <主进程> 启动新主进程，就绪后对旧主进程发送 QUIT
+- 启动时打印主进程就绪耗时与每个 worker 的启动耗时、内存（RSS / PSS / 共享）
+- 进程内状态（工作表快照缓存、任务队列、指标、脚本存储、限流计数、幂等键）按 worker 独立：
+  多 worker 启动前要求限流与幂等使用 Redis（RATE_LIMIT_REDIS_URL / IDEMPOTENCY_REDIS_URL）、任务状态写入数据库
+  （JOB_STORE=database），否则拒绝启动；快照缓存与脚本存储没有共享后端，须由反向代理按用户粘性路由，
+  确认后设置 ALLOW_PER_WORKER_STATE=true 跳过检查
+
+未安装 gunicorn（如 Windows）时退化为 uvicorn 多进程模式：无预加载，建表仍只执行一次。
+
+运行: python serve.py [--workers 4] [--host 0.0.0.0] [--port 8000] [--no-ssl]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+_PROCESS_STARTED = time.perf_counter()
+
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# 多 worker 时跳过共享状态检查（快照缓存、脚本存储、指标仍按 worker 独立，由部署方保证粘性路由）
+ALLOW_PER_WORKER_STATE = os.getenv("ALLOW_PER_WORKER_STATE", "false").lower() == "true"
+# 重载或停止时等待 worker 处理完已接收请求的最长时间（秒）
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+# worker 无响应超过该时间（秒）即被重启；LLM 调用在事件循环中等待，不会阻塞心跳
+WORKER_TIMEOUT = int(os.getenv("WORKER_TIMEOUT", "120"))
+KEEPALIVE = int(os.getenv("KEEPALIVE", "5"))
+# 每个 worker 处理该数量的请求后重启（0 为不重启），用于缓解内存增长
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", "0"))
+
+
+def find_ssl_files() -> Tuple[Optional[str], Optional[str]]:
+    """查找 HTTPS 证书与私钥文件（优先用户目录下 office-addin-dev-certs 生成的证书），未找到时为 None"""
+    cert_file = None
+    key_file = None
+
+    # 检查可能的证书文件位置（按优先级顺序）
+    possible_cert_paths = [
+        Path.home() / ".office-addin-dev-certs" / "localhost.crt",
+        Path.home() / ".office-addin-dev-certs" / "ca.crt",
+        Path(__file__).parent.parent / "localhost.crt",
+        Path(__file__).parent.parent / "localhost.pem"
+    ]
+
+    possible_key_paths = [
+        Path.home() / ".office-addin-dev-certs" / "localhost.key",
+        Path.home() / ".office-addin-dev-certs" / "ca.key",
+        Path(__file__).parent.parent / "localhost-key.pem",
+        Path(__file__).parent.parent / "localhost.key"
+    ]
+
+    for cert_path in possible_cert_paths:
+        if cert_path.exists():
+            cert_file = str(cert_path)
+            print(f"找到证书文件: {cert_file}")
+            break
+
+    for key_path in possible_key_paths:
+        if key_path.exists():
+            key_file = str(key_path)
+            print(f"找到私钥文件: {key_file}")
+            break
+
+    return cert_file, key_file
+
+
+def memory_usage() -> Dict[str, float]:
+    """
+    当前进程的内存（MB）
+    Linux 上读取 smaps_rollup：rss 为常驻内存，pss 按共享进程数分摊，shared 为与其他进程（主进程）共享的部分；
+    其他平台只有 getrusage 的峰值 RSS
+    """
+    try:
+        values = {}
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                if name in ("Rss", "Pss", "Shared_Clean", "Shared_Dirty"):
+                    values[name] = int(rest.split()[0]) / 1024
+        return {
+            "rss_mb": round(values["Rss"], 1),
+            "pss_mb": round(values["Pss"], 1),
+            "shared_mb": round(values["Shared_Clean"] + values["Shared_Dirty"], 1),
+        }
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        # Windows 没有 resource 模块
+        return {}
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {"max_rss_mb": round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)}
+
+
+def _format_memory(usage: Dict[str, float]) -> str:
+    return ", ".join(f"{name[:-3].upper()} {value:.1f} MB" for name, value in usage.items())
+
+
+def per_worker_state_problems() -> List[str]:
+    """多 worker 部署时仍按进程独立、会导致请求结果取决于落在哪个 worker 的配置项"""
+    problems = []
+    if os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true" and not os.getenv("RATE_LIMIT_REDIS_URL"):
+        problems.append("限流计数（设置 RATE_LIMIT_REDIS_URL）")
+    if os.getenv("IDEMPOTENCY_ENABLED", "true").lower() == "true" and not os.getenv("IDEMPOTENCY_REDIS_URL"):
+        problems.append("幂等键（设置 IDEMPOTENCY_REDIS_URL）")
+    if os.getenv("JOB_STORE", "memory").lower() != "database":
+        problems.append("任务状态（设置 JOB_STORE=database）")
+    return problems
+
+
+def init_once() -> float:
+    """主进程中的一次性启动工作（建表），返回耗时；之后导入 main 的进程不再建表"""
+    started = time.perf_counter()
+    import database
+    database.init_db()
+    # 主进程建表时打开的连接不能被 fork 出的 worker 继承
+    database.engine.dispose()
+    os.environ["DB_AUTO_CREATE"] = "false"
+    return time.perf_counter() - started
+
+
+def load_app():
+    """导入应用并冻结导入期间创建的对象，fork 后这些对象不再被垃圾回收扫描"""
+    started = time.perf_counter()
+    import main
+    gc.collect()
+    gc.freeze()
+    print(f"进程 {os.getpid()} 已加载应用: {time.perf_counter() - started:.2f}s，{_format_memory(memory_usage())}")
+    return main.app
+
+
+def run_gunicorn(args, cert_file: Optional[str], key_file: Optional[str]) -> None:
+    from gunicorn.app.base import BaseApplication
+
+    def when_ready(server):
+        server.log.info(f"主进程就绪: 启动耗时 {time.perf_counter() - _PROCESS_STARTED:.2f}s，"
+                        f"{_format_memory(memory_usage())}，worker 数 {args.workers}")
+
+    def post_fork(server, worker):
+        # 预加载时连接池对象来自主进程：丢弃继承的连接（不关闭，它们属于主进程），worker 按需新建
+        import database
+        database.engine.dispose(close=False)
+        worker.boot_started = time.perf_counter()
+
+    def post_worker_init(worker):
+        worker.log.info(f"worker {worker.pid} 就绪: 启动耗时 {time.perf_counter() - worker.boot_started:.2f}s，"
+                        f"{_format_memory(memory_usage())}")
+
+    class Application(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{args.host}:{args.port}",
+                "workers": args.workers,
+                "worker_class": "uvicorn.workers.UvicornWorker",
+                "preload_app": True,
+                "graceful_timeout": GRACEFUL_TIMEOUT,
+                "timeout": WORKER_TIMEOUT,
+                "keepalive": KEEPALIVE,
+                "max_requests": MAX_REQUESTS,
+                "max_requests_jitter": MAX_REQUESTS // 10,
+                "when_ready": when_ready,
+                "post_fork": post_fork,
+                "post_worker_init": post_worker_init,
+            }
+            if cert_file and key_file:
+                options.update(certfile=cert_file, keyfile=key_file)
+            for name, value in options.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return load_app()
+
+    Application().run()
+
+
+def run_uvicorn(args, cert_file: Optional[str], key_file: Optional[str]) -> None:
+    """未安装 gunicorn 时的退化路径：uvicorn 多进程（各 worker 独立导入应用，无写时复制共享）"""
+    import uvicorn
+    options = {"ssl_certfile": cert_file, "ssl_keyfile": key_file} if cert_file and key_file else {}
+    uvicorn.run("serve:load_app", factory=True, host=args.host, port=args.port, workers=args.workers,
+                timeout_graceful_shutdown=GRACEFUL_TIMEOUT, timeout_keep_alive=KEEPALIVE, **options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Excel AI 后端生产环境启动器")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY,
+                        help="worker 进程数，默认 1；大于 1 时须配置共享存储（见 ALLOW_PER_WORKER_STATE）")
+    parser.add_argument("--no-ssl", action="store_true", help="不查找证书，以 HTTP 启动（如由反向代理终止 TLS）")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers 至少为 1")
+    if args.workers > 1 and not ALLOW_PER_WORKER_STATE:
+        problems = per_worker_state_problems()
+        if problems:
+            parser.error(
+                f"--workers {args.workers}: 以下状态仍按 worker 独立，请配置共享存储或使用 --workers 1: "
+                + "；".join(problems)
+                + "。工作表快照缓存与脚本存储始终按 worker 独立，须由反向代理按用户粘性路由，"
+                "确认后设置 ALLOW_PER_WORKER_STATE=true"
+            )
+    if args.workers > 1:
+        print("⚠️  多 worker：工作表快照缓存、脚本存储与指标按 worker 独立，请确认反向代理按用户粘性路由")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    cert_file, key_file = (None, None) if args.no_ssl else find_ssl_files()
+    print(f"{'🔒 HTTPS' if cert_file and key_file else '⚠️  HTTP'} 启动，worker 数 {args.workers}")
+    print(f"数据库初始化完成: {init_once():.2f}s")
+
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        print("💡 未安装 gunicorn，使用 uvicorn 多进程模式（无预加载）；安装: pip install gunicorn")
+        run_uvicorn(args, cert_file, key_file)
+        return
+    run_gunicorn(args, cert_file, key_file)
+
+
+if __name__ == "__main__":
+    main()
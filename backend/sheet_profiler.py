@@ -0,0 +1,383 @@
+"""
+工作表统计概况
+对一个范围按列做一次向量化统计（类型推断、空值率、基数、最值 / 分位数、常见值、分层样本），
+再在 token 预算内渲染成一段紧凑的提示词，让 LLM 以几百个 token 的代价了解百万行级别的表格
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from excel_address import column_letter, parse_cell, range_address
+from llm_config import estimate_tokens, truncate_to_tokens
+from metrics import record_cache
+from workbook_cache import SheetSnapshot, columnize, get_workbook_cache, is_number
+
+# 渲染概况时的默认 token 预算
+DEFAULT_PROFILE_TOKENS = int(os.getenv("PROFILE_MAX_TOKENS", "400"))
+# 常见值与样本行的数量上限
+TOP_K = 5
+SAMPLE_ROWS = 8
+# 概况缓存条目数（按快照内容寻址）
+_PROFILE_CACHE_SIZE = 64
+# 类型推断时检查的字符串样本数
+_TYPE_SAMPLE = 200
+# 样本中单元格的最大显示长度
+_CELL_WIDTH = 24
+
+_DATE_PATTERN = re.compile(r"^\d{4}[-/.]\d{1,2}[-/.]\d{1,2}([ T]\d{1,2}:\d{2}(:\d{2})?)?$|^\d{4}年\d{1,2}月\d{1,2}日$")
+_NUMERIC_TEXT_PATTERN = re.compile(r"^[-+]?[\d,]*\.?\d+%?$")
+
+
+def _format_number(value: float) -> str:
+    if not np.isfinite(value):
+        # inf / NaN 无法转为整数，原样显示
+        return str(value)
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return f"{value:.6g}"
+
+
+def _coerce_numeric(column: np.ndarray) -> np.ndarray:
+    """全部为数字（或空）的 object 列转为 float64，空值为 NaN"""
+    if column.dtype == np.float64:
+        return column
+    values = column.tolist()
+    if all(value is None or is_number(value) for value in values):
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    return column
+
+
+def _top_values(values: np.ndarray, k: int) -> Tuple[np.ndarray, List[Tuple[Any, int]]]:
+    """一次 np.unique 同时得到有序的唯一值和出现次数最多的 k 个值"""
+    uniques, counts = np.unique(values, return_counts=True)
+    order = np.argsort(-counts, kind="stable")[:k]
+    return uniques, [(uniques[i].item() if hasattr(uniques[i], "item") else uniques[i], int(counts[i])) for i in order]
+
+
+def _frequent(top: List[Tuple[Any, int]], total: int) -> List[Tuple[Any, int]]:
+    """只保留占比不低于 1% 的常见值；高基数列的常见值对理解数据没有帮助"""
+    return [(value, count) for value, count in top if count * 100 >= total]
+
+
+def _profile_numeric(column: np.ndarray) -> Dict[str, Any]:
+    present = column[~np.isnan(column)]
+    stats: Dict[str, Any] = {"type": "number", "non_null": int(present.size)}
+    if present.size == 0:
+        stats["type"] = "empty"
+        stats["distinct"] = 0
+        return stats
+    # inf 计入非空值，但不参与最值、均值与分位数
+    finite = present[np.isfinite(present)]
+    if finite.size < present.size:
+        stats["non_finite"] = int(present.size - finite.size)
+    if finite.size == 0:
+        stats["distinct"] = len(np.unique(present))
+        return stats
+    if np.all(finite == np.floor(finite)):
+        stats["type"] = "integer"
+    uniques, top = _top_values(finite, TOP_K)
+    distinct = len(uniques) + len(np.unique(present[~np.isfinite(present)]))
+    q25, q50, q75 = np.quantile(finite, [0.25, 0.5, 0.75])
+    stats.update({
+        "distinct": distinct,
+        "min": float(finite.min()),
+        "max": float(finite.max()),
+        "mean": float(finite.mean()),
+        "p25": float(q25),
+        "p50": float(q50),
+        "p75": float(q75),
+        "top": _frequent(top, present.size),
+    })
+    return stats
+
+
+def _profile_object(column: np.ndarray) -> Dict[str, Any]:
+    present = column[column != None]  # noqa: E711  逐元素比较
+    stats: Dict[str, Any] = {"non_null": int(present.size)}
+    if present.size == 0:
+        stats.update({"type": "empty", "distinct": 0})
+        return stats
+
+    kinds = {type(value) for value in present.tolist()}
+    if kinds == {str}:
+        probe = present[:: max(1, present.size // _TYPE_SAMPLE)][:_TYPE_SAMPLE].tolist()
+        if all(_DATE_PATTERN.match(value.strip()) for value in probe):
+            stats["type"] = "date"
+        elif all(_NUMERIC_TEXT_PATTERN.match(value.strip()) for value in probe):
+            stats["type"] = "numeric_text"
+        else:
+            stats["type"] = "text"
+        text = present.astype(str)
+    elif kinds == {bool}:
+        stats["type"] = "boolean"
+        text = present.astype(str)
+    else:
+        stats["type"] = "mixed"
+        text = np.array([str(value) for value in present.tolist()], dtype=str)
+
+    uniques, top = _top_values(text, TOP_K)
+    lengths = np.char.str_len(uniques)
+    stats.update({
+        "distinct": len(uniques),
+        "top": _frequent(top, present.size),
+        "min_length": int(lengths.min()),
+        "max_length": int(lengths.max()),
+    })
+    if stats["type"] == "date":
+        stats["min"] = str(uniques[0])
+        stats["max"] = str(uniques[-1])
+    return stats
+
+
+def _stratified_sample(columns: Sequence[np.ndarray], profiles: List[Dict[str, Any]], row_count: int,
+                       size: int) -> Tuple[Optional[int], List[int]]:
+    """
+    选取样本行下标
+
+    存在低基数文本列时按该列分层，每层至少一行、其余名额按层大小分配；
+    否则在全表范围内等距取样
+    """
+    if row_count <= size:
+        return None, list(range(row_count))
+
+    for col, profile in enumerate(profiles):
+        if profile["type"] in ("text", "boolean") and 2 <= profile["distinct"] <= size * 2:
+            keys = np.array(["" if value is None else str(value) for value in columns[col].tolist()], dtype=str)
+            _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+            # 大层优先，保证每层至少一行
+            order = np.argsort(-counts, kind="stable")[:size]
+            quotas = np.maximum(1, np.floor(counts[order] / counts[order].sum() * size)).astype(int)
+            picked: List[int] = []
+            for stratum, quota in zip(order, quotas):
+                members = np.flatnonzero(inverse == stratum)
+                step = max(1, members.size // quota)
+                picked.extend(members[::step][:quota].tolist())
+            return col, sorted(picked[:size])
+
+    return None, sorted(set(np.linspace(0, row_count - 1, size).astype(int).tolist()))
+
+
+def profile_columns(columns: Sequence[np.ndarray], headers: Optional[Sequence[Any]] = None, start_col: int = 0,
+                    sample_size: int = SAMPLE_ROWS) -> Dict[str, Any]:
+    """
+    计算列数据的统计概况
+
+    Args:
+        columns: 列数据（float64 或 object 数组，参见 workbook_cache.columnize）
+        headers: 列名，为空时使用列字母
+        start_col: 第一列的列下标，用于生成列字母
+        sample_size: 样本行数
+
+    Returns:
+        概况字典: {"row_count", "column_count", "columns": [...], "sample": {...}}
+    """
+    columns = [_coerce_numeric(column) for column in columns]
+    row_count = len(columns[0]) if columns else 0
+    profiles: List[Dict[str, Any]] = []
+    for col, column in enumerate(columns):
+        profile = _profile_numeric(column) if column.dtype == np.float64 else _profile_object(column)
+        header = headers[col] if headers is not None and col < len(headers) else None
+        profile["letter"] = column_letter(start_col + col)
+        profile["name"] = str(header) if header not in (None, "") else profile["letter"]
+        profile["null_rate"] = 1 - profile["non_null"] / row_count if row_count else 0.0
+        profiles.append(profile)
+
+    strata_col, indices = _stratified_sample(columns, profiles, row_count, sample_size)
+    sample_rows = []
+    for index in indices:
+        row = []
+        for column in columns:
+            value = column[index]
+            row.append(None if value is None or (isinstance(value, float) and value != value) else value)
+        sample_rows.append(row)
+
+    return {
+        "row_count": row_count,
+        "column_count": len(columns),
+        "columns": profiles,
+        "sample": {
+            "strata": profiles[strata_col]["name"] if strata_col is not None else None,
+            "rows": sample_rows,
+        },
+    }
+
+
+def profile_rows(rows: Sequence[Sequence[Any]], has_header: Optional[bool] = None, start_cell: str = "A1") -> Dict[str, Any]:
+    """
+    计算行数据的统计概况
+
+    Args:
+        rows: 二维数组
+        has_header: 首行是否为表头，为空时自动判断（首行全部为文本）
+        start_cell: 范围左上角单元格
+
+    Returns:
+        概况字典，额外包含 address 与 has_header
+    """
+    column_count = max((len(row) for row in rows), default=0)
+    return _profile_with_header(columnize(rows, column_count), len(rows), has_header, start_cell)
+
+
+def split_header(columns: Sequence[np.ndarray], has_header: Optional[bool] = None) -> Tuple[Optional[List[Any]], List[np.ndarray]]:
+    """
+    拆分表头与数据列
+
+    Args:
+        columns: 列数据
+        has_header: 首行是否为表头，为空时自动判断（首行全部为文本）
+
+    Returns:
+        (表头列表，无表头时为 None；数据列，全部为数字的列已转为 float64)
+    """
+    row_count = len(columns[0]) if columns else 0
+    if has_header is None:
+        first = [column[0] for column in columns] if row_count else []
+        has_header = row_count > 1 and any(value is not None for value in first) and all(
+            isinstance(value, str) for value in first if value is not None and not (isinstance(value, float) and value != value)
+        )
+    headers = [column[0] for column in columns] if has_header else None
+    body = [column[1:] for column in columns] if has_header else list(columns)
+    return headers, [_coerce_numeric(column) for column in body]
+
+
+def _profile_with_header(columns: List[np.ndarray], row_count: int, has_header: Optional[bool], start_cell: str) -> Dict[str, Any]:
+    headers, body = split_header(columns, has_header)
+    has_header = headers is not None
+
+    start_row, start_col = parse_cell(start_cell)
+    profile = profile_columns(body, headers, start_col)
+    profile["has_header"] = has_header
+    profile["address"] = (
+        range_address(start_row, start_col, start_row + row_count - 1, start_col + len(columns) - 1)
+        if row_count and columns else None
+    )
+    return profile
+
+
+# 概况缓存：同一快照内容只统计一次；profile_snapshot 会在线程池中调用，读写缓存须持有锁
+_profile_cache: "OrderedDict[Tuple, Dict[str, Any]]" = OrderedDict()
+_profile_cache_lock = threading.Lock()
+
+
+def profile_snapshot(user_id: int, snapshot: SheetSnapshot) -> Dict[str, Any]:
+    """
+    计算工作表快照的统计概况，按快照的块哈希缓存
+
+    块已被淘汰时抛出 KeyError（携带缺失的哈希列表）
+    """
+    # 概况中带有 sheet_name，内容相同的不同工作表各自缓存
+    key = (user_id, snapshot.sheet_name, snapshot.start_cell, tuple(snapshot.block_hashes))
+    with _profile_cache_lock:
+        cached = _profile_cache.get(key)
+        if cached is not None:
+            _profile_cache.move_to_end(key)
+    record_cache("sheet_profile", cached is not None)
+    if cached is not None:
+        return cached
+
+    columns = get_workbook_cache().read_columns(user_id, snapshot)
+    profile = _profile_with_header(columns, snapshot.row_count, None, snapshot.start_cell)
+    profile["sheet_name"] = snapshot.sheet_name
+
+    with _profile_cache_lock:
+        _profile_cache[key] = profile
+        while len(_profile_cache) > _PROFILE_CACHE_SIZE:
+            _profile_cache.popitem(last=False)
+    return profile
+
+
+def _format_cell(value: Any) -> str:
+    if value is None:
+        return ""
+    text = _format_number(value) if is_number(value) else str(value)
+    return text if len(text) <= _CELL_WIDTH else text[:_CELL_WIDTH - 1] + "…"
+
+
+def _render_column(profile: Dict[str, Any], level: int) -> List[str]:
+    parts = [f"{profile['type']}", f"空值 {profile['null_rate']:.1%}", f"唯一值 {profile['distinct']}"]
+    if profile.get("non_finite"):
+        parts.append(f"非有限值 {profile['non_finite']}")
+    if profile["type"] in ("number", "integer") and "min" in profile:
+        if level < 2:
+            parts.append(
+                f"min {_format_number(profile['min'])} / p25 {_format_number(profile['p25'])} / "
+                f"p50 {_format_number(profile['p50'])} / p75 {_format_number(profile['p75'])} / max {_format_number(profile['max'])}"
+            )
+            parts.append(f"均值 {_format_number(profile['mean'])}")
+        else:
+            parts.append(f"范围 {_format_number(profile['min'])} ~ {_format_number(profile['max'])}")
+    elif profile["type"] == "date":
+        parts.append(f"范围 {profile['min']} ~ {profile['max']}")
+    elif profile["type"] in ("text", "mixed", "numeric_text") and level < 2:
+        parts.append(f"长度 {profile['min_length']}~{profile['max_length']}")
+
+    lines = [f"列 {profile['letter']}「{profile['name']}」: " + "，".join(parts)]
+    top_count = (TOP_K, 3, 1, 0)[level]
+    top = profile.get("top", [])[:top_count]
+    if top and profile["non_null"]:
+        shown = ", ".join(f"{_format_cell(value)}({count / profile['non_null']:.0%})" for value, count in top)
+        lines.append(f"  常见值: {shown}")
+    return lines
+
+
+def _render(profile: Dict[str, Any], level: int) -> str:
+    location = profile.get("address") or ""
+    if profile.get("sheet_name"):
+        location = f"{profile['sheet_name']}!{location}"
+    header_note = "，首行为表头" if profile.get("has_header") else ""
+    lines = [f"[数据概况] {location}，{profile['row_count']} 行 × {profile['column_count']} 列{header_note}"]
+    for column in profile["columns"]:
+        lines.extend(_render_column(column, level))
+
+    sample_count = (SAMPLE_ROWS, 5, 3, 0)[level]
+    rows = profile["sample"]["rows"][:sample_count]
+    if rows:
+        strata = profile["sample"]["strata"]
+        lines.append(f"样本行（按「{strata}」分层）:" if strata else "样本行:")
+        lines.append(" | ".join(column["name"] for column in profile["columns"]))
+        lines.extend(" | ".join(_format_cell(value) for value in row) for row in rows)
+    return "\n".join(lines)
+
+
+def render_profile(profile: Dict[str, Any], max_tokens: Optional[int] = None) -> str:
+    """
+    将概况渲染为提示词片段，在 token 预算内逐级精简（减少常见值、样本行、分位数），
+    最精简的版本仍超出预算时按 token 截断
+
+    Args:
+        profile: profile_columns / profile_rows / profile_snapshot 的结果
+        max_tokens: token 预算，默认为 PROFILE_MAX_TOKENS
+
+    Returns:
+        提示词文本
+    """
+    budget = max_tokens or DEFAULT_PROFILE_TOKENS
+    text = ""
+    for level in range(4):
+        text = _render(profile, level)
+        if estimate_tokens(text) <= budget:
+            return text
+    return truncate_to_tokens(text, budget)
+
+
+def describe_sheet(user_id: int, workbook_id: Optional[str], sheet_name: Optional[str],
+                   max_tokens: Optional[int] = None) -> Optional[str]:
+    """
+    为对话上下文指向的工作表快照生成概况提示词
+
+    Returns:
+        提示词文本；没有快照或快照的块已被淘汰时返回 None
+    """
+    if not workbook_id or not sheet_name:
+        return None
+    snapshot = get_workbook_cache().get_sheet(user_id, workbook_id, sheet_name)
+    if snapshot is None or snapshot.row_count == 0:
+        return None
+    try:
+        profile = profile_snapshot(user_id, snapshot)
+    except KeyError:
+        return None
+    return render_profile(profile, max_tokens)
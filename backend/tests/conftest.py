@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# 后端模块以顶层模块方式互相导入（如 from excel_address import ...）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 须在导入 main / database 之前设置：测试使用临时数据库与 LLM 桩服务，不限流
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="excel-ai-tests-"), "test.db")
+os.environ["LLM_PROVIDER"] = "stub"
+os.environ["FAKE_LLM_LATENCY_MS"] = "1"
+os.environ.setdefault("WARMUP_ON_STARTUP", "false")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+PASSWORD = "test-password"
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    import main
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(scope="session")
+def auth_headers(client):
+    email = "tests@example.com"
+    client.post("/register", json={"email": email, "password": PASSWORD})
+    response = client.post("/token", data={"username": email, "password": PASSWORD})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
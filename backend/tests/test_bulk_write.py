@@ -0,0 +1,133 @@
+"""分块写入：块边界、断点续写与脚本大小"""
+
+import json
+import shutil
+import subprocess
+
+import pytest
+
+from bulk_write import build_chunked_payload, build_chunked_write
+
+
+def make_rows(row_count, column_count=3):
+    return [[f"r{row}c{col}" if col % 2 == 0 else row * 10 + col for col in range(column_count)]
+            for row in range(row_count)]
+
+
+def decode_block(payload, index):
+    """按生成脚本的方式还原一个块的行数据"""
+    block = payload["blocks"][index]
+    return [
+        [payload["dict"][block[col][row]] if payload["types"][col] == "s" else block[col][row]
+         for col in range(payload["columns"])]
+        for row in range(len(block[0]))
+    ]
+
+
+@pytest.mark.parametrize("row_count, chunk_rows, expected", [
+    # 行数为块大小的整数倍
+    (20, 5, ["B2:D6", "B7:D11", "B12:D16", "B17:D21"]),
+    # 最后一块不满
+    (23, 5, ["B2:D6", "B7:D11", "B12:D16", "B17:D21", "B22:D24"]),
+    # 行数少于一块
+    (3, 5, ["B2:D4"]),
+])
+def test_block_boundaries(row_count, chunk_rows, expected):
+    rows = make_rows(row_count)
+    payload = build_chunked_payload(rows, "B2", chunk_rows)
+
+    assert payload["addresses"] == expected
+    assert [len(block[0]) for block in payload["blocks"]] == [
+        min(chunk_rows, row_count - start) for start in range(0, row_count, chunk_rows)
+    ]
+    decoded = [row for index in range(len(payload["blocks"])) for row in decode_block(payload, index)]
+    assert decoded == rows
+
+
+def test_empty_cells_are_cleared():
+    payload = build_chunked_payload([["a", None], [None, 1.5]], "A1", 10)
+    assert decode_block(payload, 0) == [["a", ""], ["", 1.5]]
+
+
+def test_invalid_chunk_rows():
+    with pytest.raises(ValueError):
+        build_chunked_payload(make_rows(3), "A1", 0)
+
+
+def test_start_block_keeps_block_layout():
+    rows = make_rows(23)
+    full = build_chunked_payload(rows, "B2", 5)
+    resumed = build_chunked_payload(rows, "B2", 5, start_block=3)
+
+    assert resumed["startBlock"] == 3
+    assert resumed["addresses"] == full["addresses"]
+    assert resumed["blocks"] == full["blocks"]
+
+
+@pytest.mark.parametrize("chunk_rows", [0, 7])
+def test_script_size_independent_of_row_count(chunk_rows):
+    sizes = set()
+    for row_count in (10, 1_000, 50_000):
+        js_code, payload = build_chunked_write("数据", "A1", make_rows(row_count), chunk_rows=chunk_rows)
+        assert "r9c0" not in js_code
+        sizes.add(len(js_code))
+    assert len(sizes) == 1
+
+
+# 模拟 Excel.run：写入在 sync 成功后才算提交，第 fail_at 次 sync 抛出异常
+_EXCEL_STUB = """
+const {payload, failAt} = JSON.parse(require("fs").readFileSync(0, "utf8"));
+const committed = [];
+let pending = [];
+let syncs = 0;
+const sheet = {
+    getRange: (address) => new Proxy({}, {set(target, property, value) { pending.push([address, property, value]); return true; }}),
+};
+const context = {
+    workbook: {worksheets: {
+        getItem: () => sheet, getActiveWorksheet: () => sheet,
+        getItemOrNullObject: () => ({...sheet, isNullObject: false}), add: () => sheet,
+    }},
+    sync: async () => {
+        syncs += 1;
+        if (syncs === failAt) { pending = []; throw new Error("network"); }
+        committed.push(...pending);
+        pending = [];
+    },
+};
+const Excel = {run: (callback) => callback(context)};
+(async () => {
+    const result = await (async (payload) => { %s })(payload);
+    console.log(JSON.stringify({result, committed}));
+})();
+"""
+
+
+def run_script(js_code, payload, fail_at=0):
+    completed = subprocess.run(["node", "-e", _EXCEL_STUB % js_code], input=json.dumps({"payload": payload, "failAt": fail_at}),
+                               capture_output=True, text=True, check=True, timeout=60)
+    return json.loads(completed.stdout)
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="需要 node 执行生成的 Office.js 代码")
+@pytest.mark.parametrize("row_count", [20, 23])
+def test_resume_after_failed_sync(row_count):
+    rows = make_rows(row_count)
+    js_code, payload = build_chunked_write("数据", "B2", rows, chunk_rows=5, create_sheet=True)
+    total_blocks = len(payload["blocks"])
+
+    # create_sheet 时第 1 次 sync 用于检查工作表是否存在；第 4 次 sync 提交第 3 块（下标 2）时失败
+    first = run_script(js_code, payload, fail_at=4)
+    assert first["result"] == {"status": "partial", "committedBlock": 1, "nextBlock": 2,
+                               "totalBlocks": total_blocks, "error": "Error: network"}
+    assert [address for address, _, _ in first["committed"]] == payload["addresses"][:2]
+
+    js_code, payload = build_chunked_write("数据", "B2", rows, chunk_rows=5, start_block=first["result"]["nextBlock"],
+                                           create_sheet=True)
+    second = run_script(js_code, payload)
+    assert second["result"] == {"status": "done", "committedBlock": total_blocks - 1, "totalBlocks": total_blocks}
+    assert [address for address, _, _ in second["committed"]] == payload["addresses"][2:]
+
+    written = [row for _, prop, values in first["committed"] + second["committed"] for row in values]
+    assert all(prop == "values" for _, prop, _ in first["committed"] + second["committed"])
+    assert written == rows
@@ -0,0 +1,30 @@
+"""公式规范化：运算符空白与交集运算符"""
+
+import pytest
+
+from formula_batch import normalize_formula
+
+
+@pytest.mark.parametrize("formula, expected", [
+    ("=sum( a1 : a3 )", "=SUM(A1:A3)"),
+    ("= A1 + B1 ", "=A1+B1"),
+    ('=IF( A1 > 0 , "a  b" , B1 )', '=IF(A1>0,"a  b",B1)'),
+    ("=SUM(A1)  +  1", "=SUM(A1)+1"),
+    ("=A1   B1", "=A1 B1"),
+])
+def test_operator_spaces_are_removed(formula, expected):
+    assert normalize_formula(formula) == expected
+
+
+@pytest.mark.parametrize("formula, expected", [
+    ("=SUM(A1:A3) SUM(B1:B3)", "=SUM(A1:A3) SUM(B1:B3)"),
+    ("=sum(a1:c3)  (b2:b4)", "=SUM(A1:C3) (B2:B4)"),
+    ("=A1:C3 (B2:B4)", "=A1:C3 (B2:B4)"),
+    ("=(A1:C3) B2:B4", "=(A1:C3) B2:B4"),
+])
+def test_intersection_space_is_kept(formula, expected):
+    assert normalize_formula(formula) == expected
+
+
+def test_intersection_differs_from_union():
+    assert normalize_formula("=SUM(A1:A3) SUM(B1:B3)") != normalize_formula("=SUM(A1:A3)SUM(B1:B3)")
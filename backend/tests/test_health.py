@@ -0,0 +1,25 @@
+"""健康检查只暴露状态标志"""
+
+import main
+
+
+def test_health_hides_warmup_errors(client, monkeypatch):
+    report = {
+        "phases": {
+            "database": {"ok": True, "ms": 3.2},
+            "llm_connection": {"ok": False, "ms": 10.0, "error": "connect to 10.0.0.5:443 refused"},
+        },
+        "total_ms": 13.2,
+    }
+    monkeypatch.setattr(main.app.state, "warmup", report)
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert response.json() == {
+        "status": "ok",
+        "warmup": {"ok": False, "phases": {"database": True, "llm_connection": False}},
+    }
+    assert "10.0.0.5" not in response.text
+
+
+def test_health_without_warmup(client):
+    assert client.get("/health").json() == {"status": "ok", "warmup": None}
@@ -0,0 +1,55 @@
+"""幂等存储的容量上限与令牌缓存的过期检查"""
+
+import asyncio
+import time
+
+from idempotency import MemoryIdempotencyStore, StoredResponse
+from rate_limit import RateLimiter
+
+
+def _response(size: int) -> StoredResponse:
+    return StoredResponse("fp", 200, [], b"x" * size)
+
+
+def test_memory_store_is_bounded_by_total_bytes():
+    store = MemoryIdempotencyStore(max_entries=100, ttl=60, max_bytes=2500)
+
+    async def scenario():
+        for index in range(5):
+            await store.save(f"k{index}", _response(1000))
+        return [await store.get(f"k{index}") is not None for index in range(5)]
+
+    assert asyncio.run(scenario()) == [False, False, False, True, True]
+    assert store.total_bytes == 2000
+    assert store.get_stats()["bytes"] == 2000
+
+
+def test_replacing_an_entry_keeps_the_byte_count():
+    store = MemoryIdempotencyStore(max_entries=100, ttl=60, max_bytes=10_000)
+
+    async def scenario():
+        await store.save("k", _response(1000))
+        await store.save("k", _response(300))
+
+    asyncio.run(scenario())
+    assert store.total_bytes == 300
+
+
+def test_cached_token_is_not_trusted_after_expiry():
+    limiter = RateLimiter(rules={}, enabled=False)
+    # 缓存中的令牌已过期：不再直接返回缓存的用户，而是重新验签（这里的令牌无法通过验签）
+    limiter._tokens["expired-token"] = ("expired@example.com", time.time() - 1)
+    assert limiter.user_for_token("expired-token") is None
+    assert "expired-token" not in limiter._tokens
+
+
+def test_cached_token_records_its_expiry():
+    from jose import jwt
+    from config import ALGORITHM, SECRET_KEY
+
+    limiter = RateLimiter(rules={}, enabled=False)
+    exp = int(time.time()) + 600
+    token = jwt.encode({"sub": "cached@example.com", "exp": exp}, SECRET_KEY, algorithm=ALGORITHM)
+    assert limiter.user_for_token(token) == "cached@example.com"
+    assert limiter._tokens[token] == ("cached@example.com", float(exp))
+    assert limiter.user_for_token(token) == "cached@example.com"
@@ -0,0 +1,88 @@
+import asyncio
+
+from jobs import JobManager
+from metrics import STAGE_SECONDS, _request_stages, observe_stage
+
+
+async def _stage_job(context, params):
+    observe_stage("job_test_stage", 0.01)
+    return {"ok": True}
+
+
+def test_lazily_started_workers_record_stages_as_background():
+    """在请求中懒启动的 worker 不继承请求的阶段列表，任务阶段归入 background"""
+    manager = JobManager(workers=1)
+    manager.register("stage_test", _stage_job)
+    before_wait = STAGE_SECONDS.count("background", "job_queue_wait:stage_test")
+    before_stage = STAGE_SECONDS.count("background", "job_test_stage")
+
+    async def scenario():
+        request_stages = []
+        token = _request_stages.set(request_stages)
+        try:
+            job = await manager.submit(1, "stage_test", {})
+        finally:
+            _request_stages.reset(token)
+        while not job.done:
+            await asyncio.sleep(0.01)
+        await manager.stop()
+        return job, request_stages
+
+    job, request_stages = asyncio.run(scenario())
+    assert job.result == {"ok": True}
+    assert request_stages == []
+    assert STAGE_SECONDS.count("background", "job_queue_wait:stage_test") == before_wait + 1
+    assert STAGE_SECONDS.count("background", "job_test_stage") == before_stage + 1
+
+
+async def _quick_job(context, params):
+    return params
+
+
+def test_finished_jobs_are_capped_oldest_first():
+    manager = JobManager(workers=1, max_retained=2)
+    manager.register("quick", _quick_job)
+
+    async def scenario():
+        jobs = [await manager.submit(1, "quick", {"n": n}) for n in range(4)]
+        while not all(job.done for job in jobs):
+            await asyncio.sleep(0.01)
+        await manager.stop()
+        return jobs
+
+    jobs = asyncio.run(scenario())
+    assert [job.id in manager._jobs for job in jobs] == [False, False, True, True]
+
+
+def test_cancel_requested_by_another_worker_is_honoured_after_a_stage():
+    import database
+    from jobs import CANCELLED, DatabaseJobStore
+
+    database.init_db()
+    store = DatabaseJobStore()
+    manager = JobManager(workers=1, store=store)
+
+    async def scenario():
+        started = asyncio.Event()
+        stage_done = asyncio.Event()
+
+        async def staged_job(context, params):
+            await context.report(0.0, "开始")
+            started.set()
+            await stage_done.wait()
+            return {"ok": True}
+
+        manager.register("staged", staged_job)
+        job = await manager.submit(1, "staged", {})
+        await started.wait()
+        # 另一个 worker 进程只能通过存储写入取消请求
+        await asyncio.to_thread(store.request_cancel, job.id)
+        stage_done.set()
+        while not job.done:
+            await asyncio.sleep(0.01)
+        await manager.stop()
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.status == CANCELLED
+    assert store.load(job.id).status == CANCELLED
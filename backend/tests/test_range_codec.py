@@ -0,0 +1,42 @@
+"""范围编码：往返与解码时的输入校验"""
+
+import zlib
+
+import msgpack
+import pytest
+
+from range_codec import MAX_ROWS, decode_columns, decode_rows, encode_rows
+
+ROWS = [[1, 2.5, "a", True], [None, 3.0, None, False], [7, None, "b", None]]
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_round_trip(compress):
+    assert decode_rows(encode_rows(ROWS, compress)) == ROWS
+
+
+def compressed_payload(segment: bytes, row_count: int) -> bytes:
+    return msgpack.packb({"v": 1, "n": row_count, "z": "zlib", "cols": [{"t": "f8", "d": segment}]}, use_bin_type=True)
+
+
+def test_rejects_decompression_bomb():
+    # 约 64 KB 的压缩数据可展开为 64 MB
+    bomb = zlib.compress(b"\0" * (1 << 26), 9)
+    with pytest.raises(ValueError):
+        decode_columns(compressed_payload(bomb, 3))
+
+
+@pytest.mark.parametrize("segment", [
+    zlib.compress(b"\0" * 16),                       # 短于 行数 × 8
+    zlib.compress(b"\0" * 32),                       # 长于 行数 × 8
+    zlib.compress(b"\0" * 24)[:-4],                  # 截断的压缩流
+])
+def test_rejects_segment_length_mismatch(segment):
+    with pytest.raises(ValueError):
+        decode_columns(compressed_payload(segment, 3))
+
+
+@pytest.mark.parametrize("row_count", [-1, MAX_ROWS + 1, "3", 2.0])
+def test_rejects_invalid_row_count(row_count):
+    with pytest.raises(ValueError):
+        decode_columns(msgpack.packb({"v": 1, "n": row_count, "cols": []}, use_bin_type=True))
@@ -0,0 +1,41 @@
+"""工作表概况：非有限数值与缓存键"""
+
+import math
+
+import numpy as np
+
+from sheet_profiler import describe_sheet, profile_columns, render_profile
+from workbook_cache import get_workbook_cache
+
+USER_ID = 990001
+
+
+def test_infinite_and_nan_values_do_not_break_profile():
+    column = np.array([1.0, math.inf, -math.inf, math.nan, 3.0])
+    profile = profile_columns([column], ["金额"])
+    stats = profile["columns"][0]
+    assert stats["non_null"] == 4
+    assert stats["non_finite"] == 2
+    assert (stats["min"], stats["max"], stats["mean"]) == (1.0, 3.0, 2.0)
+    text = render_profile(profile)
+    assert "非有限值 2" in text
+    assert "inf" in text
+
+
+def test_all_infinite_column_renders():
+    profile = profile_columns([np.array([math.inf, math.inf, -math.inf])], ["x"])
+    assert profile["columns"][0]["distinct"] == 2
+    assert "非有限值 3" in render_profile(profile)
+
+
+def test_describe_sheet_with_infinity_and_per_sheet_cache():
+    cache = get_workbook_cache()
+    block_hash = cache.put_block(USER_ID, [["金额"], [1.0], [math.inf], [2.5]])
+    for sheet_name in ("Sheet1", "Sheet2"):
+        cache.commit_sheet(USER_ID, "wb-profile", sheet_name, "A1", 4, [block_hash])
+
+    first = describe_sheet(USER_ID, "wb-profile", "Sheet1")
+    second = describe_sheet(USER_ID, "wb-profile", "Sheet2")
+    assert "Sheet1!A1:A4" in first
+    # 两个工作表内容相同，但概况中的表名各自正确
+    assert "Sheet2!A1:A4" in second
@@ -0,0 +1,58 @@
+"""凭证导入：NDJSON 批量解析与行长度上限"""
+
+import asyncio
+import json
+
+import pytest
+
+from voucher_import import LineTooLongError, iter_line_batches, iter_ndjson_records
+
+
+async def _chunks(body: bytes, size: int = 7):
+    for offset in range(0, len(body), size):
+        yield body[offset:offset + size]
+
+
+def _collect(iterator):
+    async def collect():
+        return [record async for batch in iterator for record in batch]
+    return asyncio.run(collect())
+
+
+def test_ndjson_records_keep_line_numbers_and_map_fields():
+    lines = [
+        json.dumps({"voucher_id": "记-1", "debit": 100, "extra": 1}, ensure_ascii=False),
+        "",
+        json.dumps({"凭证号": "记-1", "贷方": 100, "科目编码": "1001"}, ensure_ascii=False),
+        "not json",
+        "[1, 2]",
+        json.dumps({"voucher_id": "记-2", "summary": {"a": [1]}}, ensure_ascii=False),
+    ]
+    records = _collect(iter_ndjson_records(_chunks("\n".join(lines).encode("utf-8"))))
+    assert [number for number, _ in records] == [1, 3, 4, 5, 6]
+    assert records[0][1]["voucher_id"] == "记-1" and records[0][1]["debit"] == 100
+    assert records[1][1] == {"voucher_id": "记-1", "credit": 100, "account_code": "1001"}
+    assert records[2][1] == {} and records[3][1] == {}
+    assert records[4][1]["summary"] == '{"a": [1]}'
+
+
+def test_lines_split_across_batches_are_not_merged():
+    # 单独一行无效，但与下一行拼接后可能被解析为一个值
+    body = b'{"voucher_id": "1"\n"x": 2}\n{"voucher_id": "2"}'
+    records = _collect(iter_ndjson_records(_chunks(body, size=len(body))))
+    assert records == [(1, {}), (2, {}), (3, {"voucher_id": "2"})]
+
+
+def test_line_without_newline_is_rejected_beyond_limit():
+    async def consume():
+        async for _ in iter_line_batches(_chunks(b"x" * 100, size=10), max_line_bytes=50):
+            pass
+    with pytest.raises(LineTooLongError):
+        asyncio.run(consume())
+
+
+def test_oversized_line_returns_413(client, auth_headers, monkeypatch):
+    import voucher_import
+    monkeypatch.setattr(voucher_import, "MAX_LINE_BYTES", 1024)
+    response = client.post("/api/vouchers/import?format=ndjson", content=b"{" + b" " * 4096, headers=auth_headers)
+    assert response.status_code == 413
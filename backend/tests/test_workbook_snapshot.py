@@ -0,0 +1,60 @@
+"""工作表快照上传：解码大小与列数限制"""
+
+import sys
+import zlib
+
+import msgpack
+
+from range_codec import MAX_COLUMNS, MAX_DECODED_BYTES, MSGPACK_MEDIA_TYPE, encode_columns_map
+from workbook_cache import ColumnBlock, canonical_block_bytes, columnize
+
+ROW_COUNT = 100_000
+# 每个 f8 列 ROW_COUNT × 8 字节全零，压缩后约 800 字节
+ZERO_SEGMENT = zlib.compress(b"\0" * (ROW_COUNT * 8), 9)
+
+
+def post_snapshot(client, headers, blocks):
+    body = msgpack.packb({"workbook_id": "wb", "sheet_name": "limits", "blocks": blocks}, use_bin_type=True)
+    return client.post("/api/workbook/snapshot", content=body,
+                       headers={**headers, "Content-Type": MSGPACK_MEDIA_TYPE})
+
+
+def zero_block(column_count):
+    return {"columns": {"v": 1, "n": ROW_COUNT, "z": "zlib", "cols": [{"t": "f8", "d": ZERO_SEGMENT}] * column_count}}
+
+
+def test_small_snapshot_is_accepted(client, auth_headers):
+    rows = [["a", 1], ["b", 2]]
+    response = post_snapshot(client, auth_headers, [{"columns": encode_columns_map(columnize(rows, 2), 2, compress=True)}])
+    assert response.status_code == 200
+    assert response.json()["complete"] is True
+
+
+def test_rejects_oversized_multi_segment_payload(client, auth_headers):
+    # 每个块约 48 MB（60 列 × 800 KB），单块在限额内，多个块合计超出
+    block_bytes = ROW_COUNT * 8 * 60
+    block_count = MAX_DECODED_BYTES // block_bytes + 1
+    blocks = [zero_block(60) for _ in range(block_count)]
+    assert len(msgpack.packb(blocks, use_bin_type=True)) < 2 * 1024 * 1024
+
+    response = post_snapshot(client, auth_headers, blocks)
+    assert response.status_code == 413
+
+
+def test_rejects_single_block_over_limit(client, auth_headers):
+    column_count = MAX_DECODED_BYTES // (ROW_COUNT * 8) + 1
+    assert post_snapshot(client, auth_headers, [zero_block(column_count)]).status_code == 413
+
+
+def test_rejects_too_many_columns(client, auth_headers):
+    block = {"columns": {"v": 1, "n": 0, "cols": [{"t": "f8", "d": b""}] * (MAX_COLUMNS + 1)}}
+    assert post_snapshot(client, auth_headers, [block]).status_code == 413
+
+
+def test_block_size_counts_arrays_and_string_objects():
+    rows = [[float(i), f"客户{i}"] for i in range(1000)]
+    block = ColumnBlock.from_rows(rows)
+    numeric, text = block.columns
+    assert block.nbytes >= numeric.nbytes + text.nbytes + sum(sys.getsizeof(value) for value in text.tolist())
+    # 内存占用远大于 JSON 编码长度
+    assert block.nbytes > len(canonical_block_bytes(rows))
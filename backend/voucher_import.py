@@ -0,0 +1,428 @@
+"""
+凭证批量导入与校验
+以流的方式读取 CSV 或 NDJSON 格式的凭证分录，单次遍历完成校验：
+- 每张凭证借贷平衡（凭证的分录须连续出现，读完一张即校验）
+- 科目编码存在于内存中的科目索引
+- 日期可解析且位于会计期间内
+- 每行只能有借方或贷方之一，金额须为正数
+结果为错误索引与规范化后的数据集，数据集以一次分块写入的形式返回
+校验状态只有当前凭证的合计与有界的取值缓存；规范化数据集随行数线性增长（须完整返回给加载项写入）
+CPU 密集的校验与写入载荷构建在线程池中执行，导入大文件时不阻塞事件循环
+"""
+
+import asyncio
+import csv
+import datetime
+import json
+import math
+import re
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+from bulk_write import build_columnar_write
+from fast_json import loads as json_loads
+from financial_statements import COLUMN_ALIASES, ChartOfAccounts
+
+# 输入字段的常见表头 / 键名
+FIELD_ALIASES: Dict[str, Tuple[str, ...]] = {
+    "voucher_id": COLUMN_ALIASES["voucher_id"],
+    "date": ("日期", "凭证日期", "记账日期", "date"),
+    "account_code": COLUMN_ALIASES["account_code"],
+    "account_name": COLUMN_ALIASES["account_name"],
+    "summary": ("摘要", "summary", "description"),
+    "debit": COLUMN_ALIASES["debit"],
+    "credit": COLUMN_ALIASES["credit"],
+}
+_ALIAS_TO_FIELD = {alias: field for field, aliases in FIELD_ALIASES.items() for alias in aliases}
+
+# 规范化数据集的列
+OUTPUT_HEADER = ["凭证号", "日期", "科目编码", "科目名称", "摘要", "借方", "贷方", "校验结果"]
+
+# 错误类型与说明
+ERROR_MESSAGES = {
+    "missing_field": "缺少必填字段",
+    "invalid_amount": "金额无法解析",
+    "invalid_side": "借方、贷方须有且只有一个为正数",
+    "invalid_date": "日期无法解析",
+    "date_out_of_range": "日期不在会计期间内",
+    "unknown_account": "科目编码不存在",
+    "unbalanced": "借贷不平衡",
+    "non_contiguous": "凭证分录不连续",
+}
+
+# 借贷平衡的容差（元）
+BALANCE_TOLERANCE = 0.005
+# Excel 日期序列号的起点
+_EXCEL_EPOCH = datetime.date(1899, 12, 30)
+_DATE_PATTERNS = [
+    re.compile(r"^(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})"),
+    re.compile(r"^(\d{4})年(\d{1,2})月(\d{1,2})日"),
+    re.compile(r"^(\d{4})(\d{2})(\d{2})$"),
+]
+_AMOUNT_CLEANUP = re.compile(r"[,\s￥¥]")
+# 日期 / 科目校验结果缓存的条目上限，超过后清空，保证内存有界
+_CACHE_LIMIT = 65536
+# 单行的最大字节数；没有换行的输入在超过该长度时被拒绝，不会无限缓存
+MAX_LINE_BYTES = 1024 * 1024
+
+
+class LineTooLongError(ValueError):
+    """输入中的一行超过 MAX_LINE_BYTES"""
+
+
+class AccountIndex:
+    """
+    内存中的科目索引
+
+    给定科目编码集合时按集合精确校验；否则按科目表校验：
+    纯数字编码、长度符合 4-2-2 分级，且一级科目已登记
+    """
+
+    def __init__(self, codes: Optional[Iterable[str]] = None, chart: Optional[ChartOfAccounts] = None,
+                 names: Optional[Dict[str, str]] = None):
+        self.chart = chart or ChartOfAccounts()
+        self.codes: Optional[Set[str]] = {str(code).strip() for code in codes} if codes is not None else None
+        self.names = names or {}
+
+    def contains(self, code: str) -> bool:
+        if self.codes is not None:
+            return code in self.codes
+        return code.isdigit() and len(code) in (4, 6, 8, 10) and self.chart.top_level(code) in self.chart.accounts
+
+    def name(self, code: str) -> str:
+        return self.names.get(code) or self.chart.name(code)
+
+
+def parse_date(value: Any) -> Optional[datetime.date]:
+    """解析日期：ISO / 斜杠 / 中文格式、8 位数字、Excel 序列号"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if 1 <= value < 2958466:
+            return _EXCEL_EPOCH + datetime.timedelta(days=int(value))
+        return None
+    text = str(value).strip()
+    for pattern in _DATE_PATTERNS:
+        match = pattern.match(text)
+        if match:
+            try:
+                return datetime.date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+            except ValueError:
+                return None
+    if text.replace(".", "", 1).isdigit():
+        return parse_date(float(text))
+    return None
+
+
+def parse_amount(value: Any) -> Optional[float]:
+    """解析金额，空值为 0，无法解析时返回 None"""
+    if value is None or value == "":
+        return 0.0
+    try:
+        amount = float(value)
+    except (TypeError, ValueError):
+        try:
+            amount = float(_AMOUNT_CLEANUP.sub("", str(value)) or 0)
+        except ValueError:
+            return None
+    return amount if math.isfinite(amount) else None
+
+
+class VoucherValidator:
+    """
+    单次遍历的凭证校验器
+
+    分录校验后直接追加到按列存放的规范化数据集，只为当前凭证保留借贷合计；
+    凭证号变化时校验上一张凭证的借贷平衡（不平衡时回填该凭证各行的校验结果），
+    已结束的凭证再次出现时报告分录不连续
+    """
+
+    def __init__(self, accounts: Optional[AccountIndex] = None, period_start: Optional[datetime.date] = None,
+                 period_end: Optional[datetime.date] = None, max_errors: int = 1000):
+        self.accounts = accounts or AccountIndex()
+        self.period_start = period_start
+        self.period_end = period_end
+        self.max_errors = max_errors
+        self.errors: List[Dict[str, Any]] = []
+        self.error_counts: Dict[str, int] = {}
+        # 规范化数据集按列存放（与 OUTPUT_HEADER 对应），避免百万级逐行容器
+        self.columns: List[List[Any]] = [[] for _ in OUTPUT_HEADER]
+        self.line_count = 0
+        self.voucher_count = 0
+        self.invalid_vouchers = 0
+        self.debit_total = 0.0
+        self.credit_total = 0.0
+        self._finished: Set[str] = set()
+        self._current: Optional[str] = None
+        self._current_start = 0
+        self._current_line = 0
+        self._current_debit = 0.0
+        self._current_credit = 0.0
+        self._current_failed = False
+        # 原始日期 / 科目编码取值重复度很高，按原始值缓存校验结果
+        self._date_cache: Dict[Any, Tuple[str, Optional[str]]] = {}
+        self._account_cache: Dict[Any, Tuple[str, str, bool]] = {}
+
+    def _error(self, line: int, voucher_id: str, code: str, detail: str = "") -> str:
+        self.error_counts[code] = self.error_counts.get(code, 0) + 1
+        message = ERROR_MESSAGES[code] + (f": {detail}" if detail else "")
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"line": line, "voucher_id": voucher_id, "code": code, "message": message})
+        return message
+
+    def feed_batch(self, batch: Iterable[Tuple[int, Dict[str, Any]]]) -> None:
+        """校验一批分录"""
+        for line, record in batch:
+            self.feed(line, record)
+
+    def feed(self, line: int, record: Dict[str, Any]) -> None:
+        """校验一行分录；record 的键为规范字段名（见 FIELD_ALIASES）"""
+        self.line_count += 1
+        voucher_id = str(record.get("voucher_id") or "").strip()
+        if voucher_id != self._current:
+            self._close_voucher()
+            self._current = voucher_id
+            self._current_start = len(self.columns[0])
+            self._current_line = line
+            if voucher_id in self._finished:
+                self._current_failed = True
+                self._error(line, voucher_id, "non_contiguous")
+
+        messages: List[str] = []
+        raw_code = record.get("account_code")
+        account = self._account_cache.get(raw_code)
+        if account is None:
+            code = str(raw_code or "").strip()
+            if code.endswith(".0"):
+                code = code[:-2]
+            account = (code, self.accounts.name(code), bool(code) and self.accounts.contains(code))
+            if len(self._account_cache) >= _CACHE_LIMIT:
+                self._account_cache.clear()
+            self._account_cache[raw_code] = account
+        code, account_name, known = account
+        if not voucher_id or not code:
+            messages.append(self._error(line, voucher_id, "missing_field", "凭证号" if not voucher_id else "科目编码"))
+        elif not known:
+            messages.append(self._error(line, voucher_id, "unknown_account", code))
+
+        raw_date = record.get("date")
+        date = self._date_cache.get(raw_date)
+        if date is None:
+            date = self._check_date(raw_date)
+            if len(self._date_cache) >= _CACHE_LIMIT:
+                self._date_cache.clear()
+            self._date_cache[raw_date] = date
+        date_text, date_error = date
+        if date_error:
+            messages.append(self._error(line, voucher_id, date_error, date_text))
+
+        debit = parse_amount(record.get("debit"))
+        credit = parse_amount(record.get("credit"))
+        if debit is None or credit is None:
+            messages.append(self._error(line, voucher_id, "invalid_amount"))
+            debit, credit = debit or 0.0, credit or 0.0
+        elif (debit > 0) == (credit > 0) or debit < 0 or credit < 0:
+            messages.append(self._error(line, voucher_id, "invalid_side"))
+
+        if messages:
+            self._current_failed = True
+        self._current_debit += debit
+        self._current_credit += credit
+        ids, dates, codes, names, summaries, debits, credits, statuses = self.columns
+        ids.append(voucher_id)
+        dates.append(date_text)
+        codes.append(code)
+        names.append(record.get("account_name") or account_name)
+        summaries.append(record.get("summary") or "")
+        debits.append(round(debit, 2) if debit else None)
+        credits.append(round(credit, 2) if credit else None)
+        statuses.append("；".join(messages))
+
+    def _check_date(self, raw_date: Any) -> Tuple[str, Optional[str]]:
+        """解析并检查日期，返回 (规范化文本, 错误类型)；结果按原始值缓存"""
+        date = parse_date(raw_date)
+        if date is None:
+            return str(raw_date or ""), "invalid_date"
+        if (self.period_start and date < self.period_start) or (self.period_end and date > self.period_end):
+            return date.isoformat(), "date_out_of_range"
+        return date.isoformat(), None
+
+    def _close_voucher(self) -> None:
+        if self._current is None:
+            return
+        if abs(self._current_debit - self._current_credit) > BALANCE_TOLERANCE:
+            self._current_failed = True
+            message = self._error(
+                self._current_line, self._current, "unbalanced",
+                f"借方 {self._current_debit:.2f}，贷方 {self._current_credit:.2f}",
+            )
+            statuses = self.columns[-1]
+            for index in range(self._current_start, len(statuses)):
+                statuses[index] = f"{statuses[index]}；{message}" if statuses[index] else message
+
+        self.voucher_count += 1
+        self.invalid_vouchers += self._current_failed
+        self.debit_total += self._current_debit
+        self.credit_total += self._current_credit
+        self._finished.add(self._current)
+        self._current = None
+        self._current_debit = self._current_credit = 0.0
+        self._current_failed = False
+
+    def finish(self) -> Dict[str, Any]:
+        """结束输入，返回汇总与错误索引"""
+        self._close_voucher()
+        return {
+            "summary": {
+                "line_count": self.line_count,
+                "voucher_count": self.voucher_count,
+                "invalid_vouchers": self.invalid_vouchers,
+                "error_count": sum(self.error_counts.values()),
+                "debit_total": round(self.debit_total, 2),
+                "credit_total": round(self.credit_total, 2),
+            },
+            "error_counts": dict(self.error_counts),
+            "errors": self.errors,
+        }
+
+
+def map_fields(keys: Iterable[Any]) -> Dict[Any, str]:
+    """把表头 / 键名映射为规范字段名，无法识别的忽略"""
+    return {key: _ALIAS_TO_FIELD[str(key).strip()] for key in keys if str(key).strip() in _ALIAS_TO_FIELD}
+
+
+async def iter_line_batches(chunks: AsyncIterator[bytes], max_line_bytes: Optional[int] = None) -> AsyncIterator[List[str]]:
+    """
+    把字节流切分为文本行，每个数据块产出一批完整的行，只缓存不完整的最后一行
+    未完成的行超过 max_line_bytes（默认 MAX_LINE_BYTES）时抛出 LineTooLongError
+    """
+    max_line_bytes = max_line_bytes or MAX_LINE_BYTES
+    pending = b""
+    first = True
+    async for chunk in chunks:
+        pending += chunk
+        end = pending.rfind(b"\n")
+        if end < 0:
+            if len(pending) > max_line_bytes:
+                raise LineTooLongError(f"单行超过 {max_line_bytes} 字节")
+            continue
+        text = pending[:end].decode("utf-8-sig" if first else "utf-8")
+        pending = pending[end + 1:]
+        first = False
+        yield text.replace("\r", "").split("\n")
+    if pending:
+        yield [pending.decode("utf-8-sig" if first else "utf-8").rstrip("\r")]
+
+
+async def iter_csv_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[List[Tuple[int, Dict[str, Any]]]]:
+    """
+    逐批解析 CSV，首行为表头
+    每批为 [(行号, 记录), ...]，行号从 1 开始（表头为第 1 行）；不支持引号内换行
+    """
+    fields: Optional[List[Optional[str]]] = None
+    line_number = 0
+    async for lines in iter_line_batches(chunks):
+        batch = []
+        for values in csv.reader(lines):
+            line_number += 1
+            if not values:
+                continue
+            if fields is None:
+                mapping = map_fields(values)
+                fields = [mapping.get(value) for value in values]
+                continue
+            batch.append((line_number, {field: value for field, value in zip(fields, values) if field}))
+        if batch:
+            yield batch
+
+
+def _parse_json_lines(lines: List[str]) -> List[Any]:
+    """
+    解析一批 JSON 行：拼接为一个数组一次解析；任一行格式错误（或拼接改变了行的边界）时逐行解析，
+    无法解析的行为 None
+    """
+    try:
+        items = json_loads("[" + ",".join(lines) + "]")
+        if len(items) == len(lines):
+            return items
+    except ValueError:
+        pass
+    items = []
+    for line in lines:
+        try:
+            items.append(json_loads(line))
+        except ValueError:
+            items.append(None)
+    return items
+
+
+async def iter_ndjson_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[List[Tuple[int, Dict[str, Any]]]]:
+    """逐批解析 NDJSON，每行一个对象；键可以是规范字段名或中文表头"""
+    # 键序列 -> [(键, 规范字段名)]，键已全部是规范字段名时为 None（对象直接作为记录）；
+    # 同一来源的各行键序列通常相同，只映射一次
+    layouts: Dict[Tuple[Any, ...], Optional[List[Tuple[Any, str]]]] = {}
+    line_number = 0
+    async for lines in iter_line_batches(chunks):
+        numbered = [(line_number + index, line) for index, line in enumerate(lines, 1) if line and not line.isspace()]
+        line_number += len(lines)
+        texts = [line for _, line in numbered]
+        items = _parse_json_lines(texts)
+        # 整批文本中没有 "[" 且每行只有一个 "{" 时不存在嵌套值，跳过逐值检查
+        nested = any("[" in text or text.count("{") > 1 for text in texts)
+        batch = []
+        for (number, _), item in zip(numbered, items):
+            if type(item) is not dict:
+                batch.append((number, {}))
+                continue
+            keys = tuple(item)
+            if keys in layouts:
+                layout = layouts[keys]
+            else:
+                mapping = map_fields(keys)
+                layout = [(key, mapping[key]) for key in keys if key in mapping]
+                if all(key == field for key, field in layout):
+                    layout = None
+                layouts[keys] = layout
+            record = item if layout is None else {field: item[key] for key, field in layout}
+            if nested:
+                for field, value in record.items():
+                    if type(value) in (dict, list):
+                        # 嵌套值按文本处理，保证后续按取值缓存时可哈希
+                        record[field] = json.dumps(value, ensure_ascii=False)
+            batch.append((number, record))
+        if batch:
+            yield batch
+
+
+async def import_vouchers(records: AsyncIterator[List[Tuple[int, Dict[str, Any]]]], validator: VoucherValidator,
+                          target_sheet: str = "凭证导入") -> Dict[str, Any]:
+    """
+    校验凭证流并生成规范化数据集的分块写入操作
+
+    Args:
+        records: iter_csv_records / iter_ndjson_records 产生的记录流
+        validator: 校验器
+        target_sheet: 写入的工作表（不存在时新建）
+
+    Returns:
+        {"summary", "error_counts", "errors", "operation"}
+    """
+    async for batch in records:
+        await asyncio.to_thread(validator.feed_batch, batch)
+    return await asyncio.to_thread(_finish_import, validator, target_sheet)
+
+
+def _finish_import(validator: VoucherValidator, target_sheet: str) -> Dict[str, Any]:
+    """结束校验并构建写入操作（在线程池中执行）"""
+    result = validator.finish()
+    columns = [[header] + column for header, column in zip(OUTPUT_HEADER, validator.columns)]
+    js_code, payload = build_columnar_write(target_sheet, "A1", columns, create_sheet=True)
+    result["operation"] = {
+        "operation_type": "voucher_import",
+        "description": (
+            f"写入 {result['summary']['line_count']} 行凭证分录到 {target_sheet}"
+            f"（{result['summary']['invalid_vouchers']} 张凭证未通过校验）"
+        ),
+        "js_code": js_code,
+        "payload": payload,
+        "parameters": {"sheet_name": target_sheet, "total_blocks": len(payload["blocks"])},
+    }
+    return result
@@ -0,0 +1,81 @@
+"""
+启动预热模块
+在 FastAPI lifespan 中执行，把原本由第一个请求承担的初始化开销
+（编译 Agent 工作流、建立上游连接、构建提示词等）提前到启动阶段完成
+"""
+
+import asyncio
+import importlib
+import time
+from typing import Any, Callable, Dict, List, Tuple
+from sqlalchemy import text
+import database
+from llm_config import get_llm_config
+
+
+# 预热阶段：(阶段名称, 同步函数或返回协程的函数)
+WarmupPhase = Tuple[str, Callable[[], Any]]
+
+
+async def warmup_database() -> None:
+    """建立数据库连接池中的首个连接"""
+    def connect():
+        with database.engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    await asyncio.to_thread(connect)
+
+
+async def warmup_llm_connection() -> None:
+    """预先建立到 LLM 提供商的 TCP/TLS 连接"""
+    await get_llm_config().warmup()
+
+
+async def warmup_crypto() -> None:
+    """导入 JWT 与密码哈希的加密后端（导入 main 时不加载，避免拖慢冷启动）"""
+    def load():
+        importlib.import_module("jose.jwt")
+        import crud
+        crud.get_pwd_context().handler("bcrypt").get_backend()
+    await asyncio.to_thread(load)
+
+
+async def warmup_agent() -> None:
+    """导入 langchain / langgraph 并构建、编译全局 ExcelAgent"""
+    def build():
+        from agent_core import get_agent
+        get_agent()
+    await asyncio.to_thread(build)
+
+
+async def run_warmup(phases: List[WarmupPhase]) -> Dict[str, Any]:
+    """
+    依次执行预热阶段并记录耗时
+
+    单个阶段失败不会中断启动，失败原因会记录在报告中，对应的初始化将回退到首次使用时进行
+
+    Args:
+        phases: 预热阶段列表
+
+    Returns:
+        预热报告，格式为 {"phases": {name: {"ok": bool, "ms": float, "error": str}}, "total_ms": float}
+    """
+    report: Dict[str, Any] = {"phases": {}, "total_ms": 0.0}
+    started = time.perf_counter()
+
+    for name, func in phases:
+        phase_started = time.perf_counter()
+        try:
+            result = func()
+            if asyncio.iscoroutine(result):
+                await result
+            elapsed_ms = (time.perf_counter() - phase_started) * 1000
+            report["phases"][name] = {"ok": True, "ms": round(elapsed_ms, 2)}
+            print(f"预热阶段 {name} 完成: {elapsed_ms:.1f} ms")
+        except Exception as e:
+            elapsed_ms = (time.perf_counter() - phase_started) * 1000
+            report["phases"][name] = {"ok": False, "ms": round(elapsed_ms, 2), "error": str(e)}
+            print(f"预热阶段 {name} 失败 ({elapsed_ms:.1f} ms): {e}")
+
+    report["total_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    print(f"预热完成，总耗时 {report['total_ms']:.1f} ms")
+    return report
@@ -0,0 +1,309 @@
+"""
+工作簿快照缓存
+前端上传一次工作表已用区域的快照，后端按行块切分、以内容哈希寻址、按列存储；
+之后的同步只需上传内容发生变化的块。Agent、数据清洗、对账、公式预览等功能
+从这里读取表格数据，无需每轮对话重复上传
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from excel_address import parse_cell, range_address
+
+
+def canonical_block_bytes(rows: Sequence[Sequence[Any]]) -> bytes:
+    """块的规范 JSON 编码（紧凑分隔符、不转义非 ASCII），哈希基于该编码计算"""
+    return json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def hash_block(rows: Sequence[Sequence[Any]]) -> str:
+    """计算块的内容哈希（规范 JSON 编码的 SHA-256）"""
+    return hashlib.sha256(canonical_block_bytes(rows)).hexdigest()
+
+
+def is_number(value: Any) -> bool:
+    """是否为数值（排除布尔值）"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def columnize(rows: Sequence[Sequence[Any]], column_count: int) -> List[np.ndarray]:
+    """
+    行数据转为列存储
+
+    全部为数字（或空）的列存为 float64，空值为 NaN；其余列存为 object 数组，空值为 None
+    """
+    columns: List[np.ndarray] = []
+    for col in range(column_count):
+        values = [row[col] if col < len(row) else None for row in rows]
+        if all(value is None or value == "" or is_number(value) for value in values):
+            columns.append(np.array([np.nan if value is None or value == "" else value for value in values], dtype=np.float64))
+        else:
+            column = np.empty(len(values), dtype=object)
+            column[:] = [None if value == "" else value for value in values]
+            columns.append(column)
+    return columns
+
+
+def column_nbytes(columns: Sequence[np.ndarray]) -> int:
+    """
+    列数据的近似内存占用：数组本身的字节数，加上 object 列中各元素对象的大小
+    （同一对象只计一次，字典编码解出的重复字符串共享同一对象）
+    """
+    total = 0
+    for column in columns:
+        total += column.nbytes
+        if column.dtype == object:
+            seen = set()
+            for value in column.tolist():
+                if value is not None and id(value) not in seen:
+                    seen.add(id(value))
+                    total += sys.getsizeof(value)
+    return total
+
+
+class ColumnBlock:
+    """按列存储的行块，内容不可变，以哈希寻址"""
+
+    def __init__(self, columns: List[np.ndarray], row_count: int, block_hash: str, nbytes: int):
+        self.hash = block_hash
+        self.row_count = row_count
+        self.column_count = len(columns)
+        self.columns = columns
+        # 近似内存占用，用于缓存容量控制
+        self.nbytes = nbytes
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Sequence[Any]]) -> "ColumnBlock":
+        """由 JSON 行数据构建，哈希基于规范 JSON 编码"""
+        encoded = canonical_block_bytes(rows)
+        column_count = max((len(row) for row in rows), default=0)
+        columns = columnize(rows, column_count)
+        return cls(columns, len(rows), hashlib.sha256(encoded).hexdigest(), column_nbytes(columns))
+
+    @classmethod
+    def from_columns(cls, columns: List[np.ndarray], row_count: int, encoded: bytes) -> "ColumnBlock":
+        """由二进制传输解码得到的列构建，哈希基于客户端发送的编码字节"""
+        return cls(columns, row_count, hashlib.sha256(encoded).hexdigest(), column_nbytes(columns))
+
+    def to_rows(self) -> List[List[Any]]:
+        """还原为行数据（NaN 还原为 None）"""
+        rows: List[List[Any]] = [[] for _ in range(self.row_count)]
+        for column in self.columns:
+            if column.dtype == np.float64:
+                values = [None if value != value else value for value in column.tolist()]
+            else:
+                values = column.tolist()
+            for row, value in zip(rows, values):
+                row.append(value)
+        return rows
+
+
+class SheetSnapshot:
+    """工作表快照清单：起始单元格 + 按顺序排列的块哈希"""
+
+    def __init__(self, workbook_id: str, sheet_name: str, start_cell: str, block_rows: int, block_hashes: List[str],
+                 row_count: int, column_count: int):
+        self.workbook_id = workbook_id
+        self.sheet_name = sheet_name
+        self.start_cell = start_cell
+        self.block_rows = block_rows
+        self.block_hashes = block_hashes
+        self.row_count = row_count
+        self.column_count = column_count
+        self.updated_at = time.time()
+
+    @property
+    def address(self) -> Optional[str]:
+        """快照覆盖的范围地址，如 A1:F1200"""
+        if self.row_count == 0 or self.column_count == 0:
+            return None
+        start_row, start_col = parse_cell(self.start_cell)
+        return range_address(start_row, start_col, start_row + self.row_count - 1, start_col + self.column_count - 1)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "workbook_id": self.workbook_id,
+            "sheet_name": self.sheet_name,
+            "start_cell": self.start_cell,
+            "block_rows": self.block_rows,
+            "block_hashes": self.block_hashes,
+            "row_count": self.row_count,
+            "column_count": self.column_count,
+            "address": self.address,
+            "updated_at": self.updated_at,
+        }
+
+
+class WorkbookCache:
+    """
+    内容寻址的块缓存
+
+    块按 (用户, 哈希) 存储并按 LRU 淘汰，总量受 WORKBOOK_CACHE_MAX_MB 限制；
+    块被淘汰后引用它的快照在读取时会报告缺失，前端按 missing 列表重新上传即可；
+    快照清单按 LRU 最多保留 WORKBOOK_CACHE_MAX_SHEETS 个
+    分析接口在线程池中读取缓存，所有字典操作都在锁内进行；块内容不可变，锁外读取块的列是安全的
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None, max_sheets: Optional[int] = None):
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("WORKBOOK_CACHE_MAX_MB", "512")) * 1024 * 1024
+        self.max_sheets = max_sheets if max_sheets is not None else int(os.getenv("WORKBOOK_CACHE_MAX_SHEETS", "10000"))
+        self._blocks: "OrderedDict[Tuple[int, str], ColumnBlock]" = OrderedDict()
+        self._sheets: "OrderedDict[Tuple[int, str, str], SheetSnapshot]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.total_bytes = 0
+
+    def put_block(self, user_id: int, rows: Sequence[Sequence[Any]]) -> str:
+        """存入一个 JSON 行数据块，返回其内容哈希"""
+        return self.put_column_block(user_id, ColumnBlock.from_rows(rows))
+
+    def put_column_block(self, user_id: int, block: ColumnBlock) -> str:
+        """存入一个块，返回其内容哈希；内容已存在时只刷新 LRU 位置"""
+        key = (user_id, block.hash)
+        with self._lock:
+            if key in self._blocks:
+                self._blocks.move_to_end(key)
+                return block.hash
+            self._blocks[key] = block
+            self.total_bytes += block.nbytes
+            self._evict()
+        return block.hash
+
+    def has_block(self, user_id: int, block_hash: str) -> bool:
+        return (user_id, block_hash) in self._blocks
+
+    def get_block(self, user_id: int, block_hash: str) -> ColumnBlock:
+        key = (user_id, block_hash)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                raise KeyError(block_hash)
+            self._blocks.move_to_end(key)
+        return block
+
+    def missing_blocks(self, user_id: int, block_hashes: Sequence[str]) -> List[str]:
+        """返回缓存中不存在的块哈希（保持顺序、去重）"""
+        missing: List[str] = []
+        with self._lock:
+            for block_hash in block_hashes:
+                if not self.has_block(user_id, block_hash) and block_hash not in missing:
+                    missing.append(block_hash)
+        return missing
+
+    def commit_sheet(self, user_id: int, workbook_id: str, sheet_name: str, start_cell: str, block_rows: int,
+                     block_hashes: List[str]) -> SheetSnapshot:
+        """所有块就绪后提交工作表清单"""
+        parse_cell(start_cell)
+        blocks = [self.get_block(user_id, block_hash) for block_hash in block_hashes]
+        snapshot = SheetSnapshot(
+            workbook_id,
+            sheet_name,
+            start_cell,
+            block_rows,
+            list(block_hashes),
+            row_count=sum(block.row_count for block in blocks),
+            column_count=max((block.column_count for block in blocks), default=0),
+        )
+        key = (user_id, workbook_id, sheet_name)
+        with self._lock:
+            self._sheets.pop(key, None)
+            self._sheets[key] = snapshot
+            while len(self._sheets) > self.max_sheets:
+                self._sheets.popitem(last=False)
+        return snapshot
+
+    def get_sheet(self, user_id: int, workbook_id: str, sheet_name: str) -> Optional[SheetSnapshot]:
+        key = (user_id, workbook_id, sheet_name)
+        with self._lock:
+            snapshot = self._sheets.get(key)
+            if snapshot is not None:
+                self._sheets.move_to_end(key)
+        return snapshot
+
+    def list_sheets(self, user_id: int, workbook_id: str) -> List[SheetSnapshot]:
+        """列出某个工作簿已提交的全部工作表快照"""
+        with self._lock:
+            return [
+                snapshot for (owner, workbook, _), snapshot in self._sheets.items()
+                if owner == user_id and workbook == workbook_id
+            ]
+
+    def get_sheet_blocks(self, user_id: int, snapshot: SheetSnapshot) -> List[ColumnBlock]:
+        """获取快照的全部块；有块已被淘汰时抛出 KeyError（携带缺失的哈希列表）"""
+        with self._lock:
+            missing = self.missing_blocks(user_id, snapshot.block_hashes)
+            if missing:
+                raise KeyError(missing)
+            return [self.get_block(user_id, block_hash) for block_hash in snapshot.block_hashes]
+
+    def read_columns(self, user_id: int, snapshot: SheetSnapshot, start: int = 0, limit: Optional[int] = None) -> List[np.ndarray]:
+        """
+        按列读取快照（可指定行范围），只涉及相关的块；
+        列类型在各块间不一致时统一为 object
+        """
+        end = snapshot.row_count if limit is None else min(snapshot.row_count, start + limit)
+        slices: List[Tuple[ColumnBlock, int, int]] = []
+        offset = 0
+        for block in self.get_sheet_blocks(user_id, snapshot):
+            block_end = offset + block.row_count
+            if block_end > start and offset < end:
+                slices.append((block, max(start - offset, 0), min(end - offset, block.row_count)))
+            offset = block_end
+            if offset >= end:
+                break
+
+        columns: List[np.ndarray] = []
+        for col in range(snapshot.column_count):
+            parts = []
+            for block, lo, hi in slices:
+                if col < block.column_count:
+                    parts.append(block.columns[col][lo:hi])
+                else:
+                    parts.append(np.full(hi - lo, np.nan))
+            if any(part.dtype == object for part in parts):
+                parts = [part if part.dtype == object else np.array([None if v != v else v for v in part.tolist()], dtype=object) for part in parts]
+            columns.append(np.concatenate(parts) if parts else np.empty(0))
+        return columns
+
+    def read_rows(self, user_id: int, snapshot: SheetSnapshot, start: int = 0, limit: Optional[int] = None) -> List[List[Any]]:
+        """按行读取快照中的一段数据，只解码涉及的块"""
+        end = snapshot.row_count if limit is None else min(snapshot.row_count, start + limit)
+        rows: List[List[Any]] = []
+        offset = 0
+        for block in self.get_sheet_blocks(user_id, snapshot):
+            block_end = offset + block.row_count
+            if block_end > start and offset < end:
+                block_rows = block.to_rows()
+                rows.extend(block_rows[max(start - offset, 0):min(end - offset, block.row_count)])
+            offset = block_end
+            if offset >= end:
+                break
+        return rows
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes and len(self._blocks) > 1:
+            _, block = self._blocks.popitem(last=False)
+            self.total_bytes -= block.nbytes
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "blocks": len(self._blocks),
+            "sheets": len(self._sheets),
+            "max_sheets": self.max_sheets,
+            "total_bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+# 全局工作簿缓存实例
+workbook_cache = WorkbookCache()
+
+
+def get_workbook_cache() -> WorkbookCache:
+    """获取全局工作簿缓存实例"""
+    return workbook_cache
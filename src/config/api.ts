@@ -17,6 +17,8 @@ export const API_ENDPOINTS = {
   
   // Agent 相关
   AGENT_CHAT: `${API_BASE_URL}/agent/chat`,
+  AGENT_CHAT_STREAM: `${API_BASE_URL}/agent/chat/stream`,
+  AGENT_WS: `${API_BASE_URL.replace(/^http/, 'ws')}/agent/ws`,
 };
 
 export default API_BASE_URL;
\ No newline at end of file
@@ -211,6 +211,7 @@ interface ExcelOperation {
   description: string;
   js_code?: string;
   parameters?: any;
+  payload?: any;
 }
 
 interface AgentChatProps {
@@ -412,8 +413,8 @@ const AgentChat: React.FC<AgentChatProps> = ({ token }) => {
 
       await Excel.run(async (context) => {
         try {
-          const executeCode = new Function('context', 'Excel', jsCode);
-          const result = await executeCode(context, Excel);
+          const executeCode = new Function('context', 'Excel', 'payload', jsCode);
+          const result = await executeCode(context, Excel, operation.payload);
           
           console.log('Excel 操作执行成功:', result);
           setExecutionStatus(prev => ({ ...prev, [operationId]: 'success' }));